@@ -1,4 +1,4 @@
 
 sudo docker build -t pubsub .
 
-sudo docker run -d -p 8099:8080 --name singleserver pubsub python frontend.py
+sudo docker run -d -p 8099:8080 --name singleserver pubsub python3 frontend.py
@@ -0,0 +1,46 @@
+"""The admin HTTP interface, served on its own port when ADMIN_PORT is set.
+
+It listens on localhost only and is never started unless asked for, so none of
+its tooling costs anything in a default deployment.
+"""
+
+import json
+
+from twisted.web.resource import Resource
+from twisted.web.server import Site
+
+from profiling import ProfileResource
+from tracing import TracesResource
+
+class JsonResource(Resource):
+  """Admin endpoint serving the result of a function as JSON."""
+  isLeaf = True
+
+  def __init__(self, function):
+    Resource.__init__(self)
+    self._function = function
+
+  def render_GET(self, request):
+    request.setHeader(b'Content-Type', b'application/json')
+    return json.dumps(self._function()).encode('utf-8')
+
+def CreateAdminSite(*components):
+  """Builds the Site serving all of the admin endpoints.
+
+  Components (the backend, the PubSubResource) with endpoints of their own
+  expose them from an AdminResources() method returning a dict of path
+  segment to Resource.
+  """
+  root = Resource()
+  root.putChild(b'profile', ProfileResource())
+  root.putChild(b'traces', TracesResource())
+  AddAdminResources(root, *components)
+  return Site(root)
+
+def AddAdminResources(root, *components):
+  """Puts the endpoints of components with AdminResources() under root."""
+  for component in components:
+    admin_resources = getattr(component, 'AdminResources', None)
+    if admin_resources is not None:
+      for name, resource in admin_resources().items():
+        root.putChild(name, resource)
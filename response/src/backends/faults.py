@@ -0,0 +1,349 @@
+"""A backend stand-in that is slow, lossy or flapping on purpose.
+
+FaultInjectingBackend wraps another backend (usually a MemoryBackend) and
+injects faults into its calls, so HashBackend, ProxyBackend and the frontend
+can be tested against a bad shard without waiting for an incident. In a
+test it is used in process. faulty_backend.py serves it over HTTP like
+clustered_backend.py, configured from FAULTS.
+
+Faults are set per operation (the names of capture.py: publish, subscribe,
+unsubscribe, poll, inbox, read and commit, or * for any other) with a spec
+such as
+
+  poll:latency=lognormal:5:1,error=0.01;publish:stall=0.001,stall_time=10;
+  *:flap=30:5
+
+Each operation takes:
+
+  latency     Delay before the call, in ms, drawn from fixed:MS,
+              uniform:LOW:HIGH, exp:MEAN or lognormal:MEDIAN:SIGMA.
+  error       Fraction of calls failing with InjectedError (a 500).
+  reset       Fraction of calls whose connection is reset. In process they
+              fail with ConnectionLost, which is what ProxyBackend reports
+              for a reset.
+  stall       Fraction of calls held for stall_time seconds (default 30)
+              before they run, like a process stopped by a long pause.
+  flap        PERIOD:DOWN, in seconds: the last DOWN seconds of every PERIOD
+              every call is reset.
+
+Faults can be changed at runtime, and what was injected is counted, along
+with the most calls held at once, from GET/POST /faults on the admin port.
+"""
+
+import json
+import math
+import random
+import socket
+import struct
+
+try:
+  from urllib.parse import parse_qs
+except ImportError:
+  from urlparse import parse_qs
+
+from twisted.internet.defer import fail
+from twisted.internet.defer import maybeDeferred
+from twisted.internet.error import ConnectionLost
+from twisted.internet.task import deferLater
+from twisted.web.resource import Resource
+
+from capture import OP_NAMES
+from capture import OpFor
+
+class InjectedError(Exception):
+  """The failure of a call given an error fault."""
+
+def _ParseLatency(spec):
+  """Returns a function of a random.Random drawing a delay in seconds."""
+  parts = spec.split(':')
+  kind, values = parts[0], [float(v) for v in parts[1:]]
+  if kind == 'lognormal' and len(values) == 2:
+    mu, sigma = math.log(values[0] / 1000), values[1]
+    return lambda rng: rng.lognormvariate(mu, sigma)
+  values = [v / 1000 for v in values]
+  if kind == 'fixed' and len(values) == 1:
+    return lambda rng: values[0]
+  if kind == 'uniform' and len(values) == 2:
+    return lambda rng: rng.uniform(values[0], values[1])
+  if kind == 'exp' and len(values) == 1:
+    return lambda rng: rng.expovariate(1 / values[0])
+  raise ValueError('Bad latency %r' % spec)
+
+class Fault(object):
+  """The faults injected into one operation, see the module docstring."""
+
+  def __init__(self, latency=None, error=0.0, reset=0.0, stall=0.0,
+               stall_time=30.0, flap=None):
+    """Constructor.
+
+    Args:
+      latency: Optional latency spec, e.g. 'exp:5'.
+      error: Fraction of calls failing with InjectedError.
+      reset: Fraction of calls reset.
+      stall: Fraction of calls held for stall_time seconds.
+      stall_time: Seconds a stalled call is held for.
+      flap: Optional (period, down) tuple of seconds.
+    """
+    self._latency = _ParseLatency(latency) if latency else None
+    self.error = error
+    self.reset = reset
+    self.stall = stall
+    self.stall_time = stall_time
+    self.flap = flap
+
+  def Resets(self, rng, now):
+    """Whether a call at time now is reset."""
+    if self.flap is not None:
+      period, down = self.flap
+      if now % period >= period - down:
+        return True
+    return bool(self.reset) and rng.random() < self.reset
+
+  def Decide(self, rng, now, resets=True):
+    """Returns (action, delay) for a call at time now.
+
+    The action is None, 'error' (after delay seconds) or 'reset' (at once,
+    and only if resets).
+    """
+    if resets and self.Resets(rng, now):
+      return 'reset', 0.0
+    delay = self._latency(rng) if self._latency is not None else 0.0
+    if self.stall and rng.random() < self.stall:
+      delay += self.stall_time
+    if self.error and rng.random() < self.error:
+      return 'error', delay
+    return None, delay
+
+def ParseFaults(spec):
+  """Parses a spec (e.g. FAULTS) into a dict of operation name to Fault."""
+  faults = {}
+  for entry in filter(None, (spec or '').replace(' ', '').split(';')):
+    op, options = entry.split(':', 1)
+    if op not in OP_NAMES and op != '*':
+      raise ValueError('Unknown operation %r' % op)
+    kwargs = {}
+    for option in filter(None, options.split(',')):
+      name, value = option.split('=', 1)
+      if name == 'latency':
+        kwargs[name] = value
+      elif name == 'flap':
+        period, down = value.split(':')
+        kwargs[name] = (float(period), float(down))
+      elif name in ('error', 'reset', 'stall', 'stall_time'):
+        kwargs[name] = float(value)
+      else:
+        raise ValueError('Unknown fault %r' % name)
+    faults[op] = Fault(**kwargs)
+  return faults
+
+class FaultInjectingBackend(object):
+  """Wraps a backend, injecting faults into its calls."""
+
+  def __init__(self, backend, faults=None, clock=None, rng=None):
+    """Constructor.
+
+    Args:
+      backend: The backend to wrap.
+      faults: Dict of operation name (or '*') to Fault, or a spec string,
+        see ParseFaults.
+      clock: The reactor to delay calls with, by default the global one.
+      rng: The random.Random deciding faults.
+    """
+    self._backend = backend
+    self._clock = clock
+    self._rng = rng or random.Random()
+    self._http_resets = False
+    self._in_flight = 0
+    self.SetFaults(faults)
+
+  def SetFaults(self, faults):
+    """Replaces the faults, resetting the counts."""
+    self._spec = faults if isinstance(faults, str) else None
+    if not isinstance(faults, dict):
+      faults = ParseFaults(faults)
+    self._faults = faults
+    self._stats = dict((op, {'calls': 0, 'delayed': 0, 'error': 0,
+                             'reset': 0}) for op in OP_NAMES)
+    self._max_in_flight = self._in_flight
+
+  def _Fault(self, op):
+    return self._faults.get(op, self._faults.get('*'))
+
+  def _Reactor(self):
+    if self._clock is None:
+      from twisted.internet import reactor
+      self._clock = reactor
+    return self._clock
+
+  def ResetsConnection(self, op):
+    """Whether the connection of a request of op is reset, counting it."""
+    fault = self._Fault(op)
+    if fault is None or not fault.Resets(self._rng, self._Reactor().seconds()):
+      return False
+    self._stats[op]['calls'] += 1
+    self._stats[op]['reset'] += 1
+    return True
+
+  def _Decide(self, op):
+    """Returns the (action, delay) of a call of op, counting it."""
+    fault = self._Fault(op)
+    stats = self._stats[op]
+    stats['calls'] += 1
+    if fault is None:
+      return None, 0.0
+    # Served over HTTP, resets are decided by ResetRequest.
+    action, delay = fault.Decide(self._rng, self._Reactor().seconds(),
+                                 resets=not self._http_resets)
+    if delay:
+      stats['delayed'] += 1
+    if action is not None:
+      stats[action] += 1
+    return action, delay
+
+  def _Call(self, op, method, *args):
+    action, delay = self._Decide(op)
+    if not delay:
+      return self._Run(action, method, args)
+    self._in_flight += 1
+    self._max_in_flight = max(self._max_in_flight, self._in_flight)
+
+    def Done(result):
+      self._in_flight -= 1
+      return result
+    return deferLater(self._Reactor(), delay, self._Run, action, method,
+                      args).addBoth(Done)
+
+  def _Run(self, action, method, args):
+    if action == 'error':
+      return fail(InjectedError('Injected error'))
+    if action == 'reset':
+      return fail(ConnectionLost('Injected reset'))
+    return maybeDeferred(method, *args)
+
+  def GetMessage(self, topic_name, user):
+    """Retrieves the oldest message in topic_name that user has not gotten."""
+    return self._Call('poll', self._backend.GetMessage, topic_name, user)
+
+  def GetMessages(self, user, limit):
+    """Takes up to limit of user's pending messages, see inbox.py."""
+    return self._Call('inbox', self._backend.GetMessages, user, limit)
+
+  def PeekMessages(self, user, limit):
+    """Reads up to limit of user's pending messages, see inbox.py."""
+    return self._Call('inbox', self._backend.PeekMessages, user, limit)
+
+  def Read(self, topic_name, user, offset, limit):
+    """Reads user's pending messages from offset on, see offsets.py."""
+    return self._Call('read', self._backend.Read, topic_name, user, offset,
+                      limit)
+
+  def Commit(self, topic_name, user, seq):
+    """Takes user's pending messages up to seq, see offsets.py."""
+    return self._Call('commit', self._backend.Commit, topic_name, user, seq)
+
+  def PostMessage(self, topic_name, message, idempotency_key=None):
+    """Posts a message to topic_name."""
+    args = (topic_name, message)
+    if idempotency_key is not None:
+      args += (idempotency_key,)
+    return self._Call('publish', self._backend.PostMessage, *args)
+
+  def Subscribe(self, topic_name, user):
+    """Subscribes user to topic_name."""
+    return self._Call('subscribe', self._backend.Subscribe, topic_name, user)
+
+  def Unsubscribe(self, topic_name, user):
+    """Unsubscribes user from topic_name and clears pending messages."""
+    return self._Call('unsubscribe', self._backend.Unsubscribe, topic_name,
+                      user)
+
+  def __getattr__(self, name):
+    # Anything else (TopicVersion, snapshots...) goes to the wrapped backend.
+    return getattr(self._backend, name)
+
+  def Serving(self, site, listening, admin_listening):
+    """Resets connections of site, instead of failing calls, from now on.
+
+    Wraps the site's request factory, so requests it builds from now on
+    call ResetRequest before they are handled.
+    """
+    self._http_resets = True
+    site.requestFactory = _ResettingRequestFactory(self, site.requestFactory)
+
+  def ResetRequest(self, request):
+    """Resets the connection of an HTTP request if its faults say so.
+
+    Returns:
+      Whether the connection was reset, and the request is not to be
+      handled.
+    """
+    path, _, query = request.path.partition(b'?')
+    op = OP_NAMES[OpFor(request.method, path[1:].split(b'/'),
+                        parse_qs(query))[0]]
+    if not self.ResetsConnection(op):
+      return False
+    Reset(request.channel.transport)
+    return True
+
+  def Stats(self):
+    """Returns the injected faults per operation, and calls held."""
+    return {'spec': self._spec,
+            'ops': dict((op, stats) for op, stats in self._stats.items()
+                        if stats['calls']),
+            'in_flight': self._in_flight,
+            'max_in_flight': self._max_in_flight}
+
+  def AdminResources(self):
+    """Admin endpoints for this backend, see admin.py."""
+    resources = {}
+    admin_resources = getattr(self._backend, 'AdminResources', None)
+    if admin_resources is not None:
+      resources.update(admin_resources())
+    resources[b'faults'] = FaultsResource(self)
+    return resources
+
+def _ResettingRequestFactory(injector, request_factory):
+  """Returns a request factory whose requests injector can reset."""
+  def Factory(*args, **kwargs):
+    request = request_factory(*args, **kwargs)
+    process = request.process
+
+    def Process():
+      if not injector.ResetRequest(request):
+        process()
+    request.process = Process
+    return request
+  return Factory
+
+def Reset(transport):
+  """Closes a TCP connection with a reset rather than a FIN."""
+  handle = getattr(transport, 'getHandle', lambda: None)()
+  if handle is not None:
+    handle.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                      struct.pack('ii', 1, 0))
+  transport.abortConnection()
+
+class FaultsResource(Resource):
+  """Admin endpoint to view and change the faults at runtime.
+
+  GET / - The spec and the injected fault counts as JSON.
+  POST /?spec=SPEC - Replaces the faults (an empty SPEC removes them).
+  """
+  isLeaf = True
+
+  def __init__(self, backend):
+    Resource.__init__(self)
+    self._backend = backend
+
+  def render_GET(self, request):
+    request.setHeader(b'Content-Type', b'application/json')
+    return json.dumps(self._backend.Stats()).encode('utf-8')
+
+  def render_POST(self, request):
+    spec = request.args.get(b'spec', [b''])[0].decode('utf-8')
+    try:
+      self._backend.SetFaults(spec)
+    except ValueError:
+      request.setResponseCode(400)
+      return b''
+    return self.render_GET(request)
@@ -1,6 +1,18 @@
 import hashlib
+import json
+import logging
 import struct
 
+from twisted.internet.defer import Deferred
+from twisted.internet.defer import gatherResults
+from twisted.internet.defer import maybeDeferred
+from twisted.web.resource import Resource
+
+import tracing
+
+from patterns import IsPattern
+from patterns import WILDCARDS
+
 def _HashToNumberLessThan(value, n):
   """Hashes value into an integer less than n, repeatable across platforms."""
   fmt = '<L'
@@ -9,33 +21,331 @@ def _HashToNumberLessThan(value, n):
   val = struct.unpack(fmt, m.digest()[:struct.calcsize(fmt)])[0]
   return val % n
 
+def ParsePartitions(spec):
+  """Parses a 'topic:K,topic:K' string (e.g. PARTITIONED_TOPICS) into a dict."""
+  partitions = {}
+  for entry in filter(None, (spec or '').split(',')):
+    topic, k = entry.rsplit(':', 1)
+    partitions[topic.encode('utf-8')] = int(k)
+  return partitions
+
 class HashBackend(object):
-  """This hash backend forwards requests to other backends based on topic"""
+  """This hash backend forwards requests to other backends based on topic
+
+  Designated hot topics can be partitioned by subscriber across K backends:
+  Subscribe, GetMessage and Unsubscribe go to the partition hash(topic, user)
+  picks, and PostMessage is sent to all K partitions in parallel. Each
+  partition is an ordinary topic on its backend holding a subset of the
+  subscribers, so backends need no changes.
+
+  Pattern subscriptions (see patterns.py) are matched by the backends, so a
+  pattern has to be on every backend holding a topic it can match. With
+  prefix_segments set, topics are placed by their first prefix_segments
+  segments only, and a pattern whose first prefix_segments segments are
+  literal lives on the one backend all of its topics do. Any other pattern is
+  subscribed on every backend, and polled from each in turn until one has a
+  message.
+
+  A user's topics can be on any backend, so inbox reads (see inbox.py) peek
+  at every backend, answer with what has arrived by inbox_timeout, and
+  commit only the messages answered with.
 
-  def __init__(self, backends):
+  Offset reads and commits (see offsets.py) go where polls do.
+
+  Backends can be in process too: a co-located frontend (see colocated.py)
+  passes the MemoryBackends of the shards it owns, and topics placed on them
+  are served without a hop.
+  """
+
+  def __init__(self, backends, partitions=None, prefix_segments=0,
+               inbox_timeout=1.0, clock=None):
     """Simple constructor.
 
     Args:
       backends: A list of backends to forward requests to.
+      partitions: Optional dict of topic name to partition count.
+      prefix_segments: If set, place topics by this many leading segments.
+      inbox_timeout: Seconds an inbox read waits for the backends.
+      clock: The reactor to time inbox reads with, by default the global
+        one.
     """
     self._backends = backends
+    self._prefix_segments = prefix_segments
+    self._inbox_timeout = inbox_timeout
+    self._clock = clock
+    self._next_backend = 0
+    self._partitions = {}
+    for topic, k in (partitions or {}).items():
+      self.SetPartitions(topic, k)
+
+  def SetPartitions(self, topic_name, k):
+    """Partitions topic_name across k backends (capped at all of them).
+
+    Changing k moves the subscribers whose partition changes to a backend that
+    does not know them, so they see 404s until they subscribe again. Set k
+    before a topic gets busy, and identically on every frontend.
+    """
+    k = min(int(k), len(self._backends))
+    if k > 1:
+      self._partitions[topic_name] = k
+    else:
+      self._partitions.pop(topic_name, None)
+
+  def Partitions(self):
+    """Returns the dict of partitioned topic names to partition counts."""
+    return dict(self._partitions)
 
-  def _GetBackendFor(self, topic):
-    """Returns the correct backend for a given topic."""
-    return self._backends[_HashToNumberLessThan(topic, len(self._backends))]
+  def _PlacementKey(self, topic):
+    """Returns the part of topic that decides which backend it is on."""
+    if not self._prefix_segments:
+      return topic
+    return b'.'.join(topic.split(b'.')[:self._prefix_segments])
+
+  def _IsOnAllBackends(self, topic):
+    """Whether topic is a pattern that has to be on every backend."""
+    if not IsPattern(topic):
+      return False
+    if not self._prefix_segments:
+      return True
+    segments = topic.split(b'.')[:self._prefix_segments]
+    return (len(segments) < self._prefix_segments or
+            any(s in WILDCARDS for s in segments))
+
+  def _GetBackendFor(self, topic, user=None):
+    """Returns the correct backend for a given topic (and user)."""
+    span = tracing.StartSpan('hash.route')
+    index = _HashToNumberLessThan(
+        self._PlacementKey(topic), len(self._backends))
+    k = self._partitions.get(topic)
+    if k is not None and user is not None:
+      partition = _HashToNumberLessThan(b'%s/%s' % (topic, user), k)
+      index = (index + partition) % len(self._backends)
+    span.Finish(shard=index)
+    return self._backends[index]
+
+  def _GetAllBackendsFor(self, topic):
+    """Returns the backend of every partition of a partitioned topic."""
+    first = _HashToNumberLessThan(
+        self._PlacementKey(topic), len(self._backends))
+    return [self._backends[(first + i) % len(self._backends)]
+            for i in range(self._partitions[topic])]
 
   def GetMessage(self, topic_name, user):
     """Retrieves the oldest message in topic_name that user has not gotten."""
-    return self._GetBackendFor(topic_name).GetMessage(topic_name, user)
-  
+    if self._IsOnAllBackends(topic_name):
+      return self._GetMessageFromAny(topic_name, user)
+    return self._GetBackendFor(topic_name, user).GetMessage(topic_name, user)
+
+  def PollHint(self, topic_name, user=None):
+    """Returns the poll hint of the backend user polls topic_name on.
+
+    See pacing.py. None for patterns, and backends without hints.
+    """
+    if self._IsOnAllBackends(topic_name):
+      return None
+    backend = self._GetBackendFor(topic_name, user)
+    poll_hint = getattr(backend, 'PollHint', None)
+    return poll_hint(topic_name, user) if poll_hint is not None else None
+
+  def _GetMessageFromAny(self, topic_name, user):
+    """Polls a pattern on each backend in turn until one has a message.
+
+    Backends are asked one at a time, since a message taken from a second
+    backend could not be returned. The starting backend rotates so none is
+    always drained first. The result is the first 200, else 204 if any
+    backend knows the subscription, else 404.
+    """
+    start = self._next_backend
+    self._next_backend = (start + 1) % len(self._backends)
+    order = self._backends[start:] + self._backends[:start]
+    statuses = []
+
+    def Next(result=None):
+      if result is not None:
+        if result[0] == 200:
+          # Seqs are per backend, so none is given for these.
+          return result[:2]
+        statuses.append(result[0])
+      if len(statuses) == len(order):
+        return (204 if 204 in statuses else statuses[0]), None
+      backend = order[len(statuses)]
+      return maybeDeferred(backend.GetMessage, topic_name, user).addCallback(
+          Next)
+    return Next()
+
+  def Read(self, topic_name, user, offset, limit):
+    """Reads user's pending messages from offset on, see offsets.py.
+
+    Offsets are those of the backend (or partition) holding the
+    subscription, so patterns on every backend cannot be read (400).
+    """
+    if self._IsOnAllBackends(topic_name):
+      return 400, []
+    return self._GetBackendFor(topic_name, user).Read(topic_name, user,
+                                                      offset, limit)
+
+  def Commit(self, topic_name, user, seq):
+    """Takes user's pending messages up to seq, see offsets.py."""
+    if self._IsOnAllBackends(topic_name):
+      return 400
+    return self._GetBackendFor(topic_name, user).Commit(topic_name, user, seq)
+
+  def _OnAllBackends(self, method, *args):
+    """Calls method on every backend, firing with the list of statuses."""
+    return gatherResults(
+        [maybeDeferred(getattr(backend, method), *args)
+         for backend in self._backends],
+        consumeErrors=True).addErrback(lambda failure: failure.value.subFailure)
+
   def Subscribe(self, topic_name, user):
     """Subscribes user to topic_name."""
-    return self._GetBackendFor(topic_name).Subscribe(topic_name, user)
+    if self._IsOnAllBackends(topic_name):
+      d = self._OnAllBackends('Subscribe', topic_name, user)
+      return d.addCallback(
+          lambda codes: next((code for code in codes if code != 200), 200))
+    return self._GetBackendFor(topic_name, user).Subscribe(topic_name, user)
+
+  def PostMessage(self, topic_name, message, idempotency_key=None):
+    """Posts a message to topic_name.
+
+    For partitioned topics the result is 200 only if every partition accepted
+    the message, otherwise the first other status (or error). A failure can
+    leave the message delivered to only some partitions, which a retry with
+    the same idempotency_key delivers to the rest.
+    """
+    args = (topic_name, message)
+    if idempotency_key is not None:
+      args += (idempotency_key,)
+    if topic_name not in self._partitions:
+      return self._GetBackendFor(topic_name).PostMessage(*args)
+    d = gatherResults(
+        [maybeDeferred(backend.PostMessage, *args)
+         for backend in self._GetAllBackendsFor(topic_name)],
+        consumeErrors=True)
 
-  def PostMessage(self, topic_name, message):
-    """Posts a message to topic_name."""
-    return self._GetBackendFor(topic_name).PostMessage(topic_name, message)
+    def CombineStatus(codes):
+      return next((code for code in codes if code != 200), 200)
+    d.addCallback(CombineStatus)
+    d.addErrback(lambda failure: failure.value.subFailure)
+    return d
 
   def Unsubscribe(self, topic_name, user):
     """Unsubscribes user from topic_name and clears pending messages."""
-    return self._GetBackendFor(topic_name).Unsubscribe(topic_name, user)
+    if self._IsOnAllBackends(topic_name):
+      d = self._OnAllBackends('Unsubscribe', topic_name, user)
+      return d.addCallback(lambda codes: 200 if 200 in codes else codes[0])
+    return self._GetBackendFor(topic_name, user).Unsubscribe(topic_name, user)
+
+  def GetMessages(self, user, limit):
+    """Takes up to limit of user's pending messages from every backend.
+
+    The backends are peeked at in parallel (see PeekMessages), and the answer
+    is up to limit of the messages they sent by the deadline, in backend
+    order. Only those are committed, each topic up to the last seq answered
+    with, so messages past the limit or arriving after the deadline stay on
+    their backend for user's next read. The answer waits for the commits;
+    messages whose commit failed are answered with and delivered again.
+
+    Returns:
+      A Deferred firing with (status, messages, partial), see inbox.py. The
+      status is 200 if there are messages, else 204 if a backend knows the
+      user, else 404. It fails only if every backend did.
+    """
+    if self._clock is None:
+      from twisted.internet import reactor
+      self._clock = reactor
+    span = tracing.StartSpan('hash.GetMessages', backends=len(self._backends))
+    results = [None] * len(self._backends)
+    failures = []
+    gathered = Deferred()
+
+    def Arrived(result, i):
+      # Answers after the deadline are dropped, having taken nothing.
+      if not gathered.called:
+        results[i] = result
+        Finish()
+
+    def Failed(failure, i):
+      if not gathered.called:
+        results[i] = failure
+        failures.append(failure)
+        Finish()
+
+    def Finish(timed_out=False):
+      if not timed_out and None in results:
+        return
+      if timer.active():
+        timer.cancel()
+      gathered.callback(None)
+
+    def Answer(_):
+      answers = [(i, r) for i, r in enumerate(results)
+                 if isinstance(r, tuple)]
+      if not answers and failures:
+        span.Finish(failed=len(failures))
+        return failures[0]
+      partial = len(answers) < len(results) or any(r[2] for _, r in answers)
+      messages = []
+      commits = []
+      for i, (_, peeked, _) in answers:
+        taken = peeked[:limit - len(messages)]
+        messages.extend((topic, body) for topic, body, _ in taken)
+        last = dict((topic, seq) for topic, _, seq in taken)
+        commits.extend(self._CommitInbox(self._backends[i], topic, user, seq)
+                       for topic, seq in last.items())
+      statuses = [r[0] for _, r in answers]
+      if messages:
+        status = 200
+      elif 204 in statuses or partial:
+        status = 204
+      else:
+        status = 404
+
+      def Committed(_):
+        span.Finish(code=status, partial=partial)
+        return status, messages, partial
+      return gatherResults(commits).addCallback(Committed)
+
+    timer = self._clock.callLater(self._inbox_timeout, Finish, True)
+    for i, backend in enumerate(self._backends):
+      maybeDeferred(backend.PeekMessages, user, limit
+                    ).addCallbacks(Arrived, Failed, (i,), None, (i,))
+    return gathered.addCallback(Answer)
+
+  def _CommitInbox(self, backend, topic, user, seq):
+    """Commits a topic of an inbox read, logging (not failing) on errors."""
+    def Failed(failure):
+      logging.warning('Inbox commit of %s %s to %d failed, will redeliver: %s',
+                      topic, user, seq, failure.getErrorMessage())
+    return maybeDeferred(backend.Commit, topic, user, seq).addErrback(Failed)
+
+  def AdminResources(self):
+    """Admin endpoints for this backend, see admin.py."""
+    return {b'partitions': PartitionsResource(self)}
+
+class PartitionsResource(Resource):
+  """Admin endpoint to view and change partitioned topics at runtime.
+
+  GET / - The partitioned topics as a JSON object of topic to K.
+  POST /?topic=TOPIC&k=K - Partitions TOPIC K ways (K=1 to stop).
+  """
+  isLeaf = True
+
+  def __init__(self, backend):
+    Resource.__init__(self)
+    self._backend = backend
+
+  def render_GET(self, request):
+    request.setHeader(b'Content-Type', b'application/json')
+    return json.dumps(dict(
+        (topic.decode('utf-8'), k)
+        for topic, k in self._backend.Partitions().items())).encode('utf-8')
+
+  def render_POST(self, request):
+    topic = request.args.get(b'topic', [None])[0]
+    k = request.args.get(b'k', [b''])[0]
+    if topic is None or not k.isdigit():
+      request.setResponseCode(400)
+      return b''
+    self._backend.SetPartitions(topic, int(k))
+    return self.render_GET(request)
@@ -1,9 +1,67 @@
 
+import heapq
+import itertools
+import json
+import random
+import struct
+import time
+
+from twisted.web.resource import Resource
+
+from compression import CompressedBody
+from dedup import DedupCache
+from pacing import RateMeter
+from patterns import IsPattern
+from patterns import PatternIndex
+
+# Snapshot file layout, all integers little endian:
+#   magic, u32 topic count, then per topic:
+#     u32 name length, name, u64 version, u32 subscriber count, per
+#     subscriber u32 length and name, u32 message count, then per message:
+#       u8 flags, u32 body length, u64 seq, body, and unless _ALL_SUBSCRIBERS
+#       is set a u32 count followed by that many u32 indexes into the
+#       subscriber list.
+# Version 1 snapshots (_SNAPSHOT_MAGIC_V1) have neither versions nor seqs,
+# and their messages are numbered again from 1 on load.
+_SNAPSHOT_MAGIC = b'PSQSNAP2'
+_SNAPSHOT_MAGIC_V1 = b'PSQSNAP1'
+_COMPRESSED = 1
+_ALL_SUBSCRIBERS = 2
+_U32 = struct.Struct('<I')
+_U64 = struct.Struct('<Q')
+_MESSAGE_HEADER = struct.Struct('<BIQ')
+_MESSAGE_HEADER_V1 = struct.Struct('<BI')
+
+class _SnapshotReader(object):
+  """Reads the length prefixed fields of a snapshot file."""
+
+  def __init__(self, f):
+    self._f = f
+
+  def Read(self, size):
+    data = self._f.read(size)
+    if len(data) != size:
+      raise ValueError('Truncated snapshot')
+    return data
+
+  def U32(self):
+    return _U32.unpack(self.Read(4))[0]
+
+  def Bytes(self):
+    return self.Read(self.U32())
+
+  def U64(self):
+    return _U64.unpack(self.Read(8))[0]
+
 class _Message(object):
   """A simple message structure for the in-memory backend."""
-  def __init__(self, users, message):
+  __slots__ = ('subs', 'message', 'posted', 'seq')
+
+  def __init__(self, users, message, posted=0, seq=0):
     self.subs = set(users)
     self.message = message
+    self.posted = posted  # When it was stored, for backlog ages and retention.
+    self.seq = seq  # Its topic's version once stored.
 
   def Delivered(self):
     """Whether this message has been delivered to all subscribers."""
@@ -14,60 +72,764 @@ class _Message(object):
 
 class _Topic(object):
   """A simple topic class for the in-memory backend."""
-  def __init__(self):
+  def __init__(self, version=0):
     self.subs = set()  # Current subscribers.
     # TODO: If perf is needed, change this to be a deque.
     self.messages = []  # Pending messages.
+    self.version = version  # Messages ever stored, see TopicVersion.
+    self.bytes = 0  # Body bytes of the pending messages.
+    # Per subscriber [pending messages, pending bytes, oldest posted time,
+    # seq]: none of the subscriber's pending messages is numbered seq or less.
+    self.backlog = {}
+    # Maintenance (see _Maintain). While a job runs, delivered messages stay
+    # in messages, with no subs, as tombstones for the job to remove.
+    self.job = False
+    self.tombstones = 0
+    # Users whose messages up to a seq are dropped but may still list them in
+    # their subs, as {user: seq}.
+    self.dropping = {}
+    self.expire_before = None  # Posted time before which messages expire.
+    self.published = RateMeter()  # Publishes, see PollHint.
+
+def _BacklogEntry(topic_name, user, messages, size, oldest, now):
+  entry = {'topic': topic_name.decode('utf-8', 'replace'), 'messages': messages,
+           'bytes': size,
+           'age': round(now - oldest, 3) if oldest is not None else 0}
+  if user is not None:
+    entry['user'] = user.decode('utf-8', 'replace')
+  return entry
+
+BACKLOG_ORDERS = ('bytes', 'messages', 'age')
+
+# Messages a maintenance step handles.
+_CHUNK = 1024
+
+def _Find(messages, seq):
+  """Returns the index of the first of messages numbered seq or more.
+
+  Messages are stored in order, so a topic's are sorted by seq, tombstones
+  included.
+  """
+  low, high = 0, len(messages)
+  while low < high:
+    middle = (low + high) // 2
+    if messages[middle].seq < seq:
+      low = middle + 1
+    else:
+      high = middle
+  return low
 
 class MemoryBackend(object):
   """An in-memory backend for the pubsub server.
 
   Everything here is syncronous, so we do not have to worry about locking.
+  Work that grows with a topic's pending messages (dropping a subscriber's
+  messages, expiring old ones) and reaping unused topics are jobs that run in
+  time-sliced steps when a maintenance.Maintenance is given, and at once
+  otherwise. Their effect is visible at once either way: a job only catches
+  the data structures up.
   """
 
-  def __init__(self):
+  def __init__(self, subscriptions=None, clock=time.time, dedup=None,
+               maintenance=None, retention=None, reap_interval=60):
+    """Constructor.
+
+    Args:
+      subscriptions: Optional SubscriptionStore (see subscriptions.py) to
+        persist subscriptions to and load them from.
+      clock: Function returning the current time in seconds.
+      dedup: The dedup.DedupCache for idempotency keys, by default one with
+        its default bounds.
+      maintenance: Optional maintenance.Maintenance to run jobs in slices.
+        Retention and reaping only run with one.
+      retention: If set, drop messages pending for longer than this many
+        seconds, checking every tenth of that.
+      reap_interval: Seconds between removals of topics with neither
+        subscribers nor messages.
+    """
     self._topics = {}
+    self._clock = clock
+    self._dedup = dedup if dedup is not None else DedupCache()
+    self._maintenance = maintenance
+    self._retention = retention
+    # Topics that may have neither subscribers nor messages, to be reaped.
+    self._idle = set()
+    # The highest version of a reaped topic: new topics start from it so that
+    # a topic's version never goes back (see TopicVersion).
+    self._version_floor = 0
+    # Pending messages and their body bytes across all topics.
+    self._pending = [0, 0]
+    # The topics each user subscribes to, for inbox reads (see inbox.py).
+    self._user_topics = {}
+    # Polls, inbox reads and offset reads answered, see PollHint.
+    self._polls = RateMeter()
+    self._epoch = self._NewEpoch()
+    # Patterns (see patterns.py) with subscribers. A pattern's subscribers
+    # and messages are kept in a topic named after it.
+    self._patterns = PatternIndex()
+    self._subscriptions = subscriptions
+    if subscriptions is not None:
+      self._ApplyStoredSubscriptions()
+      self._IndexPatterns()
+      self._Recount()
+    if maintenance is not None:
+      maintenance.Every(reap_interval, self._Reap, 'reap')
+      if retention:
+        maintenance.Every(retention / 10.0, self._Expire, 'retention')
+
+  def _IndexPatterns(self):
+    """Rebuilds the pattern index from the topics."""
+    self._patterns = PatternIndex()
+    for topic_name, topic in self._topics.items():
+      if topic.subs and IsPattern(topic_name):
+        self._patterns.Add(topic_name)
+
+  def _ApplyStoredSubscriptions(self):
+    """Makes the stored subscriptions the current ones.
+
+    Pending messages are kept for users still subscribed.
+    """
+    stored = self._subscriptions.Load()
+    for topic_name in set(self._topics) - set(stored):
+      stored[topic_name] = set()
+    for topic_name, users in stored.items():
+      topic = self.GetTopic(topic_name)
+      if topic.subs != users:
+        for m in topic.messages:
+          m.subs &= users
+        topic.messages = [m for m in topic.messages if not m.Delivered()]
+        topic.subs = users
+
+  def _Recount(self):
+    """Rebuilds the backlog accounting from the messages, after a load."""
+    self._pending = [0, 0]
+    self._user_topics = {}
+    for name, topic in self._topics.items():
+      for user in topic.subs:
+        self._user_topics.setdefault(user, set()).add(name)
+      topic.bytes = 0
+      topic.backlog = dict((user, [0, 0, None, topic.version])
+                           for user in topic.subs)
+      for m in topic.messages:
+        size = len(m.message)
+        topic.bytes += size
+        for user in m.subs:
+          backlog = topic.backlog[user]
+          backlog[0] += 1
+          backlog[1] += size
+          if backlog[2] is None:
+            backlog[2] = m.posted
+            backlog[3] = m.seq - 1
+      self._pending[0] += len(topic.messages)
+      self._pending[1] += topic.bytes
+
+  def _Store(self, topic, message):
+    """Appends message for all of topic's subscribers."""
+    now = self._clock()
+    size = len(message)
+    topic.version += 1
+    topic.messages.append(_Message(topic.subs, message, now, topic.version))
+    topic.bytes += size
+    self._pending[0] += 1
+    self._pending[1] += size
+    for user in topic.subs:
+      backlog = topic.backlog[user]
+      backlog[0] += 1
+      backlog[1] += size
+      if backlog[0] == 1:
+        backlog[2] = now
+
+  def _Forget(self, topic, messages):
+    """Accounts for messages having been removed from topic.messages."""
+    for m in messages:
+      size = len(m.message)
+      topic.bytes -= size
+      self._pending[0] -= 1
+      self._pending[1] -= size
+
+  def _NewEpoch(self):
+    return b'%08x' % random.getrandbits(32)
+
+  def TopicVersion(self, topic_name):
+    """Returns b'<epoch>-<count>' for topic_name, see pollcache.py.
+
+    The count goes up whenever a message is stored for the topic, so a
+    subscriber with nothing pending at one version may have something pending
+    at a newer one. The epoch changes whenever counts could go backwards.
+    """
+    topic = self._topics.get(topic_name)
+    return b'%s-%d' % (self._epoch, topic.version if topic else 0)
+
+  def PollHint(self, topic_name, user=None):
+    """Returns (topic publishes/s, polls/s answered), see pacing.py.
+
+    None for a pattern, whose messages come from other topics.
+    """
+    if IsPattern(topic_name):
+      return None
+    now = self._clock()
+    topic = self._topics.get(topic_name)
+    return (topic.published.Rate(now) if topic else 0.0,
+            self._polls.Rate(now))
 
   def GetTopic(self, topic_name):
     """Retrieves the requested topic, potentially creating it if need be."""
     if topic_name not in self._topics:
-      self._topics[topic_name] = _Topic()
+      self._topics[topic_name] = _Topic(self._version_floor)
+      self._idle.add(topic_name)
     return self._topics[topic_name]
 
   def GetMessage(self, topic_name, user):
-    """Retrieves the oldest message in topic_name that user has not gotten."""
+    """Retrieves the oldest message in topic_name that user has not gotten.
+
+    Returns:
+      (200, body, seq) for a message, see offsets.py, or (204, None) or
+      (404, None).
+    """
+    self._polls.Add(self._clock())
+    return self._Take(topic_name, user)
+
+  def _Take(self, topic_name, user):
+    """GetMessage, without counting a poll."""
     topic = self.GetTopic(topic_name)
-    retval = None
-    index = -1
     if user not in topic.subs:
       return 404, None
-    for i, m in enumerate(topic.messages):
-      if user in m.subs:
+    backlog = topic.backlog[user]
+    if not backlog[0]:
+      return 204, None
+    # Messages user was dropped from before subscribing again.
+    dropped = topic.dropping.get(user, 0) if topic.dropping else 0
+    messages = topic.messages
+    for i in range(_Find(messages, backlog[3] + 1), len(messages)):
+      m = messages[i]
+      if user in m.subs and m.seq > dropped:
         m.subs.remove(user)
         if m.Delivered():
-          topic.messages.pop(i)
-        return 200, m.message
+          self._Forget(topic, (m,))
+          if topic.job:
+            topic.tombstones += 1
+            i += 1
+          else:
+            messages.pop(i)
+        else:
+          i += 1
+        # Messages are delivered in order, and every later message was stored
+        # while user was subscribed, so the next one is user's oldest.
+        backlog[0] -= 1
+        backlog[1] -= len(m.message)
+        backlog[2] = messages[i].posted if backlog[0] else None
+        backlog[3] = m.seq
+        return 200, m.message, m.seq
     return 204, None
 
+  def GetMessages(self, user, limit):
+    """Takes up to limit of user's pending messages, across all its topics.
+
+    Only user's own topics are looked at, oldest pending message first.
+
+    Returns:
+      A (status, messages, partial) tuple, see inbox.py: messages is a list
+      of (topic, body), and partial always False.
+    """
+    self._polls.Add(self._clock())
+    names = self._user_topics.get(user)
+    if not names:
+      return 404, [], False
+    heap = []
+    for name in names:
+      backlog = self._topics[name].backlog[user]
+      if backlog[0]:
+        heap.append((backlog[2], name))
+    heapq.heapify(heap)
+    messages = []
+    while heap and len(messages) < limit:
+      _, name = heapq.heappop(heap)
+      status, body = self._Take(name, user)[:2]
+      if status != 200:
+        continue
+      messages.append((name, body))
+      backlog = self._topics[name].backlog[user]
+      if backlog[0]:
+        heapq.heappush(heap, (backlog[2], name))
+    return (200 if messages else 204), messages, False
+
+  def PeekMessages(self, user, limit):
+    """Reads up to limit of user's pending messages without taking them.
+
+    They are the messages GetMessages would take, in the same order, so
+    committing each topic up to the last seq read takes exactly those.
+
+    Returns:
+      A (status, messages, partial) tuple, see inbox.py: messages is a list
+      of (topic, body, seq), and partial always False.
+    """
+    self._polls.Add(self._clock())
+    names = self._user_topics.get(user)
+    if not names:
+      return 404, [], False
+    pending = [self._Oldest(name, user) for name in names
+               if self._topics[name].backlog[user][0]]
+    messages = [(name, m.message, m.seq) for _, name, m in itertools.islice(
+        heapq.merge(*pending, key=lambda entry: entry[:2]), limit)]
+    return (200 if messages else 204), messages, False
+
+  def _Oldest(self, name, user):
+    """Yields (posted, name, message) for user's pending messages in name."""
+    topic = self._topics[name]
+    for m in self._Pending(topic, user, topic.backlog[user][3] + 1):
+      yield m.posted, name, m
+
+  def _Pending(self, topic, user, start):
+    """Yields user's pending messages in topic numbered start or more."""
+    dropped = topic.dropping.get(user, 0) if topic.dropping else 0
+    messages = topic.messages
+    for i in range(_Find(messages, start), len(messages)):
+      m = messages[i]
+      if user in m.subs and m.seq > dropped:
+        yield m
+
+  def Read(self, topic_name, user, offset, limit):
+    """Reads user's pending messages in topic_name without taking them.
+
+    Args:
+      topic_name: The topic to read.
+      user: The subscriber.
+      offset: The lowest seq to return.
+      limit: The most messages to return.
+
+    Returns:
+      A (status, messages) tuple, see offsets.py: messages is a list of
+      (seq, body), oldest first.
+    """
+    self._polls.Add(self._clock())
+    topic = self._topics.get(topic_name)
+    if topic is None or user not in topic.subs:
+      return 404, []
+    backlog = topic.backlog[user]
+    messages = []
+    if backlog[0]:
+      for m in self._Pending(topic, user, max(offset, backlog[3] + 1)):
+        messages.append((m.seq, m.message))
+        if len(messages) == limit:
+          break
+    return (200 if messages else 204), messages
+
+  def Commit(self, topic_name, user, seq):
+    """Takes user's pending messages in topic_name numbered seq or less.
+
+    Returns:
+      200, or 404 if user does not subscribe to topic_name.
+    """
+    topic = self._topics.get(topic_name)
+    if topic is None or user not in topic.subs:
+      return 404
+    backlog = topic.backlog[user]
+    seq = min(seq, topic.version)
+    if seq <= backlog[3]:
+      return 200
+    messages = topic.messages
+    start = _Find(messages, backlog[3] + 1)
+    end = _Find(messages, seq + 1)
+    backlog[3] = seq
+    dropped = topic.dropping.get(user, 0) if topic.dropping else 0
+    forgotten = []
+    for i in range(start, end):
+      m = messages[i]
+      if user in m.subs and m.seq > dropped:
+        m.subs.remove(user)
+        backlog[0] -= 1
+        backlog[1] -= len(m.message)
+        if m.Delivered():
+          forgotten.append(m)
+    if forgotten:
+      self._Forget(topic, forgotten)
+      if topic.job:
+        topic.tombstones += len(forgotten)
+      else:
+        messages[start:end] = [m for m in messages[start:end] if m.subs]
+    backlog[2] = None
+    if backlog[0]:
+      backlog[2] = next(self._Pending(topic, user, seq + 1)).posted
+    return 200
+
   def Subscribe(self, topic_name, user):
     """Subscribes user to topic_name."""
-    self.GetTopic(topic_name).subs.add(user)
+    topic = self.GetTopic(topic_name)
+    subs = topic.subs
+    if user not in subs:
+      topic.backlog[user] = [0, 0, None, topic.version]
+      self._user_topics.setdefault(user, set()).add(topic_name)
+      if self._subscriptions is not None:
+        self._subscriptions.Add(topic_name, user)
+    if not subs and IsPattern(topic_name):
+      self._patterns.Add(topic_name)
+    subs.add(user)
     return 200
 
-  def PostMessage(self, topic_name, message):
-    """Posts a message to topic_name."""
+  def PostMessage(self, topic_name, message, idempotency_key=None):
+    """Posts a message to topic_name, and to the patterns matching it.
+
+    Returns 400 for a pattern, which can only be subscribed to. A message
+    with the idempotency_key of one recently posted to topic_name (see
+    dedup.py) is acknowledged but not stored again.
+    """
+    if IsPattern(topic_name):
+      return 400
+    if idempotency_key is not None and self._dedup.Seen(topic_name,
+                                                        idempotency_key):
+      return 200
     topic = self.GetTopic(topic_name)
+    topic.published.Add(self._clock())
     if topic.subs != set():
-      topic.messages.append(_Message(topic.subs, message))
+      self._Store(topic, message)
+    for pattern in self._patterns.Match(topic_name):
+      self._Store(self._topics[pattern], message)
     return 200
 
+  def WriteSnapshot(self, f):
+    """Writes every topic, subscriber and pending message to file object f.
+
+    Messages delivered to some subscribers only record which are still
+    pending, as indexes into their topic's subscriber list.
+    """
+    f.write(_SNAPSHOT_MAGIC + _U32.pack(len(self._topics)))
+    for name, topic in self._topics.items():
+      subs = list(topic.subs)
+      f.write(_U32.pack(len(name)) + name + _U64.pack(topic.version) +
+              _U32.pack(len(subs)))
+      for user in subs:
+        f.write(_U32.pack(len(user)) + user)
+      messages = ((m, m.subs) for m in topic.messages)
+      count = len(topic.messages)
+      if topic.dropping or topic.tombstones:
+        # Leave out what maintenance has yet to remove.
+        messages = [(m, users) for m, users in (
+            (m, set(u for u in m.subs if m.seq > topic.dropping.get(u, 0)))
+            for m in topic.messages) if users]
+        count = len(messages)
+      f.write(_U32.pack(count))
+      index = None
+      for m, users in messages:
+        flags = _COMPRESSED if isinstance(m.message, CompressedBody) else 0
+        # A message's subscribers are always a subset of its topic's.
+        if len(users) == len(subs):
+          flags |= _ALL_SUBSCRIBERS
+        f.write(_MESSAGE_HEADER.pack(flags, len(m.message), m.seq))
+        f.write(m.message)
+        if not flags & _ALL_SUBSCRIBERS:
+          if index is None:
+            index = dict((user, i) for i, user in enumerate(subs))
+          f.write(struct.pack('<I%dI' % len(users), len(users),
+                              *[index[user] for user in users]))
+
+  def LoadSnapshot(self, f):
+    """Replaces all state with a snapshot written by WriteSnapshot.
+
+    Subscriptions in a SubscriptionStore, if there is one, are more recent
+    than any snapshot and replace those in the snapshot.
+
+    Topics keep their versions, and messages their seqs (see offsets.py),
+    except from version 1 snapshots.
+
+    Returns:
+      A (topic count, message count) tuple.
+
+    Raises:
+      ValueError: If f is not a complete snapshot.
+    """
+    reader = _SnapshotReader(f)
+    # Snapshots do not record when messages were posted, so backlog ages
+    # start again from the load.
+    now = self._clock()
+    magic = reader.Read(len(_SNAPSHOT_MAGIC))
+    if magic not in (_SNAPSHOT_MAGIC, _SNAPSHOT_MAGIC_V1):
+      raise ValueError('Not a snapshot')
+    numbered = magic == _SNAPSHOT_MAGIC
+    header = _MESSAGE_HEADER if numbered else _MESSAGE_HEADER_V1
+    topics = {}
+    message_count = 0
+    for _ in range(reader.U32()):
+      name = reader.Bytes()
+      topic = topics[name] = _Topic(reader.U64() if numbered else 0)
+      if name not in self._topics:
+        self._idle.add(name)
+      subs = [reader.Bytes() for _ in range(reader.U32())]
+      topic.subs = set(subs)
+      num_messages = reader.U32()
+      messages = topic.messages
+      for _ in range(num_messages):
+        fields = header.unpack(reader.Read(header.size))
+        flags, size = fields[:2]
+        seq = fields[2] if numbered else len(messages) + 1
+        body = reader.Read(size)
+        if flags & _COMPRESSED:
+          body = CompressedBody(body)
+        if flags & _ALL_SUBSCRIBERS:
+          users = subs
+        else:
+          count = reader.U32()
+          users = [subs[i] for i in
+                   struct.unpack('<%dI' % count, reader.Read(4 * count))]
+        messages.append(_Message(users, body, now, seq))
+      if not numbered:
+        topic.version = num_messages
+      message_count += num_messages
+    self._topics = topics
+    self._epoch = self._NewEpoch()
+    if self._subscriptions is not None:
+      self._ApplyStoredSubscriptions()
+    self._IndexPatterns()
+    self._Recount()
+    return len(topics), message_count
+
   def Unsubscribe(self, topic_name, user):
     """Unsubscribes user from topic_name and clears pending messages."""
     topic = self.GetTopic(topic_name)
     if user in topic.subs:
-      for m in topic.messages:
-        m.subs.remove(user)
-      topic.messages = [m for m in topic.messages if not m.Delivered()]
+      self._Drop(topic_name, topic, user)
+      del topic.backlog[user]
       topic.subs.remove(user)
+      names = self._user_topics[user]
+      names.discard(topic_name)
+      if not names:
+        del self._user_topics[user]
+      if not topic.subs:
+        self._idle.add(topic_name)
+        if IsPattern(topic_name):
+          self._patterns.Remove(topic_name)
+      if self._subscriptions is not None:
+        self._subscriptions.Remove(topic_name, user)
       return 200
     return 404
+
+  def _Drop(self, topic_name, topic, user=None):
+    """Drops user's pending messages in topic, or everyone's.
+
+    Dropping everyone's, or those of a topic's only subscriber, takes time
+    proportional to the subscribers. Otherwise the messages are only marked
+    as dropped, and a job removes user from them.
+
+    Returns:
+      The number of messages dropped for the subscriber(s).
+    """
+    if user is None or topic.subs == set([user]):
+      dropped = sum(backlog[0] for backlog in topic.backlog.values())
+      self._pending[0] -= len(topic.messages) - topic.tombstones
+      self._pending[1] -= topic.bytes
+      released = topic.messages
+      topic.messages = []
+      topic.bytes = 0
+      topic.tombstones = 0
+      topic.dropping = {}
+      for backlog in topic.backlog.values():
+        backlog[:] = [0, 0, None, topic.version]
+      self._Run(self._Release(released), 'release')
+      return dropped
+    dropped = topic.backlog[user][0]
+    topic.backlog[user] = [0, 0, None, topic.version]
+    if dropped:
+      topic.dropping[user] = topic.version
+      self._Schedule(topic_name, topic)
+    return dropped
+
+  def _Run(self, job, name):
+    if self._maintenance is None:
+      for _ in job:
+        pass
+    else:
+      self._maintenance.Run(job, name)
+
+  def _Release(self, messages):
+    """Job freeing a list of messages a chunk at a time."""
+    while messages:
+      del messages[-_CHUNK:]
+      yield
+
+  def _Schedule(self, topic_name, topic):
+    """Starts a job to catch topic up with its drops and expiry."""
+    if not topic.job:
+      topic.job = True
+      self._Run(self._Maintain(topic_name, topic), 'maintain')
+
+  def _Maintain(self, topic_name, topic):
+    """Job removing dropped users, expired messages and tombstones.
+
+    Each pass walks the message list a chunk per step, with chunks spliced
+    back in place. Messages are only ever appended meanwhile, and delivered
+    ones left as tombstones, so positions before the pass's stay valid.
+    """
+    try:
+      while topic.dropping or topic.expire_before is not None or (
+          topic.tombstones):
+        dropping = dict(topic.dropping)
+        cutoff = topic.expire_before
+        topic.expire_before = None
+        messages = topic.messages
+        expired = set()  # Users who had messages expire.
+        i = 0
+        while i < len(messages):
+          kept = []
+          forgotten = []
+          for m in messages[i:i + _CHUNK]:
+            subs = m.subs
+            if not subs:
+              topic.tombstones -= 1
+              continue
+            if cutoff is not None and m.posted < cutoff:
+              size = len(m.message)
+              for user in subs:
+                backlog = topic.backlog.get(user)
+                if backlog is not None and m.seq > topic.dropping.get(user, 0):
+                  backlog[0] -= 1
+                  backlog[1] -= size
+                  expired.add(user)
+              subs.clear()
+            elif dropping:
+              for user, seq in dropping.items():
+                if m.seq <= seq:
+                  subs.discard(user)
+            if subs:
+              kept.append(m)
+            else:
+              forgotten.append(m)
+          self._Forget(topic, forgotten)
+          messages[i:i + _CHUNK] = kept
+          i += len(kept)
+          if not dropping and not topic.tombstones and kept and (
+              cutoff is None or kept[-1].posted >= cutoff):
+            break  # Only expiring, and the rest is recent enough.
+          yield
+          if self._topics.get(topic_name) is not topic:
+            return  # Replaced by a load.
+          if topic.messages is not messages:
+            break  # Dropped wholesale.
+        for user, seq in dropping.items():
+          if topic.dropping.get(user) == seq:
+            del topic.dropping[user]
+        for user in expired:
+          backlog = topic.backlog.get(user)
+          if backlog is not None:
+            # The oldest message left is at least as recent as the cutoff.
+            backlog[2] = max(backlog[2], cutoff) if backlog[0] else None
+    finally:
+      topic.job = False
+      self._idle.add(topic_name)
+
+  def _Expire(self):
+    """Job marking messages older than the retention for removal."""
+    cutoff = self._clock() - self._retention
+    names = list(self._topics)
+    for start in range(0, len(names), _CHUNK):
+      for name in names[start:start + _CHUNK]:
+        topic = self._topics.get(name)
+        if topic is not None and topic.messages and (
+            topic.messages[0].posted < cutoff):
+          topic.expire_before = cutoff
+          self._Schedule(name, topic)
+      yield
+
+  def _Reap(self):
+    """Job removing topics with neither subscribers nor messages."""
+    idle, self._idle = self._idle, set()
+    while idle:
+      for _ in range(min(_CHUNK, len(idle))):
+        name = idle.pop()
+        topic = self._topics.get(name)
+        if (topic is not None and not topic.subs and not topic.messages and
+            not topic.job):
+          self._version_floor = max(self._version_floor, topic.version)
+          del self._topics[name]
+      yield
+
+  def Purge(self, topic_name, user=None):
+    """Drops pending messages without unsubscribing anyone.
+
+    Args:
+      topic_name: The topic to drop messages from.
+      user: Optional subscriber to drop messages for, by default everyone.
+
+    Returns:
+      The number of messages dropped, counted once per subscriber, or None if
+      there is no such topic or subscriber.
+    """
+    topic = self._topics.get(topic_name)
+    if topic is None or (user is not None and user not in topic.subs):
+      return None
+    return self._Drop(topic_name, topic, user)
+
+  def Backlog(self, order='bytes', limit=10):
+    """Reports pending messages, largest first.
+
+    Totals are kept as messages come and go. Ranking walks every topic, or
+    every subscription, but only when asked.
+
+    Args:
+      order: One of BACKLOG_ORDERS: rank by pending bytes, pending messages,
+        or the age in seconds of the oldest pending message.
+      limit: How many topics and subscribers to list.
+
+    Returns:
+      A dict with the 'messages' and 'bytes' pending in total (bodies
+      counted once however many subscribers they are pending for), and the
+      top 'topics' and 'subscribers' as lists of dicts.
+    """
+    now = self._clock()
+    key = {
+        'messages': lambda e: e['messages'],
+        'bytes': lambda e: e['bytes'],
+        'age': lambda e: e['age'],
+    }[order]
+    topics = heapq.nlargest(limit, (
+        _BacklogEntry(name, None, len(topic.messages) - topic.tombstones,
+                      topic.bytes,
+                      topic.messages[0].posted if topic.messages else None,
+                      now)
+        for name, topic in self._topics.items() if topic.messages), key=key)
+    subscribers = heapq.nlargest(limit, (
+        _BacklogEntry(name, user, *backlog[:3], now=now)
+        for name, topic in self._topics.items() if topic.messages
+        for user, backlog in topic.backlog.items() if backlog[0]), key=key)
+    return {'messages': self._pending[0], 'bytes': self._pending[1],
+            'topics': topics, 'subscribers': subscribers}
+
+  def AdminResources(self):
+    """Admin endpoints for this backend, see admin.py."""
+    resources = {b'backlog': BacklogResource(self)}
+    resources.update(self._dedup.AdminResources())
+    return resources
+
+class BacklogResource(Resource):
+  """Admin endpoint to find and drop the largest backlogs.
+
+  GET /?order=bytes|messages|age&limit=N - MemoryBackend.Backlog() as JSON.
+  POST /?topic=TOPIC[&user=USER] - Drops the topic's pending messages, or
+    just the user's, keeping subscriptions. 404 if there is no such topic or
+    subscriber.
+  """
+  isLeaf = True
+
+  def __init__(self, backend):
+    Resource.__init__(self)
+    self._backend = backend
+
+  def render_GET(self, request):
+    order = request.args.get(b'order', [b'bytes'])[0].decode('ascii', 'replace')
+    limit = request.args.get(b'limit', [b'10'])[0]
+    if order not in BACKLOG_ORDERS or not limit.isdigit():
+      request.setResponseCode(400)
+      return b''
+    request.setHeader(b'Content-Type', b'application/json')
+    return json.dumps(self._backend.Backlog(order, int(limit))).encode('utf-8')
+
+  def render_POST(self, request):
+    topic = request.args.get(b'topic', [None])[0]
+    user = request.args.get(b'user', [None])[0]
+    if topic is None:
+      request.setResponseCode(400)
+      return b''
+    dropped = self._backend.Purge(topic, user)
+    if dropped is None:
+      request.setResponseCode(404)
+      return b''
+    request.setHeader(b'Content-Type', b'application/json')
+    return json.dumps({'dropped': dropped}).encode('utf-8')
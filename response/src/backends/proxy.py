@@ -1,36 +1,195 @@
+import collections
+
+try:
+  from urllib.parse import quote
+except ImportError:
+  from urllib import quote
+
+import tracing
+
+from twisted.internet.defer import succeed
+
+from compression import CompressedBody
+from compression import GZIP
+from dedup import IDEMPOTENCY_KEY_HEADER
+from inbox import DecodeInbox
+from offsets import DecodeRange
+from offsets import SEQ_HEADER
+from pacing import ParseRate
+from pacing import POLL_RATE_HEADER
+from pacing import TOPIC_RATE_HEADER
+from pollcache import TOPIC_VERSION_HEADER
 from server import Server
+from sketches import CurrentPublisher
+from sketches import FORWARDED_FOR_HEADER
 
 class ProxyBackend(object):
   """This backend simply proxies the request to another service."""
 
-  def __init__(self, host):
+  def __init__(self, host, poll_cache=None, max_hints=100000):
     """Constructor.
 
     Args:
       host: The host to proxy requests to (i.e. www.example.com).
+      poll_cache: Optional pollcache.PollCache used to answer polls known to
+        be empty without asking the host.
+      max_hints: Most topics whose latest poll hint (see PollHint) is kept.
     """
+    self._host = host
     self._server = Server(host)
+    self._poll_cache = poll_cache
+    self._max_hints = max_hints
+    self._hints = collections.OrderedDict()  # topic: (topic rate, poll rate)
+
+  def _Headers(self, **headers):
+    """Returns the extra headers for a request, or None if there are none.
+
+    Adds a header propagating the current trace, if there is one, to the
+    given headers (keyword names use _ for -).
+    """
+    headers = dict((name.replace('_', '-').encode('ascii'), [value])
+                   for name, value in headers.items())
+    trace_id = tracing.CurrentTraceId()
+    if trace_id is not None:
+      headers[tracing.TRACE_HEADER] = [trace_id.encode('ascii')]
+    return headers or None
+
+  def _Path(self, *segments):
+    """Returns the request path for segments, escaped (e.g. '#' in patterns)."""
+    return b''.join(b'/' + quote(s, safe=b'').encode('ascii') for s in segments)
+
+  def _TopicVersion(self, headers):
+    return headers.getRawHeaders(TOPIC_VERSION_HEADER, [None])[0]
+
+  def _ObserveHint(self, topic_name, headers):
+    """Keeps the poll hint of a poll response, if it has one."""
+    topic_rate = ParseRate(headers.getRawHeaders(TOPIC_RATE_HEADER, [None])[0])
+    poll_rate = ParseRate(headers.getRawHeaders(POLL_RATE_HEADER, [None])[0])
+    if topic_rate is None or poll_rate is None:
+      return
+    self._hints.pop(topic_name, None)
+    self._hints[topic_name] = (topic_rate, poll_rate)
+    if len(self._hints) > self._max_hints:
+      self._hints.popitem(last=False)
+
+  def PollHint(self, topic_name, user=None):
+    """Returns the host's latest poll hint for topic_name, see pacing.py.
+
+    None if no poll of the topic has brought one back yet.
+    """
+    return self._hints.get(topic_name)
 
   def GetMessage(self, topic_name, user):
     """Retrieves the oldest message in topic_name that user has not gotten."""
-    return self._server.GET('/%s/%s' % (topic_name, user))
+    cache = self._poll_cache
+    if cache is not None and cache.Lookup(topic_name, user):
+      tracing.StartSpan('proxy.GetMessage', host=self._host).Finish(
+          cached=True)
+      return succeed((204, None))
+    span = tracing.StartSpan('proxy.GetMessage', host=self._host)
+    # Compressed bodies stay compressed until they reach the client.
+    d = self._server.GET(self._Path(topic_name, user),
+                         headers=self._Headers(Accept_Encoding=GZIP),
+                         with_headers=True)
+    d.addBoth(span.FinishPassthrough)
 
-  def PostMessage(self, topic_name, message):
+    def Parse(args):
+      status, body, headers = args
+      self._ObserveHint(topic_name, headers)
+      if cache is not None:
+        if status == 204:
+          cache.Store(topic_name, user, self._TopicVersion(headers))
+        else:
+          cache.Observe(topic_name, self._TopicVersion(headers))
+      seq = headers.getRawHeaders(SEQ_HEADER, [None])[0]
+      if status == 200 and seq is not None:
+        return status, body, int(seq)
+      return status, body
+    return d.addCallback(Parse)
+
+  def Read(self, topic_name, user, offset, limit):
+    """Reads user's pending messages from offset on, see offsets.py."""
+    span = tracing.StartSpan('proxy.Read', host=self._host)
+    d = self._server.GET(
+        b'%s?offset=%d&limit=%d' % (self._Path(topic_name, user), offset,
+                                    limit),
+        headers=self._Headers(Accept_Encoding=GZIP))
+    d.addBoth(span.FinishPassthrough)
+
+    def Parse(args):
+      status, body = args
+      return status, DecodeRange(body)[0] if status == 200 else []
+    return d.addCallback(Parse)
+
+  def Commit(self, topic_name, user, seq):
+    """Takes user's pending messages up to seq, see offsets.py."""
+    span = tracing.StartSpan('proxy.Commit', host=self._host)
+    d = self._server.POST(
+        b'%s?commit=%d' % (self._Path(topic_name, user), seq),
+        headers=self._Headers())
+    d.addBoth(span.FinishPassthrough)
+    return d.addCallback(lambda args: args[0])
+
+  def GetMessages(self, user, limit):
+    """Takes up to limit of user's pending messages, see inbox.py."""
+    return self._Inbox('GetMessages', b'%s?limit=%d' % (self._Path(user),
+                                                         limit))
+
+  def PeekMessages(self, user, limit):
+    """Reads up to limit of user's pending messages, see inbox.py."""
+    return self._Inbox('PeekMessages', b'%s?limit=%d&peek=1' % (
+        self._Path(user), limit))
+
+  def _Inbox(self, name, path):
+    span = tracing.StartSpan('proxy.' + name, host=self._host)
+    d = self._server.GET(path, headers=self._Headers(Accept_Encoding=GZIP))
+    d.addBoth(span.FinishPassthrough)
+
+    def Parse(args):
+      status, body = args
+      if status != 200:
+        return status, [], False
+      messages, partial = DecodeInbox(body)
+      return status, messages, partial
+    return d.addCallback(Parse)
+
+  def PostMessage(self, topic_name, message, idempotency_key=None):
     """Posts a message to topic_name."""
-    d = self._server.POST('/%s' % topic_name, body=message)
+    span = tracing.StartSpan('proxy.PostMessage', host=self._host)
+    if isinstance(message, CompressedBody):
+      headers = self._Headers(Content_Encoding=GZIP)
+    else:
+      headers = self._Headers()
+    if idempotency_key is not None:
+      headers = headers or {}
+      headers[IDEMPOTENCY_KEY_HEADER] = [idempotency_key]
+    publisher = CurrentPublisher()
+    if publisher is not None:
+      headers = headers or {}
+      headers[FORWARDED_FOR_HEADER] = [publisher]
+    cache = self._poll_cache
+    d = self._server.POST(self._Path(topic_name), body=message,
+                          headers=headers, with_headers=cache is not None)
+    d.addBoth(span.FinishPassthrough)
 
     def ExtractStatus(args):
-      status, _ = args
-      return status
+      if cache is not None:
+        cache.Observe(topic_name, self._TopicVersion(args[2]))
+      return args[0]
     d.addCallback(ExtractStatus)
 
     return d
 
   def Subscribe(self, topic_name, user):
     """Subscribes user to topic_name."""
-    d = self._server.POST('/%s/%s' % (topic_name, user))
+    span = tracing.StartSpan('proxy.Subscribe', host=self._host)
+    self._ForgetEmpty(topic_name, user)
+    d = self._server.POST(self._Path(topic_name, user),
+                          headers=self._Headers())
+    d.addBoth(span.FinishPassthrough)
     def ExtractStatus(args):
       status, _ = args
+      self._ForgetEmpty(topic_name, user)
       return status
     d.addCallback(ExtractStatus)
 
@@ -38,10 +197,24 @@ class ProxyBackend(object):
 
   def Unsubscribe(self, topic_name, user):
     """Unsubscribes user from topic_name and clears pending messages."""
-    d = self._server.DELETE('/%s/%s' % (topic_name, user))
+    span = tracing.StartSpan('proxy.Unsubscribe', host=self._host)
+    self._ForgetEmpty(topic_name, user)
+    d = self._server.DELETE(self._Path(topic_name, user),
+                            headers=self._Headers())
+    d.addBoth(span.FinishPassthrough)
     def ExtractStatus(args):
       status, _ = args
+      self._ForgetEmpty(topic_name, user)
       return status
     d.addCallback(ExtractStatus)
 
     return d
+
+  def _ForgetEmpty(self, topic_name, user):
+    """Drops any cached empty poll for a subscription being changed.
+
+    Called both when the change is sent and when it completes, so a 204 from
+    a poll racing the change is not kept either.
+    """
+    if self._poll_cache is not None:
+      self._poll_cache.Forget(topic_name, user)
@@ -0,0 +1,582 @@
+"""A same-host transport to a backend through shared memory ring buffers.
+
+ShmBackend is a ProxyBackend that reaches a backend on the same machine
+without HTTP or TCP. Each ShmBackend creates a file in /dev/shm holding two
+single producer, single consumer ring buffers (requests one way, responses
+the other) and connects to the backend's ShmListener over a Unix socket,
+sending the file's path. From then on records are copied into the rings, and
+the Unix socket only carries wakeups: one byte after every write to a ring,
+read by the reactor on the other side, which then drains the ring. The
+backend unlinks the file once it has mapped it, so it disappears with the two
+processes.
+
+Records are framed with a u32 length. Each ring's write position (head) is
+only written by its producer and its read position (tail) only by its
+consumer, each after the data it covers, which x86-64's store ordering makes
+visible in that order to the other process. A record larger than a quarter
+of a ring is sent as fragments. A producer that finds its ring full keeps
+the rest queued, flags that it is waiting, and retries when the consumer
+signals that it drained the ring (or after a millisecond).
+
+The records are a minimal form of the HTTP requests ProxyBackend makes:
+method, path, headers and body, answered with status, headers and body.
+"""
+
+import collections
+import logging
+import mmap
+import os
+import struct
+import tempfile
+
+try:
+  from urllib.parse import parse_qs
+  from urllib.parse import unquote_to_bytes
+except ImportError:
+  from urlparse import parse_qs
+  from urllib import unquote as unquote_to_bytes
+
+import tracing
+
+from twisted.internet.defer import Deferred
+from twisted.internet.defer import maybeDeferred
+from twisted.internet.protocol import Factory
+from twisted.internet.protocol import Protocol
+from twisted.web.http_headers import Headers
+
+from admin import JsonResource
+from backends.proxy import ProxyBackend
+from compression import CompressedBody
+from compression import GZIP
+from dedup import IDEMPOTENCY_KEY_HEADER
+from inbox import EncodeInbox
+from inbox import IsPeek
+from inbox import ParseLimit
+from offsets import EncodeRange
+from offsets import IsCommit
+from offsets import IsRead
+from offsets import ParseCommit
+from offsets import ParseRead
+from offsets import SEQ_HEADER
+from pacing import FormatRate
+from pacing import POLL_RATE_HEADER
+from pacing import TOPIC_RATE_HEADER
+from pollcache import TOPIC_VERSION_HEADER
+
+# Ring header: head and tail on their own cache lines, then the waiting flag.
+_HEAD = 0
+_TAIL = 64
+_WAITING = 128
+_RING_HEADER = 192
+_U64 = struct.Struct('<Q')
+_U32 = struct.Struct('<I')
+_MORE = 1  # Fragment flag: the record continues in the next fragment.
+_REQUEST = struct.Struct('<IB')  # id, method
+_RESPONSE = struct.Struct('<IH')  # id, status
+_METHODS = {b'GET': 1, b'POST': 2, b'DELETE': 3}
+_METHOD_NAMES = dict((code, name) for name, code in _METHODS.items())
+_WAKEUP = b'!'
+_RETRY_DELAY = 0.001
+
+DEFAULT_RING_SIZE = 4 << 20
+
+def _ShmDir():
+  return '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+class _Ring(object):
+  """A single producer, single consumer byte ring in a shared buffer."""
+
+  def __init__(self, buf, offset, capacity):
+    self._buf = buf
+    self._offset = offset
+    self._data = offset + _RING_HEADER
+    self.capacity = capacity
+
+  def _Get(self, field, fmt=_U64):
+    return fmt.unpack_from(self._buf, self._offset + field)[0]
+
+  def _Set(self, field, value, fmt=_U64):
+    fmt.pack_into(self._buf, self._offset + field, value)
+
+  def _Copy(self, position, data):
+    start = position % self.capacity
+    first = min(len(data), self.capacity - start)
+    self._buf[self._data + start:self._data + start + first] = data[:first]
+    if first < len(data):
+      self._buf[self._data:self._data + len(data) - first] = data[first:]
+
+  def _Slice(self, position, size):
+    start = position % self.capacity
+    first = min(size, self.capacity - start)
+    data = self._buf[self._data + start:self._data + start + first]
+    if first < size:
+      data += self._buf[self._data:self._data + size - first]
+    return data
+
+  def Write(self, record):
+    """Appends record if there is room, returning whether there was."""
+    head = self._Get(_HEAD)
+    if head + 4 + len(record) - self._Get(_TAIL) > self.capacity:
+      return False
+    self._Copy(head, _U32.pack(len(record)))
+    self._Copy(head + 4, record)
+    self._Set(_HEAD, head + 4 + len(record))
+    return True
+
+  def Read(self):
+    """Removes and returns the oldest record, or None if there is none."""
+    tail = self._Get(_TAIL)
+    if tail == self._Get(_HEAD):
+      return None
+    size = _U32.unpack(self._Slice(tail, 4))[0]
+    record = self._Slice(tail + 4, size)
+    self._Set(_TAIL, tail + 4 + size)
+    return record
+
+  def Waiting(self):
+    return self._Get(_WAITING, _U32)
+
+  def SetWaiting(self, waiting):
+    self._Set(_WAITING, waiting, _U32)
+
+def _MapRings(f, ring_size):
+  """Maps the two rings of file object f, sizing it if it is new.
+
+  Returns:
+    (mmap, client to server ring, server to client ring).
+  """
+  size = 2 * (_RING_HEADER + ring_size)
+  if os.fstat(f.fileno()).st_size < size:
+    f.truncate(size)
+  buf = mmap.mmap(f.fileno(), size)
+  return (buf, _Ring(buf, 0, ring_size),
+          _Ring(buf, _RING_HEADER + ring_size, ring_size))
+
+def _Fields(*fields):
+  """Packs byte strings, each with a u32 length."""
+  return b''.join(_U32.pack(len(f)) + f for f in fields)
+
+def _Unfields(data, offset):
+  """Unpacks the byte strings that _Fields packed into data[offset:]."""
+  fields = []
+  view = memoryview(data)
+  while offset < len(data):
+    size = _U32.unpack_from(data, offset)[0]
+    fields.append(bytes(view[offset + 4:offset + 4 + size]))
+    offset += 4 + size
+  return fields
+
+def _PackHeaders(headers):
+  """Packs a Headers, or a dict of name to list of values."""
+  items = headers.items() if isinstance(headers, dict) else (
+      headers.getAllRawHeaders())
+  return _Fields(*[f for name, values in items
+                   for value in values for f in (name, value)])
+
+def _UnpackHeaders(data):
+  fields = _Unfields(data, 0)
+  headers = Headers()
+  for name, value in zip(fields[::2], fields[1::2]):
+    headers.addRawHeader(name, value)
+  return headers
+
+class _Channel(Protocol):
+  """One end of a pair of rings, with the Unix socket used for wakeups."""
+
+  def __init__(self, outbound, inbound, handler, clock):
+    self._outbound = outbound
+    self._inbound = inbound
+    self._handler = handler  # Called with each complete inbound record.
+    self._clock = clock
+    self._queue = collections.deque()
+    self._fragments = []
+    self._retry = None
+    self._closed = False
+    self._fragment_size = outbound.capacity // 4 if outbound else 0
+    self.stats = collections.Counter()
+
+  def Send(self, record):
+    """Queues record to the other end, writing as much as fits now."""
+    size = self._fragment_size
+    for start in range(0, max(len(record), 1), size):
+      chunk = record[start:start + size]
+      more = _MORE if start + size < len(record) else 0
+      self._queue.append(struct.pack('<B', more) + chunk)
+    self.stats['records_sent'] += 1
+    self._Flush()
+
+  def _Retry(self):
+    self._retry = None
+    self._Flush()
+
+  def _Flush(self):
+    if self.transport is None or self._closed:
+      return
+    wrote = False
+    while self._queue and self._outbound.Write(self._queue[0]):
+      self._queue.popleft()
+      wrote = True
+    if wrote:
+      self.transport.write(_WAKEUP)
+    if self._queue:
+      self.stats['ring_full'] += 1
+      self._outbound.SetWaiting(1)
+      if self._retry is None:
+        self._retry = self._clock.callLater(_RETRY_DELAY, self._Retry)
+
+  def Drain(self):
+    """Handles every record in the inbound ring."""
+    while True:
+      fragment = self._inbound.Read()
+      if fragment is None:
+        break
+      self._fragments.append(fragment[1:])
+      if not fragment[0] & _MORE:
+        record = b''.join(self._fragments)
+        self._fragments = []
+        self.stats['records_received'] += 1
+        self._handler(record)
+    if self._inbound.Waiting():
+      self._inbound.SetWaiting(0)
+      self.transport.write(_WAKEUP)
+    if self._queue:
+      self._Flush()
+
+  def dataReceived(self, data):
+    self.stats['wakeups'] += 1
+    self.Drain()
+
+  def connectionLost(self, reason):
+    self._closed = True
+    if self._retry is not None and self._retry.active():
+      self._retry.cancel()
+    self._retry = None
+
+class _ClientChannel(_Channel):
+  """The frontend end: sends requests and matches up the responses."""
+
+  def __init__(self, clock, ring_size, on_lost):
+    f = tempfile.NamedTemporaryFile(prefix='simple_q-', dir=_ShmDir(),
+                                    delete=False)
+    self.ring_path = f.name
+    self._buf, outbound, inbound = _MapRings(f, ring_size)
+    f.close()
+    _Channel.__init__(self, outbound, inbound, self._HandleResponse, clock)
+    self._waiting = {}  # Request id to Deferred.
+    self._next_id = 0
+    self._on_lost = on_lost
+
+  def _Unlink(self):
+    try:
+      os.unlink(self.ring_path)
+    except OSError:
+      pass
+
+  def connectionMade(self):
+    self.transport.write(self.ring_path.encode('utf-8') + b'\n')
+    self._Flush()
+
+  def Request(self, method, endpoint, body, headers):
+    self._next_id = (self._next_id + 1) & 0xffffffff
+    d = self._waiting[self._next_id] = Deferred()
+    self.Send(_REQUEST.pack(self._next_id, _METHODS[method]) +
+              _Fields(endpoint, _PackHeaders(headers), body or b''))
+    return d
+
+  def _HandleResponse(self, record):
+    request_id, status = _RESPONSE.unpack_from(record)
+    headers, body = _Unfields(record, _RESPONSE.size)
+    d = self._waiting.pop(request_id, None)
+    if d is not None:
+      d.callback((status, body, _UnpackHeaders(headers)))
+
+  def Fail(self, reason):
+    """Fails every outstanding request and cleans up the rings."""
+    self._closed = True
+    self._on_lost(self)
+    self._Unlink()
+    waiting, self._waiting = self._waiting, {}
+    for d in waiting.values():
+      d.errback(reason)
+
+  def connectionLost(self, reason):
+    _Channel.connectionLost(self, reason)
+    self.Fail(reason)
+
+class _ShmClient(object):
+  """Stands in for server.Server in a ProxyBackend, over shared memory."""
+
+  def __init__(self, path, ring_size):
+    self._path = path
+    self._ring_size = ring_size
+    self._channel = None
+
+  def _Channel(self):
+    """Returns the channel, connecting (on first use) if need be."""
+    if self._channel is None:
+      from twisted.internet import reactor
+      from twisted.internet.endpoints import UNIXClientEndpoint
+      from twisted.internet.endpoints import connectProtocol
+      channel = self._channel = _ClientChannel(
+          reactor, self._ring_size, self._Lost)
+      def Failed(failure):
+        logging.error('Cannot reach %s: %s', self._path, failure.value)
+        channel.Fail(failure)
+      d = connectProtocol(UNIXClientEndpoint(reactor, self._path), channel)
+      d.addErrback(Failed)
+    return self._channel
+
+  def _Lost(self, channel):
+    """Forgets a failed channel so that the next request reconnects."""
+    if self._channel is channel:
+      self._channel = None
+
+  def Request(self, method, endpoint, body=None, headers=None,
+              with_headers=False):
+    """Same as server.Server.Request."""
+    d = self._Channel().Request(method, endpoint, body, headers or {})
+
+    def Result(result):
+      status, body, response_headers = result
+      encoding = response_headers.getRawHeaders(b'content-encoding', [None])[0]
+      if encoding == GZIP:
+        body = CompressedBody(body)
+      if with_headers:
+        return status, body, response_headers
+      return status, body
+    return d.addCallback(Result)
+
+  def GET(self, *args, **kwargs):
+    return self.Request(b'GET', *args, **kwargs)
+
+  def POST(self, *args, **kwargs):
+    return self.Request(b'POST', *args, **kwargs)
+
+  def DELETE(self, *args, **kwargs):
+    return self.Request(b'DELETE', *args, **kwargs)
+
+class ShmBackend(ProxyBackend):
+  """A ProxyBackend to a ShmListener on the same host."""
+
+  def __init__(self, path, poll_cache=None, ring_size=DEFAULT_RING_SIZE,
+               max_hints=100000):
+    """Constructor.
+
+    Args:
+      path: The Unix socket the backend's ShmListener listens on.
+      poll_cache: Optional pollcache.PollCache, as for ProxyBackend.
+      ring_size: Bytes in each of the two rings.
+      max_hints: Most topics whose poll hint is kept, as for ProxyBackend.
+    """
+    self._host = path
+    self._server = _ShmClient(path, ring_size)
+    self._poll_cache = poll_cache
+    self._max_hints = max_hints
+    self._hints = collections.OrderedDict()
+
+class _ServerChannel(_Channel):
+  """The backend end: maps the client's rings and answers its requests."""
+
+  def __init__(self, listener):
+    _Channel.__init__(self, None, None, self._HandleRequest, listener.clock)
+    self._listener = listener
+    self.stats = listener.stats
+    self._line = b''
+    self._buf = None
+
+  def connectionLost(self, reason):
+    _Channel.connectionLost(self, reason)
+    self._listener.channels.discard(self)
+
+  def dataReceived(self, data):
+    if self._buf is None:
+      self._line += data
+      if b'\n' not in self._line:
+        return
+      path = self._line.split(b'\n', 1)[0].decode('utf-8')
+      try:
+        with open(path, 'r+b') as f:
+          self._buf, self._inbound, self._outbound = _MapRings(
+              f, self._listener.ring_size)
+        os.unlink(path)
+      except (IOError, OSError, ValueError):
+        logging.exception('Cannot map shared memory rings from %s', path)
+        self.transport.loseConnection()
+        return
+      self._fragment_size = self._outbound.capacity // 4
+    _Channel.dataReceived(self, data)
+
+  def _HandleRequest(self, record):
+    request_id, method = _REQUEST.unpack_from(record)
+    endpoint, headers, body = _Unfields(record, _REQUEST.size)
+    headers = _UnpackHeaders(headers)
+    d = self._listener.Dispatch(_METHOD_NAMES[method], endpoint, headers, body)
+
+    def Failed(failure):
+      # Answered as the HTTP frontend would, so the caller is not left
+      # waiting for a response that never comes.
+      self.stats['errors'] += 1
+      logging.error('shm request %s failed: %s', endpoint,
+                    failure.getTraceback())
+      return 500, b'', Headers()
+
+    def Respond(result):
+      status, body, response_headers = result
+      if not self._closed:
+        self.Send(_RESPONSE.pack(request_id, status) +
+                  _Fields(_PackHeaders(response_headers), body or b''))
+    d.addErrback(Failed)
+    d.addCallback(Respond)
+    d.addErrback(lambda failure: logging.error(
+        'shm response to %s failed: %s', endpoint, failure.getTraceback()))
+
+class _ListenerFactory(Factory):
+  def __init__(self, listener):
+    self._listener = listener
+
+  def buildProtocol(self, addr):
+    self._listener.stats['connections'] += 1
+    channel = _ServerChannel(self._listener)
+    self._listener.channels.add(channel)
+    return channel
+
+class ShmListener(object):
+  """Serves a backend to ShmBackends on the same host.
+
+  Handles the four PubSub calls, with the topic version (see pollcache.py),
+  poll hints (see pacing.py) and compressed bodies passed along as the HTTP
+  frontend would.
+  """
+
+  def __init__(self, backend, path, ring_size=DEFAULT_RING_SIZE):
+    """Constructor.
+
+    Args:
+      backend: The backend to serve.
+      path: The Unix socket to listen on, replaced if it exists.
+      ring_size: Bytes in each ring, which must match the ShmBackends'.
+    """
+    self._backend = backend
+    self._path = path
+    self.ring_size = ring_size
+    self.clock = None
+    self._port = None
+    self.channels = set()
+    self.stats = collections.Counter()
+    self._topic_version = getattr(backend, 'TopicVersion', None)
+    self._poll_hint = getattr(backend, 'PollHint', None)
+
+  def Start(self, reactor):
+    """Listens on the socket (see RunServer)."""
+    self.clock = reactor
+    try:
+      os.unlink(self._path)
+    except OSError:
+      pass
+    self._port = reactor.listenUNIX(self._path, _ListenerFactory(self))
+    logging.info('Shared memory transport on %s', self._path)
+
+  def Stop(self):
+    """Stops listening and disconnects every ShmBackend.
+
+    Responses to requests already handled are sent first.
+    """
+    if self._port is not None:
+      self._port.stopListening()
+      self._port = None
+    for channel in list(self.channels):
+      channel.transport.loseConnection()
+
+  def Dispatch(self, method, endpoint, headers, body):
+    """Calls the backend for a request, like PubSubResource.
+
+    Returns:
+      A Deferred firing with (status, body, response Headers).
+    """
+    path, _, query = endpoint.partition(b'?')
+    segments = [unquote_to_bytes(s) for s in path.split(b'/')[1:]]
+    args = parse_qs(query)
+    call = None
+    if method == b'GET' and len(segments) == 2 and IsRead(args):
+      read = ParseRead(args)
+      if read is None:
+        return maybeDeferred(lambda: (400, b'', Headers()))
+      call = ('Read', self._backend.Read, segments + list(read))
+    elif method == b'GET' and len(segments) == 2:
+      call = ('GetMessage', self._backend.GetMessage, segments)
+    elif method == b'GET' and len(segments) == 1:
+      limit = ParseLimit(args)
+      if limit is None:
+        return maybeDeferred(lambda: (400, b'', Headers()))
+      if IsPeek(args):
+        call = ('PeekMessages', self._backend.PeekMessages, segments + [limit])
+      else:
+        call = ('GetMessages', self._backend.GetMessages, segments + [limit])
+    elif method == b'POST' and len(segments) == 1:
+      if headers.getRawHeaders(b'content-encoding', [None])[0] == GZIP:
+        body = CompressedBody(body)
+      key = headers.getRawHeaders(IDEMPOTENCY_KEY_HEADER, [None])[0]
+      call = ('PostMessage', self._backend.PostMessage,
+              segments + [body] + ([key] if key is not None else []))
+    elif method == b'POST' and len(segments) == 2 and IsCommit(args):
+      seq = ParseCommit(args)
+      if seq is None:
+        return maybeDeferred(lambda: (400, b'', Headers()))
+      call = ('Commit', self._backend.Commit, segments + [seq])
+    elif method == b'POST' and len(segments) == 2:
+      call = ('Subscribe', self._backend.Subscribe, segments)
+    elif method == b'DELETE' and len(segments) == 2:
+      call = ('Unsubscribe', self._backend.Unsubscribe, segments)
+    self.stats['requests'] += 1
+    response_headers = Headers()
+    if call is None:
+      return maybeDeferred(lambda: (404, b'', response_headers))
+    name, function, args = call
+    trace_id = tracing.TRACER.Begin(
+        headers.getRawHeaders(tracing.TRACE_HEADER, [None])[0])
+    token = tracing.Activate(trace_id) if trace_id is not None else None
+    try:
+      span = tracing.StartSpan('shm.' + name)
+      d = maybeDeferred(function, *args)
+      d.addBoth(span.FinishPassthrough)
+    finally:
+      if token is not None:
+        tracing.Deactivate(token)
+
+    def Result(result):
+      if name == 'GetMessage':
+        status, body = result[:2]
+        if len(result) > 2:
+          response_headers.setRawHeaders(SEQ_HEADER, [b'%d' % result[2]])
+        hint = self._poll_hint(*args) if self._poll_hint is not None else None
+        if hint is not None:
+          response_headers.setRawHeaders(TOPIC_RATE_HEADER,
+                                         [FormatRate(hint[0])])
+          response_headers.setRawHeaders(POLL_RATE_HEADER,
+                                         [FormatRate(hint[1])])
+      elif name == 'Read':
+        status, messages = result
+        body = b''
+        # As from the HTTP frontend, a 200 without messages has no body.
+        if status == 200 and messages:
+          body = EncodeRange(messages, messages[-1][0] + 1)
+      elif name in ('GetMessages', 'PeekMessages'):
+        status, messages, partial = result
+        body = EncodeInbox(messages, partial) if status == 200 else b''
+      else:
+        status, body = result, b''
+      if isinstance(body, CompressedBody):
+        response_headers.setRawHeaders(b'Content-Encoding', [GZIP])
+      if self._topic_version is not None and name in ('GetMessage',
+                                                      'PostMessage'):
+        response_headers.setRawHeaders(TOPIC_VERSION_HEADER,
+                                       [self._topic_version(args[0])])
+      return status, body, response_headers
+    return d.addCallback(Result)
+
+  def Stats(self):
+    return dict(self.stats)
+
+  def AdminResources(self):
+    """Admin endpoints for the listener, see admin.py."""
+    return {b'shm': JsonResource(self.Stats)}
@@ -0,0 +1,160 @@
+"""Durable subscriptions for MemoryBackend, kept in a local SQLite file.
+
+MemoryBackend stays the authority for reads. Subscribe and Unsubscribe only
+queue the change here, and a worker thread writes queued changes in batches,
+one transaction each, so the reactor thread never waits on the disk. A change
+is durable a few milliseconds after the request that made it returned.
+"""
+
+import logging
+import sqlite3
+import threading
+import time
+
+try:
+  import queue
+except ImportError:
+  import Queue as queue
+
+from admin import JsonResource
+
+_ADD = 1
+_REMOVE = 2
+_STOP = object()
+
+_SCHEMA = ('CREATE TABLE IF NOT EXISTS subscriptions ('
+           'topic BLOB, user BLOB, PRIMARY KEY (topic, user)) WITHOUT ROWID')
+
+class SubscriptionStore(object):
+  """Write-behind SQLite store of (topic, user) subscriptions."""
+
+  def __init__(self, path, batch_size=1000, max_delay=0.01):
+    """Constructor, which starts the worker thread.
+
+    Args:
+      path: The SQLite database file, created if needed.
+      batch_size: Most changes written in one transaction.
+      max_delay: Seconds the worker waits after a change for more to batch.
+    """
+    self._path = path
+    self._batch_size = batch_size
+    self._max_delay = max_delay
+    self._queue = queue.Queue()
+    self._stats = {
+        'queued': 0,
+        'batches': 0,
+        'written': 0,
+        'coalesced': 0,  # Changes superseded by a later one in their batch.
+        'failures': 0,
+        'last_batch_ms': None,
+        'load_ms': None,
+    }
+    connection = self._Connect()
+    connection.execute(_SCHEMA)
+    connection.close()
+    self._thread = threading.Thread(target=self._Run, name='subscriptions')
+    self._thread.daemon = True
+    self._thread.start()
+
+  def _Connect(self):
+    connection = sqlite3.connect(self._path)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    return connection
+
+  def Start(self, reactor):
+    """Flushes and stops the worker when reactor shuts down (see RunServer)."""
+    reactor.addSystemEventTrigger('after', 'shutdown', self.Close)
+
+  def Load(self):
+    """Returns every stored subscription as a dict of topic to set of users."""
+    start = time.time()
+    topics = {}
+    connection = self._Connect()
+    try:
+      for topic, user in connection.execute(
+          'SELECT topic, user FROM subscriptions'):
+        users = topics.get(topic)
+        if users is None:
+          users = topics[topic] = set()
+        users.add(user)
+    finally:
+      connection.close()
+    self._stats['load_ms'] = (time.time() - start) * 1000
+    return topics
+
+  def Add(self, topic_name, user):
+    """Queues storing a subscription."""
+    self._stats['queued'] += 1
+    self._queue.put((_ADD, topic_name, user))
+
+  def Remove(self, topic_name, user):
+    """Queues deleting a subscription."""
+    self._stats['queued'] += 1
+    self._queue.put((_REMOVE, topic_name, user))
+
+  def Flush(self):
+    """Blocks until every queued change has been written."""
+    self._queue.join()
+
+  def Close(self):
+    """Writes the remaining changes and stops the worker."""
+    if self._thread.is_alive():
+      self._queue.put(_STOP)
+      self._thread.join()
+
+  def Stats(self):
+    """Returns the write-behind counters, plus changes not yet written."""
+    stats = dict(self._stats)
+    stats['pending'] = self._queue.qsize()
+    return stats
+
+  def _Run(self):
+    """The worker thread: writes batches of changes until stopped."""
+    connection = self._Connect()
+    stopping = False
+    while not stopping:
+      batch = [self._queue.get()]
+      if batch[0] is not _STOP and self._queue.qsize() < self._batch_size:
+        # Linger so a burst of changes shares one transaction.
+        time.sleep(self._max_delay)
+      while len(batch) < self._batch_size:
+        try:
+          batch.append(self._queue.get_nowait())
+        except queue.Empty:
+          break
+      stopping = _STOP in batch
+      self._Write(connection, [c for c in batch if c is not _STOP])
+      for _ in batch:
+        self._queue.task_done()
+    connection.close()
+
+  def _Write(self, connection, changes):
+    """Writes one batch of changes in a single transaction."""
+    if not changes:
+      return
+    start = time.time()
+    # Only the last change to a subscription in the batch matters.
+    latest = {}
+    for op, topic_name, user in changes:
+      latest[(topic_name, user)] = op
+    try:
+      with connection:
+        connection.executemany(
+            'INSERT OR IGNORE INTO subscriptions VALUES (?, ?)',
+            [key for key, op in latest.items() if op == _ADD])
+        connection.executemany(
+            'DELETE FROM subscriptions WHERE topic = ? AND user = ?',
+            [key for key, op in latest.items() if op == _REMOVE])
+    except sqlite3.Error:
+      self._stats['failures'] += 1
+      logging.exception('Failed to write %d subscription changes', len(latest))
+      return
+    self._stats['batches'] += 1
+    self._stats['written'] += len(latest)
+    self._stats['coalesced'] += len(changes) - len(latest)
+    self._stats['last_batch_ms'] = (time.time() - start) * 1000
+
+  def AdminResources(self):
+    """Admin endpoints for the store, see admin.py."""
+    return {b'subscriptions': JsonResource(self.Stats)}
@@ -0,0 +1,270 @@
+import collections
+import io
+import json
+import random
+
+from backends.faults import FaultInjectingBackend
+from backends.faults import InjectedError
+from backends.faults import ParseFaults
+from backends.hash import HashBackend
+from backends.hash import _HashToNumberLessThan
+from backends.memory import MemoryBackend
+from backends.proxy import ProxyBackend
+from frontend import PubSubResource
+from frontend import PubSubSite
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.error import ConnectionLost
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+from twisted.web.test.test_web import DummyRequest
+
+class ParseFaultsTest(unittest.TestCase):
+  def test_parse(self):
+    """Verify specs parse per operation, and bad ones are refused."""
+    faults = ParseFaults('poll:latency=fixed:5,error=0.5; *:flap=10:2,'
+                         'stall=0.1,stall_time=3')
+    self.assertEqual(['*', 'poll'], sorted(faults))
+    self.assertEqual((0.5, (10.0, 2.0)), (faults['poll'].error,
+                                          faults['*'].flap))
+    self.assertEqual(3.0, faults['*'].stall_time)
+    self.assertEqual({}, ParseFaults(''))
+    for bad in ('get:error=1', 'poll:oops=1', 'poll:latency=zipf:1'):
+      self.assertRaises(ValueError, ParseFaults, bad)
+
+  def test_latencies(self):
+    """Verify each distribution draws delays around its parameters."""
+    rng = random.Random(0)
+    def Draw(spec):
+      fault = ParseFaults('poll:latency=%s' % spec)['poll']
+      return sorted(fault.Decide(rng, 0)[1] for _ in range(1000))
+    self.assertEqual([0.005], list(set(Draw('fixed:5'))))
+    draws = Draw('uniform:1:3')
+    self.assertTrue(0.001 <= draws[0] and draws[-1] <= 0.003)
+    self.assertTrue(0.009 < sum(Draw('exp:10')) / 1000 < 0.011)
+    draws = Draw('lognormal:10:1')
+    self.assertTrue(0.009 < draws[500] < 0.011)
+    self.assertGreater(draws[990], 0.08)
+
+class FaultInjectingBackendTest(unittest.TestCase):
+  def setUp(self):
+    self._clock = Clock()
+    self._backend = FaultInjectingBackend(MemoryBackend(), '', self._clock,
+                                          random.Random(0))
+    self._backend.Subscribe(b'topic', b'user')
+
+  def test_passes_through(self):
+    """Verify calls without faults go to the wrapped backend at once."""
+    self.assertEqual(200, self.successResultOf(
+        self._backend.PostMessage(b'topic', b'm')))
+    self.assertEqual((200, b'm', 1), self.successResultOf(
+        self._backend.GetMessage(b'topic', b'user')))
+    self.assertEqual((204, []), self.successResultOf(
+        self._backend.Read(b'topic', b'user', 0, 10)))
+    self.assertEqual(1, self._backend.Stats()['ops']['poll']['calls'])
+    self.assertEqual(1, self._backend.Stats()['ops']['read']['calls'])
+    # Everything else is the wrapped backend's.
+    self.assertEqual(self._backend._backend.TopicVersion(b'topic'),
+                     self._backend.TopicVersion(b'topic'))
+
+  def test_errors_and_resets(self):
+    """Verify errors and resets fail calls, each with its own failure."""
+    self._backend.SetFaults('poll:error=1;publish:reset=1')
+    self.failureResultOf(self._backend.GetMessage(b'topic', b'user'),
+                         InjectedError)
+    self.failureResultOf(self._backend.PostMessage(b'topic', b'm'),
+                         ConnectionLost)
+    stats = self._backend.Stats()['ops']
+    self.assertEqual((1, 1), (stats['poll']['error'],
+                              stats['publish']['reset']))
+
+  def test_latency_and_stalls(self):
+    """Verify delayed calls are held, and counted while they are."""
+    self._backend.SetFaults('poll:latency=fixed:100;publish:stall=1,'
+                            'stall_time=30')
+    polls = [self._backend.GetMessage(b'topic', b'user') for _ in range(3)]
+    posted = self._backend.PostMessage(b'topic', b'm')
+    self.assertNoResult(polls[0])
+    self._clock.advance(0.1)
+    self.assertEqual((204, None), self.successResultOf(polls[0]))
+    self.assertNoResult(posted)
+    self.assertEqual((1, 4), (self._backend.Stats()['in_flight'],
+                              self._backend.Stats()['max_in_flight']))
+    self._clock.advance(30)
+    self.assertEqual(200, self.successResultOf(posted))
+    self.assertEqual(0, self._backend.Stats()['in_flight'])
+
+  def test_flap(self):
+    """Verify a flapping backend resets every call while it is down."""
+    self._backend.SetFaults('*:flap=10:3')
+    self._clock.advance(6.9)
+    self.successResultOf(self._backend.GetMessage(b'topic', b'user'))
+    self._clock.advance(0.2)
+    self.failureResultOf(self._backend.GetMessage(b'topic', b'user'),
+                         ConnectionLost)
+    self._clock.advance(3)
+    self.successResultOf(self._backend.Subscribe(b'topic', b'other'))
+
+  def test_admin(self):
+    """Verify faults are changed and counted from the admin endpoint."""
+    resource = self._backend.AdminResources()[b'faults']
+    request = DummyRequest([])
+    request.args = {b'spec': [b'poll:error=1']}
+    self.assertEqual('poll:error=1',
+                     json.loads(resource.render_POST(request))['spec'])
+    self.failureResultOf(self._backend.GetMessage(b'topic', b'user'))
+    stats = json.loads(resource.render_GET(DummyRequest([])))
+    self.assertEqual(1, stats['ops']['poll']['error'])
+    request.args = {b'spec': [b'poll:bad=1']}
+    resource.render_POST(request)
+    self.assertEqual(400, request.responseCode)
+
+class ResetOverHttpTest(unittest.TestCase):
+  """Serves a FaultInjectingBackend to a ProxyBackend over loopback TCP."""
+
+  def setUp(self):
+    self._backend = FaultInjectingBackend(MemoryBackend(), 'poll:reset=1')
+    site = PubSubSite(PubSubResource(self._backend))
+    self._port = reactor.listenTCP(0, site, interface='127.0.0.1')
+    self._backend.Serving(site, self._port, None)
+    self._proxy = ProxyBackend('127.0.0.1:%d' % self._port.getHost().port)
+
+  @inlineCallbacks
+  def tearDown(self):
+    yield self._proxy._server.Close()
+    yield self._port.stopListening()
+
+  @inlineCallbacks
+  def test_reset(self):
+    """Verify a reset connection fails the call, and the next one works."""
+    self.assertEqual(200, (yield self._proxy.Subscribe(b'topic', b'user')))
+    try:
+      yield self._proxy.GetMessage(b'topic', b'user')
+      self.fail('Expected the connection to be reset')
+    except Exception:
+      pass
+    self.assertEqual(1, self._backend.Stats()['ops']['poll']['reset'])
+    self._backend.SetFaults('')
+    self.assertEqual((204, b''),
+                     (yield self._proxy.GetMessage(b'topic', b'user')))
+
+def _Percentile(values, pct):
+  return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+class TailLatencyTest(unittest.TestCase):
+  """Frontend latency and held requests with one of 4 shards faulty.
+
+  A frontend (PubSubResource over HashBackend) is sent a publish or a poll
+  every millisecond of simulated time, over 16 topics, and each request's
+  time to finish is measured on the clock.
+  """
+  SHARDS = 4
+
+  def _Run(self, faults, requests=2000, inbox=False):
+    """Sends the requests with faults (a spec) on shard 0.
+
+    Returns:
+      A dict with the sorted latencies, statuses by shard, the most requests
+      unfinished at once, and shard 0's stats.
+    """
+    clock = Clock()
+    shards = [FaultInjectingBackend(MemoryBackend(), '', clock,
+                                    random.Random(i))
+              for i in range(self.SHARDS)]
+    hash_backend = HashBackend(shards, inbox_timeout=0.1, clock=clock)
+    resource = PubSubResource(hash_backend)
+    topics = [b'topic-%d' % i for i in range(16)]
+    for topic in topics:
+      hash_backend.Subscribe(topic, b'user')
+    shards[0].SetFaults(faults)
+    result = {'latencies': [], 'statuses': collections.defaultdict(
+        collections.Counter), 'max_unfinished': 0}
+    unfinished = [0]
+
+    def Finished(_, request, start, shard):
+      unfinished[0] -= 1
+      result['latencies'].append(clock.seconds() - start)
+      result['statuses'][shard][request.responseCode or 200] += 1
+
+    for i in range(requests):
+      topic = topics[i % len(topics)]
+      shard = _HashToNumberLessThan(topic, self.SHARDS)
+      if inbox:
+        request = DummyRequest([b'user'])
+        shard = None
+      elif i % 2:
+        request = DummyRequest([topic, b'user'])
+      else:
+        request = DummyRequest([topic])
+        request.method = b'POST'
+        request.content = io.BytesIO(b'message')
+      unfinished[0] += 1
+      request.notifyFinish().addCallback(Finished, request, clock.seconds(),
+                                         shard)
+      resource.render(request)
+      result['max_unfinished'] = max(result['max_unfinished'], unfinished[0])
+      clock.advance(0.001)
+    while unfinished[0] and clock.seconds() < 100:
+      clock.advance(0.01)
+    self.assertEqual(0, unfinished[0])
+    result['latencies'].sort()
+    result['shard'] = shards[0].Stats()
+    return result
+
+  def test_baseline(self):
+    """Verify every request is answered at once without faults."""
+    result = self._Run('')
+    self.assertEqual(0, _Percentile(result['latencies'], 99))
+    self.assertEqual(0, result['max_unfinished'])
+
+  def test_slow_shard(self):
+    """Verify a slow shard sets p99, but not p50, and holds requests."""
+    result = self._Run('poll:latency=lognormal:20:1;'
+                       'publish:latency=lognormal:20:1')
+    self.assertEqual(0, _Percentile(result['latencies'], 50))
+    self.assertGreater(_Percentile(result['latencies'], 99), 0.1)
+    # About a quarter of 1000 requests/s, held 20ms+ each.
+    self.assertTrue(5 < result['max_unfinished'] < 100)
+
+  def test_lossy_shard(self):
+    """Verify errors on a shard are 500s for its topics only."""
+    result = self._Run('poll:error=0.2;publish:error=0.2')
+    failed = dict((shard, statuses[500])
+                  for shard, statuses in result['statuses'].items())
+    self.assertEqual(result['shard']['ops']['poll']['error'] +
+                     result['shard']['ops']['publish']['error'], failed[0])
+    self.assertTrue(50 < failed[0] < 200)
+    self.assertEqual(0, sum(failed.values()) - failed[0])
+
+  def test_flapping_shard(self):
+    """Verify a flapping shard fails its topics only while it is down."""
+    result = self._Run('*:flap=0.5:0.1', requests=4000)
+    statuses = result['statuses'][0]
+    # Down a fifth of the time.
+    total = sum(statuses.values())
+    self.assertTrue(0.15 < statuses[500] / float(total) < 0.25)
+    self.assertEqual(0, _Percentile(result['latencies'], 99))
+
+  def test_stalling_shard(self):
+    """Verify stalled calls are held until the stall ends.
+
+    Nothing times out a backend call, so every stalled request stays open
+    on the frontend for the full stall_time.
+    """
+    result = self._Run('poll:stall=0.05,stall_time=30')
+    stalled = result['shard']['ops']['poll']['delayed']
+    self.assertTrue(5 < stalled < 30)
+    self.assertEqual(30, round(result['latencies'][-1]))
+    self.assertEqual(stalled, result['shard']['max_in_flight'])
+    self.assertEqual(stalled, result['max_unfinished'])
+
+  def test_inbox_stalling_shard(self):
+    """Verify inbox reads answer by their deadline when a shard stalls."""
+    result = self._Run('inbox:stall=1,stall_time=30', requests=500,
+                       inbox=True)
+    self.assertAlmostEqual(0.1, result['latencies'][0])
+    # Within the last step of the clock.
+    self.assertTrue(result['latencies'][-1] < 0.11)
+    # The stalled calls are still held on the shard, one per read.
+    self.assertEqual(500, result['shard']['max_in_flight'])
@@ -1,8 +1,19 @@
+import json
+
+import tracing
+
 from backends.hash import HashBackend
 from backends.hash import _HashToNumberLessThan
+from backends.hash import ParsePartitions
+from backends.memory import MemoryBackend
 
 from mock import MagicMock
+from twisted.internet.defer import Deferred
+from twisted.internet.defer import fail
+from twisted.internet.defer import maybeDeferred
+from twisted.internet.task import Clock
 from twisted.trial import unittest
+from twisted.web.test.test_web import DummyRequest
 
 class MemoryBackendTest(unittest.TestCase):
   def setUp(self):
@@ -11,7 +22,7 @@ class MemoryBackendTest(unittest.TestCase):
 
   def test_hash_number_less_than(self):
     """Verify that _HashToNumberLessThan works as expected."""
-    for val in ['cat', 'mousey', 'dogdog', 'ASDFASDF']:
+    for val in [b'cat', b'mousey', b'dogdog', b'ASDFASDF']:
       for cap in [2, 3, 5, 200]:
         v = _HashToNumberLessThan(val, cap)
         self.assertEqual(v, _HashToNumberLessThan(val, cap),
@@ -21,43 +32,268 @@ class MemoryBackendTest(unittest.TestCase):
 
   def test_get_backend_for(self):
     """Verify that _GetBackendFor always returns one of the backends."""
-    for topic in ['cats', 'kittens', 'bunnies', 'apricots']:
+    for topic in [b'cats', b'kittens', b'bunnies', b'apricots']:
       self.assertIn(self._backend._GetBackendFor(topic), self._backends)
 
     backends = set()
-    for topic in xrange(500):
-      backend = self._backend._GetBackendFor(str(topic))
+    for topic in range(500):
+      backend = self._backend._GetBackendFor(b'%d' % topic)
       self.assertIn(backend, self._backends)
       backends.add(backend)
     # For 500 topics at random we should see more than just 1 backend.
     self.assertGreater(len(backends), 1)
 
+  def test_route_span(self):
+    """Verify routing is recorded as a span of the current trace."""
+    tracer = tracing.Configure()
+    self.addCleanup(tracing.Configure)
+    token = tracing.Activate('trace')
+    try:
+      self._backend.GetMessage(b'topic', b'user')
+    finally:
+      tracing.Deactivate(token)
+    span, = tracer.Spans('trace')
+    self.assertEqual('hash.route', span['name'])
+    self.assertEqual(self._backends.index(self._backend._GetBackendFor(
+        b'topic')), span['attrs']['shard'])
+
   def test_get_message(self):
     """Verify that GetMessage is forwarded correctly."""
-    self._backend._GetBackendFor('topic').GetMessage.return_value = 'PIE'
-    self.assertEquals('PIE', self._backend.GetMessage('topic', 'user'))
-    self._backend._GetBackendFor('topic').GetMessage.assert_called_with(
-        'topic', 'user')
+    self._backend._GetBackendFor(b'topic').GetMessage.return_value = 'PIE'
+    self.assertEquals('PIE', self._backend.GetMessage(b'topic', b'user'))
+    self._backend._GetBackendFor(b'topic').GetMessage.assert_called_with(
+        b'topic', b'user')
+
+  def test_read_and_commit(self):
+    """Verify that Read and Commit go where GetMessage does."""
+    backend = self._backend._GetBackendFor(b'topic')
+    backend.Read.return_value = (200, [(1, b'm')])
+    backend.Commit.return_value = 200
+    self.assertEqual((200, [(1, b'm')]),
+                     self._backend.Read(b'topic', b'user', 0, 10))
+    backend.Read.assert_called_with(b'topic', b'user', 0, 10)
+    self.assertEqual(200, self._backend.Commit(b'topic', b'user', 1))
+    backend.Commit.assert_called_with(b'topic', b'user', 1)
+
+  def test_poll_hint(self):
+    """Verify poll hints come from the topic's backend."""
+    backend = self._backend._GetBackendFor(b'topic')
+    backend.PollHint.return_value = (1.0, 2.0)
+    self.assertEqual((1.0, 2.0), self._backend.PollHint(b'topic', b'user'))
+    backend.PollHint.assert_called_with(b'topic', b'user')
+    self.assertEqual(None, self._backend.PollHint(b'*.created', b'user'))
+    self.assertEqual(None, HashBackend([object()]).PollHint(b'topic'))
 
   def test_post_message(self):
     """Verify that PostMessage is forwarded correctly."""
-    self._backend._GetBackendFor('ooo').PostMessage.return_value = '00'
-    self.assertEquals('00', self._backend.PostMessage('ooo', 'user'))
-    self._backend._GetBackendFor('ooo').PostMessage.assert_called_with(
-        'ooo', 'user')
+    self._backend._GetBackendFor(b'ooo').PostMessage.return_value = '00'
+    self.assertEquals('00', self._backend.PostMessage(b'ooo', b'user'))
+    self._backend._GetBackendFor(b'ooo').PostMessage.assert_called_with(
+        b'ooo', b'user')
 
   def test_subscribe(self):
     """Verify that Subscribe is forwarded correctly."""
-    self._backend._GetBackendFor('cipot').Subscribe.return_value = 'APE'
-    self.assertEquals('APE', self._backend.Subscribe('cipot', 'user'))
-    self._backend._GetBackendFor('cipot').Subscribe.assert_called_with(
-        'cipot', 'user')
+    self._backend._GetBackendFor(b'cipot').Subscribe.return_value = 'APE'
+    self.assertEquals('APE', self._backend.Subscribe(b'cipot', b'user'))
+    self._backend._GetBackendFor(b'cipot').Subscribe.assert_called_with(
+        b'cipot', b'user')
 
   def test_unsubscribe(self):
     """Verify that Unsubscribe is forwarded correctly."""
-    self._backend._GetBackendFor('ttttt').Unsubscribe.return_value = '777'
-    self.assertEquals('777', self._backend.Unsubscribe('ttttt', 'user'))
-    self._backend._GetBackendFor('ttttt').Unsubscribe.assert_called_with(
-        'ttttt', 'user')
+    self._backend._GetBackendFor(b'ttttt').Unsubscribe.return_value = '777'
+    self.assertEquals('777', self._backend.Unsubscribe(b'ttttt', b'user'))
+    self._backend._GetBackendFor(b'ttttt').Unsubscribe.assert_called_with(
+        b'ttttt', b'user')
+
+
+
+class PartitionedHashBackendTest(unittest.TestCase):
+  def setUp(self):
+    self._backends = [MagicMock() for _ in range(5)]
+    for b in self._backends:
+      b.PostMessage.return_value = 200
+    self._backend = HashBackend(self._backends, {b'hot': 3})
+
+  def test_parse_partitions(self):
+    """Verify the PARTITIONED_TOPICS format is parsed."""
+    self.assertEqual({b'a': 2, b'b.c': 4}, ParsePartitions('a:2,b.c:4'))
+    self.assertEqual({}, ParsePartitions(None))
+
+  def test_set_partitions(self):
+    """Verify K is capped at the number of backends and K=1 unpartitions."""
+    self._backend.SetPartitions(b'cold', 50)
+    self.assertEqual({b'hot': 3, b'cold': 5}, self._backend.Partitions())
+    self._backend.SetPartitions(b'cold', 1)
+    self.assertEqual({b'hot': 3}, self._backend.Partitions())
+
+  def test_users_spread_over_partitions(self):
+    """Verify each user sticks to one of K backends and users spread out."""
+    used = set()
+    for i in range(100):
+      user = b'user%d' % i
+      self._backend.Subscribe(b'hot', user)
+      backend = self._backend._GetBackendFor(b'hot', user)
+      backend.Subscribe.assert_called_with(b'hot', user)
+      self._backend.GetMessage(b'hot', user)
+      backend.GetMessage.assert_called_with(b'hot', user)
+      self._backend.Unsubscribe(b'hot', user)
+      backend.Unsubscribe.assert_called_with(b'hot', user)
+      used.add(backend)
+    self.assertEqual(set(self._backend._GetAllBackendsFor(b'hot')), used)
+    self.assertEqual(3, len(used))
+
+  def test_post_fans_out(self):
+    """Verify posts to a partitioned topic reach every partition."""
+    d = self._backend.PostMessage(b'hot', b'msg')
+    for backend in self._backend._GetAllBackendsFor(b'hot'):
+      backend.PostMessage.assert_called_with(b'hot', b'msg')
+    d.addCallback(self.assertEqual, 200)
+    return d
+
+  def test_post_fan_out_idempotency_key(self):
+    """Verify every partition gets the key, so retries fill in the gaps."""
+    d = self._backend.PostMessage(b'hot', b'msg', b'key')
+    for backend in self._backend._GetAllBackendsFor(b'hot'):
+      backend.PostMessage.assert_called_with(b'hot', b'msg', b'key')
+    d.addCallback(self.assertEqual, 200)
+    return d
+
+  def test_post_fan_out_status(self):
+    """Verify a partition's non-200 status is the overall result."""
+    self._backend._GetAllBackendsFor(b'hot')[1].PostMessage.return_value = 503
+    d = self._backend.PostMessage(b'hot', b'msg')
+    d.addCallback(self.assertEqual, 503)
+    return d
+
+  def test_post_fan_out_error(self):
+    """Verify a partition's error fails the post with the original error."""
+    self._backend._GetAllBackendsFor(b'hot')[2].PostMessage.side_effect = (
+        ValueError('boom'))
+    d = self._backend.PostMessage(b'hot', b'msg')
+    return self.assertFailure(d, ValueError)
+
+  def test_partitions_resource(self):
+    """Verify partitions can be inspected and changed over the admin port."""
+    resource = self._backend.AdminResources()[b'partitions']
+    request = DummyRequest([])
+    request.args = {b'topic': [b'warm'], b'k': [b'2']}
+    self.assertEqual({'hot': 3, 'warm': 2},
+                     json.loads(resource.render_POST(request)))
+    request = DummyRequest([])
+    request.args = {b'topic': [b'warm']}
+    self.assertEqual(b'', resource.render_POST(request))
+    self.assertEqual(400, request.responseCode)
+
+class PatternHashBackendTest(unittest.TestCase):
+  def setUp(self):
+    self._backends = [MemoryBackend() for _ in range(4)]
+
+  def _Result(self, d):
+    results = []
+    maybeDeferred(lambda: d).addCallback(results.append)
+    return results[0]
+
+  def test_prefix_placement(self):
+    """Verify topics and literal prefix patterns share a backend."""
+    backend = HashBackend(self._backends, prefix_segments=1)
+    self.assertIs(backend._GetBackendFor(b'orders.created'),
+                  backend._GetBackendFor(b'orders.*'))
+    self.assertEqual(200, self._Result(backend.Subscribe(b'orders.*', b'u')))
+    self.assertEqual(200, backend.PostMessage(b'orders.created', b'msg'))
+    self.assertEqual((200, b'msg', 1),
+                     self._Result(backend.GetMessage(b'orders.*', b'u')))
+    self.assertEqual(1, sum(len(b._patterns) for b in self._backends))
+
+  def test_pattern_on_all_backends(self):
+    """Verify other patterns are on every backend and polled in turn."""
+    backend = HashBackend(self._backends)
+    self.assertEqual(200, self._Result(backend.Subscribe(b'*.created', b'u')))
+    self.assertEqual(4, sum(len(b._patterns) for b in self._backends))
+    topics = [b'%d.created' % i for i in range(20)]
+    for topic in topics:
+      backend.PostMessage(topic, topic)
+    received = set()
+    for _ in topics:
+      status, body = self._Result(backend.GetMessage(b'*.created', b'u'))
+      self.assertEqual(200, status)
+      received.add(body)
+    self.assertEqual(set(topics), received)
+    self.assertEqual((204, None),
+                     self._Result(backend.GetMessage(b'*.created', b'u')))
+    self.assertEqual((404, None),
+                     self._Result(backend.GetMessage(b'*.created', b'x')))
+    # Seqs are per backend, so these cannot be read by offset.
+    self.assertEqual((400, []), backend.Read(b'*.created', b'u', 0, 10))
+    self.assertEqual(400, backend.Commit(b'*.created', b'u', 1))
+    self.assertEqual(200, self._Result(backend.Unsubscribe(b'*.created', b'u')))
+    self.assertEqual(404, self._Result(backend.Unsubscribe(b'*.created', b'u')))
+    self.assertEqual(0, sum(len(b._patterns) for b in self._backends))
+
+class InboxHashBackendTest(unittest.TestCase):
+  def setUp(self):
+    self._clock = Clock()
+    self._memory = [MemoryBackend() for _ in range(3)]
+    self._slow = Deferred()
+    self._late = MagicMock()
+    self._late.PeekMessages.return_value = self._slow
+    self._backend = HashBackend(self._memory + [self._late], inbox_timeout=1,
+                                clock=self._clock)
+    for i in range(6):
+      topic = b'topic-%d' % i
+      self._backend.Subscribe(topic, b'u')
+      self._backend.PostMessage(topic, b'm%d' % i)
+
+  def test_gathers_by_deadline(self):
+    """Verify backends are read in parallel, and the slow one is not waited on."""
+    d = self._backend.GetMessages(b'u', 100)
+    self.assertNoResult(d)
+    self._clock.advance(1)
+    status, messages, partial = self.successResultOf(d)
+    self.assertEqual((200, True), (status, partial))
+    self.assertEqual(set(b'm%d' % i for i in range(6)),
+                     set(body for _, body in messages))
+    self._late.PeekMessages.assert_called_with(b'u', 100)
+    self.assertEqual(0, sum(m.Backlog()['messages'] for m in self._memory))
+
+    # What the slow backend peeked at arrives late, and is left on it.
+    self._slow.callback((200, [(b'other', b'late', 1)], False))
+    self.assertFalse(self._late.Commit.called)
+    self._late.PeekMessages.return_value = (200, [(b'other', b'late', 1)],
+                                            False)
+    self._late.Commit.return_value = 200
+    d = self._backend.GetMessages(b'u', 100)
+    self.assertEqual((200, [(b'other', b'late')], False),
+                     self.successResultOf(d))
+    self._late.Commit.assert_called_once_with(b'other', b'u', 1)
+
+  def test_limit(self):
+    """Verify messages past the limit are left on their backend."""
+    self._late.PeekMessages.return_value = (404, [], False)
+    received = []
+    for _ in range(2):
+      status, messages, partial = self.successResultOf(
+          self._backend.GetMessages(b'u', 4))
+      received.extend(body for _, body in messages)
+    self.assertEqual(set(b'm%d' % i for i in range(6)), set(received))
+    self.assertEqual(6, len(received))
+    self.assertEqual((204, [], False),
+                     self.successResultOf(self._backend.GetMessages(b'u', 4)))
+    self.assertEqual((404, [], False),
+                     self.successResultOf(self._backend.GetMessages(b'x', 4)))
 
+  def test_failed_commit(self):
+    """Verify messages whose commit failed are answered with, and kept."""
+    self._late.PeekMessages.return_value = (200, [(b't', b'a', 1),
+                                                  (b't', b'b', 2)], False)
+    self._late.Commit.return_value = fail(ValueError('down'))
+    backend = HashBackend([self._late], clock=self._clock)
+    self.assertEqual((200, [(b't', b'a')], False),
+                     self.successResultOf(backend.GetMessages(b'u', 1)))
+    self._late.Commit.assert_called_once_with(b't', b'u', 1)
 
+  def test_all_failed(self):
+    """Verify the read fails only when every backend did."""
+    backend = HashBackend([self._late], clock=self._clock)
+    d = backend.GetMessages(b'u', 10)
+    self._slow.errback(ValueError('down'))
+    self.failureResultOf(d, ValueError)
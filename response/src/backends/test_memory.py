@@ -1,6 +1,16 @@
+import json
+
+from io import BytesIO
+
+from backends import memory
+from backends.memory import BacklogResource
 from backends.memory import MemoryBackend
+from compression import CompressedBody
+from maintenance import Maintenance
 
+from twisted.internet.task import Clock
 from twisted.trial import unittest
+from twisted.web.test.test_web import DummyRequest
 
 class MemoryBackendTest(unittest.TestCase):
   def setUp(self):
@@ -8,7 +18,7 @@ class MemoryBackendTest(unittest.TestCase):
 
   def _TotalMessageCount(self):
     """Test utility to count all messages in the backend."""
-    return sum([len(v.messages) for _, v in self._backend._topics.iteritems()])
+    return sum([len(v.messages) for _, v in self._backend._topics.items()])
 
   def _Subscribe(self, topic, user):
     """Subscribe and verify that the operation worked."""
@@ -20,60 +30,539 @@ class MemoryBackendTest(unittest.TestCase):
 
   def test_basic(self):
     """Perform basic happy-case tests across the board."""
-    self.assertEquals((404, None), self._backend.GetMessage('topic', 'user'))
-    self._Subscribe('topic', 'user')
-    self.assertEquals((204, None), self._backend.GetMessage('topic', 'user'))
+    self.assertEquals((404, None), self._backend.GetMessage(b'topic', b'user'))
+    self._Subscribe(b'topic', b'user')
+    self.assertEquals((204, None), self._backend.GetMessage(b'topic', b'user'))
 
     self.assertEquals(0, self._TotalMessageCount())
-    self._PostMessage('topic', 'message')
+    self._PostMessage(b'topic', b'message')
     self.assertEquals(1, self._TotalMessageCount())
 
-    self.assertEquals((200, 'message'),
-                      self._backend.GetMessage('topic', 'user'))
+    self.assertEquals((200, b'message'),
+                      self._backend.GetMessage(b'topic', b'user')[:2])
     self.assertEquals(0, self._TotalMessageCount())
-    self.assertEquals((204, None), self._backend.GetMessage('topic', 'user'))
-    self.assertEquals(200, self._backend.Unsubscribe('topic', 'user'))
-    self.assertEquals((404, None), self._backend.GetMessage('topic', 'user'))
+    self.assertEquals((204, None), self._backend.GetMessage(b'topic', b'user'))
+    self.assertEquals(200, self._backend.Unsubscribe(b'topic', b'user'))
+    self.assertEquals((404, None), self._backend.GetMessage(b'topic', b'user'))
 
   def test_unsubscribe_invalid_subscription(self):
     """Verify that Unsubscribe returns 404 on invalid subscriptions."""
-    self.assertEquals(404, self._backend.Unsubscribe('topic', 'user'))
+    self.assertEquals(404, self._backend.Unsubscribe(b'topic', b'user'))
 
   def test_unsubscribe_removes_message_from_server(self):
     """Verify that a message will be removed if all subscribers unsubscribe."""
-    self._Subscribe('topic', 'user')
+    self._Subscribe(b'topic', b'user')
 
     self.assertEquals(0, self._TotalMessageCount())
-    self._PostMessage('topic', 'message')
+    self._PostMessage(b'topic', b'message')
     self.assertEquals(1, self._TotalMessageCount())
-    self.assertEquals(200, self._backend.Unsubscribe('topic', 'user'))
+    self.assertEquals(200, self._backend.Unsubscribe(b'topic', b'user'))
     self.assertEquals(0, self._TotalMessageCount())
 
   def test_dont_get_message_if_subscribe_after_post(self):
     """Verify you do not get a message if you subscribe after it is posted."""
-    self._PostMessage('topic', 'message1')
+    self._PostMessage(b'topic', b'message1')
     self.assertEquals(0, self._TotalMessageCount())
-    self._Subscribe('topic', 'user1')
-    self.assertEquals((204, None), self._backend.GetMessage('topic', 'user1'))
+    self._Subscribe(b'topic', b'user1')
+    self.assertEquals((204, None), self._backend.GetMessage(b'topic', b'user1'))
 
-    self._PostMessage('topic', 'message2')
-    self._Subscribe('topic', 'user2')
+    self._PostMessage(b'topic', b'message2')
+    self._Subscribe(b'topic', b'user2')
 
-    self.assertEquals((204, None), self._backend.GetMessage('topic', 'user2'))
+    self.assertEquals((204, None), self._backend.GetMessage(b'topic', b'user2'))
     self.assertEquals(1, self._TotalMessageCount())
-    self.assertEquals((200, 'message2'),
-                      self._backend.GetMessage('topic', 'user1'))
+    self.assertEquals((200, b'message2'),
+                      self._backend.GetMessage(b'topic', b'user1')[:2])
 
     self.assertEquals(0, self._TotalMessageCount())
 
   def test_do_not_receive_messages_from_previous_subscription(self):
     """Verify that messages do not persist across an unsubscribe cycle."""
-    self._Subscribe('topic', 'user1')
-    self._Subscribe('topic', 'user2')
-    self._PostMessage('topic', 'message')
-    self.assertEquals(200, self._backend.Unsubscribe('topic', 'user1'))
-    self._Subscribe('topic', 'user1')
-    self.assertEquals((204, None), self._backend.GetMessage('topic', 'user1'))
-    self.assertEquals((200, 'message'),
-                      self._backend.GetMessage('topic', 'user2'))
+    self._Subscribe(b'topic', b'user1')
+    self._Subscribe(b'topic', b'user2')
+    self._PostMessage(b'topic', b'message')
+    self.assertEquals(200, self._backend.Unsubscribe(b'topic', b'user1'))
+    self._Subscribe(b'topic', b'user1')
+    self.assertEquals((204, None), self._backend.GetMessage(b'topic', b'user1'))
+    self.assertEquals((200, b'message'),
+                      self._backend.GetMessage(b'topic', b'user2')[:2])
+
+
+  def test_snapshot_round_trip(self):
+    """Verify a snapshot restores subscribers and pending deliveries."""
+    self._Subscribe(b'topic', b'user1')
+    self._Subscribe(b'topic', b'user2')
+    self._PostMessage(b'topic', b'message1')
+    self._PostMessage(b'topic', CompressedBody(b'message2'))
+    self.assertEquals((200, b'message1'),
+                      self._backend.GetMessage(b'topic', b'user1')[:2])
+    self._Subscribe(b'empty', b'user3')
+    snapshot = BytesIO()
+    self._backend.WriteSnapshot(snapshot)
+
+    restored = MemoryBackend()
+    restored.Subscribe(b'gone', b'user')
+    self.assertEquals((2, 2), restored.LoadSnapshot(BytesIO(snapshot.getvalue())))
+    self.assertEquals((404, None), restored.GetMessage(b'gone', b'user'))
+    self.assertEquals((204, None), restored.GetMessage(b'empty', b'user3'))
+    status, body = restored.GetMessage(b'topic', b'user1')[:2]
+    self.assertEquals((200, b'message2'), (status, body))
+    self.assertIsInstance(body, CompressedBody)
+    self.assertEquals((200, b'message1'),
+                      restored.GetMessage(b'topic', b'user2')[:2])
+    self.assertEquals((200, b'message2'),
+                      restored.GetMessage(b'topic', b'user2')[:2])
+    self.assertEquals((204, None), restored.GetMessage(b'topic', b'user2'))
+
+  def test_snapshot_truncated(self):
+    """Verify a truncated snapshot is rejected and leaves state alone."""
+    self._Subscribe(b'topic', b'user')
+    self._PostMessage(b'topic', b'message')
+    snapshot = BytesIO()
+    self._backend.WriteSnapshot(snapshot)
+    self.assertRaises(ValueError, self._backend.LoadSnapshot,
+                      BytesIO(snapshot.getvalue()[:-1]))
+    self.assertRaises(ValueError, self._backend.LoadSnapshot, BytesIO(b'junk'))
+    self.assertEquals((200, b'message'),
+                      self._backend.GetMessage(b'topic', b'user')[:2])
+
+  def test_topic_version(self):
+    """Verify the version only moves when a message is stored."""
+    epoch, count = self._backend.TopicVersion(b'topic').split(b'-')
+    self.assertEquals(b'0', count)
+    self._PostMessage(b'topic', b'nobody listening')
+    self.assertEquals(b'%s-0' % epoch, self._backend.TopicVersion(b'topic'))
+    self._Subscribe(b'topic', b'user')
+    self._PostMessage(b'topic', b'message')
+    self.assertEquals(b'%s-1' % epoch, self._backend.TopicVersion(b'topic'))
+    self._backend.GetMessage(b'topic', b'user')
+    self.assertEquals(b'%s-1' % epoch, self._backend.TopicVersion(b'topic'))
+    self._backend.LoadSnapshot(BytesIO(b'PSQSNAP1\0\0\0\0'))
+    self.assertNotEqual(epoch, self._backend.TopicVersion(b'topic')[:8])
+
+  def test_pattern_subscriptions(self):
+    """Verify pattern subscribers get messages from every matching topic."""
+    self._Subscribe(b'orders.*', b'user')
+    self._PostMessage(b'orders.created', b'created')
+    self._PostMessage(b'orders.eu.created', b'nested')
+    self._PostMessage(b'orders.shipped', b'shipped')
+    self.assertEquals(400, self._backend.PostMessage(b'orders.*', b'x'))
+    self.assertEquals((200, b'created'),
+                      self._backend.GetMessage(b'orders.*', b'user')[:2])
+    self.assertEquals((200, b'shipped'),
+                      self._backend.GetMessage(b'orders.*', b'user')[:2])
+    self.assertEquals((204, None),
+                      self._backend.GetMessage(b'orders.*', b'user'))
+    self.assertEquals(200, self._backend.Unsubscribe(b'orders.*', b'user'))
+    self._PostMessage(b'orders.created', b'created')
+    self.assertEquals(0, self._TotalMessageCount())
+
+  def test_pattern_subscriptions_restored(self):
+    """Verify patterns keep matching after a snapshot is loaded."""
+    self._Subscribe(b'orders.#', b'user')
+    snapshot = BytesIO()
+    self._backend.WriteSnapshot(snapshot)
+    restored = MemoryBackend()
+    restored.LoadSnapshot(BytesIO(snapshot.getvalue()))
+    restored.PostMessage(b'orders', b'message')
+    self.assertEquals((200, b'message'),
+                      restored.GetMessage(b'orders.#', b'user')[:2])
+
+class BacklogTest(unittest.TestCase):
+  def setUp(self):
+    self._now = 1000.0
+    self._backend = MemoryBackend(clock=lambda: self._now)
+
+  def _Post(self, topic, body):
+    self.assertEqual(200, self._backend.PostMessage(topic, body))
+
+  def _Subscriber(self, backlog, user):
+    return next(e for e in backlog['subscribers'] if e['user'] == user)
+
+  def test_accounting_follows_deliveries(self):
+    """Verify totals and per subscriber lag as messages come and go."""
+    self._backend.Subscribe(b'topic', b'fast')
+    self._backend.Subscribe(b'topic', b'slow')
+    self._Post(b'topic', b'x' * 10)
+    self._now += 5
+    self._Post(b'topic', b'y' * 20)
+    self._backend.GetMessage(b'topic', b'fast')
+    self._now += 1
+    backlog = self._backend.Backlog()
+    self.assertEqual((2, 30), (backlog['messages'], backlog['bytes']))
+    self.assertEqual(
+        [{'topic': 'topic', 'messages': 2, 'bytes': 30, 'age': 6.0}],
+        backlog['topics'])
+    self.assertEqual({'topic': 'topic', 'user': 'slow', 'messages': 2,
+                      'bytes': 30, 'age': 6.0},
+                     self._Subscriber(backlog, 'slow'))
+    self.assertEqual((1, 20, 1.0), tuple(
+        self._Subscriber(backlog, 'fast')[k]
+        for k in ('messages', 'bytes', 'age')))
+
+    self._backend.GetMessage(b'topic', b'slow')
+    backlog = self._backend.Backlog()
+    self.assertEqual((1, 20), (backlog['messages'], backlog['bytes']))
+    self.assertEqual(1.0, self._Subscriber(backlog, 'slow')['age'])
+    self._backend.GetMessage(b'topic', b'slow')
+    self._backend.GetMessage(b'topic', b'fast')
+    backlog = self._backend.Backlog()
+    self.assertEqual((0, 0, [], []), (backlog['messages'], backlog['bytes'],
+                                      backlog['topics'],
+                                      backlog['subscribers']))
+
+  def test_order_and_limit(self):
+    """Verify the top subscribers are ranked by the requested order."""
+    for i, user in enumerate((b'a', b'b', b'c')):
+      self._backend.Subscribe(b'topic-%s' % user, user)
+      for _ in range(3 - i):
+        self._Post(b'topic-%s' % user, b'x' * (10 ** i))
+        self._now += 1
+    def Users(order):
+      return [e['user'] for e in self._backend.Backlog(order, 2)['subscribers']]
+    self.assertEqual(['c', 'b'], Users('bytes'))
+    self.assertEqual(['a', 'b'], Users('messages'))
+    self.assertEqual(['a', 'b'], Users('age'))
+
+  def test_unsubscribe_and_purge(self):
+    """Verify dropped messages leave the accounting."""
+    self._backend.Subscribe(b'topic', b'a')
+    self._backend.Subscribe(b'topic', b'b')
+    self._Post(b'topic', b'xx')
+    self._backend.GetMessage(b'topic', b'a')
+    self._Post(b'topic', b'yyy')
+    self.assertEqual(200, self._backend.Unsubscribe(b'topic', b'a'))
+    self.assertEqual((2, 5), (self._backend.Backlog()['messages'],
+                              self._backend.Backlog()['bytes']))
+    self.assertEqual(None, self._backend.Purge(b'topic', b'a'))
+    self.assertEqual(2, self._backend.Purge(b'topic', b'b'))
+    self.assertEqual(0, self._backend.Backlog()['bytes'])
+    self.assertEqual((204, None), self._backend.GetMessage(b'topic', b'b'))
+    self._Post(b'topic', b'z')
+    self.assertEqual(1, self._backend.Purge(b'topic'))
+    self.assertEqual((204, None), self._backend.GetMessage(b'topic', b'b'))
+
+  def test_snapshot_recounts(self):
+    """Verify a loaded snapshot is accounted, aged from the load."""
+    self._backend.Subscribe(b'topic', b'a')
+    self._backend.Subscribe(b'topic', b'b')
+    self._Post(b'topic', b'xx')
+    self._backend.GetMessage(b'topic', b'a')
+    f = BytesIO()
+    self._backend.WriteSnapshot(f)
+    f.seek(0)
+    self._now += 100
+    restored = MemoryBackend(clock=lambda: self._now)
+    restored.LoadSnapshot(f)
+    backlog = restored.Backlog()
+    self.assertEqual((1, 2), (backlog['messages'], backlog['bytes']))
+    self.assertEqual([('b', 0.0)], [(e['user'], e['age'])
+                                    for e in backlog['subscribers']])
+
+  def test_resource(self):
+    """Verify the admin endpoint reports, validates and purges."""
+    self._backend.Subscribe(b'topic', b'a')
+    self._Post(b'topic', b'xx')
+    resource = BacklogResource(self._backend)
+    request = DummyRequest([])
+    request.args = {b'order': [b'age']}
+    self.assertEqual(2, json.loads(resource.render_GET(request))['bytes'])
+    request = DummyRequest([])
+    request.args = {b'order': [b'size']}
+    resource.render_GET(request)
+    self.assertEqual(400, request.responseCode)
+    request = DummyRequest([])
+    request.args = {b'topic': [b'topic'], b'user': [b'nobody']}
+    resource.render_POST(request)
+    self.assertEqual(404, request.responseCode)
+    request = DummyRequest([])
+    request.args = {b'topic': [b'topic'], b'user': [b'a']}
+    self.assertEqual({'dropped': 1},
+                     json.loads(resource.render_POST(request)))
+
+class InboxTest(unittest.TestCase):
+  def setUp(self):
+    self._now = 1000.0
+    self._backend = MemoryBackend(clock=lambda: self._now)
+
+  def test_oldest_first_across_topics(self):
+    """Verify an inbox read takes the user's oldest messages first."""
+    for topic in (b'a', b'b', b'c'):
+      self._backend.Subscribe(topic, b'u')
+    self._backend.Subscribe(b'a', b'other')
+    for topic, body in ((b'b', b'1'), (b'a', b'2'), (b'b', b'3'),
+                        (b'c', b'4')):
+      self._now += 1
+      self._backend.PostMessage(topic, body)
+    self.assertEqual((200, [(b'b', b'1'), (b'a', b'2'), (b'b', b'3')], False),
+                     self._backend.GetMessages(b'u', 3))
+    self.assertEqual((200, [(b'c', b'4')], False),
+                     self._backend.GetMessages(b'u', 3))
+    self.assertEqual((204, [], False), self._backend.GetMessages(b'u', 3))
+    self.assertEqual((200, b'2'), self._backend.GetMessage(b'a', b'other')[:2])
+
+  def test_peek_then_commit(self):
+    """Verify a peek takes nothing, and commits take just what was read."""
+    for topic in (b'a', b'b'):
+      self._backend.Subscribe(topic, b'u')
+    for topic, body in ((b'b', b'1'), (b'a', b'2'), (b'b', b'3')):
+      self._now += 1
+      self._backend.PostMessage(topic, body)
+    status, messages, partial = self._backend.PeekMessages(b'u', 2)
+    self.assertEqual((200, [(b'b', b'1'), (b'a', b'2')], False),
+                     (status, [m[:2] for m in messages], partial))
+    self.assertEqual(messages, self._backend.PeekMessages(b'u', 2)[1])
+    for topic, _, seq in messages:
+      self._backend.Commit(topic, b'u', seq)
+    self.assertEqual((200, [(b'b', b'3')], False),
+                     self._backend.GetMessages(b'u', 10))
+    self.assertEqual((204, [], False), self._backend.PeekMessages(b'u', 2))
+    self.assertEqual((404, [], False), self._backend.PeekMessages(b'x', 2))
+
+  def test_index_follows_subscriptions(self):
+    """Verify only current subscriptions are read, including after a load."""
+    self.assertEqual((404, [], False), self._backend.GetMessages(b'u', 10))
+    self._backend.Subscribe(b'a', b'u')
+    self._backend.Subscribe(b'b', b'u')
+    self._backend.PostMessage(b'a', b'1')
+    self._backend.PostMessage(b'b', b'2')
+    self._backend.Unsubscribe(b'a', b'u')
+    f = BytesIO()
+    self._backend.WriteSnapshot(f)
+    f.seek(0)
+    restored = MemoryBackend()
+    restored.LoadSnapshot(f)
+    self.assertEqual((200, [(b'b', b'2')], False),
+                     restored.GetMessages(b'u', 10))
+    restored.Unsubscribe(b'b', b'u')
+    self.assertEqual((404, [], False), restored.GetMessages(b'u', 10))
+
+class PollHintTest(unittest.TestCase):
+  def test_rates(self):
+    """Verify hints carry the topic's publish rate and the poll rate."""
+    now = [1000.0]
+    backend = MemoryBackend(clock=lambda: now[0])
+    self.assertEqual((0.0, 0.0), backend.PollHint(b'topic'))
+    backend.Subscribe(b'topic', b'user')
+    for _ in range(100):
+      now[0] += 0.1
+      backend.PostMessage(b'topic', b'm')
+      backend.PostMessage(b'other', b'm')
+      backend.GetMessage(b'topic', b'user')
+    backend.GetMessages(b'user', 10)
+    topic_rate, poll_rate = backend.PollHint(b'topic')
+    self.assertTrue(9.5 < topic_rate < 10.5)
+    self.assertTrue(9.5 < poll_rate < 10.5)
+    self.assertEqual(topic_rate, backend.PollHint(b'other')[0])
+    now[0] += 10
+    self.assertTrue(backend.PollHint(b'topic')[0] < topic_rate / 3)
+    self.assertEqual(None, backend.PollHint(b'topic.#'))
+
+class ReadCommitTest(unittest.TestCase):
+  def setUp(self):
+    self._backend = MemoryBackend()
+    self._backend.Subscribe(b'topic', b'a')
+    self._backend.Subscribe(b'topic', b'b')
+    for i in range(5):
+      self._backend.PostMessage(b'topic', b'm%d' % i)
+
+  def test_read_does_not_take(self):
+    """Verify reads return ranges by seq, and leave messages pending."""
+    self.assertEqual((200, [(1, b'm0'), (2, b'm1')]),
+                     self._backend.Read(b'topic', b'a', 0, 2))
+    self.assertEqual((200, [(4, b'm3'), (5, b'm4')]),
+                     self._backend.Read(b'topic', b'a', 4, 10))
+    self.assertEqual((204, []), self._backend.Read(b'topic', b'a', 6, 10))
+    self.assertEqual((404, []), self._backend.Read(b'topic', b'c', 0, 10))
+    self.assertEqual((404, []), self._backend.Read(b'other', b'a', 0, 10))
+    self.assertEqual((200, b'm0', 1), self._backend.GetMessage(b'topic', b'a'))
+    self.assertEqual(10, self._backend.Backlog()['subscribers'][0]['bytes'])
+
+  def test_commit(self):
+    """Verify commits take messages up to a seq for one subscriber only."""
+    self.assertEqual(200, self._backend.Commit(b'topic', b'a', 3))
+    self.assertEqual((200, [(4, b'm3')]),
+                     self._backend.Read(b'topic', b'a', 0, 1))
+    self.assertEqual((200, b'm0', 1), self._backend.GetMessage(b'topic', b'b'))
+    # Committing again, or less, changes nothing.
+    self.assertEqual(200, self._backend.Commit(b'topic', b'a', 2))
+    self.assertEqual(200, self._backend.Commit(b'topic', b'b', 3))
+    topic = self._backend._topics[b'topic']
+    self.assertEqual([4, 5], [m.seq for m in topic.messages])
+    self.assertEqual(200, self._backend.Commit(b'topic', b'a', 100))
+    self.assertEqual((204, None), self._backend.GetMessage(b'topic', b'a'))
+    self.assertEqual((200, b'm3', 4), self._backend.GetMessage(b'topic', b'b'))
+    self.assertEqual(404, self._backend.Commit(b'topic', b'c', 1))
+    backlog = self._backend.Backlog()
+    self.assertEqual((1, 2), (backlog['messages'], backlog['bytes']))
+
+  def test_resubscribed(self):
+    """Verify seqs keep going up, and dropped messages are not read."""
+    self._backend.Unsubscribe(b'topic', b'a')
+    self._backend.Subscribe(b'topic', b'a')
+    self._backend.PostMessage(b'topic', b'new')
+    self.assertEqual((200, [(6, b'new')]),
+                     self._backend.Read(b'topic', b'a', 0, 10))
+    self.assertEqual(200, self._backend.Commit(b'topic', b'a', 6))
+    self.assertEqual((200, b'm0', 1), self._backend.GetMessage(b'topic', b'b'))
+
+  def test_snapshot_keeps_seqs(self):
+    """Verify seqs and versions survive a snapshot."""
+    self._backend.Commit(b'topic', b'a', 2)
+    self._backend.Commit(b'topic', b'b', 2)
+    snapshot = BytesIO()
+    self._backend.WriteSnapshot(snapshot)
+    snapshot.seek(0)
+    restored = MemoryBackend()
+    self.assertEqual((1, 3), restored.LoadSnapshot(snapshot))
+    self.assertEqual((200, [(3, b'm2'), (4, b'm3')]),
+                     restored.Read(b'topic', b'a', 0, 2))
+    self.assertTrue(restored.TopicVersion(b'topic').endswith(b'-5'))
+    restored.PostMessage(b'topic', b'm5')
+    self.assertEqual((200, [(6, b'm5')]), restored.Read(b'topic', b'b', 6, 1))
+
+  def test_version_1_snapshot(self):
+    """Verify messages of a version 1 snapshot are numbered from 1."""
+    snapshot = (b'PSQSNAP1\x01\0\0\0\x05\0\0\0topic\x01\0\0\0\x01\0\0\0a'
+                b'\x02\0\0\0\x02\x02\0\0\0m1\x02\x02\0\0\0m2')
+    self.assertEqual((1, 2), self._backend.LoadSnapshot(BytesIO(snapshot)))
+    self.assertEqual((200, [(1, b'm1'), (2, b'm2')]),
+                     self._backend.Read(b'topic', b'a', 0, 10))
+
+class SlicedMaintenanceTest(unittest.TestCase):
+  """Runs the backend's maintenance a step at a time, between requests."""
+
+  def setUp(self):
+    self.patch(memory, '_CHUNK', 2)
+    self._clock = Clock()
+    self._maintenance = Maintenance(budget=0)
+    self._backend = MemoryBackend(clock=self._clock.seconds,
+                                  maintenance=self._maintenance,
+                                  retention=100, reap_interval=10)
+    self._maintenance.Start(self._clock)
+
+  def _Step(self):
+    """Runs the next step of maintenance."""
+    call = self._clock.calls.pop(0)
+    self.assertEqual(self._clock.seconds(), call.getTime())
+    call.func(*call.args, **call.kw)
+
+  def _Finish(self):
+    self._clock.advance(0)
+    self.assertEqual(0, self._maintenance.Stats()['running'])
+
+  def _Post(self, count, prefix=b'm'):
+    for i in range(count):
+      self.assertEqual(200, self._backend.PostMessage(b'topic',
+                                                      prefix + b'%d' % i))
+
+  def test_unsubscribe(self):
+    """Verify an unsubscribe takes effect at once and is cleaned up later."""
+    self._backend.Subscribe(b'topic', b'a')
+    self._backend.Subscribe(b'topic', b'b')
+    self._Post(6)
+    self.assertEqual(200, self._backend.Unsubscribe(b'topic', b'a'))
+    self.assertEqual(1, self._maintenance.Stats()['running'])
+    self._Step()
+    self.assertEqual((200, b'm0'), self._backend.GetMessage(b'topic', b'b')[:2])
+    self.assertEqual((200, b'm1'), self._backend.GetMessage(b'topic', b'b')[:2])
+    self._backend.Subscribe(b'topic', b'a')
+    self._Post(1, b'new')
+    self.assertEqual((200, b'new0'),
+                     self._backend.GetMessage(b'topic', b'a')[:2])
+    self.assertEqual((204, None), self._backend.GetMessage(b'topic', b'a'))
+    self._Finish()
+
+    topic = self._backend._topics[b'topic']
+    self.assertEqual(({}, 0), (topic.dropping, topic.tombstones))
+    self.assertEqual([set([b'b'])] * 5, [m.subs for m in topic.messages])
+    backlog = self._backend.Backlog()
+    self.assertEqual((5, 12), (backlog['messages'], backlog['bytes']))
+    for i in range(2, 6):
+      self.assertEqual((200, b'm%d' % i),
+                       self._backend.GetMessage(b'topic', b'b')[:2])
+
+  def test_purge_and_reap(self):
+    """Verify a purge is accounted at once, and idle topics are reaped."""
+    self._backend.Subscribe(b'topic', b'a')
+    self._Post(5)
+    self.assertEqual(5, self._backend.Purge(b'topic'))
+    self.assertEqual(0, self._backend.Backlog()['messages'])
+    self.assertEqual((204, None), self._backend.GetMessage(b'topic', b'a'))
+    version = self._backend.TopicVersion(b'topic')
+    self._Finish()
+
+    self._clock.advance(10)
+    self.assertIn(b'topic', self._backend._topics)
+    self._backend.Unsubscribe(b'topic', b'a')
+    self._clock.advance(10)
+    self.assertNotIn(b'topic', self._backend._topics)
+    # A topic made again does not repeat versions polls may have cached.
+    self._backend.Subscribe(b'topic', b'a')
+    self.assertEqual(version, self._backend.TopicVersion(b'topic'))
+
+  def test_retention(self):
+    """Verify messages pending for longer than the retention are dropped."""
+    self._backend.Subscribe(b'topic', b'a')
+    self._backend.Subscribe(b'topic', b'b')
+    self._Post(5, b'old')
+    self._clock.advance(50)
+    self._Post(1, b'new')
+    self._backend.GetMessage(b'topic', b'a')
+    self._clock.advance(60)
+    self._Finish()
+    self.assertEqual((200, b'new0'),
+                     self._backend.GetMessage(b'topic', b'a')[:2])
+    backlog = self._backend.Backlog('age')
+    self.assertEqual((1, 4), (backlog['messages'], backlog['bytes']))
+    # Ages after an expiry are bounded by the cutoff, at 110 - 100.
+    self.assertEqual([('b', 1, 100.0)], [
+        (e['user'], e['messages'], e['age']) for e in backlog['subscribers']])
+
+  def test_snapshot_during_cleanup(self):
+    """Verify a snapshot leaves out what is yet to be cleaned up."""
+    self._backend.Subscribe(b'topic', b'a')
+    self._backend.Subscribe(b'topic', b'b')
+    self._Post(4)
+    self._backend.Unsubscribe(b'topic', b'a')
+    self._Step()
+    self._backend.GetMessage(b'topic', b'b')
+    f = BytesIO()
+    self._backend.WriteSnapshot(f)
+    f.seek(0)
+    restored = MemoryBackend()
+    self.assertEqual((1, 3), restored.LoadSnapshot(f))
+    self.assertEqual(3, restored.Backlog()['messages'])
+    self.assertEqual((404, None), restored.GetMessage(b'topic', b'a'))
+    self.assertEqual((200, b'm1'), restored.GetMessage(b'topic', b'b')[:2])
+
+  def test_commit_during_cleanup(self):
+    """Verify commits leave tombstones for a running job to remove."""
+    self._backend.Subscribe(b'topic', b'a')
+    self._backend.Subscribe(b'topic', b'b')
+    self._Post(6)
+    self._backend.Unsubscribe(b'topic', b'a')
+    self._Step()
+    self.assertEqual(200, self._backend.Commit(b'topic', b'b', 4))
+    topic = self._backend._topics[b'topic']
+    self.assertEqual(6, len(topic.messages))
+    self.assertEqual((200, [(5, b'm4'), (6, b'm5')]),
+                     self._backend.Read(b'topic', b'b', 0, 10))
+    self.assertEqual([2], [e['messages'] for e in
+                           self._backend.Backlog()['subscribers']])
+    self._Finish()
+    self.assertEqual([5, 6], [m.seq for m in topic.messages])
+    self.assertEqual((200, b'm4', 5), self._backend.GetMessage(b'topic', b'b'))
 
+class IdempotentPostTest(unittest.TestCase):
+  def test_duplicate_not_stored(self):
+    """Verify a repeated key is acknowledged without storing the message."""
+    backend = MemoryBackend()
+    backend.Subscribe(b'topic', b'user')
+    self.assertEqual(200, backend.PostMessage(b'topic', b'm', b'key'))
+    self.assertEqual(200, backend.PostMessage(b'topic', b'm', b'key'))
+    self.assertEqual(200, backend.PostMessage(b'topic', b'm'))
+    self.assertEqual(400, backend.PostMessage(b'a.*', b'm', b'key'))
+    self.assertEqual(2, backend.Backlog()['messages'])
+    self.assertTrue(backend.TopicVersion(b'topic').endswith(b'-2'))
+    self.assertIn(b'dedup', backend.AdminResources())
@@ -1,9 +1,17 @@
+import sketches
+import tracing
+
 from backends import proxy
+from compression import CompressedBody
+from inbox import EncodeInbox
+from offsets import EncodeRange
+from pollcache import PollCache
 
 from mock import patch
 
 from twisted.trial import unittest
 from twisted.internet.defer import succeed
+from twisted.web.http_headers import Headers
 
 class ProxyBackendTest(unittest.TestCase):
   @patch('backends.proxy.Server')
@@ -14,21 +22,98 @@ class ProxyBackendTest(unittest.TestCase):
 
   def test_get_message(self):
     """Verify GetMessage forwards to the correct endpoint."""
-    self._mock_server.GET.return_value = succeed((200, 'body'))
-    d = self._proxy.GetMessage('topic', 'user')
-    self._mock_server.GET.assert_called_with('/topic/user')
+    self._mock_server.GET.return_value = succeed(
+        (200, b'body', Headers({b'X-Message-Seq': [b'7']})))
+    d = self._proxy.GetMessage(b'topic', b'user')
+    self._mock_server.GET.assert_called_with(
+        b'/topic/user', headers={b'Accept-Encoding': [b'gzip']},
+        with_headers=True)
 
     def VerifyResult(arg):
-      self.assertEqual(arg, (200, 'body'))
+      self.assertEqual(arg, (200, b'body', 7))
+    d.addCallback(VerifyResult)
+
+    return d
+
+  def test_poll_hint(self):
+    """Verify the latest poll hint of each topic is kept."""
+    self.assertEqual(None, self._proxy.PollHint(b'topic'))
+    for rate in (b'2.000', b'3.500', b'bad'):
+      self._mock_server.GET.return_value = succeed(
+          (204, b'', Headers({b'X-Topic-Rate': [rate],
+                              b'X-Backend-Poll-Rate': [b'100.000']})))
+      self._proxy.GetMessage(b'topic', b'user')
+    self.assertEqual((3.5, 100.0), self._proxy.PollHint(b'topic', b'user'))
+
+  def test_poll_hints_bounded(self):
+    """Verify only the most recently polled topics' hints are kept."""
+    self._proxy = proxy.ProxyBackend('cat', max_hints=2)
+    self._proxy._server = self._mock_server
+    self._mock_server.GET.side_effect = lambda *args, **kwargs: succeed(
+        (204, b'', Headers({b'X-Topic-Rate': [b'1'],
+                            b'X-Backend-Poll-Rate': [b'1']})))
+    for topic in (b'a', b'b', b'a', b'c'):
+      self._proxy.GetMessage(topic, b'user')
+    self.assertEqual([None, (1.0, 1.0), (1.0, 1.0)],
+                     [self._proxy.PollHint(t) for t in (b'b', b'a', b'c')])
+
+  def test_read(self):
+    """Verify Read asks for a range, keeping bodies compressed."""
+    self._mock_server.GET.return_value = succeed(
+        (200, EncodeRange([(3, b'a'), (5, CompressedBody(b'zip'))], 6)))
+    d = self._proxy.Read(b'topic', b'user', 2, 10)
+    self._mock_server.GET.assert_called_with(
+        b'/topic/user?offset=2&limit=10',
+        headers={b'Accept-Encoding': [b'gzip']})
+
+    def VerifyResult(result):
+      self.assertEqual((200, [(3, b'a'), (5, b'zip')]), result)
+      self.assertIsInstance(result[1][1][1], CompressedBody)
     d.addCallback(VerifyResult)
+    return d
+
+  def test_commit(self):
+    """Verify Commit posts the seq."""
+    self._mock_server.POST.return_value = succeed((200, b''))
+    d = self._proxy.Commit(b'topic', b'user', 5)
+    self._mock_server.POST.assert_called_with(b'/topic/user?commit=5',
+                                              headers=None)
+    d.addCallback(self.assertEqual, 200)
+    return d
+
+  def test_get_messages(self):
+    """Verify GetMessages reads the inbox, keeping bodies compressed."""
+    inbox = EncodeInbox([(b'a', b'body'), (b'b', CompressedBody(b'zip'))],
+                        False)
+    self._mock_server.GET.return_value = succeed((200, inbox))
+    d = self._proxy.GetMessages(b'user', 10)
+    self._mock_server.GET.assert_called_with(
+        b'/user?limit=10', headers={b'Accept-Encoding': [b'gzip']})
 
+    def VerifyResult(result):
+      status, messages, partial = result
+      self.assertEqual((200, [(b'a', b'body'), (b'b', b'zip')], False),
+                       (status, messages, partial))
+      self.assertIsInstance(messages[1][1], CompressedBody)
+    d.addCallback(VerifyResult)
+    return d
+
+  def test_peek_messages(self):
+    """Verify PeekMessages asks for a peek, and keeps the seqs."""
+    inbox = EncodeInbox([(b'a', b'body', 4)], False)
+    self._mock_server.GET.return_value = succeed((200, inbox))
+    d = self._proxy.PeekMessages(b'user', 10)
+    self._mock_server.GET.assert_called_with(
+        b'/user?limit=10&peek=1', headers={b'Accept-Encoding': [b'gzip']})
+    d.addCallback(self.assertEqual, (200, [(b'a', b'body', 4)], False))
     return d
 
   def test_post_message(self):
     """Verify PostMessage forwards to the correct endpoint."""
-    self._mock_server.POST.return_value = succeed((200, ''))
-    d = self._proxy.PostMessage('topic', 'message')
-    self._mock_server.POST.assert_called_with('/topic', body='message')
+    self._mock_server.POST.return_value = succeed((200, b''))
+    d = self._proxy.PostMessage(b'topic', b'message')
+    self._mock_server.POST.assert_called_with(b'/topic', body=b'message',
+                                              headers=None, with_headers=False)
 
     def VerifyResult(arg):
       self.assertEqual(arg, 200)
@@ -36,11 +121,45 @@ class ProxyBackendTest(unittest.TestCase):
 
     return d
 
+  def test_post_compressed_message(self):
+    """Verify compressed bodies are forwarded with their encoding."""
+    self._mock_server.POST.return_value = succeed((200, b''))
+    d = self._proxy.PostMessage(b'topic', CompressedBody(b'zipped'))
+    self._mock_server.POST.assert_called_with(
+        b'/topic', body=b'zipped', headers={b'Content-Encoding': [b'gzip']},
+        with_headers=False)
+    d.addCallback(self.assertEqual, 200)
+    return d
+
+  def test_post_idempotent_message(self):
+    """Verify the idempotency key is forwarded as a header."""
+    self._mock_server.POST.return_value = succeed((200, b''))
+    d = self._proxy.PostMessage(b'topic', b'message', b'key')
+    self._mock_server.POST.assert_called_with(
+        b'/topic', body=b'message', headers={b'Idempotency-Key': [b'key']},
+        with_headers=False)
+    d.addCallback(self.assertEqual, 200)
+    return d
+
+  def test_post_forwards_publisher(self):
+    """Verify the current publisher is forwarded as X-Forwarded-For."""
+    self._mock_server.POST.return_value = succeed((200, b''))
+    token = sketches.ActivatePublisher(b'10.0.0.9')
+    try:
+      d = self._proxy.PostMessage(b'topic', b'message')
+    finally:
+      sketches.DeactivatePublisher(token)
+    self._mock_server.POST.assert_called_with(
+        b'/topic', body=b'message',
+        headers={b'X-Forwarded-For': [b'10.0.0.9']}, with_headers=False)
+    d.addCallback(self.assertEqual, 200)
+    return d
+
   def test_subscribe(self):
     """Verify Subscribe forwards to the correct endpoint."""
-    self._mock_server.POST.return_value = succeed((200, ''))
-    d = self._proxy.Subscribe('topic', 'user')
-    self._mock_server.POST.assert_called_with('/topic/user')
+    self._mock_server.POST.return_value = succeed((200, b''))
+    d = self._proxy.Subscribe(b'topic', b'user')
+    self._mock_server.POST.assert_called_with(b'/topic/user', headers=None)
 
     def VerifyResult(arg):
       self.assertEqual(arg, 200)
@@ -50,12 +169,76 @@ class ProxyBackendTest(unittest.TestCase):
 
   def test_unsubscribe(self):
     """Verify Unsubscribe forwards to the correct endpoint."""
-    self._mock_server.DELETE.return_value = succeed((200, ''))
-    d = self._proxy.Unsubscribe('topic', 'user')
-    self._mock_server.DELETE.assert_called_with('/topic/user')
+    self._mock_server.DELETE.return_value = succeed((200, b''))
+    d = self._proxy.Unsubscribe(b'topic', b'user')
+    self._mock_server.DELETE.assert_called_with(b'/topic/user', headers=None)
 
     def VerifyResult(arg):
       self.assertEqual(arg, 200)
     d.addCallback(VerifyResult)
 
     return d
+
+  def test_trace_propagated(self):
+    """Verify the current trace is forwarded in a header and spanned."""
+    tracer = tracing.Configure()
+    self.addCleanup(tracing.Configure)
+    self._mock_server.GET.return_value = succeed((200, b'body', Headers()))
+    token = tracing.Activate('trace')
+    try:
+      d = self._proxy.GetMessage(b'topic', b'user')
+    finally:
+      tracing.Deactivate(token)
+    self._mock_server.GET.assert_called_with(
+        b'/topic/user', headers={tracing.TRACE_HEADER: [b'trace'],
+                                 b'Accept-Encoding': [b'gzip']},
+        with_headers=True)
+    self.assertEqual(['proxy.GetMessage'],
+                     [s['name'] for s in tracer.Spans('trace')])
+    return d
+
+def _VersionHeaders(version):
+  return Headers({b'X-Topic-Version': [version]})
+
+class PollCachedProxyBackendTest(unittest.TestCase):
+  @patch('backends.proxy.Server')
+  def setUp(self, mock_server):
+    self._cache = PollCache(ttl=10)
+    self._proxy = proxy.ProxyBackend('cat', poll_cache=self._cache)
+    self._mock_server = mock_server.return_value
+
+  def _Poll(self, status, version):
+    self._mock_server.GET.reset_mock()
+    self._mock_server.GET.return_value = succeed(
+        (status, b'', _VersionHeaders(version)))
+    results = []
+    self._proxy.GetMessage(b'topic', b'user').addCallback(results.append)
+    return results[0], self._mock_server.GET.called
+
+  def test_empty_poll_cached(self):
+    """Verify a 204 is answered locally until the topic version moves."""
+    self.assertEqual(((204, b''), True), self._Poll(204, b'e-1'))
+    self.assertEqual(((204, None), False), self._Poll(204, b'e-1'))
+    self._mock_server.POST.return_value = succeed(
+        (200, b'', _VersionHeaders(b'e-2')))
+    self._proxy.PostMessage(b'topic', b'message')
+    self.assertEqual(((200, b''), True), self._Poll(200, b'e-2'))
+    self.assertEqual(1, self._cache.Stats()['hits'])
+
+  def test_subscription_change_forgets(self):
+    """Verify unsubscribing drops the cached 204."""
+    self._Poll(204, b'e-1')
+    self._mock_server.DELETE.return_value = succeed((200, b''))
+    self._proxy.Unsubscribe(b'topic', b'user')
+    self.assertEqual(((404, b''), True), self._Poll(404, b'e-1'))
+
+  def test_pattern_polls_not_cached(self):
+    """Verify polls of patterns always reach the backend, escaped."""
+    # A fresh deferred per call, as each adds its callbacks.
+    self._mock_server.GET.side_effect = lambda *args, **kwargs: succeed(
+        (204, b'', _VersionHeaders(b'e-1')))
+    self._proxy.GetMessage(b'orders.#', b'user')
+    self._proxy.GetMessage(b'orders.#', b'user')
+    self.assertEqual(2, self._mock_server.GET.call_count)
+    self.assertEqual(b'/orders.%23/user',
+                     self._mock_server.GET.call_args[0][0])
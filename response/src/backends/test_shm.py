@@ -0,0 +1,201 @@
+import os
+import tempfile
+
+from backends import shm
+from backends.memory import MemoryBackend
+from compression import CompressedBody
+from pollcache import PollCache
+
+from twisted.trial import unittest
+from twisted.internet import reactor
+from twisted.internet.defer import gatherResults
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.task import deferLater
+
+class RingTest(unittest.TestCase):
+  def setUp(self):
+    self._ring = shm._Ring(bytearray(shm._RING_HEADER + 32), 0, 32)
+
+  def test_records_wrap(self):
+    """Verify records come out in order, including across the end."""
+    for i in range(20):
+      record = b'%02d-record' % i
+      self.assertTrue(self._ring.Write(record))
+      self.assertEqual(record, self._ring.Read())
+    self.assertEqual(None, self._ring.Read())
+
+  def test_full(self):
+    """Verify a full ring refuses records until it is read."""
+    self.assertTrue(self._ring.Write(b'x' * 12))
+    self.assertTrue(self._ring.Write(b'y' * 12))
+    self.assertFalse(self._ring.Write(b'z'))
+    self.assertEqual(b'x' * 12, self._ring.Read())
+    self.assertTrue(self._ring.Write(b'z'))
+    self.assertEqual([b'y' * 12, b'z'], [self._ring.Read(), self._ring.Read()])
+
+class ShmBackendTest(unittest.TestCase):
+  """Runs requests through real rings and a real Unix socket."""
+
+  def setUp(self):
+    self._dir = tempfile.mkdtemp()
+    path = os.path.join(self._dir, 'backend.sock')
+    self._memory = MemoryBackend()
+    # Small rings so that large bodies are fragmented and fill them.
+    self._listener = shm.ShmListener(self._memory, path, ring_size=4096)
+    self._listener.Start(reactor)
+    self._cache = PollCache()
+    self._backend = shm.ShmBackend(path, self._cache, ring_size=4096)
+
+  @inlineCallbacks
+  def tearDown(self):
+    channel = self._backend._server._channel
+    if channel is not None:
+      channel.transport.loseConnection()
+    if self._listener._port is not None:
+      yield self._listener._port.stopListening()
+    yield deferLater(reactor, 0.01, lambda: None)
+    os.rmdir(self._dir)
+
+  @inlineCallbacks
+  def test_round_trip(self):
+    """Verify the PubSub calls, with statuses, bodies and patterns."""
+    self.assertEqual((404, b''),
+                     (yield self._backend.GetMessage(b'topic', b'user')))
+    self.assertEqual(200, (yield self._backend.Subscribe(b'topic', b'user')))
+    self.assertEqual(200, (yield self._backend.Subscribe(b'a.#', b'user')))
+    self.assertEqual(200, (yield self._backend.PostMessage(b'topic', b'm1')))
+    self.assertEqual(200, (yield self._backend.PostMessage(b'a.b', b'm2')))
+    self.assertEqual((200, b'm1', 1),
+                     (yield self._backend.GetMessage(b'topic', b'user')))
+    self.assertEqual((200, b'm2', 1),
+                     (yield self._backend.GetMessage(b'a.#', b'user')))
+    self.assertEqual(200, (yield self._backend.Unsubscribe(b'topic', b'user')))
+    self.assertEqual(404, (yield self._backend.Unsubscribe(b'topic', b'user')))
+    self.assertFalse(os.path.exists(self._backend._server._channel.ring_path))
+
+  @inlineCallbacks
+  def test_inbox(self):
+    """Verify inbox reads, with compressed bodies kept compressed."""
+    self.assertEqual((404, [], False),
+                     (yield self._backend.GetMessages(b'user', 10)))
+    yield self._backend.Subscribe(b'a', b'user')
+    yield self._backend.Subscribe(b'b', b'user')
+    yield self._backend.PostMessage(b'a', b'm1')
+    yield self._backend.PostMessage(b'b', CompressedBody(b'm2'))
+    self.assertEqual((200, [(b'a', b'm1', 1)], False),
+                     (yield self._backend.PeekMessages(b'user', 1)))
+    status, messages, partial = yield self._backend.GetMessages(b'user', 10)
+    self.assertEqual((200, [(b'a', b'm1'), (b'b', b'm2')], False),
+                     (status, messages, partial))
+    self.assertIsInstance(messages[1][1], CompressedBody)
+    self.assertEqual((204, [], False),
+                     (yield self._backend.GetMessages(b'user', 10)))
+
+  @inlineCallbacks
+  def test_large_and_compressed_bodies(self):
+    """Verify bodies bigger than a ring arrive whole, compressed or not."""
+    yield self._backend.Subscribe(b'topic', b'user')
+    big = os.urandom(50000)
+    yield self._backend.PostMessage(b'topic', big)
+    yield self._backend.PostMessage(b'topic', CompressedBody(b'zipped'))
+    self.assertEqual((200, big, 1),
+                     (yield self._backend.GetMessage(b'topic', b'user')))
+    status, body, _ = yield self._backend.GetMessage(b'topic', b'user')
+    self.assertIsInstance(body, CompressedBody)
+    self.assertEqual(b'zipped', body)
+    self.assertTrue(self._backend._server._channel.stats['ring_full'])
+
+  @inlineCallbacks
+  def test_concurrent_requests(self):
+    """Verify pipelined requests are matched with their own responses."""
+    users = [b'user-%d' % i for i in range(50)]
+    yield gatherResults([self._backend.Subscribe(b'topic', u) for u in users])
+    yield self._backend.PostMessage(b'topic', b'hello')
+    results = yield gatherResults(
+        [self._backend.GetMessage(b'topic', u) for u in users] +
+        [self._backend.GetMessage(b'other', u) for u in users])
+    self.assertEqual([(200, b'hello')] * 50 + [(404, None)] * 50,
+                     [(r[0], r[1] or None) for r in results])
+
+  @inlineCallbacks
+  def test_read_and_commit(self):
+    """Verify offset reads and commits, with compressed bodies kept."""
+    self.assertEqual((404, []),
+                     (yield self._backend.Read(b'topic', b'user', 0, 10)))
+    yield self._backend.Subscribe(b'topic', b'user')
+    yield self._backend.PostMessage(b'topic', b'm1')
+    yield self._backend.PostMessage(b'topic', CompressedBody(b'm2'))
+    status, messages = yield self._backend.Read(b'topic', b'user', 0, 10)
+    self.assertEqual((200, [(1, b'm1'), (2, b'm2')]), (status, messages))
+    self.assertIsInstance(messages[1][1], CompressedBody)
+    self.assertEqual(200, (yield self._backend.Commit(b'topic', b'user', 1)))
+    self.assertEqual((200, [(2, b'm2')]),
+                     (yield self._backend.Read(b'topic', b'user', 0, 10)))
+    self.assertEqual((204, []),
+                     (yield self._backend.Read(b'topic', b'user', 3, 10)))
+
+  @inlineCallbacks
+  def test_backend_failure(self):
+    """Verify a failing backend call gets a 500 instead of no response."""
+    def Fail(*args):
+      raise RuntimeError('backend failed')
+    self._memory.Subscribe = Fail
+    self.assertEqual(500, (yield self._backend.Subscribe(b'topic', b'user')))
+    self.assertEqual({}, self._backend._server._channel._waiting)
+    self.assertEqual(1, self._listener.Stats()['errors'])
+    # A 200 read without messages, which MemoryBackend never returns.
+    self._memory.Read = lambda *args: (200, [])
+    self.assertEqual((200, []),
+                     (yield self._backend.Read(b'topic', b'user', 0, 10)))
+
+  @inlineCallbacks
+  def test_idempotency_key(self):
+    """Verify idempotency keys reach the backend."""
+    yield self._backend.Subscribe(b'topic', b'user')
+    for _ in range(2):
+      self.assertEqual(200, (yield self._backend.PostMessage(
+          b'topic', b'm', b'key')))
+    self.assertEqual(1, self._memory.Backlog()['messages'])
+
+  @inlineCallbacks
+  def test_poll_cache(self):
+    """Verify topic versions come back so empty polls can be cached."""
+    yield self._backend.Subscribe(b'topic', b'user')
+    status, _ = yield self._backend.GetMessage(b'topic', b'user')
+    self.assertEqual(204, status)
+    self.assertTrue(self._cache.Lookup(b'topic', b'user'))
+    yield self._backend.PostMessage(b'topic', b'm')
+    self.assertFalse(self._cache.Lookup(b'topic', b'user'))
+
+  @inlineCallbacks
+  def test_poll_hint(self):
+    """Verify polls bring back the backend's poll hint."""
+    yield self._backend.Subscribe(b'topic', b'user')
+    yield self._backend.PostMessage(b'topic', b'm')
+    yield self._backend.GetMessage(b'topic', b'user')
+    topic_rate, poll_rate = self._backend.PollHint(b'topic')
+    self.assertAlmostEqual(self._memory.PollHint(b'topic')[0], topic_rate,
+                           places=2)
+    self.assertTrue(poll_rate > 0)
+
+  @inlineCallbacks
+  def test_reconnects(self):
+    """Verify requests fail when the connection drops, then reconnect."""
+    yield self._backend.Subscribe(b'topic', b'user')
+    channel = self._backend._server._channel
+    channel.transport.loseConnection()
+    yield deferLater(reactor, 0.01, lambda: None)
+    self.assertEqual(None, self._backend._server._channel)
+    self.assertFalse(os.path.exists(channel.ring_path))
+    self.assertEqual(200, (yield self._backend.Subscribe(b'topic', b'other')))
+    self.assertEqual(2, self._listener.Stats()['connections'])
+
+  @inlineCallbacks
+  def test_stop(self):
+    """Verify Stop disconnects ShmBackends and releases the socket path."""
+    yield self._backend.Subscribe(b'topic', b'user')
+    self._listener.Stop()
+    yield deferLater(reactor, 0.01, lambda: None)
+    self.assertEqual(None, self._backend._server._channel)
+    self.assertEqual(set(), self._listener.channels)
+    self.assertFalse(os.path.exists(self._listener._path))
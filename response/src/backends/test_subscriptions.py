@@ -0,0 +1,93 @@
+import os
+
+from io import BytesIO
+
+from backends.memory import MemoryBackend
+from backends.subscriptions import SubscriptionStore
+
+from twisted.trial import unittest
+
+class SubscriptionStoreTest(unittest.TestCase):
+  def setUp(self):
+    self._path = os.path.abspath(self.mktemp())
+    self._store = self._Open()
+
+  def _Open(self):
+    store = SubscriptionStore(self._path, max_delay=0)
+    self.addCleanup(store.Close)
+    return store
+
+  def test_changes_written_behind(self):
+    """Verify queued changes reach the database and reload."""
+    self._store.Add(b'topic', b'user1')
+    self._store.Add(b'topic', b'user2')
+    self._store.Add(b'other', b'user1')
+    self._store.Remove(b'topic', b'user2')
+    self._store.Flush()
+    self.assertEqual({b'topic': set([b'user1']), b'other': set([b'user1'])},
+                     self._Open().Load())
+    stats = self._store.Stats()
+    self.assertEqual(4, stats['queued'])
+    self.assertEqual(0, stats['pending'])
+    self.assertEqual(0, stats['failures'])
+
+  def test_batch_coalesces(self):
+    """Verify only the last change to a subscription in a batch is written."""
+    store = SubscriptionStore(self._path, max_delay=0.2)
+    self.addCleanup(store.Close)
+    store.Add(b'topic', b'user')
+    store.Remove(b'topic', b'user')
+    store.Add(b'topic', b'user')
+    store.Flush()
+    stats = store.Stats()
+    self.assertEqual(1, stats['batches'])
+    self.assertEqual(1, stats['written'])
+    self.assertEqual(2, stats['coalesced'])
+    self.assertEqual({b'topic': set([b'user'])}, store.Load())
+
+  def test_close_flushes(self):
+    """Verify Close writes what is still queued."""
+    self._store.Add(b'topic', b'user')
+    self._store.Close()
+    self.assertEqual({b'topic': set([b'user'])}, self._Open().Load())
+
+class DurableMemoryBackendTest(unittest.TestCase):
+  def setUp(self):
+    self._path = os.path.abspath(self.mktemp())
+
+  def _Restart(self):
+    store = SubscriptionStore(self._path, max_delay=0)
+    self.addCleanup(store.Close)
+    return MemoryBackend(store), store
+
+  def test_subscriptions_survive_restart(self):
+    """Verify subscriptions, but not messages, are reloaded."""
+    backend, store = self._Restart()
+    backend.Subscribe(b'topic', b'user1')
+    backend.Subscribe(b'topic', b'user2')
+    backend.PostMessage(b'topic', b'message')
+    self.assertEqual(200, backend.Unsubscribe(b'topic', b'user2'))
+    store.Flush()
+
+    backend, _ = self._Restart()
+    self.assertEqual((204, None), backend.GetMessage(b'topic', b'user1'))
+    self.assertEqual((404, None), backend.GetMessage(b'topic', b'user2'))
+
+  def test_store_overrides_snapshot(self):
+    """Verify subscriptions changed since a snapshot win on restore."""
+    backend, store = self._Restart()
+    backend.Subscribe(b'topic', b'user1')
+    backend.Subscribe(b'topic', b'user2')
+    backend.PostMessage(b'topic', b'message')
+    snapshot = BytesIO()
+    backend.WriteSnapshot(snapshot)
+    backend.Unsubscribe(b'topic', b'user2')
+    backend.Subscribe(b'topic', b'user3')
+    store.Flush()
+
+    backend, _ = self._Restart()
+    backend.LoadSnapshot(BytesIO(snapshot.getvalue()))
+    self.assertEqual((200, b'message'),
+                     backend.GetMessage(b'topic', b'user1')[:2])
+    self.assertEqual((404, None), backend.GetMessage(b'topic', b'user2'))
+    self.assertEqual((204, None), backend.GetMessage(b'topic', b'user3'))
@@ -0,0 +1,65 @@
+"""Measures the cost of traffic capture, and replays what it captured.
+
+Runs the default workload (common.PubSubWorkload) against a single server,
+once without a capture and once with CAPTURE_PATH set, and reports both.
+The captured traffic is then replayed (see replay.py) against a fresh server
+at each of --speeds, 0 meaning as fast as it answers.
+
+Usage (from src/):
+  python -m benchmarks.capture [--duration S] [--concurrency N]
+                               [--speeds 1,2,0]
+"""
+
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+from benchmarks import common
+from benchmarks import replay
+
+def _Replay(args):
+  """Replays in a process of its own, since a reactor only runs once."""
+  return replay.Replay(*args)
+
+def main():
+  parser = common.ArgParser(__doc__)
+  parser.add_argument('--speeds', default='1,2,0')
+  args = parser.parse_args()
+
+  directory = tempfile.mkdtemp()
+  path = os.path.join(directory, 'traffic.cap')
+  try:
+    rows = []
+    for name, env in (('off', {}), ('capturing', {'CAPTURE_PATH': path})):
+      port, procs = common.StartSingle(env)
+      try:
+        result = common.RunLoad(port, concurrency=args.concurrency,
+                                duration=args.duration)
+      finally:
+        common.StopProcesses(procs)
+      rows.append(common.Summarize(name, result))
+    common.PrintTable(common.SUMMARY_HEADER, rows)
+    print('')
+    print('Capture: %d bytes' % os.path.getsize(path))
+    print('')
+
+    rows = []
+    for speed in args.speeds.split(','):
+      port, procs = common.StartSingle()
+      try:
+        pool = multiprocessing.Pool(1)
+        results = pool.apply(
+            _Replay, ((path, 'localhost:%d' % port, float(speed)),))
+        pool.close()
+        pool.join()
+      finally:
+        common.StopProcesses(procs)
+      rows.extend(replay.Rows(results, '%sx' % speed if float(speed) else
+                              'max'))
+    common.PrintTable(['speed'] + replay.HEADER, rows)
+  finally:
+    shutil.rmtree(directory)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,192 @@
+"""Compares the client library with naive per-request usage.
+
+Publishes --messages messages spread over --topics topics to one server, then
+reads them all back, each way:
+
+  naive blocking  http.client, a new connection per request, one at a time.
+  naive twisted   server.Server, a new connection per request, one at a time.
+  blocking        BlockingPublisher (--senders threads) and a
+                  BlockingConsumer per topic.
+  twisted         Publisher and a Consumer per topic over PubSubClient.
+
+Usage (from src/):
+  python -m benchmarks.client [--messages N] [--topics N] [--body-size BYTES]
+"""
+
+import threading
+import time
+
+try:
+  from http.client import HTTPConnection
+except ImportError:
+  from httplib import HTTPConnection
+
+from benchmarks import common
+
+def _Row(name, args, publish_elapsed, consume_elapsed, latencies):
+  latencies.sort()
+  return [name, '%.0f' % (args.messages / publish_elapsed),
+          '%.0f' % (args.messages / consume_elapsed),
+          '%.2f' % (1000 * common.Percentile(latencies, 50)),
+          '%.2f' % (1000 * common.Percentile(latencies, 99))]
+
+def _Topics(args):
+  return [b'topic-%d' % i for i in range(args.topics)]
+
+def _NaiveBlocking(port, args):
+  def Request(method, path, body=None):
+    connection = HTTPConnection('localhost', port)
+    start = time.time()
+    connection.request(method, path, body)
+    response = connection.getresponse()
+    data = response.read()
+    latencies.append(time.time() - start)
+    connection.close()
+    return response.status, data
+
+  latencies = []
+  topics = _Topics(args)
+  for topic in topics:
+    Request('POST', '/%s/naive' % topic.decode())
+  body = b'x' * args.body_size
+  start = time.time()
+  for i in range(args.messages):
+    Request('POST', '/%s' % topics[i % len(topics)].decode(), body)
+  publish_elapsed = time.time() - start
+  start = time.time()
+  for topic in topics:
+    while Request('GET', '/%s/naive' % topic.decode())[0] == 200:
+      pass
+  consume_elapsed = time.time() - start
+  return _Row('naive blocking', args, publish_elapsed, consume_elapsed,
+              latencies[len(topics):len(topics) + args.messages])
+
+def _Blocking(port, args):
+  import client
+
+  pubsub = client.BlockingClient('localhost:%d' % port,
+                                 max_connections=args.senders)
+  topics = _Topics(args)
+  for topic in topics:
+    pubsub.Subscribe(topic, b'sdk')
+  body = b'x' * args.body_size
+  start = time.time()
+  publisher = pubsub.Publisher(senders=args.senders)
+  for i in range(args.messages):
+    publisher.Publish(topics[i % len(topics)], body)
+  publisher.Close()
+  publish_elapsed = time.time() - start
+
+  start = time.time()
+  def Consume(topic, count):
+    consumer = pubsub.Consumer(topic, b'sdk', prefetch=args.prefetch)
+    for _ in range(count):
+      consumer.Get(timeout=10)
+    consumer.Stop()
+  threads = [threading.Thread(
+      target=Consume, args=(topic, len(range(i, args.messages, len(topics)))))
+             for i, topic in enumerate(topics)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  consume_elapsed = time.time() - start
+  stats = pubsub.Stats()['publish']
+  pubsub.Close()
+  return ['blocking', '%.0f' % (args.messages / publish_elapsed),
+          '%.0f' % (args.messages / consume_elapsed),
+          '%.2f' % stats['p50_ms'], '%.2f' % stats['p99_ms']]
+
+def _Twisted(port, args):
+  """Runs the naive twisted and the twisted configurations."""
+  from twisted.internet import reactor
+  from twisted.internet.defer import gatherResults
+  from twisted.internet.defer import inlineCallbacks
+
+  import client
+  from server import Server
+
+  host = 'localhost:%d' % port
+  topics = _Topics(args)
+  body = b'x' * args.body_size
+  rows = []
+
+  @inlineCallbacks
+  def Naive():
+    server = Server(host)
+    for topic in topics:
+      yield server.POST(b'/%s/naive-twisted' % topic)
+    latencies = []
+    start = time.time()
+    for i in range(args.messages):
+      request_start = time.time()
+      yield server.POST(b'/%s' % topics[i % len(topics)], body=body)
+      latencies.append(time.time() - request_start)
+    publish_elapsed = time.time() - start
+    start = time.time()
+    for topic in topics:
+      while (yield server.GET(b'/%s/naive-twisted' % topic))[0] == 200:
+        pass
+    rows.append(_Row('naive twisted', args, publish_elapsed,
+                     time.time() - start, latencies))
+
+  @inlineCallbacks
+  def Sdk():
+    pubsub = client.PubSubClient(host, max_connections=args.senders)
+    yield gatherResults([pubsub.Subscribe(t, b'twisted') for t in topics])
+    start = time.time()
+    publisher = pubsub.Publisher()
+    for i in range(args.messages):
+      publisher.Publish(topics[i % len(topics)], body)
+    yield publisher.Flush()
+    publish_elapsed = time.time() - start
+
+    @inlineCallbacks
+    def Consume(topic, count):
+      consumer = pubsub.Consumer(topic, b'twisted', prefetch=args.prefetch)
+      for _ in range(count):
+        yield consumer.Get()
+      consumer.Stop()
+    start = time.time()
+    yield gatherResults([
+        Consume(topic, len(range(i, args.messages, len(topics))))
+        for i, topic in enumerate(topics)])
+    consume_elapsed = time.time() - start
+    stats = pubsub.Stats()['publish']
+    rows.append(['twisted', '%.0f' % (args.messages / publish_elapsed),
+                 '%.0f' % (args.messages / consume_elapsed),
+                 '%.2f' % stats['p50_ms'], '%.2f' % stats['p99_ms']])
+    yield pubsub.Close()
+
+  @inlineCallbacks
+  def Run():
+    try:
+      yield Naive()
+      yield Sdk()
+    finally:
+      reactor.stop()
+
+  reactor.callWhenRunning(Run)
+  reactor.run()
+  return rows
+
+def main():
+  parser = common.ArgParser(__doc__)
+  parser.add_argument('--messages', type=int, default=5000)
+  parser.add_argument('--topics', type=int, default=8)
+  parser.add_argument('--body-size', type=int, default=100)
+  parser.add_argument('--senders', type=int, default=8)
+  parser.add_argument('--prefetch', type=int, default=16)
+  args = parser.parse_args()
+
+  port, procs = common.StartSingle()
+  try:
+    rows = [_NaiveBlocking(port, args), _Blocking(port, args)]
+    rows.extend(_Twisted(port, args))
+  finally:
+    common.StopProcesses(procs)
+  common.PrintTable(['client', 'publishes/s', 'messages read/s',
+                     'publish p50 ms', 'publish p99 ms'], rows)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,43 @@
+"""Compares co-located frontends with separate frontend and backends.
+
+The default load (each worker publishing to and polling its own user on one
+of 16 topics) runs through:
+
+  cluster      1 frontend and --shards backends, one hop to every topic.
+  co-located   --shards frontends, each owning one shard (see colocated.py),
+               all of the load on the first of them. Topics on its shard
+               are served in process, the others take the same hop.
+
+Usage (from src/):
+  python -m benchmarks.colocated [--shards N]
+"""
+
+from benchmarks import common
+
+def main():
+  parser = common.ArgParser(__doc__)
+  parser.add_argument('--shards', type=int, default=2)
+  args = parser.parse_args()
+
+  rows = []
+  for shards in sorted(set([1, args.shards])):
+    port, procs = common.StartCluster(shards)
+    try:
+      rows.append(common.Summarize(
+          'cluster, %d shard(s)' % shards,
+          common.RunLoad(port, concurrency=args.concurrency,
+                         duration=args.duration)))
+    finally:
+      common.StopProcesses(procs)
+    ports, procs = common.StartColocated(shards)
+    try:
+      rows.append(common.Summarize(
+          'co-located, %d shard(s)' % shards,
+          common.RunLoad(ports[0], concurrency=args.concurrency,
+                         duration=args.duration)))
+    finally:
+      common.StopProcesses(procs)
+  common.PrintTable(common.SUMMARY_HEADER, rows)
+
+if __name__ == '__main__':
+  main()
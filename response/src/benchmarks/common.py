@@ -0,0 +1,244 @@
+"""Shared helpers for the benchmark scripts.
+
+The benchmarks launch real server processes from this directory (the same
+scripts used in production) and drive them from separate worker processes that
+use blocking keep-alive HTTP connections, so the load generator never shares a
+reactor or an interpreter with the process being measured.
+"""
+
+import argparse
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import time
+
+try:
+  from http.client import HTTPConnection
+except ImportError:
+  from httplib import HTTPConnection
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def FreePort():
+  """Returns a TCP port on localhost that is currently free."""
+  s = socket.socket()
+  s.bind(('localhost', 0))
+  port = s.getsockname()[1]
+  s.close()
+  return port
+
+def WaitForPort(port, proc, timeout=10):
+  """Blocks until something accepts connections on port."""
+  deadline = time.time() + timeout
+  while time.time() < deadline:
+    if proc.poll() is not None:
+      raise RuntimeError('Server exited with %d before listening on %d' %
+                         (proc.returncode, port))
+    try:
+      socket.create_connection(('localhost', port), 0.1).close()
+      return
+    except socket.error:
+      time.sleep(0.05)
+  raise RuntimeError('Timed out waiting for port %d' % port)
+
+def StartProcess(script, port, env=None, wait=True):
+  """Starts one of the server scripts in src/ listening on port.
+
+  Args:
+    script: The script to run, e.g. 'clustered_backend.py'.
+    port: The port the script will listen on (passed as PORT).
+    env: Extra environment variables for the process.
+    wait: Whether to wait until something accepts connections on port.
+
+  Returns:
+    The subprocess.Popen for the started server.
+  """
+  full_env = dict(os.environ)
+  full_env.update(env or {})
+  full_env['PORT'] = str(port)
+  full_env['PYTHONPATH'] = SRC_DIR
+  proc = subprocess.Popen([sys.executable, script], cwd=SRC_DIR, env=full_env)
+  if wait:
+    WaitForPort(port, proc)
+  return proc
+
+def StopProcesses(procs):
+  """Terminates and reaps all of the given processes."""
+  for proc in procs:
+    if proc.poll() is None:
+      proc.terminate()
+  for proc in procs:
+    proc.wait()
+
+def StartSingle(env=None):
+  """Starts a single server process, returning (frontend_port, processes)."""
+  port = FreePort()
+  return port, [StartProcess('clustered_backend.py', port, env)]
+
+def StartCluster(num_backends, env=None, frontend_env=None,
+                 backend_admin=False, shm_dir=None, faults=None):
+  """Starts num_backends backends and one frontend routing across them.
+
+  Args:
+    backend_admin: Whether to give each backend an admin port, passed to the
+      frontend as BACKEND<i>_ADMIN_PORT.
+    shm_dir: If set, a directory for Unix sockets through which the frontend
+      reaches the backends over shared memory (see backends/shm.py).
+    faults: Optional dict of backend index to a FAULTS spec. Those backends
+      run faulty_backend.py (see backends/faults.py).
+
+  Returns:
+    A (frontend_port, processes) tuple.
+  """
+  procs = []
+  cluster_env = dict(env or {})
+  cluster_env['NUM_BACKENDS'] = str(num_backends)
+  for i in range(num_backends):
+    port = FreePort()
+    backend_env = dict(env or {})
+    # Every publish reaching a backend was checked by the frontend, which
+    # also names the publishing client.
+    backend_env['TRUST_GZIP'] = '1'
+    backend_env['TRUST_FORWARDED_FOR'] = '1'
+    if backend_admin:
+      admin_port = FreePort()
+      backend_env['ADMIN_PORT'] = str(admin_port)
+      cluster_env['BACKEND%d_ADMIN_PORT' % i] = (
+          'tcp://localhost:%d' % admin_port)
+    if shm_dir:
+      backend_env['SHM_SOCKET'] = os.path.join(shm_dir, 'backend%d.sock' % i)
+      cluster_env['BACKEND%d_SHM' % i] = backend_env['SHM_SOCKET']
+    script = 'clustered_backend.py'
+    if faults and i in faults:
+      script = 'faulty_backend.py'
+      backend_env['FAULTS'] = faults[i]
+      backend_env['FAULT_SEED'] = str(i)
+    procs.append(StartProcess(script, port, backend_env))
+    cluster_env['BACKEND%d_PORT' % i] = 'tcp://localhost:%d' % port
+  cluster_env.update(frontend_env or {})
+  port = FreePort()
+  procs.append(StartProcess('clustered_frontend.py', port, cluster_env))
+  return port, procs
+
+def StartColocated(num_frontends, env=None):
+  """Starts num_frontends co-located frontends, each owning one shard.
+
+  See colocated.py. Frontend i owns shard i, serving it to the others.
+
+  Returns:
+    A (frontend_ports, processes) tuple.
+  """
+  cluster_env = dict(env or {})
+  cluster_env['NUM_BACKENDS'] = str(num_frontends)
+  for i in range(num_frontends):
+    cluster_env['BACKEND%d_PORT' % i] = 'tcp://localhost:%d' % FreePort()
+  ports, procs = [], []
+  for i in range(num_frontends):
+    ports.append(FreePort())
+    procs.append(StartProcess('clustered_frontend.py', ports[-1],
+                              dict(cluster_env, LOCAL_BACKENDS=str(i))))
+  return ports, procs
+
+class Client(object):
+  """A blocking keep-alive HTTP client used by the load generating workers."""
+
+  def __init__(self, port, host='localhost'):
+    self._conn = HTTPConnection(host, port)
+
+  def Request(self, method, path, body=None, headers=None):
+    """Performs a request, returning (status, body, headers)."""
+    self._conn.request(method, path, body, headers or {})
+    response = self._conn.getresponse()
+    return response.status, response.read(), dict(response.getheaders())
+
+  def Close(self):
+    self._conn.close()
+
+def PubSubWorkload(client, worker_id, deadline, topics=16, body=b'x' * 100):
+  """The default benchmark mix: each worker posts and polls its own user.
+
+  Returns:
+    The list of per-request latencies in seconds.
+  """
+  topic = 'bench-%d' % (worker_id % topics)
+  user = 'user-%d' % worker_id
+  latencies = []
+  client.Request('POST', '/%s/%s' % (topic, user))
+  while time.time() < deadline:
+    start = time.time()
+    client.Request('POST', '/%s' % topic, body)
+    latencies.append(time.time() - start)
+    start = time.time()
+    client.Request('GET', '/%s/%s' % (topic, user))
+    latencies.append(time.time() - start)
+  return latencies
+
+def _RunWorker(args):
+  """Process pool entry point wrapping a workload with its own client."""
+  port, workload, worker_id, deadline, kwargs = args
+  client = Client(port)
+  try:
+    return workload(client, worker_id, deadline, **kwargs)
+  finally:
+    client.Close()
+
+def RunLoad(port, workload=PubSubWorkload, concurrency=8, duration=5.0,
+            **kwargs):
+  """Runs workload from concurrency worker processes for duration seconds.
+
+  Returns:
+    A dict with the total ops, elapsed time and sorted latencies.
+  """
+  pool = multiprocessing.Pool(concurrency)
+  try:
+    start = time.time()
+    deadline = start + duration
+    results = pool.map(
+        _RunWorker,
+        [(port, workload, i, deadline, kwargs) for i in range(concurrency)])
+    elapsed = time.time() - start
+  finally:
+    pool.close()
+    pool.join()
+  latencies = sorted(l for result in results for l in result)
+  return {'ops': len(latencies), 'elapsed': elapsed, 'latencies': latencies}
+
+def Percentile(sorted_values, pct):
+  """Returns the pct percentile of an already sorted list."""
+  if not sorted_values:
+    return 0.0
+  index = min(len(sorted_values) - 1, int(len(sorted_values) * pct / 100.0))
+  return sorted_values[index]
+
+def Summarize(name, result):
+  """Turns a RunLoad result into a row for PrintTable."""
+  latencies = result['latencies']
+  return [name,
+          '%.0f' % (result['ops'] / result['elapsed']),
+          '%.2f' % (1000 * Percentile(latencies, 50)),
+          '%.2f' % (1000 * Percentile(latencies, 99))]
+
+SUMMARY_HEADER = ['config', 'req/s', 'p50 ms', 'p99 ms']
+
+def PrintTable(header, rows):
+  """Prints rows as a markdown table, ready to paste into the README."""
+  widths = [max(len(str(r[i])) for r in [header] + rows)
+            for i in range(len(header))]
+  def Line(row):
+    return '| %s |' % ' | '.join(
+        str(c).ljust(w) for c, w in zip(row, widths))
+  print(Line(header))
+  print('|%s|' % '|'.join('-' * (w + 2) for w in widths))
+  for row in rows:
+    print(Line(row))
+
+def ArgParser(description):
+  """Returns an ArgumentParser with the options every benchmark shares."""
+  parser = argparse.ArgumentParser(description=description)
+  parser.add_argument('--duration', type=float, default=5.0,
+                      help='Seconds to run each configuration for.')
+  parser.add_argument('--concurrency', type=int, default=8,
+                      help='Number of load generating worker processes.')
+  return parser
@@ -0,0 +1,106 @@
+"""Measures the memory and bandwidth saved by compressing message bodies.
+
+Publishes --messages JSON bodies through a frontend to one backend with a
+single subscriber, then drains them, with compression off and on. Reports the
+backend's RSS growth while holding the messages, the body bytes moved between
+frontend and backend (in each direction) and from the frontend to the client,
+and publish throughput.
+
+Usage (from src/):
+  python -m benchmarks.compression [--messages N] [--threshold B]
+"""
+
+import json
+import random
+import time
+
+try:
+  from urllib.request import urlopen
+except ImportError:
+  from urllib2 import urlopen
+
+from benchmarks import common
+
+def _JsonBody(rng, items=20):
+  """A compressible JSON body roughly like our order events."""
+  return json.dumps({
+      'event': 'order_updated',
+      'order_id': rng.randint(0, 10 ** 9),
+      'customer': {'id': rng.randint(0, 10 ** 6), 'tier': 'gold'},
+      'items': [{'sku': 'SKU-%06d' % rng.randint(0, 999999),
+                 'quantity': rng.randint(1, 9),
+                 'status': rng.choice(['pending', 'shipped', 'delivered'])}
+                for _ in range(items)],
+  }).encode('utf-8')
+
+def RssBytes(pid):
+  """Returns the resident set size of a process from /proc."""
+  with open('/proc/%d/status' % pid) as f:
+    for line in f:
+      if line.startswith('VmRSS:'):
+        return int(line.split()[1]) * 1024
+  return 0
+
+def _Run(bodies, threshold, accept_gzip):
+  """Runs one configuration and returns its result row."""
+  env = {}
+  if threshold is not None:
+    env['COMPRESS_THRESHOLD'] = str(threshold)
+  admin_port = common.FreePort()
+  env['ADMIN_PORT'] = str(admin_port)
+  port, procs = common.StartCluster(1, frontend_env=env)
+  backend_pid = procs[0].pid
+  client = common.Client(port)
+  try:
+    client.Request('POST', '/bench/reader')
+    rss_before = RssBytes(backend_pid)
+    start = time.time()
+    for body in bodies:
+      client.Request('POST', '/bench', body)
+    publish_rate = len(bodies) / (time.time() - start)
+    rss_held = RssBytes(backend_pid) - rss_before
+
+    headers = {'Accept-Encoding': 'gzip'} if accept_gzip else {}
+    client_bytes = 0
+    while True:
+      status, body, _ = client.Request('GET', '/bench/reader', None, headers)
+      if status != 200:
+        break
+      client_bytes += len(body)
+    stats = json.loads(urlopen(
+        'http://127.0.0.1:%d/compression' % admin_port).read().decode('utf-8'))
+  finally:
+    client.Close()
+    common.StopProcesses(procs)
+  raw = sum(len(b) for b in bodies)
+  if stats['compressed']:
+    backend_bytes = stats['compressed_bytes']
+  else:
+    backend_bytes = raw
+  return ['off' if threshold is None else '>=%dB' % threshold,
+          'gzip' if accept_gzip else 'identity',
+          '%.1f' % (rss_held / 2.0 ** 20),
+          '%.1f' % (backend_bytes / 2.0 ** 20),
+          '%.1f' % (client_bytes / 2.0 ** 20),
+          '%.0f' % publish_rate]
+
+def main():
+  parser = common.ArgParser(__doc__)
+  parser.add_argument('--messages', type=int, default=20000)
+  parser.add_argument('--threshold', type=int, default=256)
+  args = parser.parse_args()
+
+  rng = random.Random(0)
+  bodies = [_JsonBody(rng) for _ in range(args.messages)]
+  print('%d messages, %.1f MiB raw, %d bytes average' % (
+      len(bodies), sum(len(b) for b in bodies) / 2.0 ** 20,
+      sum(len(b) for b in bodies) // len(bodies)))
+  rows = [_Run(bodies, None, False),
+          _Run(bodies, args.threshold, False),
+          _Run(bodies, args.threshold, True)]
+  common.PrintTable(['compression', 'client accepts', 'backend RSS MiB',
+                     'frontend<->backend MiB', 'frontend->client MiB',
+                     'publishes/s'], rows)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,74 @@
+"""Frontend latency and memory with one faulty backend of four.
+
+Starts a frontend over --backends backends, the first of them a
+faulty_backend.py (see backends/faults.py) with each scenario's faults on
+its polls and publishes, and runs a publish and poll workload over 64
+topics, so about a quarter of the requests go to the faulty backend.
+Reported: req/s, p50/p99/max latency, the share of requests that failed
+(anything but 200/204), and the frontend's resident memory afterwards.
+
+Usage (from src/):
+  python -m benchmarks.faults [--duration S] [--concurrency N] [--backends N]
+"""
+
+import time
+
+from benchmarks import common
+from benchmarks.compression import RssBytes
+
+SCENARIOS = [
+    ('none', ''),
+    ('slow (lognormal 20ms)', 'latency=lognormal:20:1'),
+    ('lossy (5% errors)', 'error=0.05'),
+    ('resets (5%)', 'reset=0.05'),
+    ('flapping (down 1s of 5s)', 'flap=5:1'),
+    ('stalls (1% for 1s)', 'stall=0.01,stall_time=1'),
+]
+
+def _Workload(client, worker_id, deadline, topics=64, body=b'x' * 100):
+  """Publishes and polls topics in turn, returning (latency, status) pairs."""
+  user = 'user-%d' % worker_id
+  names = ['faults-%d' % i for i in range(topics)]
+  for topic in names:
+    client.Request('POST', '/%s/%s' % (topic, user))
+  results = []
+  i = worker_id
+  while time.time() < deadline:
+    topic = names[i % topics]
+    i += 1
+    for method, path, data in (('POST', '/%s' % topic, body),
+                               ('GET', '/%s/%s' % (topic, user), None)):
+      start = time.time()
+      status = client.Request(method, path, data)[0]
+      results.append((time.time() - start, status))
+  return results
+
+def main():
+  parser = common.ArgParser(__doc__)
+  parser.add_argument('--backends', type=int, default=4)
+  args = parser.parse_args()
+
+  rows = []
+  for name, spec in SCENARIOS:
+    faults = {0: 'poll:%s;publish:%s' % (spec, spec) if spec else ''}
+    port, procs = common.StartCluster(args.backends, faults=faults)
+    try:
+      result = common.RunLoad(port, _Workload, args.concurrency,
+                              args.duration)
+      rss = RssBytes(procs[-1].pid)
+    finally:
+      common.StopProcesses(procs)
+    latencies = [latency for latency, _ in result['latencies']]
+    failed = sum(1 for _, status in result['latencies']
+                 if status not in (200, 204))
+    rows.append([name, '%.0f' % (result['ops'] / result['elapsed']),
+                 '%.2f' % (1000 * common.Percentile(latencies, 50)),
+                 '%.2f' % (1000 * common.Percentile(latencies, 99)),
+                 '%.0f' % (1000 * latencies[-1]),
+                 '%.2f%%' % (100.0 * failed / max(1, len(latencies))),
+                 '%.1f' % (rss / 2.0 ** 20)])
+  common.PrintTable(['faults on 1 backend', 'req/s', 'p50 ms', 'p99 ms',
+                     'max ms', 'failed', 'frontend MiB'], rows)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,101 @@
+"""Measures garbage collector pauses of a large MemoryBackend, and tuning.
+
+Each config runs in a fresh process, on a real reactor: a MemoryBackend is
+filled with --messages pending messages on one topic whose subscriber never
+reads, and a GcMonitor started with the config's tuning. Then, for
+--duration seconds, bursts of --burst-ms alternate with quiet spells of
+--quiet-ms; during bursts, every 5ms a batch of --batch messages is
+published to a topic with a reader and an idle subscriber, and the reader
+gets them, so the heap keeps growing as a real backlog does.
+
+Reported: how late the batches finished against when they were due (the
+latency a request arriving then would have seen on top of its own work),
+and the full (generation 2) collections the GcMonitor timed.
+
+Usage (from src/):
+  python -m benchmarks.gcpauses [--messages N] [--idle-collect S]
+"""
+
+import multiprocessing
+import time
+
+from backends.memory import MemoryBackend
+from benchmarks import common
+from gcpauses import GcMonitor
+
+_TICK = 0.005
+
+def _Run(config, args, results):
+  from twisted.internet import reactor
+
+  backend = MemoryBackend()
+  backend.Subscribe(b'big', b'idle')
+  body = b'x' * 100
+  for _ in range(args.messages):
+    backend.PostMessage(b'big', body)
+  backend.Subscribe(b'stream', b'reader')
+  backend.Subscribe(b'stream', b'idle')
+  monitor = GcMonitor(freeze='freeze' in config,
+                      idle_collect=args.idle_collect if 'idle' in config else 0)
+  monitor.Start(reactor)
+  latencies = []
+  start = time.time()
+  period = (args.burst_ms + args.quiet_ms) / 1000.0
+
+  def Tick(due):
+    for _ in range(args.batch):
+      backend.PostMessage(b'stream', body)
+      backend.GetMessage(b'stream', b'reader')
+    now = time.time()
+    latencies.append(now - due)
+    if now - start >= args.duration:
+      monitor.Stop()
+      reactor.stop()
+      return
+    phase = (now - start) % period
+    if phase < args.burst_ms / 1000.0:
+      reactor.callLater(_TICK, Tick, now + _TICK)
+    else:
+      # Sits out the rest of the quiet spell.
+      reactor.callLater(period - phase, Tick, start + period * (
+          (now - start) // period + 1))
+
+  reactor.callLater(_TICK, Tick, time.time() + _TICK)
+  reactor.run()
+  latencies.sort()
+  stats = monitor.Stats()
+  full = stats['generations'][2]
+  results.put([config, '%d' % stats['frozen'],
+               '%.1f' % (1000 * common.Percentile(latencies, 50)),
+               '%.1f' % (1000 * common.Percentile(latencies, 99)),
+               '%.1f' % (1000 * latencies[-1]),
+               '%d' % full['collections'], '%.1f' % full['max_pause_ms'],
+               '%d' % stats.get('idle_collections', 0),
+               '%d' % stats.get('forced_collections', 0)])
+
+def _InProcess(config, args):
+  results = multiprocessing.Queue()
+  proc = multiprocessing.Process(target=_Run, args=(config, args, results))
+  proc.start()
+  result = results.get()
+  proc.join()
+  return result
+
+def main():
+  parser = common.ArgParser(__doc__)
+  parser.set_defaults(duration=20.0)
+  parser.add_argument('--messages', type=int, default=300000)
+  parser.add_argument('--batch', type=int, default=40)
+  parser.add_argument('--burst-ms', type=float, default=800)
+  parser.add_argument('--quiet-ms', type=float, default=400)
+  parser.add_argument('--idle-collect', type=float, default=2.0)
+  args = parser.parse_args()
+
+  rows = [_InProcess(config, args)
+          for config in ('default', 'freeze', 'idle', 'freeze+idle')]
+  common.PrintTable(['config', 'frozen', 'p50 ms', 'p99 ms', 'max ms',
+                     'full gcs', 'max full gc ms', 'idle gcs', 'forced gcs'],
+                    rows)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,145 @@
+"""Measures restarting a backend with a state handoff, against kill and start.
+
+For each state size, one backend process is filled with that many MB of
+pending messages (over 100 topics) and then replaced by a new process, while
+a load thread polls it over a new connection per request, as frontends do:
+
+  handoff  The new process takes over through HANDOFF_SOCKET (handoff.py).
+  restart  The old process is killed and the new one started, losing the
+           state.
+
+Reported: the handoff's transfer time and throughput (from the new process's
+GET /handoff), the longest the load thread went without a successful
+response, its failed requests, its slowest successful request, and the
+messages left in the new process.
+
+Usage (from src/):
+  python -m benchmarks.handoff [--sizes-mb 10,100,500] [--body-size BYTES]
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+try:
+  from http.client import HTTPConnection
+  from http.client import HTTPException
+except ImportError:
+  from httplib import HTTPConnection
+  from httplib import HTTPException
+
+import client
+
+from benchmarks import common
+
+_TOPICS = 100
+
+def _Poll(port, stop, events):
+  """Load thread: polls until stop is set, recording (start, end, ok)."""
+  while not stop.is_set():
+    start = time.time()
+    ok = False
+    try:
+      connection = HTTPConnection('localhost', port, timeout=30)
+      connection.request('GET', '/load/user')
+      response = connection.getresponse()
+      response.read()
+      connection.close()
+      # After a restart the subscription is gone: a 404 is still an answer.
+      ok = response.status < 500
+    except (HTTPException, OSError):
+      time.sleep(0.001)
+    events.append((start, time.time(), ok))
+
+def _Fill(port, megabytes, body_size):
+  """Publishes megabytes of pending messages, returning how many."""
+  pubsub = client.BlockingClient('localhost:%d' % port)
+  pubsub.Subscribe(b'load', b'user')
+  for i in range(_TOPICS):
+    pubsub.Subscribe(b'state-%d' % i, b'user')
+  count = int(megabytes * 1e6 / body_size)
+  publisher = pubsub.Publisher(senders=8)
+  body = b'x' * body_size
+  for i in range(count):
+    publisher.Publish(b'state-%d' % (i % _TOPICS), body)
+  publisher.Close()
+  pubsub.Close()
+  return count
+
+def _Messages(admin_port):
+  connection = HTTPConnection('localhost', admin_port)
+  connection.request('GET', '/backlog?limit=1')
+  backlog = json.loads(connection.getresponse().read())
+  connection.close()
+  return backlog['messages']
+
+def _Replace(port, megabytes, args, handoff_dir, mode):
+  """Fills a backend, replaces it in the given mode and returns a row."""
+  path = os.path.join(handoff_dir, 'handoff.sock')
+  env = {'HANDOFF_SOCKET': path} if mode == 'handoff' else {}
+  old = common.StartProcess('clustered_backend.py', port, env)
+  new = None
+  try:
+    count = _Fill(port, megabytes, args.body_size)
+    events = []
+    stop = threading.Event()
+    load = threading.Thread(target=_Poll, args=(port, stop, events))
+    load.start()
+    time.sleep(0.5)
+    replaced = time.time()
+    admin_port = common.FreePort()
+    env = dict(env, ADMIN_PORT=str(admin_port))
+    if mode == 'restart':
+      old.terminate()
+      old.wait()
+    new = common.StartProcess('clustered_backend.py', port, env, wait=False)
+    common.WaitForPort(admin_port, new, timeout=600)
+    old.wait()
+    time.sleep(0.5)
+    stop.set()
+    load.join()
+
+    stats = {'state_received': False}
+    if mode == 'handoff':
+      connection = HTTPConnection('localhost', admin_port)
+      connection.request('GET', '/handoff')
+      stats = json.loads(connection.getresponse().read())
+      connection.close()
+    after = [e for e in events if e[1] >= replaced]
+    ok_ends = [replaced] + sorted(end for _, end, ok in after if ok)
+    gap = max(b - a for a, b in zip(ok_ends, ok_ends[1:]))
+    slowest = max([end - start for start, end, ok in after if ok] or [0])
+    transfer = ('%.0f' % stats['receive_ms'] if stats['state_received']
+                else '-')
+    rate = ('%.0f' % stats['receive_mb_per_s'] if stats['state_received']
+            else '-')
+    return ['%d' % megabytes, '%d' % count, mode, transfer, rate,
+            '%.0f' % (1000 * gap), '%d' % sum(1 for e in after if not e[2]),
+            '%.0f' % (1000 * slowest), '%d' % _Messages(admin_port)]
+  finally:
+    common.StopProcesses([p for p in (old, new) if p is not None])
+
+def main():
+  parser = common.ArgParser(__doc__)
+  parser.add_argument('--sizes-mb', default='10,100,500')
+  parser.add_argument('--body-size', type=int, default=16384)
+  args = parser.parse_args()
+
+  handoff_dir = tempfile.mkdtemp()
+  rows = []
+  try:
+    for megabytes in [int(s) for s in args.sizes_mb.split(',')]:
+      for mode in ('handoff', 'restart'):
+        rows.append(_Replace(common.FreePort(), megabytes, args, handoff_dir,
+                             mode))
+  finally:
+    shutil.rmtree(handoff_dir)
+  common.PrintTable(['state MB', 'messages', 'mode', 'transfer ms',
+                     'transfer MB/s', 'longest gap ms', 'failed requests',
+                     'slowest request ms', 'messages after'], rows)
+
+if __name__ == '__main__':
+  main()
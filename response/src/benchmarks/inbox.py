@@ -0,0 +1,95 @@
+"""Compares inbox reads with polling each of a user's topics.
+
+A user subscribes to --topics topics on a frontend with 2 backends, and
+--messages messages are published over the first --busy of them. The user
+then takes every message, each way:
+
+  poll   GET /<topic>/<user> on every topic in turn, until a whole pass over
+         them finds nothing, as a client without inbox reads has to.
+  inbox  GET /<user>?limit=--limit until it answers 204.
+
+Both use one keep-alive connection (client.BlockingClient). Reported: the
+requests made, the time to take every message, and the time of a check for
+new messages when there are none.
+
+Usage (from src/):
+  python -m benchmarks.inbox [--topics N] [--busy N] [--messages N]
+                             [--limit N]
+"""
+
+import time
+
+import client
+
+from benchmarks import common
+
+def _Fill(pubsub, args):
+  topics = [b'topic-%d' % i for i in range(args.topics)]
+  for topic in topics:
+    pubsub.Subscribe(topic, b'user')
+  publisher = pubsub.Publisher(senders=8)
+  for i in range(args.messages):
+    publisher.Publish(topics[i % args.busy], b'x' * 100)
+  publisher.Close()
+  return topics
+
+def _Poll(pubsub, topics):
+  """Takes every message by polling, returning (messages, requests)."""
+  messages = requests = 0
+  found = True
+  while found:
+    found = False
+    for topic in topics:
+      requests += 1
+      if pubsub.Poll(topic, b'user')[0] == 200:
+        messages += 1
+        found = True
+  return messages, requests
+
+def _Inbox(pubsub, args):
+  """Takes every message with inbox reads, returning (messages, requests)."""
+  messages = requests = 0
+  while True:
+    requests += 1
+    status, taken, _ = pubsub.Inbox(b'user', args.limit)
+    if status != 200:
+      return messages, requests
+    messages += len(taken)
+
+def main():
+  parser = common.ArgParser(__doc__)
+  parser.add_argument('--topics', type=int, default=500)
+  parser.add_argument('--busy', type=int, default=50)
+  parser.add_argument('--messages', type=int, default=2000)
+  parser.add_argument('--limit', type=int, default=100)
+  args = parser.parse_args()
+
+  rows = []
+  for method in ('poll', 'inbox'):
+    port, procs = common.StartCluster(2)
+    try:
+      pubsub = client.BlockingClient('localhost:%d' % port)
+      topics = _Fill(pubsub, args)
+      start = time.time()
+      if method == 'poll':
+        messages, requests = _Poll(pubsub, topics)
+      else:
+        messages, requests = _Inbox(pubsub, args)
+      elapsed = time.time() - start
+      start = time.time()
+      if method == 'poll':
+        _Poll(pubsub, topics)
+      else:
+        _Inbox(pubsub, args)
+      check = time.time() - start
+      pubsub.Close()
+    finally:
+      common.StopProcesses(procs)
+    rows.append([method, '%d' % args.topics, '%d' % messages, '%d' % requests,
+                 '%.0f' % (1000 * elapsed), '%.0f' % (messages / elapsed),
+                 '%.1f' % (1000 * check)])
+  common.PrintTable(['method', 'topics', 'messages', 'requests', 'ms',
+                     'messages/s', 'empty check ms'], rows)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,71 @@
+"""Measures latency and peak memory when moving large message bodies.
+
+For each size a fresh frontend and backend are started, one subscriber is
+added, and --repeats bodies of that size are published and then fetched one
+at a time. Reports the median publish and fetch latency, and how far each
+process's peak RSS rose above its idle RSS, in multiples of the body size.
+
+Usage (from src/):
+  python -m benchmarks.large_bodies [--sizes 1,5,10,25,50] [--repeats N]
+"""
+
+import os
+import time
+
+from benchmarks import common
+
+def PeakRssBytes(pid):
+  """Returns the peak resident set size (VmHWM) of a process from /proc."""
+  with open('/proc/%d/status' % pid) as f:
+    for line in f:
+      if line.startswith('VmHWM:'):
+        return int(line.split()[1]) * 1024
+  return 0
+
+def _Run(size, repeats):
+  """Runs one body size and returns its result row."""
+  body = os.urandom(size)
+  port, procs = common.StartCluster(1)
+  pids = [proc.pid for proc in procs]
+  client = common.Client(port)
+  try:
+    client.Request('POST', '/large/reader')
+    idle = [PeakRssBytes(pid) for pid in pids]
+    post_latencies = []
+    get_latencies = []
+    for _ in range(repeats):
+      start = time.time()
+      status, _, _ = client.Request('POST', '/large', body)
+      post_latencies.append(time.time() - start)
+      assert status == 200, status
+      start = time.time()
+      status, received, _ = client.Request('GET', '/large/reader')
+      get_latencies.append(time.time() - start)
+      assert status == 200 and received == body, status
+    peak = [PeakRssBytes(pid) for pid in pids]
+  finally:
+    client.Close()
+    common.StopProcesses(procs)
+  backend_growth, frontend_growth = [
+      (p - i) / float(size) for p, i in zip(peak, idle)]
+  return ['%d MiB' % (size // 2 ** 20),
+          '%.0f' % (common.Percentile(sorted(post_latencies), 50) * 1000),
+          '%.0f' % (common.Percentile(sorted(get_latencies), 50) * 1000),
+          '%.1fx' % frontend_growth,
+          '%.1fx' % backend_growth]
+
+def main():
+  parser = common.ArgParser(__doc__)
+  parser.add_argument('--sizes', default='1,5,10,25,50',
+                      help='Comma separated body sizes in MiB.')
+  parser.add_argument('--repeats', type=int, default=3)
+  args = parser.parse_args()
+
+  rows = [_Run(int(mib) * 2 ** 20, args.repeats)
+          for mib in args.sizes.split(',')]
+  common.PrintTable(['body', 'publish p50 ms', 'fetch p50 ms',
+                     'frontend peak RSS / body', 'backend peak RSS / body'],
+                    rows)
+
+if __name__ == '__main__':
+  main()
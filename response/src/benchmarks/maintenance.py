@@ -0,0 +1,102 @@
+"""Measures reactor stalls from maintenance of a topic with many messages.
+
+A MemoryBackend is filled with --messages pending messages on one topic with
+two subscribers, and then, on the reactor:
+
+  unsubscribe  One of the subscribers unsubscribes.
+  purge        Every pending message is dropped.
+  retention    Every message outlives the retention.
+
+Each runs with the jobs in one go (a budget longer than any job, as before
+maintenance was sliced), and then sliced with --budget-ms. Reported: how long
+the call itself took, how long until the job finished (for retention,
+from the periodic check), the longest the
+reactor went without running a 1ms timer (the longest a request would have
+waited), how many times that exceeded 50ms, and the longest slice.
+
+Usage (from src/):
+  python -m benchmarks.maintenance [--messages N] [--budget-ms MS]
+"""
+
+import time
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.task import deferLater
+
+from backends.memory import MemoryBackend
+from benchmarks import common
+from maintenance import Maintenance
+from maintenance import StallMonitor
+
+_RETENTION = 10
+
+def _Sleep(seconds):
+  return deferLater(reactor, seconds, lambda: None)
+
+@inlineCallbacks
+def _Measure(operation, budget, messages):
+  """Runs operation on a filled backend and returns a row."""
+  offset = [0]
+  monitor = StallMonitor(interval=0.001, window=100000)
+  maintenance = Maintenance(budget, monitor)
+  backend = MemoryBackend(clock=lambda: time.time() + offset[0],
+                          maintenance=maintenance, retention=_RETENTION)
+  backend.Subscribe(b'big', b'a')
+  backend.Subscribe(b'big', b'b')
+  body = b'x' * 100
+  for _ in range(messages):
+    backend.PostMessage(b'big', body)
+  maintenance.Start(reactor)
+  yield _Sleep(0.2)
+
+  start = time.time()
+  if operation == 'unsubscribe':
+    backend.Unsubscribe(b'big', b'a')
+  elif operation == 'purge':
+    backend.Purge(b'big')
+  else:
+    offset[0] = _RETENTION + 1
+  call = time.time() - start
+  if operation == 'retention':
+    # Timed from the check, which runs every tenth of the retention.
+    while not maintenance.Stats().get('started.retention'):
+      yield _Sleep(0.001)
+    start = time.time()
+  while maintenance.Stats()['running']:
+    yield _Sleep(0.001)
+  done = time.time() - start
+  yield _Sleep(0.1)
+  maintenance.Stop()
+  monitor.Stop()
+  stats = maintenance.Stats()
+  left = backend.Backlog()['messages']
+  return [operation, '%d' % messages,
+                   'one go' if budget > 1 else '%.0f ms' % (budget * 1000),
+                   '%.1f' % (call * 1000), '%.0f' % (done * 1000),
+                   '%.1f' % stats['max_stall_ms'], '%d' % stats['stalls'],
+                   '%.1f' % stats['max_slice_ms'], '%d' % left]
+
+@inlineCallbacks
+def _Main(args):
+  rows = []
+  try:
+    for operation in ('unsubscribe', 'purge', 'retention'):
+      for budget in (3600, args.budget_ms / 1000.0):
+        rows.append((yield _Measure(operation, budget, args.messages)))
+  finally:
+    reactor.stop()
+  common.PrintTable(['operation', 'messages', 'slices', 'call ms', 'done ms',
+                     'max stall ms', 'stalls > 50ms', 'max slice ms',
+                     'pending after'], rows)
+
+def main():
+  parser = common.ArgParser(__doc__)
+  parser.add_argument('--messages', type=int, default=1000000)
+  parser.add_argument('--budget-ms', type=float, default=5)
+  args = parser.parse_args()
+  reactor.callWhenRunning(_Main, args)
+  reactor.run()
+
+if __name__ == '__main__':
+  main()
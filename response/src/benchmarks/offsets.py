@@ -0,0 +1,80 @@
+"""Compares catching up on a backlog by polling with offset reads.
+
+A user subscribed to one topic on a single server has --messages messages
+pending, with a second subscriber that takes nothing, so the topic keeps
+them all. The user then takes every message, each way:
+
+  poll    GET /<topic>/<user> until it answers 204, a message per request.
+  read    GET /<topic>/<user>?offset=N&limit=--limit, then POST
+          ?commit=<last seq read>, until a read answers 204.
+
+Both use one keep-alive connection (client.BlockingClient). Reported: the
+requests made, the time to take every message, and the messages taken per
+second.
+
+Usage (from src/):
+  python -m benchmarks.offsets [--messages N] [--limit N] [--body N]
+"""
+
+import time
+
+import client
+
+from benchmarks import common
+
+def _Poll(pubsub):
+  """Takes every message by polling, returning (messages, requests)."""
+  messages = requests = 0
+  while True:
+    requests += 1
+    if pubsub.Poll(b'topic', b'user')[0] != 200:
+      return messages, requests
+    messages += 1
+
+def _Read(pubsub, limit):
+  """Takes every message with reads and commits, as (messages, requests)."""
+  messages = requests = 0
+  offset = 0
+  while True:
+    requests += 1
+    status, taken, offset = pubsub.Read(b'topic', b'user', offset, limit)
+    if status != 200:
+      return messages, requests
+    messages += len(taken)
+    requests += 1
+    pubsub.Commit(b'topic', b'user', taken[-1][0])
+
+def main():
+  parser = common.ArgParser(__doc__)
+  parser.add_argument('--messages', type=int, default=20000)
+  parser.add_argument('--limit', type=int, default=100)
+  parser.add_argument('--body', type=int, default=100)
+  args = parser.parse_args()
+
+  rows = []
+  for method in ('poll', 'read'):
+    port, procs = common.StartSingle()
+    try:
+      pubsub = client.BlockingClient('localhost:%d' % port)
+      for user in (b'user', b'idle'):
+        pubsub.Subscribe(b'topic', user)
+      publisher = pubsub.Publisher(senders=8)
+      for _ in range(args.messages):
+        publisher.Publish(b'topic', b'x' * args.body)
+      publisher.Close()
+      start = time.time()
+      if method == 'poll':
+        messages, requests = _Poll(pubsub)
+      else:
+        messages, requests = _Read(pubsub, args.limit)
+      elapsed = time.time() - start
+      pubsub.Close()
+    finally:
+      common.StopProcesses(procs)
+    rows.append([method, '%d' % messages, '%d' % requests,
+                 '%.0f' % (1000 * elapsed), '%.0f' % (messages / elapsed)])
+  common.PrintTable(['method', 'messages', 'requests', 'ms', 'messages/s'],
+                    rows)
+
+if __name__ == '__main__':
+  main()
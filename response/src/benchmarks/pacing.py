@@ -0,0 +1,120 @@
+"""Measures how much poll pacing cuts the polls of mostly cold topics.
+
+Worker 0 publishes to --hot topics at --hot-rate messages a second each and
+to --cold topics at --cold-rate each, bodies holding the time they were sent.
+Every other worker subscribes its own user to all of the topics and polls
+them as client.Consumer does: at once after a message, and after a 204 again
+once the server's X-Poll-After wait has passed, or without one backing off
+from 10ms, doubling up to --max-idle-delay.
+
+Runs against a frontend with 2 backends, with pacing off and with waits of up
+to --max-wait seconds (POLL_PACING_MAX_WAIT), reporting the polls a second
+the frontend served, the share of them that were empty, and the delay from
+publish to delivery on hot and cold topics. Publishing starts a second in,
+and rates are averaged over 10 seconds (see pacing.py), so runs should be a
+good deal longer than that. A topic starts out cold: until its rate is
+known its pollers are asked to wait up to --max-wait.
+
+Usage (from src/):
+  python -m benchmarks.pacing [--max-wait S] [--hot N] [--cold N]
+"""
+
+import time
+
+from benchmarks import common
+
+def _Topics(hot, cold):
+  return ['hot-%d' % i for i in range(hot)] + ['cold-%d' % i
+                                               for i in range(cold)]
+
+def _Publish(client, deadline, hot, cold, hot_rate, cold_rate):
+  """Publishes to every topic at its rate until deadline."""
+  start = time.time() + 1
+  due = dict((topic, start) for topic in _Topics(hot, cold))
+  while True:
+    topic, at = min(due.items(), key=lambda item: item[1])
+    if at >= deadline:
+      return []
+    time.sleep(max(0.0, at - time.time()))
+    client.Request('POST', '/%s' % topic, repr(time.time()).encode('ascii'))
+    due[topic] = at + 1.0 / (hot_rate if topic.startswith('hot') else
+                             cold_rate)
+
+def PacedPollWorkload(client, worker_id, deadline, hot=2, cold=40,
+                      hot_rate=20.0, cold_rate=0.05, max_idle_delay=0.25):
+  """Worker 0 publishes, the others poll every topic, see the docstring.
+
+  Returns:
+    A list of ('poll', 0) per poll, ('empty', 0) per 204 and ('hot' or
+    'cold', seconds from publish to delivery) per message.
+  """
+  if worker_id == 0:
+    return _Publish(client, deadline, hot, cold, hot_rate, cold_rate)
+  user = 'user-%d' % worker_id
+  topics = _Topics(hot, cold)
+  for topic in topics:
+    client.Request('POST', '/%s/%s' % (topic, user))
+  due = dict((topic, time.time()) for topic in topics)
+  delays = dict((topic, 0.01) for topic in topics)
+  records = []
+  while True:
+    topic, at = min(due.items(), key=lambda item: item[1])
+    if at >= deadline:
+      return records
+    time.sleep(max(0.0, at - time.time()))
+    status, body, headers = client.Request('GET', '/%s/%s' % (topic, user))
+    now = time.time()
+    records.append(('poll', 0))
+    if status == 200:
+      records.append((topic.split('-')[0], now - float(body)))
+      delays[topic] = 0.01
+      due[topic] = now
+    elif 'X-Poll-After' in headers:
+      records.append(('empty', 0))
+      due[topic] = now + int(headers['X-Poll-After']) / 1000.0
+    else:
+      records.append(('empty', 0))
+      due[topic] = now + delays[topic]
+      delays[topic] = min(delays[topic] * 2, max_idle_delay)
+
+def main():
+  parser = common.ArgParser(__doc__)
+  parser.set_defaults(duration=20.0, concurrency=3)
+  parser.add_argument('--max-wait', type=float, default=2.0)
+  parser.add_argument('--hot', type=int, default=2)
+  parser.add_argument('--cold', type=int, default=40)
+  parser.add_argument('--hot-rate', type=float, default=20.0)
+  parser.add_argument('--cold-rate', type=float, default=0.05)
+  parser.add_argument('--max-idle-delay', type=float, default=0.25)
+  args = parser.parse_args()
+
+  rows = []
+  for max_wait in (0, args.max_wait):
+    port, procs = common.StartCluster(2, frontend_env={
+        'POLL_PACING_MAX_WAIT': str(max_wait)})
+    try:
+      result = common.RunLoad(
+          port, PacedPollWorkload, concurrency=args.concurrency,
+          duration=args.duration, hot=args.hot, cold=args.cold,
+          hot_rate=args.hot_rate, cold_rate=args.cold_rate,
+          max_idle_delay=args.max_idle_delay)
+    finally:
+      common.StopProcesses(procs)
+    records = result['latencies']
+    polls = sum(1 for kind, _ in records if kind == 'poll')
+    empty = sum(1 for kind, _ in records if kind == 'empty')
+    row = ['max wait %gs' % max_wait if max_wait else 'no pacing',
+           '%.0f' % (polls / result['elapsed']),
+           '%.1f%%' % (100.0 * empty / max(1, polls))]
+    for kind in ('hot', 'cold'):
+      delays = sorted(seconds for k, seconds in records if k == kind)
+      row += ['%d' % len(delays),
+              '%.0f' % (1000 * common.Percentile(delays, 50)),
+              '%.0f' % (1000 * common.Percentile(delays, 99))]
+    rows.append(row)
+  common.PrintTable(['config', 'polls/s', 'empty', 'hot msgs', 'hot p50 ms',
+                     'hot p99 ms', 'cold msgs', 'cold p50 ms', 'cold p99 ms'],
+                    rows)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,52 @@
+"""Measures a single hot topic's throughput as it is partitioned K ways.
+
+Every worker subscribes its own user to one topic. The first --publishers
+workers then post to it in a loop while the rest poll for messages.
+
+Usage (from src/):
+  python -m benchmarks.partitions [--backends N] [--duration S]
+"""
+
+import time
+
+from benchmarks import common
+
+def HotTopicWorkload(client, worker_id, deadline, publishers=2,
+                     body=b'x' * 100):
+  """Publishes or polls the 'hot' topic until deadline."""
+  user = 'user-%d' % worker_id
+  client.Request('POST', '/hot/%s' % user)
+  latencies = []
+  while time.time() < deadline:
+    start = time.time()
+    if worker_id < publishers:
+      client.Request('POST', '/hot', body)
+    else:
+      client.Request('GET', '/hot/%s' % user)
+    latencies.append(time.time() - start)
+  return latencies
+
+def main():
+  parser = common.ArgParser(__doc__)
+  parser.add_argument('--backends', type=int, default=4)
+  parser.add_argument('--publishers', type=int, default=2)
+  args = parser.parse_args()
+
+  rows = []
+  k = 1
+  while k <= args.backends:
+    port, procs = common.StartCluster(
+        args.backends, frontend_env={'PARTITIONED_TOPICS': 'hot:%d' % k})
+    try:
+      result = common.RunLoad(port, HotTopicWorkload,
+                              concurrency=args.concurrency,
+                              duration=args.duration,
+                              publishers=args.publishers)
+    finally:
+      common.StopProcesses(procs)
+    rows.append(common.Summarize('K=%d' % k, result))
+    k *= 2
+  common.PrintTable(common.SUMMARY_HEADER, rows)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,81 @@
+"""Measures the cost of matching a published topic against N patterns.
+
+Compares PatternIndex, the trie MemoryBackend uses, with checking every
+pattern in turn. Patterns are a mix of svcI.*, svcI.#, *.evtI and svcI.*.evtJ,
+and topics are svcI.REGION.evtJ, so most patterns do not match. The match
+cache is disabled so every topic is matched from scratch.
+
+Usage (from src/):
+  python -m benchmarks.patterns [--counts 10,100,1000,10000,100000]
+"""
+
+import random
+import time
+
+from benchmarks import common
+from patterns import PatternIndex
+
+def _Patterns(count, rng):
+  """Returns count distinct patterns over about count / 4 services."""
+  services = max(1, count // 4)
+  patterns = set()
+  while len(patterns) < count:
+    i = rng.randrange(services)
+    patterns.add(rng.choice([
+        b'svc%d.*' % i, b'svc%d.#' % i, b'*.evt%d' % i,
+        b'svc%d.*.evt%d' % (i, rng.randrange(100))]))
+  return list(patterns)
+
+def _SegmentsMatch(pattern, topic):
+  """Whether the pattern segments match the topic segments, by recursion."""
+  if not pattern:
+    return not topic
+  if pattern[0] == b'#':
+    return any(_SegmentsMatch(pattern[1:], topic[i:])
+               for i in range(len(topic) + 1))
+  if not topic:
+    return False
+  return (pattern[0] in (b'*', topic[0]) and
+          _SegmentsMatch(pattern[1:], topic[1:]))
+
+def _LinearMatch(patterns, topic):
+  segments = topic.split(b'.')
+  return [p for p, split in patterns if _SegmentsMatch(split, segments)]
+
+def _Time(function, topics):
+  """Returns microseconds per call of function over topics."""
+  start = time.time()
+  for topic in topics:
+    function(topic)
+  return (time.time() - start) / len(topics) * 1e6
+
+def main():
+  parser = common.ArgParser(__doc__)
+  parser.add_argument('--counts', default='10,100,1000,10000,100000')
+  parser.add_argument('--topics', type=int, default=2000)
+  args = parser.parse_args()
+
+  rng = random.Random(0)
+  rows = []
+  for count in [int(c) for c in args.counts.split(',')]:
+    patterns = _Patterns(count, rng)
+    index = PatternIndex(cache_size=0)
+    for pattern in patterns:
+      index.Add(pattern)
+    services = max(1, count // 4)
+    topics = [b'svc%d.%s.evt%d' % (rng.randrange(services),
+                                   rng.choice([b'eu', b'us', b'ap']),
+                                   rng.randrange(100))
+              for _ in range(args.topics)]
+    split = [(p, p.split(b'.')) for p in patterns]
+    matches = sum(len(index.Match(t)) for t in topics) / float(len(topics))
+    trie_us = _Time(index.Match, topics)
+    # The scan is slow enough at large counts to need fewer samples.
+    sample = topics[:max(20, args.topics * 100 // count)]
+    linear_us = _Time(lambda t: _LinearMatch(split, t), sample)
+    rows.append([count, '%.1f' % matches, '%.1f' % trie_us,
+                 '%.0f' % linear_us])
+  common.PrintTable(['patterns', 'matches/topic', 'trie us', 'scan us'], rows)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,68 @@
+"""Measures how much the frontend poll cache saves on mostly empty polls.
+
+Each worker subscribes its own user to one of --topics topics and then polls
+it in a loop, publishing to it once every --polls-per-publish polls, through a
+frontend with 2 backends. Runs with the cache off and with --ttl, reporting
+throughput, latency and the cache's hit rate.
+
+Usage (from src/):
+  python -m benchmarks.pollcache [--ttl S] [--polls-per-publish N]
+"""
+
+import json
+import time
+
+try:
+  from urllib.request import urlopen
+except ImportError:
+  from urllib2 import urlopen
+
+from benchmarks import common
+
+def MostlyEmptyPollWorkload(client, worker_id, deadline, topics=16,
+                            polls_per_publish=20, body=b'x' * 100):
+  """Polls the worker's topic, publishing to it now and then."""
+  topic = 'idle-%d' % (worker_id % topics)
+  user = 'user-%d' % worker_id
+  client.Request('POST', '/%s/%s' % (topic, user))
+  latencies = []
+  requests = 0
+  while time.time() < deadline:
+    start = time.time()
+    if requests % polls_per_publish == 0:
+      client.Request('POST', '/%s' % topic, body)
+    else:
+      client.Request('GET', '/%s/%s' % (topic, user))
+    latencies.append(time.time() - start)
+    requests += 1
+  return latencies
+
+def main():
+  parser = common.ArgParser(__doc__)
+  parser.add_argument('--ttl', type=float, default=0.5)
+  parser.add_argument('--polls-per-publish', type=int, default=20)
+  args = parser.parse_args()
+
+  rows = []
+  for ttl in (0, args.ttl):
+    admin_port = common.FreePort()
+    port, procs = common.StartCluster(2, frontend_env={
+        'POLL_CACHE_TTL': str(ttl), 'ADMIN_PORT': str(admin_port)})
+    try:
+      result = common.RunLoad(port, MostlyEmptyPollWorkload,
+                              concurrency=args.concurrency,
+                              duration=args.duration,
+                              polls_per_publish=args.polls_per_publish)
+      hit_rate = '-'
+      if ttl:
+        stats = json.loads(urlopen('http://127.0.0.1:%d/pollcache' %
+                                   admin_port).read().decode('utf-8'))
+        hit_rate = '%.0f%%' % (100 * stats['hit_rate'])
+    finally:
+      common.StopProcesses(procs)
+    name = 'TTL %gs' % ttl if ttl else 'no cache'
+    rows.append(common.Summarize(name, result) + [hit_rate])
+  common.PrintTable(common.SUMMARY_HEADER + ['hit rate'], rows)
+
+if __name__ == '__main__':
+  main()
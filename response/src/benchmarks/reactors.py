@@ -0,0 +1,36 @@
+"""Compares request throughput and latency across the selectable reactors.
+
+Usage (from src/):
+  python -m benchmarks.reactors [--cluster N] [--duration S] [--concurrency C]
+"""
+
+from benchmarks import common
+
+REACTORS = ['epoll', 'poll', 'select', 'asyncio']
+
+def main():
+  parser = common.ArgParser(__doc__)
+  parser.add_argument('--cluster', type=int, default=0,
+                      help='Run a frontend with this many backends instead '
+                           'of a single server.')
+  parser.add_argument('--reactors', default=','.join(REACTORS),
+                      help='Comma separated reactors to compare.')
+  args = parser.parse_args()
+
+  rows = []
+  for name in args.reactors.split(','):
+    env = {'REACTOR': name}
+    if args.cluster:
+      port, procs = common.StartCluster(args.cluster, env)
+    else:
+      port, procs = common.StartSingle(env)
+    try:
+      result = common.RunLoad(port, concurrency=args.concurrency,
+                              duration=args.duration)
+    finally:
+      common.StopProcesses(procs)
+    rows.append(common.Summarize(name, result))
+  common.PrintTable(common.SUMMARY_HEADER, rows)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,254 @@
+"""Replays a traffic capture (see capture.py) against a server.
+
+Every captured request is sent again, with a body of the captured size for
+publishes, at the captured time scaled by --speed: 1 replays at the captured
+rate, 4 at four times it, and 0 as fast as the server answers. Timed replays
+are open loop: a request is sent when it is due even if earlier ones are
+still waiting, up to --concurrency in flight, and its latency counts from
+when it was due, so a server falling behind shows up as latency rather than
+as a slower send rate. At speed 0 --concurrency requests are kept in flight
+and latency is service time.
+
+By default the subscriptions polled in the capture but made before it began
+are made first, so polls get what the captured ones got rather than 404s.
+Offset reads (see offsets.py) are replayed from offset 0, and commits commit
+what the replay last read of their subscription.
+Without --target a server is started, with --backends backends behind a
+frontend if set.
+
+Reported per operation: requests, req/s, latency percentiles, and the
+statuses, against the captured p50 and p99.
+
+Usage (from src/):
+  python -m benchmarks.replay CAPTURE [--speed X] [--concurrency N]
+                              [--target HOST:PORT | --backends N]
+                              [--no-presubscribe]
+"""
+
+import collections
+import time
+
+from capture import COMMIT
+from capture import OP_NAMES
+from capture import OTHER
+from capture import POLL
+from capture import PUBLISH
+from capture import READ
+from capture import SUBSCRIBE
+from capture import UNSUBSCRIBE
+from capture import ReadCapture
+
+from benchmarks import common
+
+_PUMP_INTERVAL = 0.001
+
+def _Subscriptions(path):
+  """Returns the (topic, user) pairs polled before any subscribe of theirs."""
+  subscribed = set()
+  needed = set()
+  with open(path, 'rb') as f:
+    for request in ReadCapture(f)[2]:
+      pair = (request.topic, request.user)
+      if request.op in (SUBSCRIBE, UNSUBSCRIBE):
+        subscribed.add(pair)
+      elif request.op in (POLL, READ, COMMIT) and pair not in subscribed:
+        needed.add(pair)
+  return needed
+
+def _Send(pubsub, request, read_to):
+  """Sends request through a client.PubSubClient, firing with the status.
+
+  Reads are from offset 0, and commits commit what the replay last read of
+  their subscription, kept in read_to.
+  """
+  if request.op == PUBLISH:
+    return pubsub.Publish(request.topic, b'x' * request.size)
+  if request.op == SUBSCRIBE:
+    return pubsub.Subscribe(request.topic, request.user)
+  if request.op == UNSUBSCRIBE:
+    return pubsub.Unsubscribe(request.topic, request.user)
+  if request.op == POLL:
+    return pubsub.Poll(request.topic, request.user).addCallback(
+        lambda result: result[0])
+  pair = (request.topic, request.user)
+  if request.op == READ:
+    def Read(result):
+      if result[1]:
+        read_to[pair] = result[1][-1][0]
+      return result[0]
+    return pubsub.Read(request.topic, request.user, 0).addCallback(Read)
+  if request.op == COMMIT:
+    return pubsub.Commit(request.topic, request.user, read_to.get(pair, 0))
+  return pubsub.Inbox(request.user).addCallback(lambda result: result[0])
+
+def Replay(path, host, speed=1.0, concurrency=64, presubscribe=True):
+  """Replays the capture at path against host, running the reactor.
+
+  Returns:
+    A dict of op name to a dict with the latencies (sorted, seconds), the
+    captured durations (sorted) and a Counter of statuses, plus 'elapsed'.
+  """
+  from twisted.internet import reactor
+  from twisted.internet.defer import Deferred
+  from twisted.internet.defer import gatherResults
+  from twisted.internet.defer import inlineCallbacks
+
+  import client
+
+  pubsub = client.PubSubClient(host, max_connections=concurrency)
+  results = collections.defaultdict(lambda: {
+      'latencies': [], 'captured': [], 'statuses': collections.Counter()})
+  f = open(path, 'rb')
+  requests = ReadCapture(f)[2]
+  waiting = collections.deque()
+  state = {'in_flight': 0, 'start': None, 'end': None, 'next': None,
+           'exhausted': False}
+  done = []
+  read_to = {}
+
+  def Issue(request, due):
+    state['in_flight'] += 1
+    result = results[OP_NAMES[request.op]]
+    result['captured'].append(request.duration)
+
+    def Finished(status):
+      result['latencies'].append(time.time() - due)
+      result['statuses'][status] += 1
+
+    def Failed(failure):
+      result['statuses']['error'] += 1
+
+    def Next(_):
+      state['in_flight'] -= 1
+      if waiting:
+        Issue(*waiting.popleft())
+      elif speed == 0 and not state['exhausted']:
+        Pump()
+      elif state['exhausted'] and not state['in_flight']:
+        Finish()
+    d = _Send(pubsub, request, read_to)
+    d.addCallbacks(Finished, Failed).addCallback(Next)
+
+  def Take():
+    """Returns the next request to replay, or None at the end."""
+    for request in requests:
+      if request.op != OTHER:
+        return request
+    state['exhausted'] = True
+    return None
+
+  def Pump():
+    """Sends every request that is due, then waits for the next one."""
+    while True:
+      if state['next'] is None:
+        state['next'] = Take()
+        if state['next'] is None:
+          if not state['in_flight']:
+            Finish()
+          return
+      request = state['next']
+      if speed == 0:
+        if state['in_flight'] >= concurrency:
+          return
+        due = time.time()
+      else:
+        due = state['start'] + request.arrival / speed
+        wait = due - time.time()
+        if wait > 0:
+          reactor.callLater(max(wait, _PUMP_INTERVAL), Pump)
+          return
+      state['next'] = None
+      if state['in_flight'] < concurrency:
+        Issue(request, due)
+      else:
+        waiting.append((request, due))
+
+  def Finish():
+    if state['end'] is None:
+      state['end'] = time.time()
+      done[0].callback(None)
+
+  @inlineCallbacks
+  def Run():
+    try:
+      if presubscribe:
+        pairs = list(_Subscriptions(path))
+        for i in range(0, len(pairs), concurrency):
+          yield gatherResults([pubsub.Subscribe(topic, user)
+                               for topic, user in pairs[i:i + concurrency]])
+      done.append(Deferred())
+      state['start'] = time.time()
+      Pump()
+      yield done[0]
+      yield pubsub.Close()
+    finally:
+      reactor.stop()
+
+  reactor.callWhenRunning(Run)
+  reactor.run()
+  f.close()
+  results = dict(results)
+  for result in results.values():
+    result['latencies'].sort()
+    result['captured'].sort()
+  results['elapsed'] = (state['end'] or time.time()) - state['start']
+  return results
+
+def Rows(results, name=None):
+  """Turns Replay results into PrintTable rows, one per op and a total."""
+  elapsed = results['elapsed']
+  ops = [op for op in OP_NAMES if op in results]
+  total = {'latencies': [], 'captured': [], 'statuses': collections.Counter()}
+  for op in ops:
+    total['latencies'].extend(results[op]['latencies'])
+    total['captured'].extend(results[op]['captured'])
+    total['statuses'].update(results[op]['statuses'])
+  total['latencies'].sort()
+  total['captured'].sort()
+  rows = []
+  for op, result in [(op, results[op]) for op in ops] + [('all', total)]:
+    latencies = result['latencies']
+    row = [op, '%d' % sum(result['statuses'].values()),
+           '%.0f' % (sum(result['statuses'].values()) / elapsed)]
+    row += ['%.2f' % (1000 * common.Percentile(latencies, pct))
+            for pct in (50, 90, 99)]
+    row += ['%.2f' % (1000 * (latencies[-1] if latencies else 0))]
+    row += ['%.2f' % (1000 * common.Percentile(result['captured'], pct))
+            for pct in (50, 99)]
+    row.append(' '.join('%s:%d' % item
+                        for item in sorted(result['statuses'].items(),
+                                           key=lambda item: str(item[0]))))
+    rows.append(([name] if name is not None else []) + row)
+  return rows
+
+HEADER = ['op', 'requests', 'req/s', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms',
+          'captured p50 ms', 'captured p99 ms', 'statuses']
+
+def main():
+  parser = common.ArgParser(__doc__)
+  parser.add_argument('capture')
+  parser.add_argument('--speed', type=float, default=1.0)
+  parser.add_argument('--target', default=None)
+  parser.add_argument('--backends', type=int, default=0)
+  parser.add_argument('--no-presubscribe', dest='presubscribe',
+                      action='store_false')
+  parser.set_defaults(concurrency=64)
+  args = parser.parse_args()
+
+  procs = []
+  host = args.target
+  if host is None:
+    if args.backends:
+      port, procs = common.StartCluster(args.backends)
+    else:
+      port, procs = common.StartSingle()
+    host = 'localhost:%d' % port
+  try:
+    results = Replay(args.capture, host, args.speed, args.concurrency,
+                     args.presubscribe)
+  finally:
+    common.StopProcesses(procs)
+  common.PrintTable(HEADER, Rows(results))
+
+if __name__ == '__main__':
+  main()
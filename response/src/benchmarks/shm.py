@@ -0,0 +1,98 @@
+"""Compares the shared memory transport with loopback HTTP.
+
+Transport: one backend process, driven directly from this process through a
+ProxyBackend and then a ShmBackend, --requests publishes one at a time
+(latency) and then --requests publishes with --window in flight (throughput).
+
+End to end: the default load through 1 frontend and 2 backends, reached over
+HTTP and then over shared memory.
+
+Usage (from src/):
+  python -m benchmarks.shm [--requests N] [--window N] [--body-size BYTES]
+"""
+
+import os
+import shutil
+import tempfile
+import time
+
+from benchmarks import common
+
+def _Transport(args, shm_dir):
+  """Measures the backend calls alone, returning table rows."""
+  from twisted.internet import reactor
+  from twisted.internet.defer import DeferredSemaphore
+  from twisted.internet.defer import gatherResults
+  from twisted.internet.defer import inlineCallbacks
+
+  from backends.proxy import ProxyBackend
+  from backends.shm import ShmBackend
+
+  socket_path = os.path.join(shm_dir, 'transport.sock')
+  port = common.FreePort()
+  procs = [common.StartProcess('clustered_backend.py', port,
+                               {'SHM_SOCKET': socket_path})]
+  body = b'x' * args.body_size
+  rows = []
+
+  @inlineCallbacks
+  def Measure(name, backend):
+    yield backend.Subscribe(b'warmup', b'user')
+    latencies = []
+    for _ in range(args.requests):
+      start = time.time()
+      yield backend.PostMessage(b'topic', body)
+      latencies.append(time.time() - start)
+    latencies.sort()
+    semaphore = DeferredSemaphore(args.window)
+    start = time.time()
+    yield gatherResults([semaphore.run(backend.PostMessage, b'topic', body)
+                         for _ in range(args.requests)])
+    elapsed = time.time() - start
+    rows.append([name, '%.0f' % (1e6 * common.Percentile(latencies, 50)),
+                 '%.0f' % (1e6 * common.Percentile(latencies, 99)),
+                 '%.0f' % (args.requests / elapsed)])
+
+  @inlineCallbacks
+  def Run():
+    try:
+      yield Measure('http', ProxyBackend('localhost:%d' % port))
+      yield Measure('shm', ShmBackend(socket_path))
+    finally:
+      reactor.stop()
+
+  reactor.callWhenRunning(Run)
+  try:
+    reactor.run()
+  finally:
+    common.StopProcesses(procs)
+  return rows
+
+def main():
+  parser = common.ArgParser(__doc__)
+  parser.add_argument('--requests', type=int, default=5000)
+  parser.add_argument('--window', type=int, default=64)
+  parser.add_argument('--body-size', type=int, default=100)
+  args = parser.parse_args()
+
+  shm_dir = tempfile.mkdtemp()
+  try:
+    rows = _Transport(args, shm_dir)
+    common.PrintTable(['transport', 'p50 us', 'p99 us',
+                       'publishes/s (%d in flight)' % args.window], rows)
+    print('')
+    rows = []
+    for name, directory in (('http', None), ('shm', shm_dir)):
+      port, procs = common.StartCluster(2, shm_dir=directory)
+      try:
+        result = common.RunLoad(port, concurrency=args.concurrency,
+                                duration=args.duration)
+      finally:
+        common.StopProcesses(procs)
+      rows.append(common.Summarize(name, result))
+    common.PrintTable(common.SUMMARY_HEADER, rows)
+  finally:
+    shutil.rmtree(shm_dir)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,97 @@
+"""Measures the cost and accuracy of the traffic sketches.
+
+First feeds TrafficSketches --requests publishes and polls over --topics
+topics with Zipf distributed popularity and --users users, reporting the cost
+per request and how the top 10 topics and distinct counts compare with exact
+counting. Then runs the default load through a frontend with 2 backends with
+SKETCH_WINDOW off and on, and checks the frontend's merged cluster-sketches
+endpoint against the workload.
+
+Usage (from src/):
+  python -m benchmarks.sketches [--requests N] [--topics N] [--users N]
+"""
+
+import collections
+import json
+import random
+import time
+
+try:
+  from urllib.request import urlopen
+except ImportError:
+  from urllib2 import urlopen
+
+from benchmarks import common
+from sketches import Report
+from sketches import TrafficSketches
+
+def _ZipfTopics(count, topics, rng, s=1.1):
+  """Returns count topic names drawn with Zipf(s) popularity."""
+  weights = [1.0 / (rank ** s) for rank in range(1, topics + 1)]
+  names = [b'topic-%d' % i for i in range(topics)]
+  return rng.choices(names, weights, k=count)
+
+def _Accuracy(args):
+  rng = random.Random(0)
+  topics = _ZipfTopics(args.requests, args.topics, rng)
+  users = [b'user-%d' % rng.randrange(args.users) for _ in topics]
+  sketches = TrafficSketches(window=3600)
+  start = time.time()
+  for i, (topic, user) in enumerate(zip(topics, users)):
+    if i % 2:
+      sketches.RecordPoll(topic, user)
+    else:
+      sketches.RecordPublish(topic, b'10.0.%d.%d' % (i % 7, i % 11), 100)
+  us = (time.time() - start) / len(topics) * 1e6
+  report = Report(sketches.Export()['current'], limit=10)
+  exact = collections.Counter(topics[::2])
+  true_top = set(t.decode('ascii') for t, _ in exact.most_common(10))
+  found_top = set(t['topic'] for t in report['top_published'])
+  worst = max(abs(t['count'] - exact[t['topic'].encode('ascii')]) /
+              float(exact[t['topic'].encode('ascii')])
+              for t in report['top_published'])
+  distinct = len(set(users[1::2]))
+  common.PrintTable(
+      ['requests', 'topics', 'us/request', 'top-10 recall',
+       'worst top-10 count error', 'distinct users', 'HLL estimate'],
+      [[args.requests, args.topics, '%.1f' % us,
+        '%d/10' % len(true_top & found_top), '%.1f%%' % (100 * worst),
+        distinct, report['distinct_subscribers']]])
+
+def _Cluster(args):
+  rows = []
+  for window in (0, 60):
+    admin_port = common.FreePort()
+    port, procs = common.StartCluster(
+        2, env={'SKETCH_WINDOW': str(window)},
+        frontend_env={'ADMIN_PORT': str(admin_port)}, backend_admin=True)
+    try:
+      result = common.RunLoad(port, concurrency=args.concurrency,
+                              duration=args.duration)
+      top = '-'
+      if window:
+        report = json.loads(urlopen(
+            'http://127.0.0.1:%d/cluster-sketches?limit=1' % admin_port)
+            .read().decode('utf-8'))['current']
+        top = '%s (%d), %d users' % (
+            report['top_published'][0]['topic'],
+            report['top_published'][0]['count'],
+            report['distinct_subscribers'])
+    finally:
+      common.StopProcesses(procs)
+    name = 'sketches %gs' % window if window else 'no sketches'
+    rows.append(common.Summarize(name, result) + [top])
+  common.PrintTable(common.SUMMARY_HEADER + ['cluster top topic'], rows)
+
+def main():
+  parser = common.ArgParser(__doc__)
+  parser.add_argument('--requests', type=int, default=1000000)
+  parser.add_argument('--topics', type=int, default=100000)
+  parser.add_argument('--users', type=int, default=200000)
+  args = parser.parse_args()
+  _Accuracy(args)
+  print('')
+  _Cluster(args)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,93 @@
+"""Measures snapshot and restore times for large MemoryBackend states.
+
+For each --sizes entry a fresh process fills a MemoryBackend with that many
+GiB of random message bodies (spread over 1000 topics with 4 subscribers each,
+one of whom has already read every other message), takes a snapshot through
+Snapshotter and reports how long the fork paused the process, how long the
+child took to write the file and its size. Another fresh process then restores
+the file and reports how long that took.
+
+Usage (from src/):
+  python -m benchmarks.snapshots [--sizes 0.5,1,2] [--body-size B] [--dir D]
+"""
+
+import multiprocessing
+import os
+import tempfile
+import time
+
+from twisted.internet.task import Clock
+
+from backends.memory import MemoryBackend
+from benchmarks import common
+from snapshot import Snapshotter
+
+def _Fill(backend, total_bytes, body_size, topics=1000, subscribers=4):
+  """Publishes total_bytes of random bodies to backend."""
+  for t in range(topics):
+    for s in range(subscribers):
+      backend.Subscribe(b'topic-%d' % t, b'user-%d' % s)
+  for i in range(total_bytes // body_size):
+    topic = b'topic-%d' % (i % topics)
+    backend.PostMessage(topic, os.urandom(body_size))
+    if i % 2:
+      backend.GetMessage(topic, b'user-0')
+
+def _Snapshot(path, total_bytes, body_size, results):
+  backend = MemoryBackend()
+  _Fill(backend, total_bytes, body_size)
+  clock = Clock()
+  snapshotter = Snapshotter(backend, path, on_shutdown=False)
+  snapshotter.Start(clock)
+  done = []
+  snapshotter.Take().addCallback(done.append)
+  while not done:
+    time.sleep(0.01)
+    clock.advance(0.05)
+  results.put(done[0])
+
+def _Restore(path, results):
+  snapshotter = Snapshotter(MemoryBackend(), path, on_shutdown=False)
+  snapshotter.Restore()
+  results.put(snapshotter.Stats())
+
+def _InProcess(target, *args):
+  """Runs target in a fresh process, returning what it put on the queue."""
+  results = multiprocessing.Queue()
+  proc = multiprocessing.Process(target=target, args=args + (results,))
+  proc.start()
+  result = results.get()
+  proc.join()
+  return result
+
+def main():
+  parser = common.ArgParser(__doc__)
+  parser.add_argument('--sizes', default='0.5,1,2',
+                      help='Comma separated state sizes in GiB.')
+  parser.add_argument('--body-size', type=int, default=16384)
+  parser.add_argument('--dir', default=tempfile.gettempdir(),
+                      help='Where to write the snapshot file.')
+  args = parser.parse_args()
+
+  path = os.path.join(args.dir, 'bench-snapshot-%d' % os.getpid())
+  rows = []
+  try:
+    for gib in args.sizes.split(','):
+      total_bytes = int(float(gib) * 2 ** 30)
+      taken = _InProcess(_Snapshot, path, total_bytes, args.body_size)
+      restored = _InProcess(_Restore, path)
+      rows.append(['%s GiB' % gib,
+                   '%.1f' % taken['last_fork_ms'],
+                   '%.0f' % taken['last_duration_ms'],
+                   '%.0f' % (taken['last_bytes'] / 2.0 ** 20),
+                   '%.0f' % restored['restore_ms'],
+                   '%.0f' % (taken['last_bytes'] / 2.0 ** 20 /
+                             (restored['restore_ms'] / 1000.0))])
+  finally:
+    if os.path.exists(path):
+      os.unlink(path)
+  common.PrintTable(['state', 'fork pause ms', 'snapshot ms', 'file MiB',
+                     'restore ms', 'restore MiB/s'], rows)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,243 @@
+"""Traffic capture: a compact record of every request, to replay later.
+
+While capturing, a frontend appends one record per finished request to a
+file: when it arrived, how long it took, the operation, the status, the topic
+and user, and the size of the body published or delivered. Bodies
+themselves are not kept. Start a capture with CAPTURE_PATH, or at runtime
+from the admin port:
+
+  POST /capture?path=/tmp/prod.cap[&seconds=300]  start
+  POST /capture                                   stop
+  GET /capture                                    the counters
+
+With anonymize, every dot separated segment of topics and users is replaced
+by a keyed hash, with a new key per capture. Names stay distinct, wildcards
+stay wildcards, and topics that share a prefix still do, so patterns and
+prefix placement (see backends/hash.py) replay the same.
+
+The file is a header (_MAGIC, the capture's start time and flags) followed by
+records of _RECORD and then the topic and user. Records are buffered in
+memory and written _BUFFER_SIZE bytes at a time, and a capture stops by
+itself once it has written max_bytes. benchmarks/replay.py replays captures.
+"""
+
+import collections
+import hashlib
+import json
+import logging
+import os
+import struct
+import time
+
+from twisted.web.resource import Resource
+
+from offsets import IsCommit
+from offsets import IsRead
+from patterns import WILDCARDS
+
+_MAGIC = b'PSQCAP01'
+_HEADER = struct.Struct('<dB')  # start time, flags
+_ANONYMIZED = 1
+# Arrival (us since the start), duration (us), op, status, topic length,
+# user length, body size.
+_RECORD = struct.Struct('<QIBHHHI')
+_BUFFER_SIZE = 256 << 10
+_MAX_NAMES = 100000
+
+# Operations, numbered in the file.
+OTHER, PUBLISH, SUBSCRIBE, UNSUBSCRIBE, POLL, INBOX, READ, COMMIT = range(8)
+OP_NAMES = ('other', 'publish', 'subscribe', 'unsubscribe', 'poll', 'inbox',
+            'read', 'commit')
+
+CapturedRequest = collections.namedtuple(
+    'CapturedRequest', 'arrival duration op status topic user size')
+
+def OpFor(method, segments, args=None):
+  """Returns the operation of a request, and its topic and user.
+
+  Args:
+    method: The request's method.
+    segments: The path segments.
+    args: Optional query args, telling offset reads and commits (see
+      offsets.py) from polls and subscribes.
+  """
+  if method == b'POST' and len(segments) == 1:
+    return PUBLISH, segments[0], b''
+  if len(segments) == 2 and args:
+    if method == b'GET' and IsRead(args):
+      return READ, segments[0], segments[1]
+    if method == b'POST' and IsCommit(args):
+      return COMMIT, segments[0], segments[1]
+  if len(segments) == 2:
+    op = {b'POST': SUBSCRIBE, b'DELETE': UNSUBSCRIBE, b'GET': POLL}.get(
+        method, OTHER)
+    return op, segments[0], segments[1]
+  if method == b'GET' and len(segments) == 1:
+    return INBOX, b'', segments[0]
+  return OTHER, b'', b''
+
+class TrafficCapture(object):
+  """Records requests to a file while a capture is on."""
+
+  def __init__(self, path=None, anonymize=False, max_bytes=1 << 30,
+               clock=time.time):
+    """Constructor.
+
+    Args:
+      path: If set, capture to this file from Start on.
+      anonymize: Whether to hash topic and user names.
+      max_bytes: Size at which a capture stops.
+      clock: Function returning the current time in seconds.
+    """
+    self._path = path
+    self._anonymize = anonymize
+    self._max_bytes = max_bytes
+    self._clock = clock
+    self._reactor = None
+    self._file = None
+    self._buffer = bytearray()
+    self._start = None
+    self._key = None
+    self._names = {}
+    self._timer = None
+    self._stats = {'path': None, 'records': 0, 'bytes': 0}
+
+  @property
+  def active(self):
+    return self._file is not None
+
+  def Start(self, reactor):
+    """Starts capturing to path, if set, until the reactor stops."""
+    self._reactor = reactor
+    reactor.addSystemEventTrigger('before', 'shutdown', self.End)
+    if self._path:
+      self.Begin(self._path)
+
+  def Begin(self, path, seconds=None):
+    """Starts a capture to path, replacing the file, for seconds if set."""
+    if self._file is not None:
+      raise ValueError('Already capturing to %s' % self._stats['path'])
+    self._file = open(path, 'wb')
+    self._start = self._clock()
+    self._key = os.urandom(16)
+    self._names = {}
+    self._buffer = bytearray(_MAGIC + _HEADER.pack(
+        self._start, _ANONYMIZED if self._anonymize else 0))
+    self._stats = {'path': path, 'records': 0, 'bytes': len(self._buffer)}
+    if seconds:
+      self._timer = self._reactor.callLater(seconds, self.End)
+    logging.info('Capturing traffic to %s', path)
+
+  def End(self):
+    """Stops the capture, if there is one, writing out what is buffered."""
+    if self._file is None:
+      return
+    if self._timer is not None and self._timer.active():
+      self._timer.cancel()
+    self._timer = None
+    self.Flush()
+    self._file.close()
+    self._file = None
+    logging.info('Captured %d requests to %s', self._stats['records'],
+                 self._stats['path'])
+
+  def Flush(self):
+    if self._file is not None and self._buffer:
+      self._file.write(self._buffer)
+      self._file.flush()
+      self._buffer = bytearray()
+
+  def _Name(self, name):
+    anonymized = self._names.get(name)
+    if anonymized is None:
+      if len(self._names) >= _MAX_NAMES:
+        self._names = {}
+      anonymized = self._names[name] = b'.'.join(
+          s if s in WILDCARDS or not s else hashlib.blake2b(
+              s, key=self._key, digest_size=6).hexdigest().encode('ascii')
+          for s in name.split(b'.'))
+    return anonymized
+
+  def Record(self, op, topic, user, start, status, size):
+    """Records a request that arrived at start and has just finished."""
+    if self._file is None:
+      return
+    now = self._clock()
+    if self._anonymize:
+      topic = self._Name(topic)
+      user = self._Name(user)
+    topic = topic[:0xffff]
+    user = user[:0xffff]
+    buf = self._buffer
+    buf += _RECORD.pack(
+        max(0, int((start - self._start) * 1e6)),
+        min(0xffffffff, max(0, int((now - start) * 1e6))), op, status,
+        len(topic), len(user), min(size, 0xffffffff))
+    buf += topic
+    buf += user
+    self._stats['records'] += 1
+    self._stats['bytes'] += _RECORD.size + len(topic) + len(user)
+    if len(buf) >= _BUFFER_SIZE:
+      self.Flush()
+    if self._stats['bytes'] >= self._max_bytes:
+      self.End()
+
+  def Stats(self):
+    """Returns whether a capture is on, and what it has recorded."""
+    return dict(self._stats, active=self.active)
+
+  def AdminResources(self):
+    """Admin endpoints for captures, see admin.py."""
+    return {b'capture': CaptureResource(self)}
+
+def ReadCapture(f):
+  """Reads a capture from file object f.
+
+  Returns:
+    A (start time, anonymized, requests) tuple, requests being an iterator
+    of CapturedRequest with arrival and duration in seconds.
+  """
+  if f.read(len(_MAGIC)) != _MAGIC:
+    raise ValueError('Not a capture')
+  start, flags = _HEADER.unpack(f.read(_HEADER.size))
+
+  def Requests():
+    while True:
+      header = f.read(_RECORD.size)
+      if len(header) < _RECORD.size:
+        return
+      arrival, duration, op, status, topic_length, user_length, size = (
+          _RECORD.unpack(header))
+      topic = f.read(topic_length)
+      user = f.read(user_length)
+      yield CapturedRequest(arrival / 1e6, duration / 1e6, op, status, topic,
+                            user, size)
+  return start, bool(flags & _ANONYMIZED), Requests()
+
+class CaptureResource(Resource):
+  """Admin endpoint to start and stop captures, see the module docstring."""
+  isLeaf = True
+
+  def __init__(self, capture):
+    Resource.__init__(self)
+    self._capture = capture
+
+  def render_GET(self, request):
+    request.setHeader(b'Content-Type', b'application/json')
+    return json.dumps(self._capture.Stats()).encode('utf-8')
+
+  def render_POST(self, request):
+    path = request.args.get(b'path', [None])[0]
+    if path is None:
+      self._capture.End()
+      return self.render_GET(request)
+    seconds = request.args.get(b'seconds', [b'0'])[0]
+    try:
+      self._capture.Begin(path.decode('utf-8'), float(seconds))
+    except ValueError:
+      request.setResponseCode(409)
+      return b''
+    except IOError:
+      request.setResponseCode(400)
+      return b''
+    return self.render_GET(request)
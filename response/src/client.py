@@ -0,0 +1,791 @@
+"""Client library for the PubSub HTTP API.
+
+Two flavors with the same shape:
+
+  PubSubClient    For Twisted code: every call returns a Deferred. Built on
+                  server.Server with a pool of keep-alive connections.
+  BlockingClient  For code without a reactor: plain calls over a thread safe
+                  pool of keep-alive http.client connections.
+
+Both make the four calls (Publish, Subscribe, Unsubscribe, Poll), read
+inboxes (Inbox, see inbox.py), read and commit by offset (Read, Commit, see
+offsets.py) and create:
+
+  Publishers, which queue messages and send them in batches per topic, once a
+    batch holds max_batch_messages or max_batch_bytes, or has waited linger
+    seconds. The API has no batch endpoint, so a batch goes out as back to
+    back requests on pooled connections: one at a time, in order, when
+    ordered (the default), otherwise all at once. Batches of different topics
+    are sent in parallel. Every message gets an Idempotency-Key (see
+    dedup.py), so sends that fail or get a 5xx or 429 are retried without
+    risking duplicates.
+  Consumers, which poll a subscription up to `prefetch` messages ahead of the
+    application, backing off exponentially while it is empty, or waiting as
+    long as the server asks (X-Poll-After, see pacing.py). The API has no
+    long poll, and a prefetched message is already consumed on the server, so
+    it is lost if the process exits before handling it (Read and Commit are
+    for consumers that cannot lose messages).
+
+Every request's latency is recorded in a Histogram per call, see Stats().
+"""
+
+import collections
+import logging
+import math
+import threading
+import time
+import uuid
+import zlib
+
+try:
+  from http.client import HTTPConnection
+  from http.client import HTTPException
+except ImportError:
+  from httplib import HTTPConnection
+  from httplib import HTTPException
+
+try:
+  import queue
+except ImportError:
+  import Queue as queue
+
+try:
+  from urllib.parse import quote
+except ImportError:
+  from urllib import quote
+
+from twisted.internet.defer import Deferred
+from twisted.internet.defer import gatherResults
+from twisted.internet.defer import succeed
+
+from dedup import IDEMPOTENCY_KEY_HEADER
+from inbox import DecodeInbox
+from offsets import DecodeRange
+from pacing import POLL_AFTER_HEADER
+from server import Server
+
+def _Bytes(value):
+  return value if isinstance(value, bytes) else value.encode('utf-8')
+
+def _Path(*segments):
+  """Returns the request path for segments, escaped (e.g. '#' in patterns)."""
+  return b''.join(b'/' + quote(_Bytes(s), safe=b'').encode('ascii')
+                  for s in segments)
+
+def _ReadPath(topic, user, offset, limit):
+  return b'%s?offset=%d&limit=%d' % (_Path(topic, user), offset, limit)
+
+def _Range(result, offset):
+  """Returns (status, messages, next offset) of a read's (status, body)."""
+  messages, next_offset = DecodeRange(result[1])
+  if next_offset is None:
+    next_offset = offset
+  return result[0], messages, next_offset
+
+def _Paced(status, body, poll_after):
+  """Returns a poll's (status, body), plus the seconds to wait before polling
+  again if the server asked for a wait (see pacing.py)."""
+  if poll_after is None or not poll_after.isdigit():
+    return status, body
+  return status, body, int(poll_after) / 1000.0
+
+def _NewKey():
+  return uuid.uuid4().hex.encode('ascii')
+
+def _Retryable(status):
+  return status == 429 or status >= 500
+
+class PublishError(Exception):
+  """A publish still failed, or answered 5xx/429, after all its retries."""
+
+  def __init__(self, status):
+    Exception.__init__(self, 'Publish failed with status %d' % status)
+    self.status = status
+
+class ConsumerError(Exception):
+  """A consumer's subscription answered with something other than 200/204."""
+
+  def __init__(self, status):
+    Exception.__init__(self, 'Poll failed with status %d' % status)
+    self.status = status
+
+class Histogram(object):
+  """Latencies in log spaced buckets, 16 per doubling (within 4.4%)."""
+
+  _BUCKETS_PER_DOUBLING = 16
+
+  def __init__(self):
+    self._counts = collections.Counter()
+    self._lock = threading.Lock()
+    self.count = 0
+    self.total = 0.0
+    self.max = 0.0
+
+  def Record(self, seconds):
+    bucket = int(math.log2(max(seconds * 1e6, 1.0)) *
+                 self._BUCKETS_PER_DOUBLING)
+    with self._lock:
+      self._counts[bucket] += 1
+      self.count += 1
+      self.total += seconds
+      self.max = max(self.max, seconds)
+
+  def Percentile(self, pct):
+    """Returns the upper bound, in seconds, of the pct percentile's bucket."""
+    with self._lock:
+      target = max(1, int(math.ceil(self.count * pct / 100.0)))
+      seen = 0
+      for bucket in sorted(self._counts):
+        seen += self._counts[bucket]
+        if seen >= target:
+          return min(self.max, 2.0 ** (
+              (bucket + 1.0) / self._BUCKETS_PER_DOUBLING) / 1e6)
+    return 0.0
+
+  def Summary(self):
+    """Returns the count and the mean, p50, p90, p99 and max in ms."""
+    summary = {'count': self.count,
+               'mean_ms': 1000 * self.total / self.count if self.count else 0,
+               'max_ms': 1000 * self.max}
+    for pct in (50, 90, 99):
+      summary['p%d_ms' % pct] = 1000 * self.Percentile(pct)
+    return summary
+
+class _Histograms(object):
+  """A Histogram per call name."""
+
+  def __init__(self):
+    self._histograms = collections.defaultdict(Histogram)
+
+  def Record(self, name, seconds):
+    self._histograms[name].Record(seconds)
+
+  def Stats(self):
+    return dict((name, h.Summary()) for name, h in self._histograms.items())
+
+class PubSubClient(object):
+  """Twisted client: the PubSub calls, returning Deferreds."""
+
+  def __init__(self, host, max_connections=8):
+    """Constructor.
+
+    Args:
+      host: The frontend's host:port.
+      max_connections: Idle keep-alive connections kept for reuse.
+    """
+    self._server = Server(host, max_connections)
+    self._histograms = _Histograms()
+
+  def _Request(self, name, method, path, body=None, headers=None,
+               with_headers=False):
+    start = time.time()
+    d = self._server.Request(method, path, body, headers, with_headers)
+    def Record(result):
+      self._histograms.Record(name, time.time() - start)
+      return result
+    return d.addBoth(Record)
+
+  def Publish(self, topic, body, idempotency_key=None):
+    """Publishes body to topic, firing with the status."""
+    headers = None
+    if idempotency_key is not None:
+      headers = {IDEMPOTENCY_KEY_HEADER: [idempotency_key]}
+    d = self._Request('publish', b'POST', _Path(topic), body, headers)
+    return d.addCallback(lambda result: result[0])
+
+  def Subscribe(self, topic, user):
+    """Subscribes user to topic, firing with the status."""
+    d = self._Request('subscribe', b'POST', _Path(topic, user))
+    return d.addCallback(lambda result: result[0])
+
+  def Unsubscribe(self, topic, user):
+    """Unsubscribes user from topic, firing with the status."""
+    d = self._Request('unsubscribe', b'DELETE', _Path(topic, user))
+    return d.addCallback(lambda result: result[0])
+
+  def Poll(self, topic, user):
+    """Takes user's next message from topic, firing with (status, body).
+
+    A 204 the server paced (see pacing.py) fires with (status, body, seconds
+    to wait before polling again).
+    """
+    d = self._Request('poll', b'GET', _Path(topic, user), with_headers=True)
+    return d.addCallback(lambda result: _Paced(
+        result[0], result[1],
+        result[2].getRawHeaders(POLL_AFTER_HEADER, [None])[0]))
+
+  def Inbox(self, user, limit=100):
+    """Takes up to limit of user's messages from all its topics.
+
+    Fires with (status, messages, partial), messages being (topic, body)
+    tuples, see inbox.py.
+    """
+    d = self._Request('inbox', b'GET', b'%s?limit=%d' % (_Path(user), limit))
+    return d.addCallback(lambda result: (result[0],) + DecodeInbox(result[1]))
+
+  def Read(self, topic, user, offset, limit=100):
+    """Reads up to limit of user's messages in topic from offset on.
+
+    Nothing is taken. Fires with (status, messages, next offset), messages
+    being (seq, body) tuples, see offsets.py.
+    """
+    d = self._Request('read', b'GET', _ReadPath(topic, user, offset, limit))
+    return d.addCallback(lambda result: _Range(result, offset))
+
+  def Commit(self, topic, user, seq):
+    """Takes user's messages in topic up to seq, firing with the status."""
+    d = self._Request('commit', b'POST',
+                      b'%s?commit=%d' % (_Path(topic, user), seq))
+    return d.addCallback(lambda result: result[0])
+
+  def Publisher(self, **kwargs):
+    """Returns a Publisher sending through this client, see Publisher."""
+    return Publisher(self, **kwargs)
+
+  def Consumer(self, topic, user, **kwargs):
+    """Returns a Consumer of user's subscription to topic, see Consumer."""
+    return Consumer(self, topic, user, **kwargs)
+
+  def Stats(self):
+    """Returns a latency summary per call, see Histogram.Summary."""
+    return self._histograms.Stats()
+
+  def Close(self):
+    """Closes the pooled connections, returning a Deferred."""
+    return self._server.Close()
+
+def _Reactor(clock):
+  if clock is None:
+    from twisted.internet import reactor
+    clock = reactor
+  return clock
+
+class Publisher(object):
+  """Batches messages per topic and sends them with retries (Twisted)."""
+
+  def __init__(self, client, max_batch_messages=100, max_batch_bytes=1 << 20,
+               linger=0.005, ordered=True, retries=3, retry_delay=0.05,
+               clock=None):
+    """Constructor.
+
+    Args:
+      client: The PubSubClient to send through.
+      max_batch_messages: Send a topic's batch once it has this many.
+      max_batch_bytes: Send a topic's batch once its bodies total this.
+      linger: Seconds the first message of a batch waits for company.
+      ordered: Whether to send each topic's messages one at a time, in
+        order, rather than a whole batch at once.
+      retries: Retries of a failed send before giving up on it.
+      retry_delay: Seconds before the first retry, doubling for each next.
+      clock: The reactor to schedule on, by default the global one.
+    """
+    self._client = client
+    self._max_messages = max_batch_messages
+    self._max_bytes = max_batch_bytes
+    self._linger = linger
+    self._ordered = ordered
+    self._retries = retries
+    self._retry_delay = retry_delay
+    self._clock = _Reactor(clock)
+    self._batches = {}  # topic: [messages, bytes, linger DelayedCall]
+    self._sending = {}  # topic: deque of batches, the first being sent
+    self._outstanding = set()  # Deferreds of messages not yet sent.
+    self.stats = collections.Counter()
+
+  def Publish(self, topic, body):
+    """Queues body for topic.
+
+    Returns:
+      A Deferred firing with the final status once the message is sent, or
+      failing if it could not be.
+    """
+    topic = _Bytes(topic)
+    d = Deferred()
+    self._outstanding.add(d)
+    d.addBoth(self._Done, d)
+    batch = self._batches.get(topic)
+    if batch is None:
+      batch = self._batches[topic] = [[], 0, self._clock.callLater(
+          self._linger, self._Flush, topic)]
+    batch[0].append((body, _NewKey(), d))
+    batch[1] += len(body)
+    if len(batch[0]) >= self._max_messages or batch[1] >= self._max_bytes:
+      self._Flush(topic)
+    return d
+
+  def _Done(self, result, d):
+    self._outstanding.discard(d)
+    return result
+
+  def Flush(self):
+    """Sends every queued batch now, firing once all messages are sent."""
+    for topic in list(self._batches):
+      self._Flush(topic)
+    return gatherResults([_Observe(d) for d in list(self._outstanding)]
+                        ).addCallback(lambda _: None)
+
+  def _Flush(self, topic):
+    messages, _, timer = self._batches.pop(topic)
+    if timer.active():
+      timer.cancel()
+    self.stats['batches'] += 1
+    queued = self._sending.setdefault(topic, collections.deque())
+    queued.append(messages)
+    if len(queued) == 1:
+      self._SendBatch(topic)
+
+  def _SendBatch(self, topic):
+    messages = self._sending[topic][0]
+    if self._ordered:
+      d = succeed(None)
+      for message in messages:
+        d.addCallback(lambda _, m=message: self._Send(topic, *m))
+    else:
+      d = gatherResults([self._Send(topic, *m) for m in messages])
+
+    def Next(_):
+      queued = self._sending[topic]
+      queued.popleft()
+      if queued:
+        self._SendBatch(topic)
+      else:
+        del self._sending[topic]
+    d.addCallback(Next)
+
+  def _Send(self, topic, body, key, result, attempt=0):
+    """Sends one message, firing result, and fires once done with it."""
+    done = Deferred()
+
+    def Retry(reason):
+      if attempt >= self._retries:
+        self.stats['failed'] += 1
+        logging.error('Publish to %s failed: %s', topic, reason)
+        result.errback(PublishError(reason) if isinstance(reason, int)
+                       else reason)
+        done.callback(None)
+        return
+      self.stats['retries'] += 1
+      self._clock.callLater(
+          self._retry_delay * 2 ** attempt,
+          lambda: self._Send(topic, body, key, result,
+                             attempt + 1).chainDeferred(done))
+
+    def Sent(status):
+      if _Retryable(status):
+        Retry(status)
+        return
+      self.stats['sent'] += 1
+      result.callback(status)
+      done.callback(None)
+
+    d = self._client.Publish(topic, body, key)
+    d.addCallbacks(Sent, Retry)
+    return done
+
+def _Observe(d):
+  """Returns a Deferred firing (with None) when d fires, leaving d alone."""
+  observer = Deferred()
+  def Fire(result):
+    observer.callback(None)
+    return result
+  d.addBoth(Fire)
+  return observer
+
+class Consumer(object):
+  """Polls a subscription ahead of the application (Twisted)."""
+
+  def __init__(self, client, topic, user, prefetch=10, idle_delay=0.01,
+               max_idle_delay=1.0, clock=None):
+    """Constructor, which starts polling.
+
+    Args:
+      client: The PubSubClient to poll through.
+      topic: The topic subscribed to.
+      user: The subscriber.
+      prefetch: Most messages held ahead of Get.
+      idle_delay: Seconds to wait after an empty poll, doubling each time
+        the topic stays empty, up to max_idle_delay.
+      max_idle_delay: The longest wait between polls of an empty topic.
+      clock: The reactor to schedule on, by default the global one.
+    """
+    self._client = client
+    self._topic = _Bytes(topic)
+    self._user = _Bytes(user)
+    self._prefetch = prefetch
+    self._idle_delay = idle_delay
+    self._max_idle_delay = max_idle_delay
+    self._delay = idle_delay
+    self._clock = _Reactor(clock)
+    self._buffer = collections.deque()
+    self._waiters = collections.deque()
+    self._polling = False
+    self._timer = None
+    self._error = None
+    self._stopped = False
+    self.stats = collections.Counter()
+    self._Fill()
+
+  def Get(self):
+    """Returns a Deferred firing with the next message body.
+
+    Fails with ConsumerError if the subscription is gone.
+    """
+    if self._buffer:
+      d = succeed(self._buffer.popleft())
+    elif self._error is not None:
+      d = Deferred()
+      d.errback(self._error)
+    else:
+      d = Deferred()
+      self._waiters.append(d)
+    self._Fill()
+    return d
+
+  def Stop(self):
+    """Stops polling. Messages already prefetched can still be got."""
+    self._stopped = True
+    if self._timer is not None and self._timer.active():
+      self._timer.cancel()
+
+  def _Fill(self):
+    if (self._polling or self._stopped or self._error is not None or
+        (self._timer is not None and self._timer.active()) or
+        len(self._buffer) >= self._prefetch):
+      return
+    self._polling = True
+    self.stats['polls'] += 1
+    d = self._client.Poll(self._topic, self._user)
+    d.addCallbacks(self._Polled, self._Failed)
+
+  def _Polled(self, result):
+    self._polling = False
+    status, body = result[:2]
+    if status == 200:
+      self._delay = self._idle_delay
+      self.stats['messages'] += 1
+      if self._waiters:
+        self._waiters.popleft().callback(body)
+      else:
+        self._buffer.append(body)
+      self._Fill()
+    elif status == 204:
+      self.stats['empty'] += 1
+      self._Wait(result[2] if len(result) > 2 else None)
+    else:
+      self._error = ConsumerError(status)
+      waiters, self._waiters = self._waiters, collections.deque()
+      for d in waiters:
+        d.errback(self._error)
+
+  def _Failed(self, failure):
+    self._polling = False
+    self.stats['errors'] += 1
+    logging.warning('Poll of %s failed: %s', self._topic, failure.value)
+    self._Wait()
+
+  def _Wait(self, paced=None):
+    """Polls again later: after paced seconds if given, else backing off."""
+    if self._stopped:
+      return
+    if paced is not None:
+      self.stats['paced'] += 1
+      self._timer = self._clock.callLater(paced, self._Fill)
+      return
+    self._timer = self._clock.callLater(self._delay, self._Fill)
+    self._delay = min(self._delay * 2, self._max_idle_delay)
+
+class BlockingClient(object):
+  """Blocking client: the PubSub calls over pooled http.client connections.
+
+  Safe to share between threads.
+  """
+
+  def __init__(self, host, max_connections=8, timeout=30):
+    """Constructor.
+
+    Args:
+      host: The frontend's host:port.
+      max_connections: Idle keep-alive connections kept for reuse.
+      timeout: Socket timeout in seconds.
+    """
+    self._host = host
+    self._timeout = timeout
+    self._idle = queue.LifoQueue(max_connections)
+    self._histograms = _Histograms()
+
+  def _Request(self, name, method, path, body=None, headers=None,
+               with_headers=False):
+    start = time.time()
+    try:
+      connection = self._idle.get_nowait()
+      reused = True
+    except queue.Empty:
+      connection = HTTPConnection(self._host, timeout=self._timeout)
+      reused = False
+    try:
+      connection.request(method, path.decode('ascii'), body, headers or {})
+      response = connection.getresponse()
+      data = response.read()
+    except (HTTPException, OSError):
+      connection.close()
+      if not reused:
+        raise
+      # The server may have closed an idle connection: retry on a new one.
+      return self._Request(name, method, path, body, headers, with_headers)
+    try:
+      self._idle.put_nowait(connection)
+    except queue.Full:
+      connection.close()
+    self._histograms.Record(name, time.time() - start)
+    if with_headers:
+      return response.status, data, response.msg
+    return response.status, data
+
+  def Publish(self, topic, body, idempotency_key=None):
+    """Publishes body to topic, returning the status."""
+    headers = None
+    if idempotency_key is not None:
+      headers = {'Idempotency-Key': idempotency_key}
+    return self._Request('publish', 'POST', _Path(topic), body, headers)[0]
+
+  def Subscribe(self, topic, user):
+    """Subscribes user to topic, returning the status."""
+    return self._Request('subscribe', 'POST', _Path(topic, user))[0]
+
+  def Unsubscribe(self, topic, user):
+    """Unsubscribes user from topic, returning the status."""
+    return self._Request('unsubscribe', 'DELETE', _Path(topic, user))[0]
+
+  def Poll(self, topic, user):
+    """Takes user's next message from topic, returning (status, body).
+
+    A 204 the server paced (see pacing.py) returns (status, body, seconds to
+    wait before polling again).
+    """
+    status, data, headers = self._Request('poll', 'GET', _Path(topic, user),
+                                          with_headers=True)
+    return _Paced(status, data, headers.get(POLL_AFTER_HEADER.decode('ascii')))
+
+  def Inbox(self, user, limit=100):
+    """Takes up to limit of user's messages from all its topics.
+
+    Returns (status, messages, partial), messages being (topic, body)
+    tuples, see inbox.py.
+    """
+    status, data = self._Request('inbox', 'GET',
+                                 b'%s?limit=%d' % (_Path(user), limit))
+    return (status,) + DecodeInbox(data)
+
+  def Read(self, topic, user, offset, limit=100):
+    """Reads up to limit of user's messages in topic from offset on.
+
+    Nothing is taken. Returns (status, messages, next offset), messages
+    being (seq, body) tuples, see offsets.py.
+    """
+    return _Range(self._Request('read', 'GET',
+                                _ReadPath(topic, user, offset, limit)), offset)
+
+  def Commit(self, topic, user, seq):
+    """Takes user's messages in topic up to seq, returning the status."""
+    return self._Request('commit', 'POST',
+                         b'%s?commit=%d' % (_Path(topic, user), seq))[0]
+
+  def Publisher(self, **kwargs):
+    """Returns a BlockingPublisher sending through this client."""
+    return BlockingPublisher(self, **kwargs)
+
+  def Consumer(self, topic, user, **kwargs):
+    """Returns a BlockingConsumer of user's subscription to topic."""
+    return BlockingConsumer(self, topic, user, **kwargs)
+
+  def Stats(self):
+    """Returns a latency summary per call, see Histogram.Summary."""
+    return self._histograms.Stats()
+
+  def Close(self):
+    """Closes the pooled connections."""
+    while True:
+      try:
+        self._idle.get_nowait().close()
+      except queue.Empty:
+        return
+
+_STOP = object()
+
+class BlockingPublisher(object):
+  """Batches messages per topic and sends them from background threads.
+
+  Publish only queues. Each topic's batches are sent by the same one of
+  `senders` threads, so a topic's messages stay in order.
+  """
+
+  def __init__(self, client, max_batch_messages=100, max_batch_bytes=1 << 20,
+               linger=0.005, senders=4, retries=3, retry_delay=0.05):
+    """Constructor, which starts the threads. See Publisher for the args."""
+    self._client = client
+    self._max_messages = max_batch_messages
+    self._max_bytes = max_batch_bytes
+    self._linger = linger
+    self._retries = retries
+    self._retry_delay = retry_delay
+    self._lock = threading.Condition()
+    self._batches = collections.OrderedDict()  # topic: [messages, bytes, due]
+    self._closed = False
+    self._queues = [queue.Queue() for _ in range(senders)]
+    self.stats = collections.Counter()
+    self._threads = [threading.Thread(target=self._Send, args=(q,))
+                     for q in self._queues]
+    self._threads.append(threading.Thread(target=self._Linger))
+    for thread in self._threads:
+      thread.daemon = True
+      thread.start()
+
+  def Publish(self, topic, body):
+    """Queues body for topic."""
+    topic = _Bytes(topic)
+    with self._lock:
+      batch = self._batches.get(topic)
+      if batch is None:
+        batch = self._batches[topic] = [[], 0, time.time() + self._linger]
+        self._lock.notify()
+      batch[0].append((body, _NewKey()))
+      batch[1] += len(body)
+      if len(batch[0]) >= self._max_messages or batch[1] >= self._max_bytes:
+        self._Flush(topic)
+
+  def _Flush(self, topic):
+    """Hands topic's batch to its sender. Called with the lock held."""
+    messages = self._batches.pop(topic)[0]
+    self.stats['batches'] += 1
+    self._queues[zlib.crc32(topic) % len(self._queues)].put((topic, messages))
+
+  def Flush(self):
+    """Sends every queued batch, returning once all are sent."""
+    with self._lock:
+      for topic in list(self._batches):
+        self._Flush(topic)
+    for q in self._queues:
+      q.join()
+
+  def Close(self):
+    """Flushes and stops the threads."""
+    self.Flush()
+    with self._lock:
+      self._closed = True
+      self._lock.notify()
+    for q in self._queues:
+      q.put(_STOP)
+    for thread in self._threads:
+      thread.join()
+
+  def _Linger(self):
+    """Thread flushing batches whose linger has passed."""
+    with self._lock:
+      while not self._closed:
+        now = time.time()
+        for topic, batch in list(self._batches.items()):
+          if batch[2] > now:
+            break
+          self._Flush(topic)
+        if self._batches:
+          wait = next(iter(self._batches.values()))[2] - now
+          self._lock.wait(max(wait, 0))
+        else:
+          self._lock.wait()
+
+  def _Send(self, batches):
+    """Sender thread: publishes batches from its queue in order."""
+    while True:
+      item = batches.get()
+      if item is _STOP:
+        batches.task_done()
+        return
+      topic, messages = item
+      for body, key in messages:
+        self._SendOne(topic, body, key)
+      batches.task_done()
+
+  def _SendOne(self, topic, body, key):
+    for attempt in range(self._retries + 1):
+      if attempt:
+        self.stats['retries'] += 1
+        time.sleep(self._retry_delay * 2 ** (attempt - 1))
+      try:
+        status = self._client.Publish(topic, body, key)
+      except (HTTPException, OSError) as e:
+        logging.warning('Publish to %s failed: %s', topic, e)
+        continue
+      if not _Retryable(status):
+        self.stats['sent'] += 1
+        return
+    self.stats['failed'] += 1
+    logging.error('Giving up publishing to %s', topic)
+
+class BlockingConsumer(object):
+  """Polls a subscription ahead of the application from a thread."""
+
+  def __init__(self, client, topic, user, prefetch=10, idle_delay=0.01,
+               max_idle_delay=1.0):
+    """Constructor, which starts polling. See Consumer for the args."""
+    self._client = client
+    self._topic = _Bytes(topic)
+    self._user = _Bytes(user)
+    self._idle_delay = idle_delay
+    self._max_idle_delay = max_idle_delay
+    self._buffer = queue.Queue(prefetch)
+    self._stopped = threading.Event()
+    self._error = None
+    self.stats = collections.Counter()
+    self._thread = threading.Thread(target=self._Run)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def Get(self, timeout=None):
+    """Returns the next message body.
+
+    Raises:
+      queue.Empty: If there was none within timeout seconds.
+      ConsumerError: If the subscription is gone.
+    """
+    item = self._buffer.get(timeout=timeout)
+    if isinstance(item, ConsumerError):
+      self._buffer.put(item)
+      raise item
+    return item
+
+  def Stop(self):
+    """Stops polling. Messages already prefetched can still be got."""
+    self._stopped.set()
+    self._thread.join()
+
+  def _Run(self):
+    delay = self._idle_delay
+    while not self._stopped.is_set():
+      self.stats['polls'] += 1
+      try:
+        result = self._client.Poll(self._topic, self._user)
+        status, body = result[:2]
+      except (HTTPException, OSError) as e:
+        self.stats['errors'] += 1
+        logging.warning('Poll of %s failed: %s', self._topic, e)
+        status = None
+      if status == 200:
+        delay = self._idle_delay
+        self.stats['messages'] += 1
+        while not self._stopped.is_set():
+          try:
+            self._buffer.put(body, timeout=0.1)
+            break
+          except queue.Full:
+            pass
+        continue
+      if status not in (204, None):
+        self._buffer.put(ConsumerError(status))
+        return
+      self.stats['empty'] += status == 204
+      if status == 204 and len(result) > 2:
+        self.stats['paced'] += 1
+        self._stopped.wait(result[2])
+        continue
+      self._stopped.wait(delay)
+      delay = min(delay * 2, self._max_idle_delay)
@@ -1,8 +1,27 @@
 import os
 
-from backends.memory import MemoryBackend
+from backends.shm import ShmListener
 from frontend import RunServer
+from frontend import ServerOptionsFromEnv
+from handoff import Handoff
+from shards import BuildShard
+from shards import ProcessComponents
 
 if __name__ == '__main__':
-  RunServer(MemoryBackend(), int(os.environ['PORT']))
-
+  maintenance, gc_monitor = ProcessComponents()
+  backend, components, snapshotter = BuildShard(maintenance)
+  components += [maintenance, gc_monitor]
+  if os.environ.get('SHM_SOCKET'):
+    components.append(ShmListener(backend, os.environ['SHM_SOCKET']))
+  listen_fd = None
+  handoff = None
+  if os.environ.get('HANDOFF_SOCKET'):
+    handoff = Handoff(backend, os.environ['HANDOFF_SOCKET'],
+                      drain=float(os.environ.get('HANDOFF_DRAIN', 2)),
+                      components=list(components))
+    listen_fd = handoff.Receive()
+    components.append(handoff)
+  if snapshotter is not None and not (handoff and handoff.received):
+    snapshotter.Restore()
+  RunServer(backend, int(os.environ['PORT']), components=components,
+            listen_fd=listen_fd, **ServerOptionsFromEnv())
@@ -2,13 +2,64 @@ import os
 
 from backends.proxy import ProxyBackend
 from backends.hash import HashBackend
+from backends.hash import ParsePartitions
+from backends.shm import ShmBackend
+from colocated import ParseLocalBackends
+from colocated import ShardListener
+from compression import Compressor
 from frontend import RunServer
+from frontend import ServerOptionsFromEnv
+from pollcache import PollCache
+from shards import BuildShard
+from shards import ProcessComponents
+from sketches import ClusterSketches
 
 if __name__ == '__main__':
+  options = ServerOptionsFromEnv()
+  components = []
+  poll_cache = None
+  if float(os.environ.get('POLL_CACHE_TTL', 0)):
+    poll_cache = PollCache(float(os.environ['POLL_CACHE_TTL']))
+    components.append(poll_cache)
   backends = []
-  for i in xrange(int(os.environ['NUM_BACKENDS'])):
+  num_backends = int(os.environ['NUM_BACKENDS'])
+  local = ParseLocalBackends(os.environ.get('LOCAL_BACKENDS'), num_backends)
+  if local:
+    maintenance, gc_monitor = ProcessComponents()
+    components += [maintenance, gc_monitor]
+  for i in range(num_backends):
+    if i in local:
+      # A shard owned by this process (see colocated.py), served to the
+      # other frontends on its port.
+      backend, shard_components, snapshotter = BuildShard(
+          maintenance, 'BACKEND%d_' % i)
+      if snapshotter is not None:
+        snapshotter.Restore()
+      port = int(os.environ['BACKEND%d_PORT' % i].rsplit(':', 1)[1])
+      # Publishes reaching the shard were checked by a frontend.
+      compressor = Compressor(
+          options['compress_threshold'], options['compress_level'],
+          options['max_message_size'], check_gzip=False)
+      components.append(ShardListener(
+          backend, port, name=b'shard%d' % i, components=shard_components,
+          compressor=compressor, max_message_size=options['max_message_size']))
+      backends.append(backend)
+      continue
+    if os.environ.get('BACKEND%d_SHM' % i):
+      # A backend on this host, reached through shared memory.
+      backends.append(ShmBackend(os.environ['BACKEND%d_SHM' % i], poll_cache))
+      continue
     key = os.environ['BACKEND%d_PORT' % i]
     address = key.split('//')[1]
-    backends.append(ProxyBackend(address))
-  RunServer(HashBackend(backends), int(os.environ['PORT']))
+    backends.append(ProxyBackend(address, poll_cache))
+  admin_hosts = [os.environ['BACKEND%d_ADMIN_PORT' % i].split('//')[1]
+                 for i in range(len(backends))
+                 if os.environ.get('BACKEND%d_ADMIN_PORT' % i)]
+  if admin_hosts:
+    components.append(ClusterSketches(admin_hosts))
+  partitions = ParsePartitions(os.environ.get('PARTITIONED_TOPICS'))
+  prefix_segments = int(os.environ.get('HASH_PREFIX_SEGMENTS', 0))
+  inbox_timeout = float(os.environ.get('INBOX_TIMEOUT', 1))
+  RunServer(HashBackend(backends, partitions, prefix_segments, inbox_timeout),
+            int(os.environ['PORT']), components=components, **options)
 
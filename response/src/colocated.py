@@ -0,0 +1,93 @@
+"""Co-located mode: frontends that own some of the shards themselves.
+
+In a cluster every request goes from a frontend to the backend owning its
+topic over HTTP, even when both run on the same box. A co-located frontend
+(LOCAL_BACKENDS, see clustered_frontend.py) holds the shards at the given
+indexes in an in-process MemoryBackend each, built as clustered_backend.py
+builds its own (see shards.py), and puts those in HashBackend's list of
+backends where their ProxyBackends would have been. HashBackend calls them
+like any other backend, so a topic placed on a local shard is served without
+leaving the process, and every other topic is proxied as before.
+
+Other frontends still reach a local shard at its BACKENDn_PORT, which
+ShardListener serves with the plain PubSub API, as clustered_backend.py
+would. Only frontends send to that port, so like a cluster backend it counts
+their X-Forwarded-For as the publisher, and clustered_frontend.py has it take
+their gzip bodies as they are. The shard's admin endpoints are under /shardN
+on the frontend's admin port. Every process must agree on NUM_BACKENDS and
+the BACKENDn_PORTs, and each shard must be local to exactly one of them.
+"""
+
+import logging
+
+from twisted.web.resource import Resource
+
+from admin import AddAdminResources
+from frontend import PubSubResource
+from frontend import PubSubSite
+
+def ParseLocalBackends(spec, num_backends):
+  """Parses 'I[,I...]' (LOCAL_BACKENDS) into a set of shard indexes.
+
+  Raises:
+    ValueError: If an index is malformed or not below num_backends.
+  """
+  indexes = set(int(i) for i in filter(None, (spec or '').split(',')))
+  if indexes and not 0 <= min(indexes) <= max(indexes) < num_backends:
+    raise ValueError('Bad local backends %r' % spec)
+  return indexes
+
+class ShardListener(object):
+  """Serves an in-process shard to the other frontends of a cluster."""
+
+  def __init__(self, backend, port, interface='', name=b'shard',
+               components=(), compressor=None, max_message_size=None):
+    """Constructor.
+
+    Args:
+      backend: The shard's backend.
+      port: The TCP port to listen on (the shard's BACKENDn_PORT).
+      interface: The interface to listen on, by default all of them.
+      name: The admin path segment of the shard's endpoints.
+      components: The shard's own components (see shards.BuildShard),
+        started with the listener and with their endpoints under name.
+      compressor: The compression.Compressor for message bodies, normally
+        with check_gzip off.
+      max_message_size: If set, request bodies over this many bytes get a
+        413.
+    """
+    self._backend = backend
+    self._port = port
+    self._interface = interface
+    self._name = name
+    self._components = list(components)
+    self._compressor = compressor
+    self._max_message_size = max_message_size
+    self.listening = None
+
+  def Start(self, reactor):
+    """Starts the shard's components and listens on the port (see RunServer)."""
+    for component in self._components:
+      if hasattr(component, 'Start'):
+        component.Start(reactor)
+    resource = PubSubResource(self._backend, self._compressor,
+                              trust_forwarded_for=True)
+    self.listening = reactor.listenTCP(
+        self._port, PubSubSite(resource, self._max_message_size),
+        interface=self._interface)
+    logging.info('Local shard on port %d', self.listening.getHost().port)
+
+  def Stop(self):
+    """Stops listening and the components, returning a Deferred."""
+    for component in self._components:
+      if hasattr(component, 'Stop'):
+        component.Stop()
+    listening, self.listening = self.listening, None
+    if listening is not None:
+      return listening.stopListening()
+
+  def AdminResources(self):
+    """Admin endpoints of the shard, see admin.py."""
+    shard = Resource()
+    AddAdminResources(shard, self._backend, *self._components)
+    return {self._name: shard}
@@ -0,0 +1,186 @@
+"""Threshold based compression of message bodies.
+
+A body is compressed at most once, by the first frontend that receives the
+publish, and stays compressed from then on: MemoryBackend stores it as is,
+ProxyBackend and Server move it with Content-Encoding: gzip, and it is only
+inflated by the PubSubResource delivering it to a client that does not accept
+gzip. Compressed bodies are CompressedBody instances, which behave exactly like
+bytes so none of the backends need to know about compression.
+
+A publish sent already gzipped is inflated once on arrival, up to max_size
+bytes, so a corrupt body is refused (CorruptBodyError, a 400) before it is
+stored rather than failing the poll that takes it, and a small body that
+inflates past the limit (BodyTooLargeError, a 413) cannot get around
+MAX_MESSAGE_SIZE. Only the edge needs to: a backend whose publishes all come
+from frontends (TRUST_GZIP) takes their gzip bodies as they are, so a body is
+inflated at most twice, once on arrival and once on delivery.
+"""
+
+import logging
+import zlib
+
+GZIP = b'gzip'
+
+# zlib wbits selecting the gzip container, which is what HTTP clients expect
+# for Content-Encoding: gzip. 47 auto-detects zlib or gzip on the way in.
+_GZIP_WBITS = 31
+_AUTO_WBITS = 47
+
+class CompressedBody(bytes):
+  """A gzip compressed message body."""
+  __slots__ = ()
+
+class CorruptBodyError(ValueError):
+  """A gzip body that does not inflate."""
+
+class BodyTooLargeError(ValueError):
+  """A gzip body that inflates past the maximum size."""
+
+def AcceptsGzip(accept_encoding):
+  """Whether an Accept-Encoding header value allows gzip.
+
+  The value is a comma separated list of codings with optional q weights
+  (RFC 7231 5.3.4). gzip is allowed when it, x-gzip, or failing those *, is
+  listed with a q above 0, so 'gzip;q=0' refuses it.
+  """
+  if accept_encoding is None:
+    return False
+  wildcard = False
+  for entry in accept_encoding.lower().split(b','):
+    params = entry.split(b';')
+    coding = params[0].strip()
+    q = 1.0
+    for param in params[1:]:
+      name, _, value = param.partition(b'=')
+      if name.strip() == b'q':
+        try:
+          q = float(value)
+        except ValueError:
+          q = 0.0
+    if coding in (GZIP, b'x-gzip'):
+      return q > 0
+    if coding == b'*':
+      wildcard = q > 0
+  return wildcard
+
+class Compressor(object):
+  """Compresses bodies over a size threshold and counts the savings."""
+
+  def __init__(self, threshold=None, level=6, max_size=None, check_gzip=True):
+    """Constructor.
+
+    Args:
+      threshold: Bodies of at least this many bytes are compressed. None
+        disables compression, though already compressed bodies are still
+        handled.
+      level: The zlib compression level, 1 (fastest) to 9 (smallest).
+      max_size: If set, the most bytes a gzip body may inflate to.
+      check_gzip: Whether gzip publishes are inflated to check them. Off
+        where every publish comes from a frontend that checked it.
+    """
+    self._threshold = threshold
+    self._level = level
+    self._max_size = max_size
+    self._check_gzip = check_gzip
+    self._stats = {
+        'compressed': 0,  # Bodies compressed here.
+        'raw_bytes': 0,  # Their size before compression.
+        'compressed_bytes': 0,  # And after.
+        'skipped_incompressible': 0,  # Bodies that did not get smaller.
+        'received_compressed': 0,  # Bodies that arrived already compressed.
+        'delivered_compressed': 0,  # Deliveries passed through as gzip.
+        'delivered_compressed_bytes': 0,
+        'inflated': 0,  # Deliveries decompressed for the client.
+        'rejected_corrupt': 0,  # Gzip publishes that did not inflate.
+        'rejected_too_large': 0,  # And those inflating past max_size.
+        'inflate_failed': 0,  # Deliveries passed through as they could not be.
+    }
+
+  def Stats(self):
+    """Returns the counters, plus bytes saved in storage and on the wire."""
+    stats = dict(self._stats)
+    stats['bytes_saved'] = stats['raw_bytes'] - stats['compressed_bytes']
+    return stats
+
+  def _Inflate(self, body):
+    """Returns gzip body inflated, up to max_size bytes.
+
+    Raises:
+      CorruptBodyError: If body is not a whole gzip (or zlib) stream.
+      BodyTooLargeError: If it inflates to more than max_size bytes.
+    """
+    inflater = zlib.decompressobj(_AUTO_WBITS)
+    try:
+      # A max_length of 0 is no limit.
+      raw = inflater.decompress(
+          body, self._max_size + 1 if self._max_size is not None else 0)
+    except zlib.error as e:
+      raise CorruptBodyError(str(e))
+    if self._max_size is not None and len(raw) > self._max_size:
+      raise BodyTooLargeError('Inflates past %d bytes' % self._max_size)
+    if not inflater.eof or inflater.unused_data:
+      raise CorruptBodyError('Truncated, or data after the gzip stream')
+    return raw
+
+  def FromRequest(self, body, content_encoding):
+    """Returns the body of a publish as it should be stored.
+
+    Args:
+      body: The request body.
+      content_encoding: The request's Content-Encoding header, if any.
+
+    Raises:
+      CorruptBodyError: If a gzip body does not inflate.
+      BodyTooLargeError: If a gzip body inflates past max_size.
+    """
+    if content_encoding is not None and content_encoding.lower() == GZIP:
+      if not self._check_gzip:
+        self._stats['received_compressed'] += 1
+        return CompressedBody(body)
+      try:
+        self._Inflate(body)
+      except CorruptBodyError:
+        self._stats['rejected_corrupt'] += 1
+        raise
+      except BodyTooLargeError:
+        self._stats['rejected_too_large'] += 1
+        raise
+      self._stats['received_compressed'] += 1
+      return CompressedBody(body)
+    if self._threshold is None or len(body) < self._threshold:
+      return body
+    compressor = zlib.compressobj(self._level, zlib.DEFLATED, _GZIP_WBITS)
+    compressed = compressor.compress(body) + compressor.flush()
+    if len(compressed) >= len(body):
+      self._stats['skipped_incompressible'] += 1
+      return body
+    self._stats['compressed'] += 1
+    self._stats['raw_bytes'] += len(body)
+    self._stats['compressed_bytes'] += len(compressed)
+    return CompressedBody(compressed)
+
+  def ForResponse(self, body, accept_encoding):
+    """Returns (body, content_encoding) to deliver body to a client.
+
+    A body that cannot be inflated within max_size (stored before it was
+    checked on arrival, or under a larger limit) is delivered gzipped
+    rather than lost, as it has already been taken from the topic.
+
+    Args:
+      body: The stored body, which may be a CompressedBody.
+      accept_encoding: The client's Accept-Encoding header, if any.
+    """
+    if not isinstance(body, CompressedBody):
+      return body, None
+    if AcceptsGzip(accept_encoding):
+      self._stats['delivered_compressed'] += 1
+      self._stats['delivered_compressed_bytes'] += len(body)
+      return body, GZIP
+    try:
+      raw = self._Inflate(body)
+    except (CorruptBodyError, BodyTooLargeError) as e:
+      self._stats['inflate_failed'] += 1
+      logging.warning('Delivering a body gzipped, as it did not inflate: %s', e)
+      return body, GZIP
+    self._stats['inflated'] += 1
+    return raw, None
@@ -0,0 +1,77 @@
+"""Idempotent publishes: dropping retried messages by key.
+
+A publish may carry an Idempotency-Key header. The backend that stores the
+topic remembers (topic, key) for a while, and a publish repeating a
+remembered pair is acknowledged with 200 without being stored again, so a
+client or ProxyBackend retrying after a timeout does not deliver a message
+twice.
+
+Keys are remembered for `ttl` seconds since they were last seen, and at most
+`max_entries` of them, the least recently seen being forgotten first. Both
+bounds are enforced on every check in O(1) amortized time. Keys are not kept
+in snapshots.
+"""
+
+import collections
+import time
+
+from admin import JsonResource
+
+IDEMPOTENCY_KEY_HEADER = b'Idempotency-Key'
+MAX_KEY_LENGTH = 256
+
+class DedupCache(object):
+  """Recently seen (topic, idempotency key) pairs, LRU with expiry."""
+
+  def __init__(self, ttl=300, max_entries=100000, clock=time.monotonic):
+    """Constructor.
+
+    Args:
+      ttl: Seconds a key is remembered after it was last seen.
+      max_entries: Most keys remembered.
+      clock: Function returning monotonic time in seconds.
+    """
+    self._ttl = ttl
+    self._max_entries = max_entries
+    self._clock = clock
+    # (topic, key): expiry time. Least recently seen, so soonest to expire,
+    # first.
+    self._seen = collections.OrderedDict()
+    self._stats = {'checks': 0, 'duplicates': 0, 'expired': 0, 'evicted': 0}
+
+  def Seen(self, topic_name, key):
+    """Records a publish of key to topic_name.
+
+    Returns:
+      Whether the same key was published to topic_name within the window.
+    """
+    now = self._clock()
+    self._stats['checks'] += 1
+    while self._seen:
+      oldest, expiry = next(iter(self._seen.items()))
+      if expiry > now:
+        break
+      del self._seen[oldest]
+      self._stats['expired'] += 1
+    entry = (topic_name, key)
+    duplicate = entry in self._seen
+    if duplicate:
+      self._stats['duplicates'] += 1
+      self._seen.move_to_end(entry)
+    self._seen[entry] = now + self._ttl
+    if len(self._seen) > self._max_entries:
+      self._seen.popitem(last=False)
+      self._stats['evicted'] += 1
+    return duplicate
+
+  def Stats(self):
+    """Returns the counters, the entry count and the hit rate."""
+    stats = dict(self._stats)
+    stats['entries'] = len(self._seen)
+    stats['hit_rate'] = (float(stats['duplicates']) / stats['checks']
+                         if stats['checks'] else 0.0)
+    return stats
+
+  def AdminResources(self):
+    """Admin endpoints for the cache, see admin.py."""
+    return {b'dedup': JsonResource(self.Stats)}
@@ -34,35 +34,35 @@ class ClientCalculationTestCase(unittest.TestCase):
   def test_example(self):
     """Verify that the example given in the description works."""
     content = (
-        'http://cuteoverload.files.wordpress.com/2014/10/unnamed23.jpg?'
-        'w=750&h=1000')
+        b'http://cuteoverload.files.wordpress.com/2014/10/unnamed23.jpg?'
+        b'w=750&h=1000')
     alice_subscription = self._VerifyStatus(
-        self.server.POST('/kittens_and_puppies/alice'), 200)
+        self.server.POST(b'/kittens_and_puppies/alice'), 200)
     bob_subscription = self._VerifyStatus(
-        self.server.POST('/kittens_and_puppies/bob'), 200)
+        self.server.POST(b'/kittens_and_puppies/bob'), 200)
     deferred = DeferredList([alice_subscription, bob_subscription])
 
     def CharlesPosting(unused_argument):
       charles_post = self._VerifyStatus(
-          self.server.POST('/kittens_and_puppies', body=content), 200)
+          self.server.POST(b'/kittens_and_puppies', body=content), 200)
       return charles_post
     deferred.addCallback(CharlesPosting)
 
     def AliceSuccessfullyGetsPost(unused_argument):
       alice_get = self._VerifyStatusAndBody(
-          self.server.GET('/kittens_and_puppies/alice'), 200, content)
+          self.server.GET(b'/kittens_and_puppies/alice'), 200, content)
       return alice_get
     deferred.addCallback(AliceSuccessfullyGetsPost)
 
     def AliceSeesNoPost(unused_argument):
       alice_get = self._VerifyStatus(
-          self.server.GET('/kittens_and_puppies/alice'), 204)
+          self.server.GET(b'/kittens_and_puppies/alice'), 204)
       return alice_get
     deferred.addCallback(AliceSeesNoPost)
 
     def BobSuccessfullyGetsPost(unused_argument):
       bob_get = self._VerifyStatusAndBody(
-          self.server.GET('/kittens_and_puppies/bob'), 200, content)
+          self.server.GET(b'/kittens_and_puppies/bob'), 200, content)
       return bob_get
     deferred.addCallback(BobSuccessfullyGetsPost)
 
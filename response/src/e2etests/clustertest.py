@@ -32,39 +32,39 @@ class ClusterTestCases(unittest.TestCase):
     deferred_request.addCallback(VerifyStatusAndBody)
     return deferred_request
 
-  def _RunExampleTest(self, server_func, topic='kittens_and_puppies'):
+  def _RunExampleTest(self, server_func, topic=b'kittens_and_puppies'):
     """Verify that the example given in the description on all servers."""
     content = (
-        'http://cuteoverload.files.wordpress.com/2014/10/unnamed23.jpg?'
-        'w=750&h=1000')
+        b'http://cuteoverload.files.wordpress.com/2014/10/unnamed23.jpg?'
+        b'w=750&h=1000')
 
     alice_subscription = self._VerifyStatus(
-        server_func().POST('/%s/alice' % topic), 200)
+        server_func().POST(b'/%s/alice' % topic), 200)
     bob_subscription = self._VerifyStatus(
-        server_func().POST('/%s/bob' % topic), 200)
+        server_func().POST(b'/%s/bob' % topic), 200)
     deferred = DeferredList([alice_subscription, bob_subscription])
 
     def CharlesPosting(unused_argument):
       charles_post = self._VerifyStatus(
-          server_func().POST('/%s' % topic, body=content), 200)
+          server_func().POST(b'/%s' % topic, body=content), 200)
       return charles_post
     deferred.addCallback(CharlesPosting)
 
     def AliceSuccessfullyGetsPost(unused_argument):
       alice_get = self._VerifyStatusAndBody(
-          server_func().GET('/%s/alice' % topic), 200, content)
+          server_func().GET(b'/%s/alice' % topic), 200, content)
       return alice_get
     deferred.addCallback(AliceSuccessfullyGetsPost)
 
     def AliceSeesNoPost(unused_argument):
       alice_get = self._VerifyStatus(
-          server_func().GET('/%s/alice' % topic), 204)
+          server_func().GET(b'/%s/alice' % topic), 204)
       return alice_get
     deferred.addCallback(AliceSeesNoPost)
 
     def BobSuccessfullyGetsPost(unused_argument):
       bob_get = self._VerifyStatusAndBody(
-          server_func().GET('/%s/bob' % topic), 200, content)
+          server_func().GET(b'/%s/bob' % topic), 200, content)
       return bob_get
     deferred.addCallback(BobSuccessfullyGetsPost)
 
@@ -106,8 +106,8 @@ class ClusterTestCases(unittest.TestCase):
       return self._servers[servers['current']]
 
     deferreds = []
-    for i in xrange(50):
-      topic = str(i)
+    for i in range(50):
+      topic = b'%d' % i
       deferreds.append(self._RunExampleTest(NextServer, topic=topic))
 
     dl = DeferredList(deferreds)
@@ -0,0 +1,23 @@
+"""A backend that injects faults, see backends/faults.py.
+
+Runs like clustered_backend.py, with its MemoryBackend behind a
+FaultInjectingBackend configured from FAULTS, and changed at runtime from
+/faults on ADMIN_PORT. FAULT_SEED makes the faults repeatable.
+"""
+
+import os
+import random
+
+from backends.faults import FaultInjectingBackend
+from backends.memory import MemoryBackend
+from frontend import RunServer
+from frontend import ServerOptionsFromEnv
+
+if __name__ == '__main__':
+  rng = None
+  if os.environ.get('FAULT_SEED'):
+    rng = random.Random(int(os.environ['FAULT_SEED']))
+  backend = FaultInjectingBackend(
+      MemoryBackend(), os.environ.get('FAULTS', ''), rng=rng)
+  RunServer(backend, int(os.environ['PORT']), components=[backend],
+            **ServerOptionsFromEnv())
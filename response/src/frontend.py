@@ -3,93 +3,458 @@ import logging
 import time
 import os
 import errno
+import importlib
+import socket
 
-from twisted.internet import reactor
 from twisted.internet.task import deferLater
 from twisted.internet.defer import maybeDeferred
 from twisted.web.resource import Resource
 from twisted.web.server import NOT_DONE_YET
+from twisted.web.server import Request
 from twisted.web.server import Site
 
+import tracing
+
+from admin import CreateAdminSite
+from admin import JsonResource
 from backends.memory import MemoryBackend
+from capture import OpFor
+from capture import PUBLISH
+from capture import TrafficCapture
+from compression import BodyTooLargeError
+from compression import Compressor
+from compression import CorruptBodyError
+from dedup import IDEMPOTENCY_KEY_HEADER
+from dedup import MAX_KEY_LENGTH
+from inbox import EncodeInbox
+from inbox import IsPeek
+from inbox import ParseLimit
+from offsets import EncodeRange
+from offsets import IsCommit
+from offsets import IsRead
+from offsets import ParseCommit
+from offsets import ParseRead
+from offsets import SEQ_HEADER
+from pacing import FormatRate
+from pacing import POLL_RATE_HEADER
+from pacing import PollPacer
+from pacing import TOPIC_RATE_HEADER
+from pollcache import TOPIC_VERSION_HEADER
+from ratelimit import ParseLimits
+from ratelimit import RateLimiter
+from ratelimit import RetryAfter
+from sketches import ActivatePublisher
+from sketches import DeactivatePublisher
+from sketches import FORWARDED_FOR_HEADER
+from sketches import TrafficSketches
 
 def _FormatTime(start):
   """Logging utility that returns string of time since start with units."""
   time_in_ms = 1000*(time.time() - start)
   return '%dms' % int(time_in_ms)
 
+def _LogValue(value, limit=64):
+  """Formats a call argument for the logs, eliding the middle of big bodies."""
+  if isinstance(value, bytes) and len(value) > limit:
+    return '%s...(%d bytes)' % (value[:limit], len(value))
+  return str(value)
+
+class _BodyBuffer(object):
+  """Request content that keeps the received chunks and joins them once.
+
+  Twisted's default is a BytesIO for small bodies and a temporary file for
+  anything over 100KB, so a large message goes through the disk and is copied
+  at least twice more before it is a bytes object. Here each chunk off the
+  socket is kept by reference and copied exactly once, when the body is read.
+  """
+
+  def __init__(self):
+    self._chunks = []
+    self.size = 0
+    self._position = 0
+
+  def write(self, data):
+    self._chunks.append(data)
+    self.size += len(data)
+    self._position = self.size
+
+  def seek(self, offset, whence=0):
+    self._position = offset if whence == 0 else self.size + offset
+
+  def tell(self):
+    return self._position
+
+  def getvalue(self):
+    """Returns the whole body, joining the chunks on the first call."""
+    if len(self._chunks) != 1:
+      self._chunks = [b''.join(self._chunks)]
+    return self._chunks[0]
+
+  def read(self, size=-1):
+    body = self.getvalue()
+    start = self._position
+    end = self.size if size < 0 else min(self.size, start + size)
+    self._position = end
+    if start == 0 and end == self.size:
+      return body
+    return body[start:end]
+
+  def close(self):
+    self._chunks = []
+
+class PubSubRequest(Request):
+  """Request that buffers bodies with a single copy and limits their size.
+
+  A body declared larger than the site's max_message_size is refused with a
+  413 before any of it is read, and a chunked body is refused as soon as it
+  grows past the limit. The connection is closed in both cases so the rest of
+  the body is never read.
+
+  While the site's capture (see capture.py) is on, every request is recorded
+  to it as it finishes.
+  """
+  _rejected = False
+  _arrived = None
+
+  def _MaxSize(self):
+    return getattr(self.channel.site, 'max_message_size', None)
+
+  def _Reject(self, size):
+    self._rejected = True
+    self.content = _BodyBuffer()
+    # Twisted would otherwise invite the client to send the body.
+    self.requestHeaders.removeHeader(b'expect')
+    self.channel.transport.write(
+        b'HTTP/1.1 413 Payload Too Large\r\n'
+        b'Content-Length: 0\r\nConnection: close\r\n\r\n')
+    self.channel.loseConnection()
+    logging.info('413 body of %d+ bytes over the %d byte limit',
+                 size, self._MaxSize())
+
+  def gotLength(self, length):
+    max_size = self._MaxSize()
+    if length is not None and max_size is not None and length > max_size:
+      self._Reject(length)
+      return
+    self.content = _BodyBuffer()
+
+  def handleContentChunk(self, data):
+    if self._rejected:
+      return
+    self.content.write(data)
+    max_size = self._MaxSize()
+    if max_size is not None and self.content.size > max_size:
+      self._Reject(self.content.size)
+
+  def requestReceived(self, command, path, version):
+    if not self._rejected:
+      Request.requestReceived(self, command, path, version)
+
+  def _Capture(self):
+    return getattr(self.channel.site, 'capture', None)
+
+  def process(self):
+    capture = self._Capture()
+    if capture is not None and capture.active:
+      self._arrived = time.time()
+    if not getattr(self.channel.site, 'draining', False):
+      Request.process(self)
+      return
+    # The state has moved to another process (see handoff.py): send the
+    # client back to the listening socket, which that process now serves.
+    channel = self.channel
+    self.setResponseCode(503)
+    self.setHeader(b'Retry-After', b'1')
+    self.setHeader(b'Connection', b'close')
+    self.finish()
+    channel.loseConnection()
+
+  def finish(self):
+    if self._arrived is not None and self.channel is not None:
+      op, topic, user = OpFor(self.method, self.postpath, self.args)
+      if op == PUBLISH:
+        size = getattr(self.content, 'size', 0)
+      else:
+        size = self.sentLength
+      self._Capture().Record(op, topic, user, self._arrived, self.code, size)
+    return Request.finish(self)
+
+class PubSubSite(Site):
+  """Site serving PubSubRequests, with an optional max_message_size.
+
+  A draining site answers every request with a 503 and closes the connection.
+  A site's capture, if set, is a capture.TrafficCapture recording requests.
+  """
+  requestFactory = PubSubRequest
+
+  def __init__(self, resource, max_message_size=None, capture=None, **kwargs):
+    Site.__init__(self, resource, **kwargs)
+    self.max_message_size = max_message_size
+    self.draining = False
+    self.capture = capture
+
+def _ClientHost(request):
+  """Returns the remote address of request as bytes, or None."""
+  client = getattr(request.getClientAddress(), 'host', None)
+  return client.encode('ascii') if client else None
+
 class PubSubResource(Resource):
   """The resource that provides the perscribed HTTP endpoints."""
   isLeaf=True
 
-  def __init__(self, backend):
-    """Basic constructor for PubSubResource."""
+  def __init__(self, backend, compressor=None, limiter=None, sketches=None,
+               pacer=None, trust_forwarded_for=False):
+    """Basic constructor for PubSubResource.
+
+    Args:
+      backend: The backend implementing the PubSub API.
+      compressor: The compression.Compressor for message bodies. By default
+        nothing is compressed, but compressed bodies are still handled.
+      limiter: Optional ratelimit.RateLimiter checked before publishes and
+        polls reach the backend.
+      sketches: Optional sketches.TrafficSketches recording publishes and
+        polls.
+      pacer: Optional pacing.PollPacer asking pollers to wait after a 204,
+        for backends giving poll hints.
+      trust_forwarded_for: Whether publishes come from frontends, whose
+        X-Forwarded-For names the publishing client, see sketches.py.
+    """
     self._backend = backend
+    self._compressor = compressor or Compressor()
+    self._limiter = limiter
+    self._sketches = sketches
+    self._pacer = pacer
+    self._trust_forwarded_for = trust_forwarded_for
+    # Backends that version their topics let frontends cache empty polls.
+    self._topic_version = getattr(backend, 'TopicVersion', None)
+    # Backends that track publish rates let frontends pace polls.
+    self._poll_hint = getattr(backend, 'PollHint', None)
+
+  def _SetTopicVersion(self, request, topic):
+    if self._topic_version is not None:
+      request.setHeader(TOPIC_VERSION_HEADER, self._topic_version(topic))
+
+  def _SetPollHint(self, request, topic, user, code):
+    """Passes the backend's poll hint on, and paces a 204, see pacing.py."""
+    if self._poll_hint is None:
+      return
+    hint = self._poll_hint(topic, user)
+    if hint is None:
+      return
+    request.setHeader(TOPIC_RATE_HEADER, FormatRate(hint[0]))
+    request.setHeader(POLL_RATE_HEADER, FormatRate(hint[1]))
+    if code == 204 and self._pacer is not None:
+      self._pacer.Pace(request, *hint)
+
+  def AdminResources(self):
+    """Admin endpoints for this resource, see admin.py."""
+    resources = {b'compression': JsonResource(self._compressor.Stats)}
+    if self._limiter is not None:
+      resources.update(self._limiter.AdminResources())
+    if self._sketches is not None:
+      resources.update(self._sketches.AdminResources())
+    if self._pacer is not None:
+      resources[b'pacing'] = JsonResource(self._pacer.Stats)
+    return resources
+
+  def _RateLimited(self, request, topic, user=None, **costs):
+    """Answers 429 if the request is over a rate limit.
+
+    Returns:
+      Whether the request was rejected.
+    """
+    if self._limiter is None:
+      return False
+    wait = self._limiter.Acquire(topic, user, _ClientHost(request), **costs)
+    if not wait:
+      return False
+    logging.info('429 %s %s %s retry in %.2fs', request.method.decode('ascii'),
+                 topic, user or b'', wait)
+    request.setResponseCode(429, b'Too Many Requests')
+    request.setHeader(b'Retry-After', RetryAfter(wait))
+    return True
+
+  def _Publisher(self, request):
+    """Returns the address of the client publishing request, or None."""
+    if self._trust_forwarded_for:
+      forwarded = request.getHeader(FORWARDED_FOR_HEADER)
+      if forwarded:
+        return forwarded.split(b',')[0].strip()
+    return _ClientHost(request)
 
-  def _FailureCallback(self, request, start, logstring):
+  def _CallBackend(self, request, name, method, *args):
+    """Calls a backend method, under the request's trace if it has one.
+
+    Returns:
+      A (deferred, span, logstring) tuple. The deferred fires with the backend
+      result, span should be finished when the response is, and logstring
+      identifies the call (and trace) in the logs.
+    """
+    logstring = '%s (%s)' % (name, ', '.join(_LogValue(a) for a in args))
+    trace_id = tracing.TRACER.Begin(request.getHeader(tracing.TRACE_HEADER))
+    if trace_id is None:
+      return maybeDeferred(method, *args), tracing.NULL_SPAN, logstring
+    request.setHeader(tracing.TRACE_HEADER, trace_id.encode('ascii'))
+    token = tracing.Activate(trace_id)
+    try:
+      span = tracing.StartSpan(name)
+      backend_span = tracing.StartSpan(
+          'backend.' + name, backend=type(self._backend).__name__)
+      d = maybeDeferred(method, *args)
+      d.addBoth(backend_span.FinishPassthrough)
+    finally:
+      tracing.Deactivate(token)
+    return d, span, '%s trace=%s' % (logstring, trace_id)
+
+  def _FailureCallback(self, request, start, span, logstring):
     """Generates a simple errback handler for deferred http requests."""
     def FailureCallback(err):
       request.setResponseCode(500)
-      request.write('')
+      request.write(b'')
       request.finish()
+      span.Finish(code=500)
       logging.error(err)
       logging.info('500 %s %s', _FormatTime(start), logstring)
     return FailureCallback
 
   def _GetNextMessage(self, topic, user, request):
     """Wraps the backend GetNextMessage with HTTP protocol to the client."""
-    d = maybeDeferred(self._backend.GetMessage, topic, user)
+    d, span, logstring = self._CallBackend(
+        request, 'GetMessage', self._backend.GetMessage, topic, user)
     start = time.time()
-    logstring = 'GetMessage (%s, %s)' % (topic, user)
     def FinishGetNextMessage(arg):
-      code, body = arg
-      body = body or ''
-      logging.info('%d %s %s %s', code, _FormatTime(start), logstring, body)
+      # Backends that number their messages add the seq, see offsets.py.
+      code, body = arg[:2]
+      if len(arg) > 2:
+        request.setHeader(SEQ_HEADER, b'%d' % arg[2])
+      body, encoding = self._compressor.ForResponse(
+          body or b'', request.getHeader(b'accept-encoding'))
+      if encoding is not None:
+        request.setHeader(b'Content-Encoding', encoding)
+      logging.info('%d %s %s %s',
+                   code, _FormatTime(start), logstring, _LogValue(body))
+      self._SetTopicVersion(request, topic)
+      self._SetPollHint(request, topic, user, code)
       request.setResponseCode(code)
       request.write(body)
       request.finish()
+      span.Finish(code=code)
     d.addCallback(FinishGetNextMessage)
-    d.addErrback(self._FailureCallback(request, start, logstring))
+    d.addErrback(self._FailureCallback(request, start, span, logstring))
+
+  def _GetInbox(self, user, limit, request, peek=False):
+    """Wraps the backend's inbox read with HTTP protocol, see inbox.py."""
+    name = 'PeekMessages' if peek else 'GetMessages'
+    d, span, logstring = self._CallBackend(
+        request, name, getattr(self._backend, name), user, limit)
+    start = time.time()
+    def FinishGetInbox(arg):
+      code, messages, partial = arg
+      accept_encoding = request.getHeader(b'accept-encoding')
+      body = b''
+      if messages:
+        request.setHeader(b'Content-Type', b'application/json')
+        body = EncodeInbox(
+            messages, partial,
+            lambda m: self._compressor.ForResponse(m, accept_encoding))
+      logging.info('%d %s %s %d messages%s', code, _FormatTime(start),
+                   logstring, len(messages), ' (partial)' if partial else '')
+      request.setResponseCode(code)
+      request.write(body)
+      request.finish()
+      span.Finish(code=code, messages=len(messages), partial=partial)
+    d.addCallback(FinishGetInbox)
+    d.addErrback(self._FailureCallback(request, start, span, logstring))
+
+  def _Read(self, topic, user, offset, limit, request):
+    """Wraps the backend Read with HTTP protocol, see offsets.py."""
+    d, span, logstring = self._CallBackend(
+        request, 'Read', self._backend.Read, topic, user, offset, limit)
+    start = time.time()
+    def FinishRead(arg):
+      code, messages = arg
+      accept_encoding = request.getHeader(b'accept-encoding')
+      body = b''
+      if messages:
+        request.setHeader(b'Content-Type', b'application/json')
+        body = EncodeRange(
+            messages, messages[-1][0] + 1,
+            lambda m: self._compressor.ForResponse(m, accept_encoding))
+      logging.info('%d %s %s %d messages', code, _FormatTime(start),
+                   logstring, len(messages))
+      request.setResponseCode(code)
+      request.write(body)
+      request.finish()
+      span.Finish(code=code, messages=len(messages))
+    d.addCallback(FinishRead)
+    d.addErrback(self._FailureCallback(request, start, span, logstring))
+
+  def _Commit(self, topic, user, seq, request):
+    """Wraps the backend Commit with HTTP protocol, see offsets.py."""
+    d, span, logstring = self._CallBackend(
+        request, 'Commit', self._backend.Commit, topic, user, seq)
+    start = time.time()
+    def FinishCommit(code):
+      logging.info('%d %s %s', code, _FormatTime(start), logstring)
+      request.setResponseCode(code)
+      request.write(b'')
+      request.finish()
+      span.Finish(code=code)
+    d.addCallback(FinishCommit)
+    d.addErrback(self._FailureCallback(request, start, span, logstring))
 
   def _Subscribe(self, topic, user, request):
     """Wraps the backend Subscribe with HTTP protocol to the client."""
-    d = maybeDeferred(self._backend.Subscribe, topic, user)
+    d, span, logstring = self._CallBackend(
+        request, 'Subscribe', self._backend.Subscribe, topic, user)
     start = time.time()
-    logstring = 'Subscribe (%s, %s)' % (topic, user)
     def FinishSubscribe(code):
       logging.info('%d %s %s', code, _FormatTime(start), logstring)
       request.setResponseCode(code)
-      request.write('')
+      request.write(b'')
       request.finish()
+      span.Finish(code=code)
     d.addCallback(FinishSubscribe)
-    d.addErrback(self._FailureCallback(request, start, logstring))
+    d.addErrback(self._FailureCallback(request, start, span, logstring))
 
   def _Unsubscribe(self, topic, user, request):
     """Wraps the backend Subscribe with HTTP protocol to the client."""
-    d = maybeDeferred(self._backend.Unsubscribe, topic, user)
+    d, span, logstring = self._CallBackend(
+        request, 'Unsubscribe', self._backend.Unsubscribe, topic, user)
     start = time.time()
-    logstring = 'Unsubscribe (%s, %s)' % (topic, user)
     def FinishUnubscribe(code):
       logging.info('%d %s %s', code, _FormatTime(start), logstring)
       request.setResponseCode(code)
-      request.write('')
+      request.write(b'')
       request.finish()
+      span.Finish(code=code)
     d.addCallback(FinishUnubscribe)
-    d.addErrback(self._FailureCallback(request, start, logstring))
+    d.addErrback(self._FailureCallback(request, start, span, logstring))
 
-  def _PostMessage(self, topic, message, request):
+  def _PostMessage(self, topic, message, request, publisher,
+                   idempotency_key=None):
     """Wraps the backend PostMessage with HTTP protocol to the client."""
-    d = maybeDeferred(self._backend.PostMessage, topic, message)
+    args = (topic, message)
+    if idempotency_key is not None:
+      args += (idempotency_key,)
+    # Makes the publisher current for ProxyBackend to forward.
+    token = ActivatePublisher(publisher)
+    try:
+      d, span, logstring = self._CallBackend(
+          request, 'PostMessage', self._backend.PostMessage, *args)
+    finally:
+      DeactivatePublisher(token)
     start = time.time()
-    logstring = 'PostMessage (%s, %s)' % (topic, message)
     def FinishPostMessage(code):
       logging.info('%d %s %s',
           code, _FormatTime(start), logstring)
+      self._SetTopicVersion(request, topic)
       request.setResponseCode(code)
-      request.write('')
+      request.write(b'')
       request.finish()
+      span.Finish(code=code)
     d.addCallback(FinishPostMessage)
-    d.addErrback(self._FailureCallback(request, start, logstring))
+    d.addErrback(self._FailureCallback(request, start, span, logstring))
 
   def render_DELETE(self, request):
     """Verifies the format of the request path and routes for DELETE calls."""
@@ -98,32 +463,188 @@ class PubSubResource(Resource):
       self._Unsubscribe(topic, user, request)
       return NOT_DONE_YET
     request.setResponseCode(404)
-    return ''
+    return b''
 
   def render_POST(self, request):
     """Verifies the format of the request path and routes for POST calls."""
     if len(request.postpath) == 1:
       topic = request.postpath[0]
-      message = request.content.read()
-      self._PostMessage(topic, message, request)
+      idempotency_key = request.getHeader(IDEMPOTENCY_KEY_HEADER)
+      if idempotency_key is not None and not (
+          0 < len(idempotency_key) <= MAX_KEY_LENGTH):
+        request.setResponseCode(400)
+        return b''
+      # read() on a _BodyBuffer hands back the joined body without a copy.
+      body = request.content.read()
+      if self._RateLimited(request, topic, publish=1, bytes=len(body)):
+        return b''
+      publisher = self._Publisher(request)
+      if self._sketches is not None:
+        self._sketches.RecordPublish(topic, publisher, len(body))
+      try:
+        message = self._compressor.FromRequest(
+            body, request.getHeader(b'content-encoding'))
+      except CorruptBodyError:
+        request.setResponseCode(400)
+        return b''
+      except BodyTooLargeError:
+        request.setResponseCode(413)
+        return b''
+      self._PostMessage(topic, message, request, publisher, idempotency_key)
+      return NOT_DONE_YET
+    elif len(request.postpath) == 2 and IsCommit(request.args):
+      topic, user = request.postpath
+      seq = ParseCommit(request.args)
+      if seq is None:
+        request.setResponseCode(400)
+        return b''
+      self._Commit(topic, user, seq, request)
       return NOT_DONE_YET
     elif len(request.postpath) == 2:
       topic, user = request.postpath
       self._Subscribe(topic, user, request)
       return NOT_DONE_YET
     request.setResponseCode(404)
-    return ''
+    return b''
 
   def render_GET(self, request):
     """Verifies the format of the request path and routes for GET calls."""
-    if len(request.postpath) == 2:
+    if len(request.postpath) == 2 and IsRead(request.args):
       topic, user = request.postpath
+      read = ParseRead(request.args)
+      if read is None:
+        request.setResponseCode(400)
+        return b''
+      if self._RateLimited(request, topic, user, poll=1):
+        return b''
+      self._Read(topic, user, read[0], read[1], request)
+      return NOT_DONE_YET
+    elif len(request.postpath) == 2:
+      topic, user = request.postpath
+      if self._RateLimited(request, topic, user, poll=1):
+        return b''
+      if self._sketches is not None:
+        self._sketches.RecordPoll(topic, user)
       self._GetNextMessage(topic, user, request)
       return NOT_DONE_YET
+    elif len(request.postpath) == 1 and request.postpath[0]:
+      user = request.postpath[0]
+      limit = ParseLimit(request.args)
+      if limit is None:
+        request.setResponseCode(400)
+        return b''
+      if self._RateLimited(request, None, user, poll=1):
+        return b''
+      self._GetInbox(user, limit, request, IsPeek(request.args))
+      return NOT_DONE_YET
     request.setResponseCode(404)
-    return ''
+    return b''
+
+# Reactors selectable by name at RunServer time, mapped to the module that
+# provides their install() function. 'default' lets Twisted pick.
+_REACTORS = {
+    'default': None,
+    'epoll': 'twisted.internet.epollreactor',
+    'poll': 'twisted.internet.pollreactor',
+    'select': 'twisted.internet.selectreactor',
+    'asyncio': 'twisted.internet.asyncioreactor',
+}
+
+def InstallReactor(name):
+  """Installs the named reactor and returns it.
+
+  This must run before anything imports twisted.internet.reactor, which is why
+  nothing in this codebase imports the reactor at module load time.
+
+  Args:
+    name: One of the keys of _REACTORS.
+  """
+  if name not in _REACTORS:
+    raise ValueError('Unknown reactor %r, expected one of %s' %
+                     (name, ', '.join(sorted(_REACTORS))))
+  module_name = _REACTORS[name]
+  if module_name is not None:
+    module = importlib.import_module(module_name)
+    if name == 'asyncio':
+      import asyncio
+      loop = asyncio.new_event_loop()
+      asyncio.set_event_loop(loop)
+      module.install(loop)
+    else:
+      module.install()
+  from twisted.internet import reactor
+  return reactor
+
+def ServerOptionsFromEnv(environ=None):
+  """Reads the RunServer keyword arguments shared by all startup scripts.
+
+  Variables: REACTOR, ADMIN_PORT, TRACE_SAMPLE_RATE, COMPRESS_THRESHOLD,
+  COMPRESS_LEVEL, MAX_MESSAGE_SIZE, RATE_LIMITS, SKETCH_WINDOW, CAPTURE_PATH,
+  CAPTURE_ANONYMIZE, POLL_PACING_MAX_WAIT, POLL_CAPACITY, TRUST_GZIP and
+  TRUST_FORWARDED_FOR. See RunServer for their meaning.
+  """
+  environ = os.environ if environ is None else environ
+  threshold = environ.get('COMPRESS_THRESHOLD')
+  max_message_size = environ.get('MAX_MESSAGE_SIZE')
+  return {
+      'reactor_name': environ.get('REACTOR', 'default'),
+      'admin_port': int(environ.get('ADMIN_PORT', 0)),
+      'trace_sample_rate': float(environ.get('TRACE_SAMPLE_RATE', 0)),
+      'compress_threshold': int(threshold) if threshold else None,
+      'compress_level': int(environ.get('COMPRESS_LEVEL', 6)),
+      'max_message_size': int(max_message_size) if max_message_size else None,
+      'rate_limits': ParseLimits(environ.get('RATE_LIMITS')),
+      'sketch_window': float(environ.get('SKETCH_WINDOW', 0)),
+      'capture_path': environ.get('CAPTURE_PATH') or None,
+      'capture_anonymize': environ.get('CAPTURE_ANONYMIZE', '0') == '1',
+      'pacing_max_wait': float(environ.get('POLL_PACING_MAX_WAIT', 0)),
+      'poll_capacity': float(environ.get('POLL_CAPACITY', 0)),
+      'trust_gzip': environ.get('TRUST_GZIP', '0') == '1',
+      'trust_forwarded_for': environ.get('TRUST_FORWARDED_FOR', '0') == '1',
+  }
+
+def RunServer(backend, port, reactor_name='default', admin_port=None,
+              trace_sample_rate=0.0, compress_threshold=None, compress_level=6,
+              max_message_size=None, rate_limits=None, sketch_window=0,
+              components=(), listen_fd=None, capture_path=None,
+              capture_anonymize=False, pacing_max_wait=0, poll_capacity=0,
+              trust_gzip=False, trust_forwarded_for=False):
+  """Serves the PubSub HTTP API for backend on port until the reactor stops.
 
-def RunServer(backend, port):
+  Args:
+    backend: The backend implementing the PubSub API.
+    port: The TCP port to listen on.
+    reactor_name: Which reactor to run under, see _REACTORS.
+    admin_port: If set, the localhost port to serve the admin endpoints on.
+    trace_sample_rate: Fraction of requests to trace, see tracing.py.
+    compress_threshold: Compress published bodies of at least this many bytes,
+      see compression.py. None disables compression.
+    compress_level: zlib level used when compressing.
+    max_message_size: If set, request bodies over this many bytes get a 413.
+    rate_limits: Optional list of limits, see ratelimit.ParseLimits. Requests
+      over a limit get a 429.
+    sketch_window: If set, keep traffic sketches (see sketches.py) over
+      windows of this many seconds.
+    components: Other objects serving admin endpoints (see admin.py). Those
+      with a Start(reactor) method are started once the reactor is installed,
+      and those with a Serving(site, listening_port, admin_listening_port)
+      method are passed the site and ports once they are listening.
+    listen_fd: An already listening IPv4 socket to serve on instead of
+      binding port, e.g. one handed over by handoff.py.
+    capture_path: If set, capture traffic to this file from the start, see
+      capture.py. Captures can also be started from the admin port.
+    capture_anonymize: Whether captures hash topic and user names.
+    pacing_max_wait: If set, answer empty polls with the time to wait before
+      polling again, up to this many seconds, see pacing.py.
+    poll_capacity: Polls per second a backend should answer, over which the
+      waits are stretched. 0 ignores the backends' load.
+    trust_gzip: Whether to store gzip publishes without checking them, for
+      backends whose publishes all come from frontends, see compression.py.
+    trust_forwarded_for: Whether to count the X-Forwarded-For address as the
+      publisher in the traffic sketches, for backends whose publishes all
+      come from frontends, see sketches.py.
+  """
+  reactor = InstallReactor(reactor_name)
   # Logging set up to go to a directory, for easy debugging of clustered
   # server.
   try:
@@ -135,10 +656,36 @@ def RunServer(backend, port):
       raise
   logging.basicConfig(filename=os.path.join('logs', 'server-%d.log' % port),
                       level=logging.DEBUG)
-  resource = PubSubResource(backend)
-  factory = Site(resource)
-  reactor.listenTCP(port, factory)
+  logging.info('Serving on port %d with %s', port, type(reactor).__name__)
+  tracing.Configure(trace_sample_rate, process='server-%d' % port)
+  resource = PubSubResource(
+      backend, Compressor(compress_threshold, compress_level,
+                          max_message_size, check_gzip=not trust_gzip),
+      RateLimiter(rate_limits) if rate_limits else None,
+      TrafficSketches(sketch_window) if sketch_window else None,
+      PollPacer(pacing_max_wait, poll_capacity) if pacing_max_wait else None,
+      trust_forwarded_for)
+  capture = TrafficCapture(capture_path, capture_anonymize)
+  components = [capture] + list(components)
+  factory = PubSubSite(resource, max_message_size, capture)
+  if listen_fd is None:
+    listening = reactor.listenTCP(port, factory)
+  else:
+    listening = reactor.adoptStreamPort(listen_fd, socket.AF_INET, factory)
+    os.close(listen_fd)
+  for component in components:
+    if hasattr(component, 'Start'):
+      component.Start(reactor)
+  admin_listening = None
+  if admin_port:
+    admin_listening = reactor.listenTCP(
+        admin_port, CreateAdminSite(backend, resource, *components),
+        interface='127.0.0.1')
+    logging.info('Admin endpoints on 127.0.0.1:%d', admin_port)
+  for component in components:
+    if hasattr(component, 'Serving'):
+      component.Serving(factory, listening, admin_listening)
   reactor.run()
 
 if __name__ == '__main__':
-  RunServer(MemoryBackend(), 8080)
+  RunServer(MemoryBackend(), 8080, **ServerOptionsFromEnv())
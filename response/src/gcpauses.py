@@ -0,0 +1,282 @@
+"""Garbage collector pauses: measured per generation, and tuning controls.
+
+Every pending message in a MemoryBackend is two objects the cyclic garbage
+collector tracks (the _Message and its set of subscribers), so a backend
+holding millions of messages has a heap that a full (generation 2)
+collection takes hundreds of milliseconds to scan. The reactor stops for all
+of it, and every topic on the shard sees the spike. Full collections run
+whenever the objects that survived into generation 2 since the last one
+number a quarter of those there before, so a growing backlog triggers them
+over and over.
+
+GcMonitor times every collection from gc.callbacks, per generation, and can:
+
+  - set the collection thresholds (gc.set_threshold),
+  - freeze the heap (gc.freeze): every object alive moves to a permanent
+    generation collections never scan. Done once the state is loaded, this
+    takes the bulk of the heap out of every later full collection. Frozen
+    objects are still freed by reference counting, so only garbage cycles
+    among them are kept until unfrozen, which MemoryBackend does not make.
+  - run full collections while the reactor is idle instead: automatic full
+    collections are turned off (the generation 2 threshold is set out of
+    reach), and a check every idle_interval runs one at the first idle
+    moment once idle_collect seconds have passed since the last, or anyway
+    once 4 times that has passed. The reactor counts as idle when nothing
+    was collected and fewer than idle_allocations objects were allocated
+    since the previous check.
+
+Stats and the controls are at /gc on the admin port (GcResource).
+"""
+
+import collections
+import gc
+import json
+import logging
+import time
+
+from twisted.internet.task import LoopingCall
+from twisted.web.resource import Resource
+
+GENERATIONS = 3
+
+# A generation 2 threshold no count of generation 1 collections reaches.
+_NEVER = 1 << 30
+
+def ParseThresholds(spec):
+  """Parses 'T0[,T1[,T2]]' (GC_THRESHOLDS) into a tuple of ints, or None.
+
+  Raises:
+    ValueError: If spec is malformed.
+  """
+  if not spec:
+    return None
+  thresholds = tuple(int(t) for t in spec.split(','))
+  if not 0 < len(thresholds) <= GENERATIONS or min(thresholds) < 0:
+    raise ValueError('Bad GC thresholds %r' % spec)
+  return thresholds
+
+class GcMonitor(object):
+  """Times garbage collections and tunes the collector, see the docstring."""
+
+  def __init__(self, thresholds=None, freeze=False, idle_collect=0,
+               idle_interval=0.05, idle_allocations=100, window=1000,
+               clock=time.perf_counter):
+    """Constructor.
+
+    Args:
+      thresholds: Optional thresholds to set on Start, see ParseThresholds.
+      freeze: Whether to freeze the heap on Start, after a collection.
+      idle_collect: If set, seconds between full collections, which are run
+        while the reactor is idle instead of automatically.
+      idle_interval: Seconds between idle checks.
+      idle_allocations: Most allocations between checks of an idle reactor.
+      window: How many recent pauses per generation percentiles are over.
+      clock: Function returning the time in seconds, to time pauses with.
+    """
+    self._thresholds = thresholds
+    self._freeze = freeze
+    self._idle_collect = idle_collect
+    self._idle_interval = idle_interval
+    self._idle_allocations = idle_allocations
+    self._clock = clock
+    self._started = None
+    self._recent = [collections.deque(maxlen=window)
+                    for _ in range(GENERATIONS)]
+    self._stats = [{'collections': 0, 'pause_ms': 0.0, 'max_pause_ms': 0.0,
+                    'collected': 0, 'uncollectable': 0}
+                   for _ in range(GENERATIONS)]
+    self._counters = collections.Counter()
+    self._reactor = None
+    self._loop = None
+    # The generation 2 threshold to go back to when idle collection stops.
+    self._full_threshold = None
+    self._last_full = None
+    self._seen = None  # Collections and generation 0 count at the last check.
+
+  def Start(self, reactor):
+    """Starts timing collections, and applies the configured tuning."""
+    self._reactor = reactor
+    gc.callbacks.append(self._Callback)
+    if self._thresholds is not None:
+      self.SetThresholds(*self._thresholds)
+    if self._freeze:
+      self.Freeze()
+    if self._idle_collect:
+      self.CollectWhenIdle(self._idle_collect)
+
+  def Stop(self):
+    """Stops timing, and gives full collections back to the collector."""
+    if self._Callback in gc.callbacks:
+      gc.callbacks.remove(self._Callback)
+    self.CollectWhenIdle(0)
+
+  def _Callback(self, phase, info):
+    if phase == 'start':
+      self._started = self._clock()
+      return
+    if self._started is None:
+      return
+    pause = (self._clock() - self._started) * 1000
+    self._started = None
+    generation = info['generation']
+    stats = self._stats[generation]
+    stats['collections'] += 1
+    stats['pause_ms'] += pause
+    stats['max_pause_ms'] = max(stats['max_pause_ms'], pause)
+    stats['collected'] += info['collected']
+    stats['uncollectable'] += info['uncollectable']
+    self._recent[generation].append(pause)
+    if generation == GENERATIONS - 1 and self._reactor is not None:
+      self._last_full = self._reactor.seconds()
+
+  def SetThresholds(self, *thresholds):
+    """Sets the collection thresholds, see gc.set_threshold.
+
+    While collecting when idle, a generation 2 threshold only applies once
+    that stops.
+    """
+    thresholds = list(thresholds) + list(gc.get_threshold()[len(thresholds):])
+    if self._loop is not None:
+      self._full_threshold = thresholds[2]
+      thresholds[2] = _NEVER
+    gc.set_threshold(*thresholds)
+    logging.info('GC thresholds set to %s', gc.get_threshold())
+
+  def Freeze(self):
+    """Collects, then moves every object alive out of future collections.
+
+    Returns:
+      The number of frozen objects.
+    """
+    gc.collect()
+    gc.freeze()
+    self._counters['freezes'] += 1
+    logging.info('Froze %d objects', gc.get_freeze_count())
+    return gc.get_freeze_count()
+
+  def Unfreeze(self):
+    """Returns the frozen objects to the oldest generation."""
+    gc.unfreeze()
+
+  def Collect(self, generation=GENERATIONS - 1):
+    """Runs a collection of generation (and the younger ones) now.
+
+    Returns:
+      The number of unreachable objects found.
+    """
+    self._counters['manual_collections'] += 1
+    return gc.collect(generation)
+
+  def CollectWhenIdle(self, interval):
+    """Runs full collections while idle, every interval seconds or so.
+
+    An interval of 0 gives full collections back to the collector. Only
+    once started.
+    """
+    if self._loop is not None:
+      self._loop.stop()
+      self._loop = None
+      threshold = gc.get_threshold()
+      gc.set_threshold(threshold[0], threshold[1], self._full_threshold)
+    self._idle_collect = interval
+    if not interval:
+      return
+    self._full_threshold = gc.get_threshold()[2]
+    threshold = gc.get_threshold()
+    gc.set_threshold(threshold[0], threshold[1], _NEVER)
+    self._last_full = self._reactor.seconds()
+    self._seen = None
+    self._loop = LoopingCall(self._CheckIdle)
+    self._loop.clock = self._reactor
+    self._loop.start(self._idle_interval, now=False)
+
+  def _CheckIdle(self):
+    seen = (sum(s['collections'] for s in self._stats), gc.get_count()[0])
+    previous, self._seen = self._seen, seen
+    since = self._reactor.seconds() - self._last_full
+    if since < self._idle_collect:
+      return
+    if since >= 4 * self._idle_collect:
+      self._counters['forced_collections'] += 1
+    elif (previous is None or seen[0] != previous[0] or
+          seen[1] - previous[1] >= self._idle_allocations):
+      return
+    else:
+      self._counters['idle_collections'] += 1
+    gc.collect()
+    self._last_full = self._reactor.seconds()
+    self._seen = None
+
+  def Stats(self):
+    """Returns pause counts, totals and percentiles per generation."""
+    generations = []
+    for stats, recent in zip(self._stats, self._recent):
+      stats = dict(stats)
+      recent = sorted(recent)
+      for pct in (50, 99):
+        stats['p%d_pause_ms' % pct] = (
+            recent[min(len(recent) - 1, len(recent) * pct // 100)]
+            if recent else 0.0)
+      generations.append(stats)
+    stats = dict(self._counters)
+    stats.update({
+        'generations': generations,
+        'thresholds': list(gc.get_threshold()),
+        'counts': list(gc.get_count()),
+        'frozen': gc.get_freeze_count(),
+        'idle_collect': self._idle_collect if self._loop is not None else 0,
+    })
+    return stats
+
+  def AdminResources(self):
+    """Admin endpoints for the collector, see admin.py."""
+    return {b'gc': GcResource(self)}
+
+class GcResource(Resource):
+  """Admin endpoint to view collector stats and tune it at runtime.
+
+  GET / - The stats as JSON.
+  POST /?threshold=T0[,T1[,T2]] - Sets the thresholds.
+  POST /?freeze=1 - Freezes the heap (freeze=0 unfreezes).
+  POST /?collect=GENERATION - Collects now.
+  POST /?idle_collect=S - Runs full collections when idle every S seconds, 0
+    gives them back to the collector.
+  """
+  isLeaf = True
+
+  def __init__(self, monitor):
+    Resource.__init__(self)
+    self._monitor = monitor
+
+  def render_GET(self, request):
+    request.setHeader(b'Content-Type', b'application/json')
+    return json.dumps(self._monitor.Stats()).encode('utf-8')
+
+  def _Arg(self, request, name):
+    return request.args.get(name, [None])[0]
+
+  def render_POST(self, request):
+    try:
+      thresholds = ParseThresholds(
+          (self._Arg(request, b'threshold') or b'').decode('ascii'))
+      freeze = self._Arg(request, b'freeze')
+      collect = self._Arg(request, b'collect')
+      idle_collect = self._Arg(request, b'idle_collect')
+      if collect is not None and not 0 <= int(collect) < GENERATIONS:
+        raise ValueError('Bad generation %r' % collect)
+      if idle_collect is not None and float(idle_collect) < 0:
+        raise ValueError('Bad interval %r' % idle_collect)
+    except ValueError:
+      request.setResponseCode(400)
+      return b''
+    if thresholds is not None:
+      self._monitor.SetThresholds(*thresholds)
+    if freeze == b'1':
+      self._monitor.Freeze()
+    elif freeze == b'0':
+      self._monitor.Unfreeze()
+    if collect is not None:
+      self._monitor.Collect(int(collect))
+    if idle_collect is not None:
+      self._monitor.CollectWhenIdle(float(idle_collect))
+    return self.render_GET(request)
@@ -0,0 +1,256 @@
+"""Zero downtime restarts: handing a backend's socket and state to a new build.
+
+Start the new process with the HANDOFF_SOCKET of the running one. Before it
+serves anything, it connects to that Unix socket, and the running process:
+
+  1. sends it the listening API socket (SCM_RIGHTS) and stops accepting on
+     it. Connections arriving from then on wait in the socket's backlog until
+     the new process accepts them.
+  2. stops everything else that could change the backend. Its site answers
+     requests on connections it had already accepted with a 503 and closes
+     them, and the components it was given are stopped (e.g. ShmListener,
+     Snapshotter) and then flushed (e.g. SubscriptionStore).
+  3. streams the backend's state into the socket from a thread, in the
+     snapshot format (see MemoryBackend.WriteSnapshot).
+  4. exits `drain` seconds later, once the responses it had written have
+     reached their clients.
+
+The new process loads the state as it arrives and then serves the socket it
+was given, so no connection is refused during a restart: those made during
+the transfer are accepted late.
+
+With no process to take over from, the new process starts as usual. If the
+state fails to arrive, it still serves the socket, with whatever state it
+would have started with otherwise. Idempotency keys (see dedup.py) are not
+handed over, just as they are not kept in snapshots.
+"""
+
+import logging
+import os
+import socket
+import time
+
+from twisted.internet import threads
+from twisted.internet.protocol import Factory
+from twisted.internet.protocol import Protocol
+
+from admin import JsonResource
+
+_MAGIC = b'PSQHAND1'
+_BUFFER_SIZE = 1 << 20
+
+class _CountingFile(object):
+  """Passes reads and writes through to a file object, counting the bytes."""
+
+  def __init__(self, f):
+    self._f = f
+    self.bytes = 0
+
+  def read(self, size):
+    data = self._f.read(size)
+    self.bytes += len(data)
+    return data
+
+  def write(self, data):
+    self.bytes += len(data)
+    return self._f.write(data)
+
+  def flush(self):
+    self._f.flush()
+
+class _HandoffProtocol(Protocol):
+  def __init__(self, handoff):
+    self._handoff = handoff
+
+  def connectionMade(self):
+    self._handoff.HandOver(self.transport)
+
+class _HandoffFactory(Factory):
+  def __init__(self, handoff):
+    self._handoff = handoff
+
+  def buildProtocol(self, addr):
+    return _HandoffProtocol(self._handoff)
+
+class Handoff(object):
+  """Takes over from the previous process, and hands over to the next."""
+
+  def __init__(self, backend, path, drain=2.0, components=()):
+    """Constructor.
+
+    Args:
+      backend: The MemoryBackend whose state is handed over.
+      path: The Unix socket to hand over through.
+      drain: Seconds between handing over and exiting.
+      components: Objects to quiesce before the state is sent. Their Stop()
+        is called, if they have one, so that they stop changing the backend,
+        and then their Flush(), so that the new process reads what they
+        wrote.
+    """
+    self._backend = backend
+    self._path = path
+    self._drain = drain
+    self._components = components
+    self._clock = None
+    self._port = None
+    self._site = None
+    self._listening = None
+    self._admin_listening = None
+    self._fd_received = None
+    self._handing_over = False
+    self._stats = {
+        'state_received': False,
+        'received_bytes': None,
+        'received_topics': None,
+        'received_messages': None,
+        'receive_ms': None,  # From connecting to the state being loaded.
+        'receive_mb_per_s': None,
+        # From the socket arriving, when the old process stopped accepting,
+        # to this process accepting on it.
+        'unavailable_ms': None,
+        'sent_bytes': None,
+        'send_ms': None,
+    }
+
+  @property
+  def received(self):
+    """Whether Receive loaded the state of a previous process."""
+    return self._stats['state_received']
+
+  def Receive(self):
+    """Takes over from the process listening on path, if there is one.
+
+    Blocks until the state has been loaded, so call it before RunServer.
+
+    Returns:
+      The listening socket's file descriptor, for RunServer's listen_fd, or
+      None if there was no process to take over from.
+    """
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+      connection.connect(self._path)
+    except socket.error:
+      connection.close()
+      logging.info('No process to take over from at %s', self._path)
+      return None
+    start = time.time()
+    try:
+      magic, fds, _, _ = socket.recv_fds(connection, len(_MAGIC), 1)
+    except socket.error:
+      logging.exception('Handoff from %s failed', self._path)
+      connection.close()
+      return None
+    if magic != _MAGIC or len(fds) != 1:
+      for fd in fds:
+        os.close(fd)
+      connection.close()
+      logging.error('Handoff from %s sent %r', self._path, magic)
+      return None
+    self._fd_received = time.time()
+    f = connection.makefile('rb', buffering=_BUFFER_SIZE)
+    reader = _CountingFile(f)
+    try:
+      topics, messages = self._backend.LoadSnapshot(reader)
+    except (socket.error, ValueError):
+      logging.exception('Handoff of the state from %s failed', self._path)
+    else:
+      elapsed = time.time() - start
+      self._stats.update(
+          state_received=True, received_bytes=reader.bytes,
+          received_topics=topics, received_messages=messages,
+          receive_ms=elapsed * 1000,
+          receive_mb_per_s=reader.bytes / 1e6 / max(elapsed, 1e-6))
+      logging.info('Took over %d topics, %d messages (%d bytes) in %.0fms',
+                   topics, messages, reader.bytes, elapsed * 1000)
+    finally:
+      f.close()
+      connection.close()
+    return fds[0]
+
+  def Start(self, reactor):
+    """Listens for the next process to hand over to (see RunServer)."""
+    self._clock = reactor
+    try:
+      os.unlink(self._path)
+    except OSError:
+      pass
+    self._port = reactor.listenUNIX(self._path, _HandoffFactory(self))
+
+  def Serving(self, site, listening, admin_listening):
+    """Records what to hand over (see RunServer)."""
+    self._site = site
+    self._listening = listening
+    self._admin_listening = admin_listening
+    if self._fd_received is not None:
+      self._stats['unavailable_ms'] = (time.time() - self._fd_received) * 1000
+
+  def HandOver(self, transport):
+    """Hands the socket and state to the process connected on transport."""
+    if self._site is None or self._handing_over:
+      transport.loseConnection()
+      return
+    self._handing_over = True
+    start = time.time()
+    logging.info('Handing over to a new process')
+    fd = os.dup(self._listening.fileno())
+    # Twisted would shut the socket down, which stops it listening in every
+    # process holding it.
+    self._listening._shouldShutdown = False
+    self._listening.stopListening()
+    if self._admin_listening is not None:
+      self._admin_listening.stopListening()
+    self._port.stopListening()
+    self._site.draining = True
+    for component in self._components:
+      if hasattr(component, 'Stop'):
+        component.Stop()
+    # Write from a blocking duplicate of the connection, so that a large
+    # state never sits in Twisted's buffers.
+    transport.stopReading()
+    connection = socket.fromfd(transport.fileno(), socket.AF_UNIX,
+                               socket.SOCK_STREAM)
+    connection.setblocking(True)
+    d = threads.deferToThread(self._Send, connection, fd)
+
+    def Sent(sent_bytes):
+      self._stats['sent_bytes'] = sent_bytes
+      self._stats['send_ms'] = (time.time() - start) * 1000
+      logging.info('Handed over %d bytes in %.0fms', sent_bytes,
+                   self._stats['send_ms'])
+
+    def Done(_):
+      transport.loseConnection()
+      self._clock.callLater(self._drain, self._Exit)
+    d.addCallbacks(Sent, lambda failure: logging.error(
+        'Handoff failed: %s', failure.getTraceback()))
+    d.addCallback(Done)
+    return d
+
+  def _Send(self, connection, fd):
+    """Runs in a thread: sends the socket, then the state."""
+    try:
+      try:
+        socket.send_fds(connection, [_MAGIC], [fd])
+      finally:
+        os.close(fd)
+      for component in self._components:
+        if hasattr(component, 'Flush'):
+          component.Flush()
+      with connection.makefile('wb', buffering=_BUFFER_SIZE) as f:
+        writer = _CountingFile(f)
+        self._backend.WriteSnapshot(writer)
+      return writer.bytes
+    finally:
+      connection.close()
+
+  def _Exit(self):
+    logging.info('Handed over, exiting')
+    self._clock.stop()
+
+  def Stats(self):
+    """Returns what was received and sent, with timings."""
+    return dict(self._stats)
+
+  def AdminResources(self):
+    """Admin endpoints for handoffs, see admin.py."""
+    return {b'handoff': JsonResource(self.Stats)}
@@ -0,0 +1,97 @@
+"""Inbox reads: a user's pending messages across all of their topics.
+
+GET /<user>?limit=N takes up to N (default 100, at most 1000) of user's
+pending messages, from every topic user subscribes to, in one request. On a
+backend, MemoryBackend.GetMessages answers from an index of each user's
+subscriptions, oldest message first. A frontend's HashBackend asks every
+backend in parallel, since a user's topics are spread across them, and
+answers with whatever has arrived by its deadline.
+
+GET /<user>?limit=N&peek=1 (PeekMessages) reads the same messages without
+taking them, each with its seq. That is how HashBackend reads: it takes up to
+N messages from the answers that arrived by its deadline, then commits (see
+offsets.py) each topic up to the last seq it is returning. An answer that
+arrives late, or messages past the limit, are dropped on the frontend but
+are still pending on their backend for the next read. A commit that fails
+leaves its messages pending, so they are delivered again.
+
+The response is JSON:
+
+  {"messages": [{"topic": "orders", "body": "<base64>"}, ...],
+   "partial": false}
+
+A body still gzip compressed (see compression.py), which is only sent when
+the request's Accept-Encoding allows gzip, carries "encoding": "gzip". A
+peeked message also carries its "seq".
+"partial" is true if a backend failed or missed the deadline, so messages
+may be waiting that are not in the response. The status is 200 with
+messages, 204 with none (and an empty body), and 404 if user subscribes to
+nothing.
+"""
+
+import base64
+import json
+
+from compression import CompressedBody
+from compression import GZIP
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+
+def ParseLimit(args):
+  """Returns the limit of an inbox request's query args, or None if invalid."""
+  value = args.get(b'limit', [b'%d' % DEFAULT_LIMIT])[0]
+  if not value.isdigit() or not 0 < int(value) <= MAX_LIMIT:
+    return None
+  return int(value)
+
+def IsPeek(args):
+  """Whether an inbox request's query args ask for a PeekMessages."""
+  return args.get(b'peek', [b''])[0] == b'1'
+
+def _Plain(body):
+  """Leaves bodies as they are, compressed ones marked as gzip."""
+  return body, (GZIP if isinstance(body, CompressedBody) else None)
+
+def EncodeInbox(messages, partial, for_response=_Plain):
+  """Returns the JSON response body for messages.
+
+  Args:
+    messages: A list of (topic, body) tuples, or of (topic, body, seq) tuples
+      for a peek.
+    partial: Whether messages may be missing, see the module docstring.
+    for_response: Function of a body returning (body, content encoding), e.g.
+      compression.Compressor.ForResponse for the request's Accept-Encoding.
+  """
+  entries = []
+  for message in messages:
+    body, encoding = for_response(message[1])
+    entry = {'topic': message[0].decode('utf-8', 'surrogateescape'),
+             'body': base64.b64encode(body).decode('ascii')}
+    if encoding is not None:
+      entry['encoding'] = encoding.decode('ascii')
+    if len(message) > 2:
+      entry['seq'] = message[2]
+    entries.append(entry)
+  return json.dumps({'messages': entries, 'partial': partial}).encode('utf-8')
+
+def DecodeInbox(data):
+  """Parses an EncodeInbox response body.
+
+  Returns:
+    A (messages, partial) tuple, with gzip bodies as CompressedBody. Messages
+    are (topic, body) tuples, or (topic, body, seq) if they carry a seq.
+  """
+  if not data:
+    return [], False
+  inbox = json.loads(data)
+  messages = []
+  for entry in inbox['messages']:
+    body = base64.b64decode(entry['body'])
+    if entry.get('encoding') == GZIP.decode('ascii'):
+      body = CompressedBody(body)
+    message = (entry['topic'].encode('utf-8', 'surrogateescape'), body)
+    if 'seq' in entry:
+      message += (entry['seq'],)
+    messages.append(message)
+  return messages, inbox['partial']
@@ -0,0 +1,188 @@
+"""Time-sliced background work, so large operations never stall the reactor.
+
+Work that grows with the size of the state, such as cleaning up after an
+unsubscribe from a topic with a million pending messages, is written as a
+generator that does a bounded chunk of work per step. Maintenance runs the
+steps of all such jobs from a twisted.internet.task.Cooperator. Each reactor
+iteration it runs steps for at most `budget` seconds and then returns to the
+reactor, so requests are answered between slices.
+
+A StallMonitor measures how late a timer fires, which shows the longest the
+reactor went without servicing events, whatever the cause.
+"""
+
+import collections
+import logging
+import time
+
+from twisted.internet.task import Cooperator
+from twisted.internet.task import LoopingCall
+
+from admin import JsonResource
+
+class StallMonitor(object):
+  """Measures how late the reactor runs a timer due every `interval`."""
+
+  def __init__(self, interval=0.01, threshold=0.05, window=1000):
+    """Constructor.
+
+    Args:
+      interval: Seconds between checks.
+      threshold: Lateness in seconds counted as a stall.
+      window: How many recent checks the percentiles are over.
+    """
+    self._interval = interval
+    self._threshold = threshold
+    self._recent = collections.deque(maxlen=window)
+    self._clock = None
+    self._call = None
+    self._expected = None
+    self._stats = {'checks': 0, 'stalls': 0, 'max_stall_ms': 0.0}
+
+  def Start(self, reactor):
+    self._clock = reactor
+    self._Schedule()
+
+  def Stop(self):
+    if self._call is not None and self._call.active():
+      self._call.cancel()
+
+  def _Schedule(self):
+    self._expected = time.time() + self._interval
+    self._call = self._clock.callLater(self._interval, self._Check)
+
+  def _Check(self):
+    late = max(0.0, time.time() - self._expected)
+    self._stats['checks'] += 1
+    self._recent.append(late)
+    if late >= self._threshold:
+      self._stats['stalls'] += 1
+    self._stats['max_stall_ms'] = max(self._stats['max_stall_ms'], late * 1000)
+    self._Schedule()
+
+  def Stats(self):
+    """Returns the worst and recent lateness in ms, and the stall count."""
+    stats = dict(self._stats)
+    recent = sorted(self._recent)
+    for pct in (50, 99):
+      stats['p%d_stall_ms' % pct] = (
+          1000 * recent[min(len(recent) - 1, len(recent) * pct // 100)]
+          if recent else 0.0)
+    return stats
+
+class Maintenance(object):
+  """Runs generator jobs in time-sliced steps (see the module docstring)."""
+
+  def __init__(self, budget=0.005, stall_monitor=None):
+    """Constructor.
+
+    Args:
+      budget: Seconds of job steps per reactor iteration.
+      stall_monitor: Optional StallMonitor, started and reported alongside.
+    """
+    self._budget = budget
+    self._stall_monitor = stall_monitor
+    self._clock = None
+    self._cooperator = None
+    self._tasks = set()
+    self._periodic = []
+    self._loops = []
+    self._stats = collections.Counter()
+    self._stats['max_slice_ms'] = 0.0
+
+  def Start(self, reactor):
+    """Runs jobs in slices from now on, and starts periodic ones."""
+    self._clock = reactor
+    self._cooperator = Cooperator(
+        terminationPredicateFactory=self._Deadline,
+        scheduler=lambda step: reactor.callLater(0, self._Slice, step))
+    for interval, factory, name in self._periodic:
+      self._StartPeriodic(interval, factory, name)
+    if self._stall_monitor is not None:
+      self._stall_monitor.Start(reactor)
+
+  def Stop(self):
+    """Pauses every job and periodic job, e.g. before a handoff."""
+    for loop in self._loops:
+      loop.stop()
+    for task in list(self._tasks):
+      task.pause()
+
+  def _Deadline(self):
+    deadline = time.time() + self._budget
+    return lambda: time.time() >= deadline
+
+  def _Slice(self, step):
+    start = time.time()
+    step()
+    elapsed = (time.time() - start) * 1000
+    self._stats['slices'] += 1
+    self._stats['max_slice_ms'] = max(self._stats['max_slice_ms'], elapsed)
+
+  def Run(self, job, name='job'):
+    """Runs the generator job to completion.
+
+    A step may yield a Deferred to pause the job until it fires. Before
+    Start, the job runs right away, in one go.
+    """
+    self._stats['started.' + name] += 1
+    if self._cooperator is None:
+      for _ in job:
+        pass
+      self._stats['finished.' + name] += 1
+      return
+    task = self._cooperator.cooperate(self._Count(job))
+    self._tasks.add(task)
+
+    def Done(result):
+      self._tasks.discard(task)
+      self._stats['finished.' + name] += 1
+      return result
+    task.whenDone().addBoth(Done).addErrback(lambda failure: logging.error(
+        'Maintenance job %s failed: %s', name, failure.getTraceback()))
+
+  def _Count(self, job):
+    for step in job:
+      self._stats['steps'] += 1
+      yield step
+
+  def Every(self, interval, factory, name):
+    """Runs factory() as a job every interval seconds, once started.
+
+    A run is skipped while the previous one is still going.
+    """
+    self._periodic.append((interval, factory, name))
+    if self._clock is not None:
+      self._StartPeriodic(interval, factory, name)
+
+  def _StartPeriodic(self, interval, factory, name):
+    running = [False]
+
+    def Launch():
+      if running[0]:
+        return
+      running[0] = True
+
+      def Job():
+        try:
+          for step in factory():
+            yield step
+        finally:
+          running[0] = False
+      self.Run(Job(), name)
+    loop = LoopingCall(Launch)
+    loop.clock = self._clock
+    loop.start(interval, now=False)
+    self._loops.append(loop)
+
+  def Stats(self):
+    """Returns job and slice counters, with the StallMonitor's stats."""
+    stats = dict(self._stats)
+    stats['running'] = len(self._tasks)
+    if self._stall_monitor is not None:
+      stats.update(self._stall_monitor.Stats())
+    return stats
+
+  def AdminResources(self):
+    """Admin endpoints for maintenance, see admin.py."""
+    return {b'maintenance': JsonResource(self.Stats)}
@@ -0,0 +1,101 @@
+"""Offset reads: a subscription's messages by sequence number, kept until
+committed.
+
+Every message stored in a topic gets the next of the topic's sequence
+numbers, which only ever go up (they survive snapshots and handoffs, and
+topics reaped and created again carry on from the highest number seen). A
+poll (GET /<topic>/<user>) returns the message's number in X-Message-Seq.
+
+Instead of polling, a consumer can read and commit:
+
+  GET /<topic>/<user>?offset=N[&limit=K]
+    Up to K (default 100, at most 1000) of user's pending messages numbered
+    N or more, oldest first. Nothing is removed, so reading again from the
+    same offset returns the same messages until they are committed.
+  POST /<topic>/<user>?commit=N
+    Removes user's pending messages numbered N or less.
+
+A consumer that crashes between the two reads the same messages again from
+its last commit. The read response is JSON:
+
+  {"messages": [{"seq": 7, "body": "<base64>"}, ...], "next": 8}
+
+with "encoding": "gzip" on bodies still compressed (see inbox.py), and
+"next" the offset to read from next. The status is 204 (and an empty body)
+if nothing is pending from the offset, and 404 without the subscription. On a
+frontend, offsets are those of the backend (or partition) the subscription is
+on, and patterns subscribed on every backend cannot be read this way (400).
+"""
+
+import base64
+import json
+
+from compression import CompressedBody
+from compression import GZIP
+from inbox import DEFAULT_LIMIT
+from inbox import MAX_LIMIT
+
+SEQ_HEADER = b'X-Message-Seq'
+
+def _Number(args, name, default=None):
+  value = args.get(name, [default])[0]
+  if value is None or not value.isdigit():
+    return None
+  return int(value)
+
+def ParseRead(args):
+  """Returns (offset, limit) of a read's query args, or None if invalid."""
+  offset = _Number(args, b'offset')
+  limit = _Number(args, b'limit', b'%d' % DEFAULT_LIMIT)
+  if offset is None or limit is None or not 0 < limit <= MAX_LIMIT:
+    return None
+  return offset, limit
+
+def ParseCommit(args):
+  """Returns the sequence number of a commit's query args, or None."""
+  return _Number(args, b'commit')
+
+def IsRead(args):
+  return b'offset' in args
+
+def IsCommit(args):
+  return b'commit' in args
+
+def _Plain(body):
+  return body, (GZIP if isinstance(body, CompressedBody) else None)
+
+def EncodeRange(messages, next_offset, for_response=_Plain):
+  """Returns the JSON response body for a read.
+
+  Args:
+    messages: A list of (seq, body) tuples.
+    next_offset: The offset to read from next.
+    for_response: Function of a body returning (body, content encoding), see
+      inbox.EncodeInbox.
+  """
+  entries = []
+  for seq, body in messages:
+    body, encoding = for_response(body)
+    entry = {'seq': seq, 'body': base64.b64encode(body).decode('ascii')}
+    if encoding is not None:
+      entry['encoding'] = encoding.decode('ascii')
+    entries.append(entry)
+  return json.dumps({'messages': entries, 'next': next_offset}).encode('utf-8')
+
+def DecodeRange(data):
+  """Parses an EncodeRange response body.
+
+  Returns:
+    A (messages, next offset) tuple, with gzip bodies as CompressedBody, or
+    ([], None) for an empty body.
+  """
+  if not data:
+    return [], None
+  decoded = json.loads(data)
+  messages = []
+  for entry in decoded['messages']:
+    body = base64.b64decode(entry['body'])
+    if entry.get('encoding') == GZIP.decode('ascii'):
+      body = CompressedBody(body)
+    messages.append((entry['seq'], body))
+  return messages, decoded['next']
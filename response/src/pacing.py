@@ -0,0 +1,134 @@
+"""Poll pacing: telling pollers of empty topics how long to wait.
+
+The API has no long poll, so a consumer of an empty topic can only poll it
+again, and how often it does decides most of the poll traffic: a topic that
+gets a message a minute is polled just as often as one getting a thousand a
+second. Backends keep, per topic, a moving average of the publish rate, and
+of the polls they answer overall (RateMeter), and return both with every
+poll response:
+
+  X-Topic-Rate: <publishes per second to the topic>
+  X-Backend-Poll-Rate: <polls per second the backend answers>
+
+A frontend with a PollPacer answers every 204 with the time the poller should
+wait before polling again, the time the topic takes to get messages_per_poll
+messages at its rate, up to max_wait:
+
+  X-Poll-After: <milliseconds>
+  Retry-After: <seconds>  (only when the wait is a second or more)
+
+so hot topics are polled as often as before while cold ones are polled every
+max_wait. When the backend answers more than poll_capacity polls a second,
+the wait is stretched by how far over it is, which spreads out the polls of
+every topic until it is back under. Clients that ignore the headers are
+served as before. Patterns (see patterns.py) get no hints: their messages
+come from topics whose rates are not tied to the pattern.
+
+Frontends of a cluster get the hints from the backend a poll went to (see
+ProxyBackend.PollHint), so their pacing follows the rates on the backends.
+"""
+
+import math
+
+from ratelimit import RetryAfter
+
+TOPIC_RATE_HEADER = b'X-Topic-Rate'
+POLL_RATE_HEADER = b'X-Backend-Poll-Rate'
+POLL_AFTER_HEADER = b'X-Poll-After'
+
+# Seconds over which RateMeters average.
+DEFAULT_TAU = 10.0
+
+class RateMeter(object):
+  """An exponentially weighted moving average of the rate of some event.
+
+  Each event adds 1/tau to the rate, which decays by e every tau seconds, so
+  events at a steady rate r average out to r. Until tau or so has passed
+  since the first event that undercounts, which is corrected for (as if the
+  events had been seen for at least a second), so a topic that just got
+  busy is not taken for a cold one.
+  """
+  __slots__ = ('_rate', '_at', '_since')
+
+  def __init__(self):
+    self._rate = 0.0
+    self._at = None
+    self._since = None
+
+  def Add(self, now, count=1, tau=DEFAULT_TAU):
+    """Records count events at time now."""
+    if self._at is None:
+      self._rate = 0.0
+      self._since = now
+    else:
+      self._rate *= math.exp(-max(0.0, now - self._at) / tau)
+    self._rate += count / tau
+    self._at = now
+
+  def Rate(self, now, tau=DEFAULT_TAU):
+    """Returns the events per second as of time now."""
+    if self._at is None:
+      return 0.0
+    seen = max(1.0, now - self._since)
+    return (self._rate * math.exp(-max(0.0, now - self._at) / tau) /
+            (1 - math.exp(-seen / tau)))
+
+def FormatRate(rate):
+  return b'%.3f' % rate
+
+def ParseRate(value):
+  """Parses an X-Topic-Rate or X-Backend-Poll-Rate value, or returns None."""
+  if value is None:
+    return None
+  try:
+    rate = float(value)
+  except ValueError:
+    return None
+  return rate if rate >= 0 else None
+
+class PollPacer(object):
+  """Decides how long pollers of empty topics are asked to wait."""
+
+  def __init__(self, max_wait=5.0, poll_capacity=0, messages_per_poll=1.0):
+    """Constructor.
+
+    Args:
+      max_wait: The longest wait asked for, in seconds.
+      poll_capacity: Polls per second a backend should answer, over which
+        waits are stretched. 0 ignores the backend's load.
+      messages_per_poll: Messages a topic should have got, at its rate, by
+        the time it is polled again.
+    """
+    self._max_wait = max_wait
+    self._poll_capacity = poll_capacity
+    self._messages_per_poll = messages_per_poll
+    self._stats = {'paced': 0, 'retry_after': 0, 'overloaded': 0}
+
+  def Wait(self, topic_rate, poll_rate):
+    """Returns the seconds to wait after a 204 from a topic.
+
+    Args:
+      topic_rate: Publishes per second to the topic.
+      poll_rate: Polls per second the topic's backend answers.
+    """
+    if topic_rate > 0:
+      wait = self._messages_per_poll / topic_rate
+    else:
+      wait = self._max_wait
+    if self._poll_capacity and poll_rate > self._poll_capacity:
+      self._stats['overloaded'] += 1
+      wait *= poll_rate / self._poll_capacity
+    return min(wait, self._max_wait)
+
+  def Pace(self, request, topic_rate, poll_rate):
+    """Sets the headers asking the poller behind a 204 request to wait."""
+    wait = self.Wait(topic_rate, poll_rate)
+    self._stats['paced'] += 1
+    request.setHeader(POLL_AFTER_HEADER, b'%d' % int(wait * 1000))
+    if wait >= 1:
+      self._stats['retry_after'] += 1
+      request.setHeader(b'Retry-After', RetryAfter(wait))
+
+  def Stats(self):
+    return dict(self._stats, max_wait=self._max_wait,
+                poll_capacity=self._poll_capacity)
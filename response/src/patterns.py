@@ -0,0 +1,117 @@
+"""Wildcard topic patterns, matched with a trie.
+
+Topic names are split into segments on '.'. A pattern is a topic name with
+at least one segment that is exactly '*', matching any one segment, or '#',
+matching any number of segments, including none:
+
+  orders.*     matches orders.created, not orders or orders.eu.created
+  orders.#     matches orders, orders.created and orders.eu.created
+  *.created    matches orders.created and users.created
+
+Subscribing to a pattern delivers every message published to a matching
+topic, from when the subscription was made. In URLs '#' must be sent as %23.
+"""
+
+WILDCARDS = (b'*', b'#')
+
+def IsPattern(topic_name):
+  """Whether topic_name has a wildcard segment."""
+  if b'*' not in topic_name and b'#' not in topic_name:
+    return False
+  return any(s in WILDCARDS for s in topic_name.split(b'.'))
+
+class _Node(object):
+  __slots__ = ('children', 'patterns')
+
+  def __init__(self):
+    self.children = {}  # Segment (or wildcard) to _Node.
+    self.patterns = set()  # Patterns ending at this node.
+
+class PatternIndex(object):
+  """A set of patterns that finds those matching a topic without a scan.
+
+  Each pattern is a path of segments through a trie. Matching a topic walks
+  the literal child and the '*' child for each of its segments, and lets a
+  '#' child consume any number of them, so the cost depends on the topic and
+  the shape of the patterns rather than on how many there are. Results are
+  cached per topic until the patterns change.
+  """
+
+  def __init__(self, cache_size=10000):
+    self._root = _Node()
+    self._count = 0
+    self._cache = {}
+    self._cache_size = cache_size
+
+  def __len__(self):
+    return self._count
+
+  def __iter__(self):
+    stack = [self._root]
+    while stack:
+      node = stack.pop()
+      for pattern in node.patterns:
+        yield pattern
+      stack.extend(node.children.values())
+
+  def Add(self, pattern):
+    """Adds pattern, if it is not already there."""
+    node = self._root
+    for segment in pattern.split(b'.'):
+      child = node.children.get(segment)
+      if child is None:
+        child = node.children[segment] = _Node()
+      node = child
+    if pattern not in node.patterns:
+      node.patterns.add(pattern)
+      self._count += 1
+      self._cache.clear()
+
+  def Remove(self, pattern):
+    """Removes pattern, pruning the trie branches only it used."""
+    path = [self._root]
+    segments = pattern.split(b'.')
+    for segment in segments:
+      child = path[-1].children.get(segment)
+      if child is None:
+        return
+      path.append(child)
+    if pattern not in path[-1].patterns:
+      return
+    path[-1].patterns.remove(pattern)
+    self._count -= 1
+    self._cache.clear()
+    for i in range(len(segments), 0, -1):
+      node = path[i]
+      if node.patterns or node.children:
+        break
+      del path[i - 1].children[segments[i - 1]]
+
+  def Match(self, topic_name):
+    """Returns a tuple of the patterns matching topic_name."""
+    matches = self._cache.get(topic_name)
+    if matches is None:
+      found = set()
+      if self._count:
+        self._Walk(self._root, topic_name.split(b'.'), 0, found)
+      matches = tuple(found)
+      if len(self._cache) >= self._cache_size:
+        self._cache.clear()
+      self._cache[topic_name] = matches
+    return matches
+
+  def _Walk(self, node, segments, i, found):
+    """Adds the patterns under node matching segments[i:] to found."""
+    multi = node.children.get(b'#')
+    if multi is not None:
+      for j in range(i, len(segments) + 1):
+        self._Walk(multi, segments, j, found)
+    if i == len(segments):
+      found.update(node.patterns)
+      return
+    child = node.children.get(segments[i])
+    if child is not None:
+      self._Walk(child, segments, i + 1, found)
+    single = node.children.get(b'*')
+    if single is not None:
+      self._Walk(single, segments, i + 1, found)
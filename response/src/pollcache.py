@@ -0,0 +1,153 @@
+"""Frontend cache of empty polls, kept honest by backend topic versions.
+
+Backends number the messages posted to each topic and return the topic's
+version, as X-Topic-Version: <epoch>-<count>, on every poll and publish
+response. The epoch is random per MemoryBackend instance so versions from a
+restarted backend never compare equal to old ones. A frontend that got a 204
+for (topic, user) at version V answers later polls with 204 itself, without a
+backend round trip, for as long as:
+
+  - the cached answer is younger than the TTL,
+  - no response it has seen since carries a newer version of the topic, and
+  - the user has not subscribed or unsubscribed through this frontend.
+
+Polls of patterns (see patterns.py) are never cached, as their messages come
+from topics whose versions the frontend cannot tie to the pattern.
+
+A cached 204 never hides a message for good: messages stay on the backend and
+are delivered by the first poll that goes through. What the cache trades away
+is freshness. A message published through another frontend, or an unsubscribe
+made through one, can be answered with 204 for up to the TTL after it happened.
+"""
+
+import collections
+import time
+
+from admin import JsonResource
+from patterns import IsPattern
+
+TOPIC_VERSION_HEADER = b'X-Topic-Version'
+
+def ParseVersion(value):
+  """Parses an X-Topic-Version value into (epoch, count), or None."""
+  if value is None:
+    return None
+  epoch, _, count = value.rpartition(b'-')
+  if not epoch or not count.isdigit():
+    return None
+  return epoch, int(count)
+
+class PollCache(object):
+  """Remembers which (topic, user) polls came back empty, and at what version.
+
+  One cache can be shared by several backends: versions are tracked per
+  epoch, and every backend has its own. Only the max_epochs epochs of a topic
+  seen most recently are kept (several for a partitioned topic, and a
+  restarted backend's old one ages out), and the versions of at most
+  max_entries topics, the least recently seen going first. A 204 cached at a
+  version that is no longer known is stale, so forgetting a version only
+  costs a round trip.
+  """
+
+  def __init__(self, ttl=0.5, max_entries=100000, clock=time.time,
+               max_epochs=8):
+    """Constructor.
+
+    Args:
+      ttl: Seconds a cached 204 may be served for.
+      max_entries: Most (topic, user) pairs remembered, and most topics whose
+        versions are; the oldest go first.
+      clock: Function returning the current time in seconds.
+      max_epochs: Most epochs remembered per topic.
+    """
+    self._ttl = ttl
+    self._max_entries = max_entries
+    self._max_epochs = max_epochs
+    self._clock = clock
+    self._empty = collections.OrderedDict()  # (topic, user): (version, expiry)
+    # topic: {epoch: newest count seen}, both least recently seen first.
+    self._versions = collections.OrderedDict()
+    self._stats = {
+        'hits': 0,
+        'misses': 0,  # Nothing cached for the pair.
+        'stale': 0,  # The topic has a newer version since the 204.
+        'expired': 0,
+        'stored': 0,
+        'evicted': 0,
+        'versions_evicted': 0,  # Topics whose versions were forgotten.
+    }
+
+  def Stats(self):
+    """Returns the counters, the hit rate and the number of cached pairs."""
+    stats = dict(self._stats)
+    lookups = (stats['hits'] + stats['misses'] + stats['stale'] +
+               stats['expired'])
+    stats['hit_rate'] = stats['hits'] / float(lookups) if lookups else 0.0
+    stats['entries'] = len(self._empty)
+    stats['topics'] = len(self._versions)
+    return stats
+
+  def Lookup(self, topic_name, user):
+    """Whether a poll of topic_name by user can be answered 204 locally."""
+    key = (topic_name, user)
+    entry = self._empty.get(key)
+    if entry is None:
+      self._stats['misses'] += 1
+      return False
+    (epoch, count), expiry = entry
+    if self._clock() >= expiry:
+      del self._empty[key]
+      self._stats['expired'] += 1
+      return False
+    if self._versions.get(topic_name, {}).get(epoch) != count:
+      del self._empty[key]
+      self._stats['stale'] += 1
+      return False
+    self._stats['hits'] += 1
+    return True
+
+  def Observe(self, topic_name, version):
+    """Notes a topic version seen on any response from a backend.
+
+    Args:
+      topic_name: The topic the response was for.
+      version: The response's X-Topic-Version value, or None.
+    """
+    parsed = ParseVersion(version)
+    if parsed is None:
+      return None
+    epoch, count = parsed
+    versions = self._versions.get(topic_name)
+    if versions is None:
+      versions = self._versions[topic_name] = collections.OrderedDict()
+      while len(self._versions) > self._max_entries:
+        self._versions.popitem(last=False)
+        self._stats['versions_evicted'] += 1
+    else:
+      self._versions.move_to_end(topic_name)
+    versions[epoch] = max(count, versions.get(epoch, -1))
+    versions.move_to_end(epoch)
+    while len(versions) > self._max_epochs:
+      versions.popitem(last=False)
+    return parsed
+
+  def Store(self, topic_name, user, version):
+    """Caches a 204 poll response carrying version."""
+    parsed = self.Observe(topic_name, version)
+    if parsed is None or IsPattern(topic_name):
+      return
+    key = (topic_name, user)
+    self._empty.pop(key, None)
+    self._empty[key] = (parsed, self._clock() + self._ttl)
+    self._stats['stored'] += 1
+    while len(self._empty) > self._max_entries:
+      self._empty.popitem(last=False)
+      self._stats['evicted'] += 1
+
+  def Forget(self, topic_name, user):
+    """Drops the cached 204 for a user whose subscription is changing."""
+    self._empty.pop((topic_name, user), None)
+
+  def AdminResources(self):
+    """Admin endpoints for the cache, see admin.py."""
+    return {b'pollcache': JsonResource(self.Stats)}
@@ -0,0 +1,298 @@
+"""On-demand CPU and memory profiling of a running server.
+
+Nothing here costs anything until it is asked for over the admin port: the CPU
+profilers are only attached for the duration of a session and tracemalloc is
+only started by an explicit request.
+"""
+
+import cProfile
+import collections
+import io
+import marshal
+import pstats
+import sys
+import threading
+import tracemalloc
+
+from twisted.web.resource import Resource
+
+class CpuProfiler(object):
+  """Runs at most one CPU profiling session at a time.
+
+  Two modes are supported:
+    cprofile: Deterministic profiling of the reactor thread with cProfile.
+      Results can be downloaded as a pstats file or as text.
+    sample: A background thread samples the reactor thread's stack every
+      interval seconds. Results are downloaded as collapsed stacks, the input
+      format of flamegraph.pl and speedscope.
+  """
+
+  MODES = ('cprofile', 'sample')
+
+  def __init__(self, clock=None, interval=0.005):
+    """Constructor.
+
+    Args:
+      clock: The IReactorTime used to end sessions, defaults to the reactor.
+      interval: Seconds between stack samples in sample mode.
+    """
+    self._clock = clock
+    self._interval = interval
+    self._mode = None
+    self._profile = None
+    self._sampler = None
+    self._stop_sampling = None
+    self._samples = None
+    self._timeout = None
+    self._result = None
+
+  def _GetClock(self):
+    if self._clock is None:
+      from twisted.internet import reactor
+      self._clock = reactor
+    return self._clock
+
+  def Running(self):
+    """Whether a session is currently in progress."""
+    return self._mode is not None
+
+  def Start(self, mode, seconds):
+    """Starts a session of the given mode that ends after seconds.
+
+    Must be called on the thread to be profiled (the reactor thread).
+
+    Returns:
+      False if a session is already running, True otherwise.
+    """
+    if mode not in self.MODES:
+      raise ValueError('Unknown profiling mode %r' % mode)
+    if self.Running():
+      return False
+    self._mode = mode
+    if mode == 'cprofile':
+      self._profile = cProfile.Profile()
+      self._profile.enable()
+    else:
+      self._samples = collections.Counter()
+      self._stop_sampling = threading.Event()
+      self._sampler = threading.Thread(
+          target=self._Sample, args=(threading.current_thread().ident,))
+      self._sampler.daemon = True
+      self._sampler.start()
+    self._timeout = self._GetClock().callLater(seconds, self.Stop)
+    return True
+
+  def _Sample(self, thread_id):
+    """Sampler thread body, counts collapsed stacks of thread_id."""
+    while not self._stop_sampling.wait(self._interval):
+      frame = sys._current_frames().get(thread_id)
+      stack = []
+      while frame is not None:
+        code = frame.f_code
+        stack.append('%s (%s:%d)' % (
+            code.co_name, code.co_filename, code.co_firstlineno))
+        frame = frame.f_back
+      if stack:
+        self._samples[';'.join(reversed(stack))] += 1
+
+  def Stop(self):
+    """Ends the current session, keeping its result for download.
+
+    Returns:
+      False if no session was running, True otherwise.
+    """
+    if not self.Running():
+      return False
+    if self._timeout.active():
+      self._timeout.cancel()
+    self._timeout = None
+    if self._mode == 'cprofile':
+      self._profile.disable()
+      self._result = ('cprofile', pstats.Stats(self._profile))
+      self._profile = None
+    else:
+      self._stop_sampling.set()
+      self._sampler.join()
+      self._result = ('sample', self._samples)
+      self._sampler = None
+      self._samples = None
+    self._mode = None
+    return True
+
+  def Result(self, fmt):
+    """Returns the last finished session formatted as fmt.
+
+    Args:
+      fmt: 'pstats' (cprofile only), 'text' or 'collapsed' (sample only).
+
+    Returns:
+      The formatted result as bytes, or None if there is no result yet.
+
+    Raises:
+      ValueError if fmt is not available for the last session's mode.
+    """
+    if self._result is None:
+      return None
+    mode, data = self._result
+    if mode == 'cprofile' and fmt == 'pstats':
+      return marshal.dumps(data.stats)
+    if mode == 'cprofile' and fmt == 'text':
+      out = io.StringIO()
+      data.stream = out
+      data.sort_stats('cumulative').print_stats(50)
+      return out.getvalue().encode('utf-8')
+    if mode == 'sample' and fmt in ('collapsed', 'text'):
+      lines = ['%s %d' % item for item in data.most_common()]
+      return '\n'.join(lines).encode('utf-8')
+    raise ValueError('Format %r not available for %s results' % (fmt, mode))
+
+class MemoryProfiler(object):
+  """Takes tracemalloc snapshots and diffs them against the previous one."""
+
+  def __init__(self):
+    self._baseline = None
+
+  def Running(self):
+    return tracemalloc.is_tracing()
+
+  def Start(self, frames=1):
+    """Starts tracing allocations, keeping frames frames of traceback."""
+    if self.Running():
+      return False
+    tracemalloc.start(frames)
+    self._baseline = None
+    return True
+
+  def Stop(self):
+    """Stops tracing allocations and drops any baseline."""
+    if not self.Running():
+      return False
+    tracemalloc.stop()
+    self._baseline = None
+    return True
+
+  def _Filter(self, snapshot, file_pattern):
+    """Restricts snapshot to files matching file_pattern (fnmatch style)."""
+    filters = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    if file_pattern:
+      filters.append(tracemalloc.Filter(True, file_pattern))
+    return snapshot.filter_traces(filters)
+
+  def Snapshot(self, limit=25, file_pattern=None):
+    """Reports the top allocation sites and makes this the new baseline."""
+    snapshot = tracemalloc.take_snapshot()
+    self._baseline = snapshot
+    stats = self._Filter(snapshot, file_pattern).statistics('lineno')
+    lines = ['Top %d allocation sites of %d' % (limit, len(stats))]
+    lines.extend(str(stat) for stat in stats[:limit])
+    return '\n'.join(lines).encode('utf-8')
+
+  def Diff(self, limit=25, file_pattern=None):
+    """Reports which allocation sites grew since the baseline.
+
+    The current snapshot then becomes the baseline, so calling this
+    periodically shows growth per interval.
+    """
+    snapshot = tracemalloc.take_snapshot()
+    baseline, self._baseline = self._baseline, snapshot
+    if baseline is None:
+      return b'No baseline yet, took one.'
+    stats = self._Filter(snapshot, file_pattern).compare_to(
+        self._Filter(baseline, file_pattern), 'lineno')
+    lines = ['Top %d allocation sites by growth' % limit]
+    lines.extend(str(stat) for stat in stats[:limit])
+    return '\n'.join(lines).encode('utf-8')
+
+def _Arg(request, name, default=None):
+  """Returns the decoded query argument name, or default."""
+  values = request.args.get(name.encode('ascii'))
+  if not values:
+    return default
+  return values[0].decode('utf-8')
+
+def _PositiveArg(request, name, default, parse=int):
+  """Returns query argument name parsed with parse, or None if invalid.
+
+  Valid values are finite and above 0.
+  """
+  try:
+    value = parse(_Arg(request, name, default))
+  except (UnicodeDecodeError, ValueError):
+    return None
+  if not 0 < value < float('inf'):
+    return None
+  return value
+
+class ProfileResource(Resource):
+  """Admin endpoints for the profilers.
+
+  POST /cpu/start?mode=cprofile|sample&seconds=N - Starts a CPU session.
+  POST /cpu/stop - Ends the CPU session early.
+  GET /cpu?format=pstats|text|collapsed - Downloads the last CPU session.
+  POST /memory/start?frames=N - Starts tracemalloc.
+  POST /memory/stop - Stops tracemalloc.
+  GET /memory/snapshot?limit=N&file=PATTERN - Top allocation sites.
+  GET /memory/diff?limit=N&file=PATTERN - Growth since the last snapshot.
+
+  seconds, frames and limit must be above 0, or the request gets a 400.
+  """
+  isLeaf = True
+
+  def __init__(self, cpu_profiler=None, memory_profiler=None):
+    Resource.__init__(self)
+    self._cpu = cpu_profiler or CpuProfiler()
+    self._memory = memory_profiler or MemoryProfiler()
+
+  def _Respond(self, request, code, body=b''):
+    request.setResponseCode(code)
+    return body
+
+  def render_POST(self, request):
+    """Routes the start and stop calls."""
+    path = request.postpath
+    if path == [b'cpu', b'start']:
+      mode = _Arg(request, 'mode', 'cprofile')
+      if mode not in CpuProfiler.MODES:
+        return self._Respond(request, 400, b'Unknown mode')
+      seconds = _PositiveArg(request, 'seconds', '10', float)
+      if seconds is None:
+        return self._Respond(request, 400, b'Bad seconds')
+      return self._Respond(request, 200 if self._cpu.Start(mode, seconds)
+                           else 409)
+    if path == [b'cpu', b'stop']:
+      return self._Respond(request, 200 if self._cpu.Stop() else 409)
+    if path == [b'memory', b'start']:
+      frames = _PositiveArg(request, 'frames', '1')
+      if frames is None:
+        return self._Respond(request, 400, b'Bad frames')
+      return self._Respond(request, 200 if self._memory.Start(frames)
+                           else 409)
+    if path == [b'memory', b'stop']:
+      return self._Respond(request, 200 if self._memory.Stop() else 409)
+    return self._Respond(request, 404)
+
+  def render_GET(self, request):
+    """Routes the downloads."""
+    path = request.postpath
+    if path == [b'cpu']:
+      if self._cpu.Running():
+        return self._Respond(request, 409, b'Session still running')
+      try:
+        result = self._cpu.Result(_Arg(request, 'format', 'text'))
+      except ValueError as e:
+        return self._Respond(request, 400, str(e).encode('utf-8'))
+      if result is None:
+        return self._Respond(request, 404)
+      return self._Respond(request, 200, result)
+    if path in ([b'memory', b'snapshot'], [b'memory', b'diff']):
+      if not self._memory.Running():
+        return self._Respond(request, 409, b'tracemalloc not started')
+      limit = _PositiveArg(request, 'limit', '25')
+      if limit is None:
+        return self._Respond(request, 400, b'Bad limit')
+      file_pattern = _Arg(request, 'file')
+      if path[1] == b'snapshot':
+        return self._Respond(
+            request, 200, self._memory.Snapshot(limit, file_pattern))
+      return self._Respond(request, 200, self._memory.Diff(limit, file_pattern))
+    return self._Respond(request, 404)
@@ -0,0 +1,197 @@
+"""Token bucket rate limits on publishes, polls and published bytes.
+
+Limits are set per kind of work and per scope, where the scope says whose
+bucket a request draws from:
+
+  kinds:  publish (requests), poll (requests), bytes (published body bytes)
+  scopes: global (one bucket), topic, user (the subscriber polling), client
+          (the remote address)
+
+A request must find enough tokens in the bucket of every limit that applies
+to it, and only then takes them from all of them. A scope's limit can be
+overridden for one topic, user or client by name.
+
+Limits are written as comma separated KIND:SCOPE[:NAME]=RATE[/BURST], with
+RATE per second and BURST defaulting to RATE, e.g. (RATE_LIMITS)
+
+  publish:topic=100/200,poll:user=20,bytes:global=50000000,publish:topic:hot=0
+
+where a RATE of 0 removes the limit (here: the hot topic is not limited).
+
+Buckets only exist while they are in use. A bucket that has refilled since it
+was last touched is the same as a new one, so buckets are dropped lazily, as
+later requests find them full, keeping memory to O(1) per active key.
+"""
+
+import collections
+import json
+import math
+import time
+
+from twisted.web.resource import Resource
+
+KINDS = ('publish', 'poll', 'bytes')
+SCOPES = ('global', 'topic', 'user', 'client')
+
+def ParseLimits(spec):
+  """Parses a RATE_LIMITS string into a list of (kind, scope, name, rate, burst).
+
+  Raises:
+    ValueError: If spec is malformed.
+  """
+  limits = []
+  for entry in filter(None, (spec or '').split(',')):
+    key, _, value = entry.rpartition('=')
+    parts = key.split(':', 2)
+    if len(parts) < 2 or parts[0] not in KINDS or parts[1] not in SCOPES:
+      raise ValueError('Bad rate limit %r' % entry)
+    name = parts[2].encode('utf-8') if len(parts) == 3 else None
+    rate, _, burst = value.partition('/')
+    limits.append((parts[0], parts[1], name, float(rate),
+                   float(burst) if burst else None))
+  return limits
+
+class RateLimiter(object):
+  """Token buckets for every (kind, scope, key) with a limit."""
+
+  def __init__(self, limits=None, clock=time.monotonic):
+    """Constructor.
+
+    Args:
+      limits: Optional list of limits as returned by ParseLimits.
+      clock: Function returning monotonic time in seconds.
+    """
+    self._clock = clock
+    self._limits = {}  # (kind, scope) or (kind, scope, name): (rate, burst)
+    # (kind, scope, key): [tokens, last update, time it will be full], least
+    # recently used first.
+    self._buckets = collections.OrderedDict()
+    self._stats = dict(('%s_%s' % (kind, result), 0)
+                       for kind in KINDS for result in ('allowed', 'limited'))
+    for limit in limits or []:
+      self.SetLimit(*limit)
+
+  def SetLimit(self, kind, scope, name=None, rate=0, burst=None):
+    """Sets (or with rate 0 removes) a limit.
+
+    Args:
+      kind: One of KINDS.
+      scope: One of SCOPES.
+      name: Optional topic, user or client (bytes) the limit is just for.
+      rate: Tokens per second.
+      burst: Bucket size, by default rate.
+    """
+    if kind not in KINDS or scope not in SCOPES:
+      raise ValueError('Unknown limit %s:%s' % (kind, scope))
+    key = (kind, scope) if name is None else (kind, scope, name)
+    if rate > 0:
+      self._limits[key] = (float(rate), float(burst or rate))
+    else:
+      self._limits.pop(key, None)
+
+  def Limits(self):
+    """Returns the limits as a dict of KIND:SCOPE[:NAME] to RATE/BURST."""
+    return dict((':'.join(k if isinstance(k, str) else k.decode('utf-8')
+                          for k in key), '%g/%g' % limit)
+                for key, limit in self._limits.items())
+
+  def Stats(self):
+    """Returns allowed/limited counts per kind and the live bucket count."""
+    stats = dict(self._stats)
+    stats['buckets'] = len(self._buckets)
+    return stats
+
+  def _Limit(self, kind, scope, key):
+    return (self._limits.get((kind, scope, key)) or
+            self._limits.get((kind, scope)))
+
+  def Acquire(self, topic=None, user=None, client=None, **costs):
+    """Takes tokens for a request from every bucket that applies to it.
+
+    Args:
+      topic: The topic of the request.
+      user: The subscriber, for polls.
+      client: The remote address.
+      costs: Tokens needed per kind, e.g. publish=1, bytes=len(body).
+
+    Returns:
+      0 if the request may go ahead, otherwise the seconds until it could.
+    """
+    now = self._clock()
+    keys = (('global', b''), ('topic', topic), ('user', user),
+            ('client', client))
+    wait = 0.0
+    charges = []
+    for kind, cost in costs.items():
+      for scope, key in keys:
+        if key is None:
+          continue
+        limit = self._Limit(kind, scope, key)
+        if limit is None:
+          continue
+        rate, burst = limit
+        bucket = self._buckets.pop((kind, scope, key), None)
+        if bucket is None:
+          tokens = burst
+        else:
+          tokens = min(burst, bucket[0] + (now - bucket[1]) * rate)
+        # Requests larger than the bucket pass when it is full, and leave it
+        # in debt.
+        needed = min(cost, burst)
+        if tokens < needed:
+          wait = max(wait, (needed - tokens) / rate)
+        charges.append(((kind, scope, key), tokens, cost, rate, burst))
+    for bucket_key, tokens, cost, rate, burst in charges:
+      if not wait:
+        tokens -= cost
+      self._buckets[bucket_key] = [tokens, now, now + (burst - tokens) / rate]
+    for kind in costs:
+      self._stats['%s_%s' % (kind, 'limited' if wait else 'allowed')] += 1
+    self._Expire(now)
+    return wait
+
+  def _Expire(self, now):
+    """Drops least recently used buckets that have refilled."""
+    while self._buckets:
+      bucket_key, bucket = next(iter(self._buckets.items()))
+      if bucket[2] > now:
+        return
+      del self._buckets[bucket_key]
+
+  def AdminResources(self):
+    """Admin endpoints for the limiter, see admin.py."""
+    return {b'ratelimits': RateLimitsResource(self)}
+
+def RetryAfter(wait):
+  """Formats a wait in seconds as a Retry-After header value."""
+  return b'%d' % max(1, int(math.ceil(wait)))
+
+class RateLimitsResource(Resource):
+  """Admin endpoint to view and change rate limits at runtime.
+
+  GET / - The limits and counters as JSON.
+  POST /?limit=KIND:SCOPE[:NAME]=RATE[/BURST] - Sets a limit, RATE 0 removes.
+  """
+  isLeaf = True
+
+  def __init__(self, limiter):
+    Resource.__init__(self)
+    self._limiter = limiter
+
+  def render_GET(self, request):
+    request.setHeader(b'Content-Type', b'application/json')
+    return json.dumps({'limits': self._limiter.Limits(),
+                       'stats': self._limiter.Stats()}).encode('utf-8')
+
+  def render_POST(self, request):
+    try:
+      limits = ParseLimits(b','.join(
+          request.args.get(b'limit', [])).decode('utf-8'))
+    except ValueError:
+      limits = None
+    if not limits:
+      request.setResponseCode(400)
+      return b''
+    for limit in limits:
+      self._limiter.SetLimit(*limit)
+    return self.render_GET(request)
@@ -1,41 +1,147 @@
-from StringIO import StringIO
-
-from twisted.internet import reactor
-from twisted.web.client import Agent, FileBodyProducer, readBody
+from twisted.internet.defer import succeed
+from twisted.internet.endpoints import HostnameEndpoint
+from twisted.web.client import Agent, HTTPConnectionPool, readBody
 from twisted.web.http_headers import Headers
+from twisted.web.iweb import IAgentEndpointFactory
+from twisted.web.iweb import IBodyProducer
+from zope.interface import implementer
+
+import tracing
+
+from compression import CompressedBody
+from compression import GZIP
+
+@implementer(IBodyProducer)
+class _BytesProducer(object):
+  """Request body producer that hands the whole body to the transport at once.
+
+  FileBodyProducer would copy the body into a BytesIO and then read it back in
+  64KB slices, one reactor iteration each; a bytes body can simply be written.
+  """
+
+  def __init__(self, body):
+    self._body = body
+    self.length = len(body)
+
+  def startProducing(self, consumer):
+    consumer.write(self._body)
+    return succeed(None)
+
+  def pauseProducing(self):
+    pass
+
+  def resumeProducing(self):
+    pass
+
+  def stopProducing(self):
+    pass
+
+class _TracedEndpoint(object):
+  """Wraps a client endpoint to record connection setup as a trace span."""
+
+  def __init__(self, endpoint):
+    self._endpoint = endpoint
+
+  def connect(self, protocol_factory):
+    span = tracing.StartSpan('proxy.connect')
+    d = self._endpoint.connect(protocol_factory)
+    d.addBoth(span.FinishPassthrough)
+    return d
+
+@implementer(IAgentEndpointFactory)
+class _TracedEndpointFactory(object):
+  """Endpoint factory for Agent that traces connects to plain HTTP hosts."""
+
+  def __init__(self, reactor):
+    self._reactor = reactor
+
+  def endpointForURI(self, uri):
+    return _TracedEndpoint(HostnameEndpoint(self._reactor, uri.host, uri.port))
 
 class Server(object):
   """Simple utility for async HTTP queries to a host."""
 
-  def __init__(self, host):
-    """Basic constructor sets host and creates an agent."""
+  def __init__(self, host, max_connections=None):
+    """Basic constructor sets host.
+
+    The agent is created on first use so that constructing a Server (e.g. for a
+    ProxyBackend) does not install the default reactor before RunServer gets
+    the chance to pick one.
+
+    Args:
+      host: The host:port to query, as str or bytes.
+      max_connections: If set, keep up to this many idle keep-alive
+        connections to host for later requests to reuse. By default every
+        request opens a new connection.
+    """
+    if not isinstance(host, bytes):
+      host = host.encode('ascii')
     self._host = host
-    self._agent = Agent(reactor)
+    self._max_connections = max_connections
+    self._pool = None
+    self._agent = None
 
-  def Request(self, method, endpoint, body=None):
+  def _GetAgent(self):
+    """Returns the agent, creating it against the running reactor if needed."""
+    if self._agent is None:
+      from twisted.internet import reactor
+      if self._max_connections:
+        self._pool = HTTPConnectionPool(reactor)
+        self._pool.maxPersistentPerHost = self._max_connections
+        self._agent = Agent.usingEndpointFactory(
+            reactor, _TracedEndpointFactory(reactor), pool=self._pool)
+      else:
+        self._agent = Agent.usingEndpointFactory(
+            reactor, _TracedEndpointFactory(reactor))
+    return self._agent
+
+  def Close(self):
+    """Closes idle pooled connections, returning a Deferred."""
+    if self._pool is None:
+      return succeed(None)
+    return self._pool.closeCachedConnections()
+
+  def Request(self, method, endpoint, body=None, headers=None,
+              with_headers=False):
     """Request a page from the server.
-    
+
     This will make an http request to the server to the passed in endpoint
     using the passed in method. The optional body will also be transferred over
     http.
-    
+
     Args:
-      method: The HTTP method for the request.
-      endpoint: The endpoint on the server to request.
-      body: The optional body of the http request.
+      method: The HTTP method for the request (bytes).
+      endpoint: The endpoint on the server to request (bytes).
+      body: The optional body of the http request (bytes).
+      headers: Optional dict of extra header name to list of values.
+      with_headers: Whether to also return the response headers.
+
+    Returns:
+      A deferred firing with a (status, body) tuple, or (status, body,
+      headers) with_headers. Responses sent with Content-Encoding: gzip have a
+      compression.CompressedBody body.
     """
     if body:
-      body = FileBodyProducer(StringIO(body))
-    d = self._agent.request(
+      body = _BytesProducer(body)
+    request_headers = Headers({b'User-Agent': [b'PubSub HTTP Client']})
+    for name, values in (headers or {}).items():
+      request_headers.setRawHeaders(name, values)
+    d = self._GetAgent().request(
         method,
-        'http://%s%s' % (self._host, endpoint),
-        Headers({'User-Agent': ['PubSub HTTP Client']}),
+        b'http://%s%s' % (self._host, endpoint),
+        request_headers,
         body)
 
     def GetStatusAndBodyAsTuple(response):
       code = response.code
       d1 = readBody(response)
-      d1.addCallback(lambda x: (code, x))
+      encoding = response.headers.getRawHeaders(b'content-encoding', [None])[0]
+      if encoding == GZIP:
+        d1.addCallback(lambda x: (code, CompressedBody(x)))
+      else:
+        d1.addCallback(lambda x: (code, x))
+      if with_headers:
+        d1.addCallback(lambda result: result + (response.headers,))
       return d1
 
     d.addCallback(GetStatusAndBodyAsTuple)
@@ -43,13 +149,12 @@ class Server(object):
 
   def GET(self, *args, **kwargs):
     """Simple wrapper of Request for GET requests."""
-    return self.Request('GET', *args, **kwargs)
+    return self.Request(b'GET', *args, **kwargs)
 
   def POST(self, *args, **kwargs):
     """Simple wrapper of Request for POST requests."""
-    return self.Request('POST', *args, **kwargs)
+    return self.Request(b'POST', *args, **kwargs)
 
   def DELETE(self, *args, **kwargs):
     """Simple wrapper of Request for DELETE requests."""
-    return self.Request('DELETE', *args, **kwargs)
-
+    return self.Request(b'DELETE', *args, **kwargs)
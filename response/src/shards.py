@@ -0,0 +1,74 @@
+"""Builds shards: the MemoryBackends holding the topics, and their parts.
+
+clustered_backend.py serves one shard, and a co-located frontend (see
+colocated.py) can own several, so both build them here from the same
+variables:
+
+  SUBSCRIPTIONS_DB, SNAPSHOT_PATH - Files of one shard, read with a prefix
+    (BACKENDn_SUBSCRIPTIONS_DB for shard n of a co-located frontend).
+  SNAPSHOT_INTERVAL, DEDUP_TTL, DEDUP_MAX_KEYS, MESSAGE_RETENTION - Shared by
+    the shards of a process.
+  MAINTENANCE_BUDGET_MS, GC_THRESHOLDS, GC_FREEZE, GC_IDLE_COLLECT - For the
+    process, see ProcessComponents.
+"""
+
+import os
+
+from backends.memory import MemoryBackend
+from backends.subscriptions import SubscriptionStore
+from dedup import DedupCache
+from gcpauses import GcMonitor
+from gcpauses import ParseThresholds
+from maintenance import Maintenance
+from maintenance import StallMonitor
+from snapshot import Snapshotter
+
+def ProcessComponents(environ=None):
+  """Builds what the shards of a process share.
+
+  Returns:
+    A (maintenance, gc_monitor) tuple: the Maintenance running the shards'
+    jobs, and the GcMonitor tuning the collector. Both are components for
+    RunServer.
+  """
+  environ = os.environ if environ is None else environ
+  maintenance = Maintenance(
+      float(environ.get('MAINTENANCE_BUDGET_MS', 5)) / 1000, StallMonitor())
+  # Started with the reactor, so a freeze takes in a restored snapshot.
+  gc_monitor = GcMonitor(
+      ParseThresholds(environ.get('GC_THRESHOLDS')),
+      freeze=environ.get('GC_FREEZE', '0') == '1',
+      idle_collect=float(environ.get('GC_IDLE_COLLECT', 0)))
+  return maintenance, gc_monitor
+
+def BuildShard(maintenance, prefix='', environ=None):
+  """Builds a shard's backend, with its subscription store and snapshots.
+
+  Args:
+    maintenance: The process's Maintenance, see ProcessComponents.
+    prefix: Prefix of the shard's own variables, e.g. 'BACKEND0_'.
+    environ: The variables, by default os.environ.
+
+  Returns:
+    A (backend, components, snapshotter) tuple. components are to be started
+    with the backend, and include snapshotter, which is None without a
+    snapshot path and has not restored the snapshot yet.
+  """
+  environ = os.environ if environ is None else environ
+  components = []
+  subscriptions = None
+  if environ.get(prefix + 'SUBSCRIPTIONS_DB'):
+    subscriptions = SubscriptionStore(environ[prefix + 'SUBSCRIPTIONS_DB'])
+    components.append(subscriptions)
+  dedup = DedupCache(float(environ.get('DEDUP_TTL', 300)),
+                     int(environ.get('DEDUP_MAX_KEYS', 100000)))
+  backend = MemoryBackend(
+      subscriptions, dedup=dedup, maintenance=maintenance,
+      retention=float(environ.get('MESSAGE_RETENTION', 0)) or None)
+  snapshotter = None
+  if environ.get(prefix + 'SNAPSHOT_PATH'):
+    snapshotter = Snapshotter(
+        backend, environ[prefix + 'SNAPSHOT_PATH'],
+        interval=float(environ.get('SNAPSHOT_INTERVAL', 0)))
+    components.append(snapshotter)
+  return backend, components, snapshotter
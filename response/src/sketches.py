@@ -0,0 +1,457 @@
+"""Bounded memory traffic sketches: hot topics and distinct users.
+
+Every PubSubResource can keep, per time window:
+
+  - space-saving summaries of the most published and most polled topics,
+  - count-min sketches estimating the publishes and polls of any topic,
+  - HyperLogLog estimates of distinct subscribers, publishers (remote
+    addresses) and topics,
+
+each updated in constant time per request and using a fixed amount of memory
+however many topics and users there are. Windows rotate lazily: the first
+request after a window ends starts a new one, and the previous window is kept
+for reporting.
+
+Summaries export to JSON and merge, which is how a frontend reports on the
+whole cluster: ClusterSketchesResource fetches every backend's export and
+merges them. A backend's publishes come from frontends, so the frontend makes
+the publishing client current while it calls the backend, ProxyBackend
+forwards it in the FORWARDED_FOR_HEADER, and backends that trust their
+frontends (TRUST_FORWARDED_FOR) count that address instead of the frontend's.
+"""
+
+import base64
+import contextvars
+import hashlib
+import json
+import math
+import time
+
+try:
+  from urllib.parse import quote
+except ImportError:
+  from urllib import quote
+
+from twisted.internet.defer import gatherResults
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET
+
+from server import Server
+
+FORWARDED_FOR_HEADER = b'X-Forwarded-For'
+
+_publisher = contextvars.ContextVar('publisher', default=None)
+
+def CurrentPublisher():
+  """Returns the address of the client whose publish is being dispatched."""
+  return _publisher.get()
+
+def ActivatePublisher(client):
+  """Makes client current, returns a token for DeactivatePublisher."""
+  return _publisher.set(client)
+
+def DeactivatePublisher(token):
+  """Restores the publisher that was current before ActivatePublisher."""
+  _publisher.reset(token)
+
+def _Hash64(key):
+  """A 64 bit hash of bytes that is the same in every process."""
+  return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'little')
+
+class CountMinSketch(object):
+  """Estimates counts per key, never under, over by at most total * e / width."""
+
+  def __init__(self, width=2048, depth=4):
+    self._width = width
+    self._depth = depth
+    self._rows = [[0] * width for _ in range(depth)]
+
+  def _Columns(self, hashed):
+    # Rows index by h1 + i * h2, which is as good as independent hashes.
+    h1, h2 = hashed & 0xffffffff, (hashed >> 32) | 1
+    return [(h1 + i * h2) % self._width for i in range(self._depth)]
+
+  def Add(self, key, count=1, hashed=None):
+    """Counts key, whose _Hash64 may be passed in as hashed."""
+    for row, column in zip(self._rows, self._Columns(
+        _Hash64(key) if hashed is None else hashed)):
+      row[column] += count
+
+  def Estimate(self, key):
+    return min(row[column]
+               for row, column in zip(self._rows, self._Columns(_Hash64(key))))
+
+class SpaceSaving(object):
+  """The most frequent keys of a stream, in the space of `capacity` counters.
+
+  Counters are grouped by count so that counting a key, and replacing the
+  least counted key when a new one arrives, are both constant time. A key's
+  count is over by at most its error, which is at most the smallest count.
+  """
+
+  def __init__(self, capacity=100):
+    self._capacity = capacity
+    self._counts = {}  # key: [count, error]
+    self._buckets = {}  # count: set of keys with that count
+    self._min = 0
+
+  def _Move(self, key, old, new):
+    if old:
+      bucket = self._buckets[old]
+      bucket.discard(key)
+      if not bucket:
+        del self._buckets[old]
+        if old == self._min:
+          self._min = new
+    self._buckets.setdefault(new, set()).add(key)
+    if not old and (not self._min or new < self._min):
+      self._min = new
+
+  def Add(self, key):
+    entry = self._counts.get(key)
+    if entry is not None:
+      self._Move(key, entry[0], entry[0] + 1)
+      entry[0] += 1
+      return
+    if len(self._counts) < self._capacity:
+      self._counts[key] = [1, 0]
+      self._Move(key, 0, 1)
+      return
+    # Replace one of the least counted keys, inheriting its count as error.
+    floor = self._min
+    evicted = next(iter(self._buckets[floor]))
+    del self._counts[evicted]
+    self._buckets[floor].discard(evicted)
+    self._counts[key] = [floor + 1, floor]
+    self._buckets.setdefault(floor + 1, set()).add(key)
+    if not self._buckets[floor]:
+      del self._buckets[floor]
+      self._min = floor + 1
+
+  def Full(self):
+    return len(self._counts) >= self._capacity
+
+  def Min(self):
+    return self._min if self.Full() else 0
+
+  def Top(self, limit=None):
+    """Returns [(key, count, error)], most counted first."""
+    top = sorted(((key, c, e) for key, (c, e) in self._counts.items()),
+                 key=lambda item: -item[1])
+    return top[:limit] if limit else top
+
+class HyperLogLog(object):
+  """Estimates the number of distinct keys, within about 1.6% at precision 12."""
+
+  def __init__(self, precision=12, registers=None):
+    self._precision = precision
+    self._registers = bytearray(registers or (1 << precision))
+
+  def Add(self, key, hashed=None):
+    """Counts key, whose _Hash64 may be passed in as hashed."""
+    value = _Hash64(key) if hashed is None else hashed
+    index = value >> (64 - self._precision)
+    rest = value & ((1 << (64 - self._precision)) - 1)
+    rank = (64 - self._precision) - rest.bit_length() + 1
+    if rank > self._registers[index]:
+      self._registers[index] = rank
+
+  def Merge(self, other):
+    """Adds the keys counted by another HyperLogLog of the same precision."""
+    self._registers = bytearray(
+        max(a, b) for a, b in zip(self._registers, other._registers))
+
+  def Count(self):
+    m = len(self._registers)
+    estimate = (0.7213 / (1 + 1.079 / m)) * m * m / sum(
+        2.0 ** -r for r in self._registers)
+    zeros = self._registers.count(0)
+    if estimate <= 2.5 * m and zeros:
+      # Linear counting is more accurate while many registers are empty.
+      return int(round(m * math.log(m / float(zeros))))
+    return int(round(estimate))
+
+  def Export(self):
+    return base64.b64encode(bytes(self._registers)).decode('ascii')
+
+  @classmethod
+  def FromExport(cls, exported, precision=12):
+    return cls(precision, base64.b64decode(exported))
+
+class _Window(object):
+  """The sketches for one window of traffic."""
+
+  def __init__(self, start, top):
+    self.start = start
+    self.publishes = 0
+    self.polls = 0
+    self.published_bytes = 0
+    self.top_published = SpaceSaving(top)
+    self.top_polled = SpaceSaving(top)
+    self.published = CountMinSketch()
+    self.polled = CountMinSketch()
+    self.subscribers = HyperLogLog()
+    self.publishers = HyperLogLog()
+    self.topics = HyperLogLog()
+
+  def Export(self, end, topic=None):
+    """Returns the window as a JSON-able dict that MergeExports accepts."""
+    def Top(summary):
+      return {'min': summary.Min(),
+              'top': [[key.decode('utf-8', 'replace'), count, error]
+                      for key, count, error in summary.Top()]}
+    exported = {
+        'seconds': end - self.start,
+        'publishes': self.publishes,
+        'polls': self.polls,
+        'published_bytes': self.published_bytes,
+        'top_published': Top(self.top_published),
+        'top_polled': Top(self.top_polled),
+        'subscribers': self.subscribers.Export(),
+        'publishers': self.publishers.Export(),
+        'topics': self.topics.Export(),
+    }
+    if topic is not None:
+      exported['topic'] = {'publishes': self.published.Estimate(topic),
+                           'polls': self.polled.Estimate(topic)}
+    return exported
+
+_DISTINCT = ('subscribers', 'publishers', 'topics')
+_TOP = ('top_published', 'top_polled')
+
+def _MergeTop(summaries, limit):
+  """Merges exported space-saving summaries.
+
+  A key missing from a full summary may have been counted there up to that
+  summary's smallest count, which is added to its error.
+  """
+  merged = {}
+  for summary in summaries:
+    seen = set()
+    for key, count, error in summary['top']:
+      entry = merged.setdefault(key, [0, 0])
+      entry[0] += count
+      entry[1] += error
+      seen.add(key)
+    for key, entry in merged.items():
+      if key not in seen:
+        entry[1] += summary['min']
+  top = sorted(([key, c, e] for key, (c, e) in merged.items()),
+               key=lambda item: -item[1])[:limit]
+  return {'min': top[-1][1] if len(top) >= limit else 0, 'top': top}
+
+def MergeExports(exports, limit=100):
+  """Merges window exports from several processes into one."""
+  exports = [e for e in exports if e]
+  if not exports:
+    return None
+  merged = {
+      'seconds': max(e['seconds'] for e in exports),
+      'publishes': sum(e['publishes'] for e in exports),
+      'polls': sum(e['polls'] for e in exports),
+      'published_bytes': sum(e['published_bytes'] for e in exports),
+  }
+  for name in _TOP:
+    merged[name] = _MergeTop([e[name] for e in exports], limit)
+  for name in _DISTINCT:
+    distinct = HyperLogLog()
+    for e in exports:
+      distinct.Merge(HyperLogLog.FromExport(e[name]))
+    merged[name] = distinct.Export()
+  if all('topic' in e for e in exports):
+    merged['topic'] = dict(
+        (name, sum(e['topic'][name] for e in exports))
+        for name in ('publishes', 'polls'))
+  return merged
+
+def Report(exported, limit=20):
+  """Turns a window export into the human readable form, or None."""
+  if exported is None:
+    return None
+  seconds = max(exported['seconds'], 1e-9)
+  report = {
+      'seconds': round(exported['seconds'], 3),
+      'publishes': exported['publishes'],
+      'polls': exported['polls'],
+      'published_bytes': exported['published_bytes'],
+  }
+  for name in _TOP:
+    report[name] = [
+        {'topic': key, 'count': count, 'error': error,
+         'per_second': round(count / seconds, 2)}
+        for key, count, error in exported[name]['top'][:limit]]
+  for name in _DISTINCT:
+    report['distinct_' + name] = HyperLogLog.FromExport(
+        exported[name]).Count()
+  if 'topic' in exported:
+    report['topic'] = exported['topic']
+  return report
+
+class TrafficSketches(object):
+  """The current and previous windows of sketches for one process."""
+
+  def __init__(self, window=60, top=100, clock=time.time):
+    """Constructor.
+
+    Args:
+      window: Seconds per window.
+      top: Topics kept by each space-saving summary.
+      clock: Function returning the current time in seconds.
+    """
+    self._window = window
+    self._top = top
+    self._clock = clock
+    self._current = _Window(clock(), top)
+    self._previous = None
+    self._previous_end = None
+
+  def _Current(self):
+    now = self._clock()
+    if now - self._current.start >= self._window:
+      self._previous, self._previous_end = self._current, now
+      self._current = _Window(now, self._top)
+    return self._current
+
+  def RecordPublish(self, topic, client, size):
+    window = self._Current()
+    window.publishes += 1
+    window.published_bytes += size
+    window.top_published.Add(topic)
+    hashed = _Hash64(topic)
+    window.published.Add(topic, hashed=hashed)
+    window.topics.Add(topic, hashed=hashed)
+    if client is not None:
+      window.publishers.Add(client)
+
+  def RecordPoll(self, topic, user):
+    window = self._Current()
+    window.polls += 1
+    window.top_polled.Add(topic)
+    hashed = _Hash64(topic)
+    window.polled.Add(topic, hashed=hashed)
+    window.topics.Add(topic, hashed=hashed)
+    window.subscribers.Add(user)
+
+  def Export(self, topic=None):
+    """Returns {'current': export, 'previous': export or None}."""
+    self._Current()
+    previous = None
+    if self._previous is not None:
+      previous = self._previous.Export(self._previous_end, topic)
+    return {'window_seconds': self._window,
+            'current': self._current.Export(self._clock(), topic),
+            'previous': previous}
+
+  def AdminResources(self):
+    """Admin endpoints for the sketches, see admin.py."""
+    return {b'sketches': SketchesResource(self)}
+
+def _ReportAll(exported, limit):
+  return {'window_seconds': exported['window_seconds'],
+          'current': Report(exported['current'], limit),
+          'previous': Report(exported['previous'], limit)}
+
+def _Args(request):
+  """Returns the (topic, limit, raw) query arguments of a sketches request.
+
+  limit is None if it is not a positive integer.
+  """
+  topic = request.args.get(b'topic', [None])[0]
+  limit = request.args.get(b'limit', [b'20'])[0]
+  raw = request.args.get(b'raw', [b''])[0] == b'1'
+  return topic, int(limit) if limit.isdigit() and int(limit) else None, raw
+
+class SketchesResource(Resource):
+  """Admin endpoint reporting this process's sketches.
+
+  GET /?limit=N&topic=TOPIC - Hot topics, distinct counts and, with topic,
+    that topic's estimated publishes and polls.
+  GET /?raw=1 - The mergeable export, as fetched by ClusterSketchesResource.
+
+  N must be a positive integer (400 otherwise).
+  """
+  isLeaf = True
+
+  def __init__(self, sketches):
+    Resource.__init__(self)
+    self._sketches = sketches
+
+  def render_GET(self, request):
+    topic, limit, raw = _Args(request)
+    if limit is None:
+      request.setResponseCode(400)
+      return b''
+    exported = self._sketches.Export(topic)
+    request.setHeader(b'Content-Type', b'application/json')
+    return json.dumps(exported if raw else _ReportAll(exported, limit)).encode(
+        'utf-8')
+
+class ClusterSketchesResource(Resource):
+  """Admin endpoint merging the sketches of every backend in a cluster.
+
+  Takes the same arguments as SketchesResource. Backends that cannot be
+  reached are listed under 'unreachable'.
+  """
+  isLeaf = True
+
+  def __init__(self, admin_hosts):
+    """Constructor.
+
+    Args:
+      admin_hosts: The host:port of each backend's admin endpoints.
+    """
+    Resource.__init__(self)
+    self._servers = [(host, Server(host)) for host in admin_hosts]
+
+  def render_GET(self, request):
+    topic, limit, raw = _Args(request)
+    if limit is None:
+      request.setResponseCode(400)
+      return b''
+    path = b'/sketches?raw=1'
+    if topic is not None:
+      path += b'&topic=' + quote(topic, safe='').encode('ascii')
+    unreachable = []
+
+    def Fetch(host, server):
+      def Parse(result):
+        status, body = result
+        if status != 200:
+          raise ValueError(status)
+        return json.loads(body.decode('utf-8'))
+      def Unreachable(failure):
+        unreachable.append(host)
+        return None
+      return server.GET(path).addCallback(Parse).addErrback(Unreachable)
+
+    def Merge(exports):
+      exports = [e for e in exports if e is not None]
+      merged = {
+          'window_seconds': exports[0]['window_seconds'] if exports else None,
+          'current': MergeExports([e['current'] for e in exports]),
+          'previous': MergeExports([e['previous'] for e in exports]),
+      }
+      result = merged if raw else _ReportAll(merged, limit)
+      result['unreachable'] = unreachable
+      request.setHeader(b'Content-Type', b'application/json')
+      request.write(json.dumps(result).encode('utf-8'))
+      request.finish()
+
+    gatherResults([Fetch(host, server) for host, server in self._servers]
+                  ).addCallback(Merge)
+    return NOT_DONE_YET
+
+class ClusterSketches(object):
+  """Frontend component serving the merged sketches of its backends."""
+
+  def __init__(self, admin_hosts):
+    """Constructor.
+
+    Args:
+      admin_hosts: The host:port of each backend's admin endpoints.
+    """
+    self._admin_hosts = admin_hosts
+
+  def AdminResources(self):
+    """Admin endpoints for the cluster, see admin.py."""
+    return {b'cluster-sketches': ClusterSketchesResource(self._admin_hosts)}
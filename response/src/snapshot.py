@@ -0,0 +1,190 @@
+"""Copy-on-write snapshots of a MemoryBackend, for fast warm restarts.
+
+A snapshot is written by a forked child process, which sees the backend
+exactly as it was at the fork while the parent keeps serving: the reactor only
+pauses for the fork itself. The child writes to a temporary file and renames
+it over the previous snapshot, so a crash mid-write never leaves a torn file.
+A backend started with the same SNAPSHOT_PATH loads the file before serving.
+"""
+
+import json
+import logging
+import os
+import time
+
+from twisted.internet.defer import Deferred
+from twisted.internet.task import LoopingCall
+from twisted.web.resource import Resource
+
+class Snapshotter(object):
+  """Takes snapshots of a MemoryBackend on demand, periodically and at exit."""
+
+  def __init__(self, backend, path, interval=0, on_shutdown=True):
+    """Constructor.
+
+    Args:
+      backend: The MemoryBackend to snapshot.
+      path: The snapshot file to write and restore from.
+      interval: Seconds between periodic snapshots, 0 for none.
+      on_shutdown: Whether to take a final snapshot when the reactor stops.
+    """
+    self._backend = backend
+    self._path = path
+    self._interval = interval
+    self._on_shutdown = on_shutdown
+    self._clock = None
+    self._loop = None
+    self._trigger = None
+    self._pid = None
+    self._started = None
+    self._waiting = []
+    self._stats = {
+        'snapshots': 0,
+        'failures': 0,
+        'in_progress': False,
+        'last_fork_ms': None,  # How long the reactor paused for the fork.
+        'last_duration_ms': None,  # Fork to file renamed.
+        'last_bytes': None,
+        'last_finished': None,
+        'restore_ms': None,
+        'restored_topics': None,
+        'restored_messages': None,
+    }
+
+  def Start(self, reactor):
+    """Schedules periodic and shutdown snapshots on reactor (see RunServer)."""
+    self._clock = reactor
+    if self._interval:
+      self._loop = LoopingCall(self.Take)
+      self._loop.clock = reactor
+      self._loop.start(self._interval, now=False)
+    if self._on_shutdown:
+      self._trigger = reactor.addSystemEventTrigger('before', 'shutdown',
+                                                    self.Take)
+
+  def Stop(self):
+    """Cancels periodic and shutdown snapshots, e.g. once handed off.
+
+    A snapshot in progress still completes.
+    """
+    if self._loop is not None and self._loop.running:
+      self._loop.stop()
+    if self._trigger is not None:
+      self._Clock().removeSystemEventTrigger(self._trigger)
+      self._trigger = None
+
+  def Restore(self):
+    """Loads the snapshot file into the backend, if there is one.
+
+    Returns:
+      Whether a snapshot was loaded.
+    """
+    if not os.path.exists(self._path):
+      return False
+    start = time.time()
+    with open(self._path, 'rb', buffering=1 << 20) as f:
+      topics, messages = self._backend.LoadSnapshot(f)
+    self._stats['restore_ms'] = (time.time() - start) * 1000
+    self._stats['restored_topics'] = topics
+    self._stats['restored_messages'] = messages
+    logging.info('Restored %d topics, %d messages from %s in %.0fms', topics,
+                 messages, self._path, self._stats['restore_ms'])
+    return True
+
+  def Stats(self):
+    """Returns counters and timings of the last snapshot and the restore."""
+    return dict(self._stats)
+
+  def Take(self):
+    """Starts a snapshot, unless one is already being written.
+
+    Returns:
+      A Deferred firing with Stats() once the snapshot in progress is done.
+    """
+    d = Deferred()
+    self._waiting.append(d)
+    if self._pid is None:
+      self._Fork()
+    return d
+
+  def _Fork(self):
+    self._started = time.time()
+    pid = os.fork()
+    if pid == 0:
+      self._WriteAndExit()
+    self._pid = pid
+    self._stats['in_progress'] = True
+    self._stats['last_fork_ms'] = (time.time() - self._started) * 1000
+    self._Clock().callLater(0.05, self._Poll)
+
+  def _WriteAndExit(self):
+    """Runs in the child: writes the snapshot and exits without cleanup."""
+    status = 1
+    temporary = '%s.%d.tmp' % (self._path, os.getpid())
+    try:
+      with open(temporary, 'wb', buffering=1 << 20) as f:
+        self._backend.WriteSnapshot(f)
+        f.flush()
+        os.fsync(f.fileno())
+      os.rename(temporary, self._path)
+      status = 0
+    except Exception:
+      if os.path.exists(temporary):
+        os.unlink(temporary)
+    finally:
+      # Never return into the parent's reactor or run its atexit handlers.
+      os._exit(status)
+
+  def _Clock(self):
+    if self._clock is None:
+      from twisted.internet import reactor
+      self._clock = reactor
+    return self._clock
+
+  def _Poll(self):
+    """Reaps the child once it exits, or checks again shortly."""
+    pid, status = os.waitpid(self._pid, os.WNOHANG)
+    if pid == 0:
+      self._Clock().callLater(0.05, self._Poll)
+      return
+    self._pid = None
+    self._stats['in_progress'] = False
+    if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0:
+      self._stats['snapshots'] += 1
+      self._stats['last_duration_ms'] = (time.time() - self._started) * 1000
+      self._stats['last_bytes'] = os.path.getsize(self._path)
+      self._stats['last_finished'] = time.time()
+      logging.info('Snapshot of %d bytes written to %s in %.0fms',
+                   self._stats['last_bytes'], self._path,
+                   self._stats['last_duration_ms'])
+    else:
+      self._stats['failures'] += 1
+      logging.error('Snapshot to %s failed with status %d', self._path, status)
+    waiting, self._waiting = self._waiting, []
+    for d in waiting:
+      d.callback(self.Stats())
+
+  def AdminResources(self):
+    """Admin endpoints for snapshots, see admin.py."""
+    return {b'snapshot': SnapshotResource(self)}
+
+class SnapshotResource(Resource):
+  """Admin endpoint to take snapshots and see their timings.
+
+  GET / - Stats() as JSON.
+  POST / - Starts a snapshot (or joins the one in progress); 202 with Stats().
+  """
+  isLeaf = True
+
+  def __init__(self, snapshotter):
+    Resource.__init__(self)
+    self._snapshotter = snapshotter
+
+  def render_GET(self, request):
+    request.setHeader(b'Content-Type', b'application/json')
+    return json.dumps(self._snapshotter.Stats()).encode('utf-8')
+
+  def render_POST(self, request):
+    self._snapshotter.Take()
+    request.setResponseCode(202)
+    return self.render_GET(request)
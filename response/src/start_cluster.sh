@@ -7,36 +7,36 @@ export BACKEND3_PORT=tcp://localhost:8113
 
 
 KILLLINE=""
-export PORT=8110 && python clustered_backend.py &
+export PORT=8110 && TRUST_GZIP=1 TRUST_FORWARDED_FOR=1 python3 clustered_backend.py &
 P=$!
 echo "Launched backend pid: $P"
 KILLLINE="$KILLLINE $P"
-export PORT=8111 && python clustered_backend.py &
+export PORT=8111 && TRUST_GZIP=1 TRUST_FORWARDED_FOR=1 python3 clustered_backend.py &
 P=$!
 echo "Launched backend pid: $P"
 KILLLINE="$KILLLINE $P"
-export PORT=8112 && python clustered_backend.py &
+export PORT=8112 && TRUST_GZIP=1 TRUST_FORWARDED_FOR=1 python3 clustered_backend.py &
 P=$!
 KILLLINE="$KILLLINE $P"
 echo "Launched backend pid: $P"
-export PORT=8113 && python clustered_backend.py &
+export PORT=8113 && TRUST_GZIP=1 TRUST_FORWARDED_FOR=1 python3 clustered_backend.py &
 P=$!
 KILLLINE="$KILLLINE $P"
 echo "Launched backend pid: $P"
 
-export PORT=8100 && python clustered_frontend.py &
+export PORT=8100 && python3 clustered_frontend.py &
 P=$!
 KILLLINE="$KILLLINE $P"
 echo "Launched frontend pid: $P"
-export PORT=8101 && python clustered_frontend.py &
+export PORT=8101 && python3 clustered_frontend.py &
 P=$!
 KILLLINE="$KILLLINE $P"
 echo "Launched frontend pid: $P"
-export PORT=8102 && python clustered_frontend.py &
+export PORT=8102 && python3 clustered_frontend.py &
 P=$!
 KILLLINE="$KILLLINE $P"
 echo "Launched frontend pid: $P"
-export PORT=8103 && python clustered_frontend.py &
+export PORT=8103 && python3 clustered_frontend.py &
 P=$!
 KILLLINE="$KILLLINE $P"
 echo "Launched frontend pid: $P"
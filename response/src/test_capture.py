@@ -0,0 +1,112 @@
+import json
+
+from capture import COMMIT
+from capture import INBOX
+from capture import OTHER
+from capture import POLL
+from capture import PUBLISH
+from capture import READ
+from capture import SUBSCRIBE
+from capture import UNSUBSCRIBE
+from capture import CaptureResource
+from capture import OpFor
+from capture import ReadCapture
+from capture import TrafficCapture
+
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+from twisted.web.test.test_web import DummyRequest
+
+class OpForTest(unittest.TestCase):
+  def test_ops(self):
+    """Verify each endpoint maps to its operation, topic and user."""
+    self.assertEqual((PUBLISH, b't', b''), OpFor(b'POST', [b't']))
+    self.assertEqual((SUBSCRIBE, b't', b'u'), OpFor(b'POST', [b't', b'u']))
+    self.assertEqual((UNSUBSCRIBE, b't', b'u'),
+                     OpFor(b'DELETE', [b't', b'u']))
+    self.assertEqual((POLL, b't', b'u'), OpFor(b'GET', [b't', b'u']))
+    self.assertEqual((INBOX, b'', b'u'), OpFor(b'GET', [b'u']))
+    self.assertEqual((READ, b't', b'u'), OpFor(b'GET', [b't', b'u'],
+                                               {b'offset': [b'0']}))
+    self.assertEqual((COMMIT, b't', b'u'), OpFor(b'POST', [b't', b'u'],
+                                                 {b'commit': [b'3']}))
+    self.assertEqual((OTHER, b'', b''), OpFor(b'GET', [b'a', b'b', b'c']))
+
+class TrafficCaptureTest(unittest.TestCase):
+  def setUp(self):
+    self._now = 1000.0
+    self._path = self.mktemp()
+    self._capture = TrafficCapture(clock=lambda: self._now)
+    self._reactor = Clock()
+    self._reactor.addSystemEventTrigger = lambda *args: None
+    self._capture.Start(self._reactor)
+
+  def _Read(self):
+    with open(self._path, 'rb') as f:
+      start, anonymized, requests = ReadCapture(f)
+      return start, anonymized, list(requests)
+
+  def test_round_trip(self):
+    """Verify records are read back as written, relative to the start."""
+    self._capture.Record(PUBLISH, b'lost', b'', self._now, 200, 1)
+    self._capture.Begin(self._path)
+    self._now += 0.5
+    self._capture.Record(PUBLISH, b't', b'', 1000.25, 200, 12)
+    self._capture.Record(POLL, b't', b'u', 1000.5, 204, 0)
+    self._capture.End()
+    start, anonymized, requests = self._Read()
+    self.assertEqual((1000.0, False), (start, anonymized))
+    self.assertEqual([(PUBLISH, b't', b'', 200, 12), (POLL, b't', b'u', 204, 0)],
+                     [(r.op, r.topic, r.user, r.status, r.size)
+                      for r in requests])
+    self.assertEqual([0.25, 0.5], [r.arrival for r in requests])
+    self.assertEqual([0.25, 0.0], [r.duration for r in requests])
+    self.assertEqual(2, self._capture.Stats()['records'])
+    self.assertFalse(self._capture.Stats()['active'])
+
+  def test_anonymize(self):
+    """Verify names are hashed by segment, keeping wildcards and prefixes."""
+    capture = TrafficCapture(anonymize=True, clock=lambda: self._now)
+    capture.Start(self._reactor)
+    capture.Begin(self._path)
+    for topic in (b'orders.eu', b'orders.us', b'orders.*', b'#'):
+      capture.Record(SUBSCRIBE, topic, b'alice', self._now, 200, 0)
+    capture.End()
+    _, anonymized, requests = self._Read()
+    self.assertTrue(anonymized)
+    topics = [r.topic.split(b'.') for r in requests]
+    self.assertNotIn(b'orders', topics[0])
+    self.assertEqual(topics[0][0], topics[1][0])
+    self.assertNotEqual(topics[0][1], topics[1][1])
+    self.assertEqual([topics[0][0], b'*'], topics[2])
+    self.assertEqual([b'#'], topics[3])
+    self.assertEqual(1, len(set(r.user for r in requests)))
+    self.assertNotEqual(b'alice', requests[0].user)
+
+  def test_limits(self):
+    """Verify a capture stops at max_bytes, and after seconds."""
+    capture = TrafficCapture(max_bytes=100, clock=lambda: self._now)
+    capture.Start(self._reactor)
+    capture.Begin(self._path)
+    while capture.active:
+      capture.Record(POLL, b'topic', b'user', self._now, 204, 0)
+    self.assertEqual(3, len(self._Read()[2]))
+
+    self._capture.Begin(self._path, seconds=10)
+    self.assertRaises(ValueError, self._capture.Begin, self._path)
+    self._reactor.advance(10)
+    self.assertFalse(self._capture.active)
+
+  def test_resource(self):
+    """Verify captures are started and stopped from the admin endpoint."""
+    resource = CaptureResource(self._capture)
+    request = DummyRequest([])
+    request.args = {b'path': [self._path.encode('utf-8')]}
+    stats = json.loads(resource.render_POST(request))
+    self.assertEqual((True, self._path), (stats['active'], stats['path']))
+    self.assertEqual(409, (resource.render_POST(request),
+                           request.responseCode)[1])
+    stats = json.loads(resource.render_POST(DummyRequest([])))
+    self.assertFalse(stats['active'])
+    self.assertFalse(json.loads(resource.render_GET(DummyRequest([])))[
+        'active'])
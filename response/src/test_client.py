@@ -0,0 +1,313 @@
+import client
+
+from backends.memory import MemoryBackend
+from frontend import PubSubResource
+from frontend import PubSubSite
+from pacing import PollPacer
+
+from mock import MagicMock
+
+from twisted.internet import reactor
+from twisted.internet import threads
+from twisted.internet.defer import Deferred
+from twisted.internet.defer import gatherResults
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+
+class HistogramTest(unittest.TestCase):
+  def test_percentiles(self):
+    """Verify percentiles are within a bucket of the exact values."""
+    histogram = client.Histogram()
+    for i in range(1, 1001):
+      histogram.Record(i / 1e6)
+    for pct in (50, 90, 99):
+      exact = pct * 10 / 1e6
+      self.assertTrue(exact <= histogram.Percentile(pct) <= exact * 1.05)
+    self.assertEqual(1000 / 1e6, histogram.Percentile(100))
+    summary = histogram.Summary()
+    self.assertEqual(1000, summary['count'])
+    self.assertAlmostEqual(0.5005, summary['mean_ms'])
+
+class PubSubClientTest(unittest.TestCase):
+  """Runs the client against a real frontend over a MemoryBackend."""
+
+  def setUp(self):
+    self._backend = MemoryBackend()
+    self._resource = PubSubResource(self._backend)
+    self._port = reactor.listenTCP(
+        0, PubSubSite(self._resource), interface='127.0.0.1')
+    self._host = '127.0.0.1:%d' % self._port.getHost().port
+
+  @inlineCallbacks
+  def tearDown(self):
+    yield self._port.stopListening()
+
+  @inlineCallbacks
+  def test_calls_reuse_connections(self):
+    """Verify the calls, and that keep-alive connections are reused."""
+    pubsub = client.PubSubClient(self._host)
+    self.addCleanup(pubsub.Close)
+    self.assertEqual(200, (yield pubsub.Subscribe('a.#', 'user')))
+    self.assertEqual(200, (yield pubsub.Publish(b'a.b', b'm', b'key')))
+    self.assertEqual(200, (yield pubsub.Publish(b'a.b', b'm', b'key')))
+    self.assertEqual((200, b'm'), (yield pubsub.Poll('a.#', 'user')))
+    self.assertEqual((204, b''), (yield pubsub.Poll('a.#', 'user')))
+    self.assertEqual(200, (yield pubsub.Unsubscribe('a.#', 'user')))
+    self.assertEqual(2, pubsub.Stats()['poll']['count'])
+    # Each request waited for the last, so one connection served them all.
+    self.assertEqual([1], [len(connections) for connections
+                           in pubsub._server._pool._connections.values()])
+
+  @inlineCallbacks
+  def test_inbox(self):
+    """Verify inbox reads from both flavors."""
+    pubsub = client.PubSubClient(self._host)
+    self.addCleanup(pubsub.Close)
+    for topic in (b'a', b'b'):
+      yield pubsub.Subscribe(topic, b'user')
+      yield pubsub.Publish(topic, topic + b'1')
+      yield pubsub.Publish(topic, topic + b'2')
+    self.assertEqual((200, [(b'a', b'a1'), (b'a', b'a2')], False),
+                     (yield pubsub.Inbox(b'user', 2)))
+    blocking = client.BlockingClient(self._host)
+    self.assertEqual((200, [(b'b', b'b1'), (b'b', b'b2')], False),
+                     (yield threads.deferToThread(blocking.Inbox, b'user')))
+    blocking.Close()
+    self.assertEqual((204, [], False), (yield pubsub.Inbox(b'user')))
+
+  @inlineCallbacks
+  def test_read_and_commit(self):
+    """Verify offset reads and commits from both flavors."""
+    pubsub = client.PubSubClient(self._host)
+    self.addCleanup(pubsub.Close)
+    yield pubsub.Subscribe(b'topic', b'user')
+    for i in range(5):
+      yield pubsub.Publish(b'topic', b'%d' % i)
+    self.assertEqual((200, [(1, b'0'), (2, b'1')], 3),
+                     (yield pubsub.Read(b'topic', b'user', 0, 2)))
+    # Reads take nothing until committed.
+    self.assertEqual((200, [(1, b'0')], 2),
+                     (yield pubsub.Read(b'topic', b'user', 0, 1)))
+    self.assertEqual(200, (yield pubsub.Commit(b'topic', b'user', 2)))
+    blocking = client.BlockingClient(self._host)
+    self.assertEqual((200, [(3, b'2'), (4, b'3'), (5, b'4')], 6),
+                     (yield threads.deferToThread(blocking.Read, b'topic',
+                                                  b'user', 0)))
+    self.assertEqual(200, (yield threads.deferToThread(
+        blocking.Commit, b'topic', b'user', 4)))
+    blocking.Close()
+    self.assertEqual((200, b'4'), (yield pubsub.Poll(b'topic', b'user')))
+    self.assertEqual((204, [], 6),
+                     (yield pubsub.Read(b'topic', b'user', 6)))
+    self.assertEqual(3, pubsub.Stats()['read']['count'])
+
+  @inlineCallbacks
+  def test_publisher_and_consumer(self):
+    """Verify messages flow in order through a Publisher and a Consumer."""
+    pubsub = client.PubSubClient(self._host)
+    self.addCleanup(pubsub.Close)
+    yield pubsub.Subscribe(b'topic', b'user')
+    publisher = pubsub.Publisher(max_batch_messages=7)
+    sent = [publisher.Publish(b'topic', b'%d' % i) for i in range(20)]
+    yield publisher.Flush()
+    self.assertEqual([200] * 20, (yield gatherResults(sent)))
+    consumer = pubsub.Consumer(b'topic', b'user', prefetch=5)
+    received = []
+    for _ in range(20):
+      received.append((yield consumer.Get()))
+    consumer.Stop()
+    self.assertEqual([b'%d' % i for i in range(20)], received)
+
+  @inlineCallbacks
+  def test_paced_polls(self):
+    """Verify empty polls of a pacing server say how long to wait."""
+    self._resource._pacer = PollPacer(max_wait=2.5)
+    pubsub = client.PubSubClient(self._host)
+    self.addCleanup(pubsub.Close)
+    yield pubsub.Subscribe(b'topic', b'user')
+    self.assertEqual((204, b'', 2.5), (yield pubsub.Poll(b'topic', b'user')))
+    def Run():
+      pubsub = client.BlockingClient(self._host)
+      try:
+        return pubsub.Poll(b'topic', b'user')
+      finally:
+        pubsub.Close()
+    self.assertEqual((204, b'', 2.5), (yield threads.deferToThread(Run)))
+
+  @inlineCallbacks
+  def test_blocking(self):
+    """Verify the blocking flavor, run in a thread against the reactor."""
+    def Run():
+      pubsub = client.BlockingClient(self._host, max_connections=2)
+      pubsub.Subscribe(b'topic', b'user')
+      publisher = pubsub.Publisher(senders=2)
+      for i in range(20):
+        publisher.Publish(b'topic', b'%d' % i)
+      publisher.Close()
+      consumer = pubsub.Consumer(b'topic', b'user', prefetch=3)
+      received = [consumer.Get(timeout=5) for _ in range(20)]
+      consumer.Stop()
+      pubsub.Unsubscribe(b'topic', b'user')
+      pubsub.Close()
+      return received, publisher.stats['sent'], pubsub.Stats()
+    received, sent, stats = yield threads.deferToThread(Run)
+    self.assertEqual([b'%d' % i for i in range(20)], received)
+    self.assertEqual(20, sent)
+    self.assertEqual(20, stats['publish']['count'])
+
+class PublisherTest(unittest.TestCase):
+  def setUp(self):
+    self._clock = Clock()
+    self._client = MagicMock()
+    self._sends = []
+    def Publish(topic, body, key):
+      d = Deferred()
+      self._sends.append((topic, body, key, d))
+      return d
+    self._client.Publish.side_effect = Publish
+    self._publisher = client.Publisher(
+        self._client, max_batch_messages=3, max_batch_bytes=10, linger=0.01,
+        clock=self._clock)
+
+  def _Answer(self, status):
+    topic, body, key, d = self._sends.pop(0)
+    d.callback(status)
+    return topic, body, key
+
+  def test_batches_by_count_and_linger(self):
+    """Verify batches go out once full or after linger, in order per topic."""
+    results = [self._publisher.Publish(b'a', b'%d' % i) for i in range(4)]
+    self.assertEqual([b'0'], [s[1] for s in self._sends])
+    self._Answer(200)
+    self.assertEqual([b'1'], [s[1] for s in self._sends])
+    self._Answer(200)
+    self._Answer(200)
+    self.assertEqual([], self._sends)
+    self._clock.advance(0.01)
+    self.assertEqual(b'3', self._Answer(200)[1])
+    self.assertEqual([200] * 4, [self.successResultOf(d) for d in results])
+    self.assertEqual(2, self._publisher.stats['batches'])
+
+  def test_batches_by_bytes_and_topics_in_parallel(self):
+    """Verify a batch goes out at max_batch_bytes, alongside other topics."""
+    self._publisher.Publish(b'a', b'x' * 10)
+    self._publisher.Publish(b'b', b'y' * 10)
+    self.assertEqual([b'a', b'b'], [s[0] for s in self._sends])
+
+  def test_retries_with_same_key(self):
+    """Verify failures and 5xx are retried with the same idempotency key."""
+    result = self._publisher.Publish(b'a', b'x' * 10)
+    _, _, key = self._Answer(503)
+    self._clock.advance(0.05)
+    self._sends.pop(0)[3].errback(ValueError('connection lost'))
+    self._clock.advance(0.1)
+    self.assertEqual(key, self._Answer(200)[2])
+    self.assertEqual(200, self.successResultOf(result))
+    self.assertEqual(2, self._publisher.stats['retries'])
+
+  def test_gives_up(self):
+    """Verify a publish fails after its retries, and the topic moves on."""
+    result = self._publisher.Publish(b'a', b'x' * 10)
+    self._publisher.Publish(b'a', b'y' * 10)
+    for delay in (0.05, 0.1, 0.2, 0):
+      self._Answer(500)
+      self._clock.advance(delay)
+    self.assertEqual(500, self.failureResultOf(
+        result, client.PublishError).value.status)
+    self.assertEqual(b'y' * 10, self._Answer(200)[1])
+
+  def test_flush(self):
+    """Verify Flush sends lingering batches and fires once all are sent."""
+    self._publisher.Publish(b'a', b'1')
+    self._publisher.Publish(b'b', b'2')
+    d = self._publisher.Flush()
+    self.assertNoResult(d)
+    self._Answer(200)
+    self._Answer(404)
+    self.assertEqual(None, self.successResultOf(d))
+
+class ConsumerTest(unittest.TestCase):
+  def setUp(self):
+    self._clock = Clock()
+    self._client = MagicMock()
+    self._polls = []
+    def Poll(topic, user):
+      d = Deferred()
+      self._polls.append(d)
+      return d
+    self._client.Poll.side_effect = Poll
+
+  def _Consumer(self, prefetch=2):
+    return client.Consumer(self._client, b'topic', b'user', prefetch=prefetch,
+                           idle_delay=0.01, max_idle_delay=0.03,
+                           clock=self._clock)
+
+  def test_prefetch(self):
+    """Verify up to prefetch messages are polled ahead of Get."""
+    consumer = self._Consumer()
+    self._polls.pop(0).callback((200, b'1'))
+    self._polls.pop(0).callback((200, b'2'))
+    self.assertEqual([], self._polls)
+    self.assertEqual(b'1', self.successResultOf(consumer.Get()))
+    self.assertEqual(1, len(self._polls))
+
+  def test_waits_and_backs_off(self):
+    """Verify Get waits for a message, polling less often while empty."""
+    consumer = self._Consumer()
+    d = consumer.Get()
+    for delay in (0.01, 0.02, 0.03, 0.03):
+      self._polls.pop(0).callback((204, b''))
+      self._clock.advance(delay - 0.001)
+      self.assertEqual([], self._polls)
+      self._clock.advance(0.001)
+    self._polls.pop(0).callback((200, b'm'))
+    self.assertEqual(b'm', self.successResultOf(d))
+    self._polls.pop(0).errback(ValueError('connection lost'))
+    self._clock.advance(0.01)
+    self.assertEqual(1, len(self._polls))
+    consumer.Stop()
+
+  def test_paced(self):
+    """Verify waits the server asks for replace the backoff."""
+    consumer = self._Consumer()
+    d = consumer.Get()
+    for _ in range(3):
+      self._polls.pop(0).callback((204, b'', 0.5))
+      self._clock.advance(0.499)
+      self.assertEqual([], self._polls)
+      self._clock.advance(0.001)
+    self._polls.pop(0).callback((204, b''))
+    self._clock.advance(0.01)
+    self._polls.pop(0).callback((200, b'm'))
+    self.assertEqual(b'm', self.successResultOf(d))
+    self.assertEqual(3, consumer.stats['paced'])
+    consumer.Stop()
+
+  def test_subscription_gone(self):
+    """Verify waiting and later Gets fail once the poll answers 404."""
+    consumer = self._Consumer()
+    d = consumer.Get()
+    self._polls.pop(0).callback((404, b''))
+    self.assertEqual(404, self.failureResultOf(
+        d, client.ConsumerError).value.status)
+    self.failureResultOf(consumer.Get(), client.ConsumerError)
+
+class BlockingPublisherTest(unittest.TestCase):
+  def test_batches_in_order_and_retries(self):
+    """Verify batches are sent in order, retrying 5xx with the same key."""
+    blocking = MagicMock()
+    statuses = [503, 200, 200, 200]
+    blocking.Publish.side_effect = lambda *args: statuses.pop(0)
+    publisher = client.BlockingPublisher(
+        blocking, max_batch_messages=2, linger=10, senders=3, retry_delay=0)
+    for i in range(3):
+      publisher.Publish(b'topic', b'%d' % i)
+    self.assertEqual(1, publisher.stats['batches'])
+    publisher.Close()
+    calls = [c[0] for c in blocking.Publish.call_args_list]
+    self.assertEqual([b'0', b'0', b'1', b'2'], [c[1] for c in calls])
+    self.assertEqual(calls[0][2], calls[1][2])
+    self.assertEqual((3, 1, 2), (publisher.stats['sent'],
+                                 publisher.stats['retries'],
+                                 publisher.stats['batches']))
@@ -0,0 +1,91 @@
+from backends.hash import _HashToNumberLessThan
+from backends.hash import HashBackend
+from backends.memory import MemoryBackend
+from backends.proxy import ProxyBackend
+from colocated import ParseLocalBackends
+from colocated import ShardListener
+from compression import CompressedBody
+from compression import Compressor
+
+from mock import MagicMock
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks
+from twisted.trial import unittest
+from twisted.web.resource import Resource
+
+def _TopicOn(shard, num_backends=2):
+  """Returns a topic HashBackend places on shard."""
+  i = 0
+  while _HashToNumberLessThan(b'topic-%d' % i, num_backends) != shard:
+    i += 1
+  return b'topic-%d' % i
+
+class ParseLocalBackendsTest(unittest.TestCase):
+  def test_parse(self):
+    """Verify shard indexes are parsed, and must be below the count."""
+    self.assertEqual(set(), ParseLocalBackends(None, 2))
+    self.assertEqual(set([0, 2]), ParseLocalBackends('0,2', 3))
+    for bad in ('x', '2', '-1'):
+      self.assertRaises(ValueError, ParseLocalBackends, bad, 2)
+
+class ColocatedTest(unittest.TestCase):
+  """Two co-located frontends, each owning one of two shards."""
+
+  def setUp(self):
+    self._shards = [MemoryBackend(), MemoryBackend()]
+    self._listeners = [ShardListener(shard, 0, interface='127.0.0.1')
+                       for shard in self._shards]
+    hosts = []
+    for listener in self._listeners:
+      listener.Start(reactor)
+      self.addCleanup(listener.Stop)
+      hosts.append('127.0.0.1:%d' % listener.listening.getHost().port)
+    self._frontends = [
+        HashBackend([self._shards[0], ProxyBackend(hosts[1])]),
+        HashBackend([ProxyBackend(hosts[0]), self._shards[1]])]
+
+  def test_local_topic_in_process(self):
+    """Verify a topic on the frontend's own shard never leaves the process."""
+    frontend = HashBackend([self._shards[0], MagicMock()])
+    topic = _TopicOn(0)
+    self.assertEqual(200, frontend.Subscribe(topic, b'user'))
+    self.assertEqual(200, frontend.PostMessage(topic, b'body'))
+    self.assertEqual((200, b'body', 1), frontend.GetMessage(topic, b'user'))
+    self.assertEqual([], frontend._backends[1].method_calls)
+
+  @inlineCallbacks
+  def test_remote_topic_proxied(self):
+    """Verify a topic on the other shard is served by its owner."""
+    topic = _TopicOn(1)
+    self.assertEqual(200, (yield self._frontends[0].Subscribe(topic, b'user')))
+    self.assertEqual(200, (yield self._frontends[0].PostMessage(topic, b'a')))
+    self.assertEqual(1, self._shards[1].Backlog()['messages'])
+    self.assertEqual(0, self._shards[0].Backlog()['messages'])
+    self.assertEqual(200, self._frontends[1].PostMessage(topic, b'b'))
+    result = yield self._frontends[0].GetMessage(topic, b'user')
+    self.assertEqual((200, b'a'), result[:2])
+    result = yield self._frontends[1].GetMessage(topic, b'user')
+    self.assertEqual((200, b'b'), result[:2])
+
+class ShardListenerTest(unittest.TestCase):
+  @inlineCallbacks
+  def test_configured(self):
+    """Verify components are started and nested, and bodies handled as set."""
+    component = MagicMock(spec=['Start', 'Stop', 'AdminResources'])
+    component.AdminResources.return_value = {b'snapshot': Resource()}
+    listener = ShardListener(
+        MemoryBackend(), 0, interface='127.0.0.1', name=b'shard1',
+        components=[component], compressor=Compressor(check_gzip=False),
+        max_message_size=10)
+    listener.Start(reactor)
+    self.addCleanup(listener.Stop)
+    component.Start.assert_called_with(reactor)
+    self.assertEqual(set([b'backlog', b'dedup', b'snapshot']),
+                     set(listener.AdminResources()[b'shard1'].children))
+    proxy = ProxyBackend('127.0.0.1:%d' % listener.listening.getHost().port)
+    self.assertEqual(200, (yield proxy.Subscribe(b'topic', b'user')))
+    self.assertEqual(413, (yield proxy.PostMessage(b'topic', b'x' * 11)))
+    # Frontends checked their gzip bodies, so the shard does not.
+    self.assertEqual(200, (yield proxy.PostMessage(
+        b'topic', CompressedBody(b'not gzip'))))
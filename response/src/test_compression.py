@@ -0,0 +1,106 @@
+import gzip
+import os
+
+from compression import AcceptsGzip
+from compression import BodyTooLargeError
+from compression import CompressedBody
+from compression import Compressor
+from compression import CorruptBodyError
+
+from mock import patch
+
+from twisted.trial import unittest
+
+_JSON = b'{"order": 1234, "status": "shipped", "items": []}' * 20
+
+class CompressorTest(unittest.TestCase):
+  def setUp(self):
+    self._compressor = Compressor(threshold=100, level=6)
+
+  def test_small_bodies_untouched(self):
+    """Verify bodies under the threshold are stored as they came."""
+    body = self._compressor.FromRequest(b'small', None)
+    self.assertNotIsInstance(body, CompressedBody)
+    self.assertEqual(b'small', body)
+
+  def test_large_bodies_compressed(self):
+    """Verify large bodies are gzipped once and counted."""
+    body = self._compressor.FromRequest(_JSON, None)
+    self.assertIsInstance(body, CompressedBody)
+    self.assertEqual(_JSON, gzip.decompress(body))
+    stats = self._compressor.Stats()
+    self.assertEqual(1, stats['compressed'])
+    self.assertEqual(len(_JSON), stats['raw_bytes'])
+    self.assertEqual(len(_JSON) - len(body), stats['bytes_saved'])
+
+  def test_incompressible_bodies_untouched(self):
+    """Verify bodies that would grow are left alone."""
+    body = self._compressor.FromRequest(os.urandom(500), None)
+    self.assertNotIsInstance(body, CompressedBody)
+    self.assertEqual(1, self._compressor.Stats()['skipped_incompressible'])
+
+  def test_already_compressed_not_recompressed(self):
+    """Verify gzip request bodies are kept as is, even when disabled."""
+    compressor = Compressor()
+    zipped = gzip.compress(_JSON)
+    body = compressor.FromRequest(zipped, b'gzip')
+    self.assertIsInstance(body, CompressedBody)
+    self.assertEqual(zipped, body)
+    self.assertEqual(1, compressor.Stats()['received_compressed'])
+
+  def test_for_response(self):
+    """Verify delivery passes gzip through or inflates as the client wants."""
+    body = self._compressor.FromRequest(_JSON, None)
+    self.assertEqual((body, b'gzip'),
+                     self._compressor.ForResponse(body, b'gzip, deflate'))
+    self.assertEqual((_JSON, None), self._compressor.ForResponse(body, None))
+    self.assertEqual((b'plain', None),
+                     self._compressor.ForResponse(b'plain', b'gzip'))
+    stats = self._compressor.Stats()
+    self.assertEqual(1, stats['delivered_compressed'])
+    self.assertEqual(1, stats['inflated'])
+
+  def test_corrupt_gzip_refused(self):
+    """Verify gzip publishes that do not inflate are refused, not stored."""
+    zipped = gzip.compress(_JSON)
+    for bad in (b'not gzip', zipped[:-10], zipped + b'trailing'):
+      self.assertRaises(CorruptBodyError,
+                        self._compressor.FromRequest, bad, b'gzip')
+    self.assertEqual(3, self._compressor.Stats()['rejected_corrupt'])
+
+  def test_gzip_bomb_refused(self):
+    """Verify gzip publishes inflating past max_size are refused."""
+    compressor = Compressor(max_size=len(_JSON))
+    compressor.FromRequest(gzip.compress(_JSON), b'gzip')
+    bomb = gzip.compress(b'\0' * (10 * 2 ** 20))
+    self.assertTrue(len(bomb) < 20000)
+    self.assertRaises(BodyTooLargeError, compressor.FromRequest, bomb,
+                      b'gzip')
+    self.assertEqual(1, compressor.Stats()['rejected_too_large'])
+
+  def test_trusted_gzip_not_inflated(self):
+    """Verify a backend trusting its frontends stores gzip bodies unchecked."""
+    compressor = Compressor(max_size=10, check_gzip=False)
+    with patch('compression.zlib.decompressobj') as decompressobj:
+      body = compressor.FromRequest(gzip.compress(_JSON), b'gzip')
+    self.assertFalse(decompressobj.called)
+    self.assertIsInstance(body, CompressedBody)
+    self.assertEqual(1, compressor.Stats()['received_compressed'])
+
+  def test_for_response_bounded(self):
+    """Verify bodies that cannot be inflated are delivered, gzipped."""
+    compressor = Compressor(max_size=1000)
+    bomb = CompressedBody(gzip.compress(b'\0' * (10 * 2 ** 20)))
+    self.assertEqual((bomb, b'gzip'), compressor.ForResponse(bomb, None))
+    corrupt = CompressedBody(b'not gzip')
+    self.assertEqual((corrupt, b'gzip'), compressor.ForResponse(corrupt, None))
+    self.assertEqual(2, compressor.Stats()['inflate_failed'])
+
+  def test_accepts_gzip(self):
+    """Verify Accept-Encoding is parsed, honouring q=0."""
+    for accepts in (b'gzip', b'deflate, GZIP;q=0.5', b'x-gzip', b'*',
+                    b'br;q=1.0, *;q=0.1'):
+      self.assertTrue(AcceptsGzip(accepts), accepts)
+    for refuses in (None, b'', b'identity', b'gzip;q=0', b'gzip; q=0.0',
+                    b'*, gzip;q=0', b'*;q=0', b'gzip;q=x', b'gzipped'):
+      self.assertFalse(AcceptsGzip(refuses), refuses)
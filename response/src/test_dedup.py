@@ -0,0 +1,41 @@
+from dedup import DedupCache
+
+from twisted.trial import unittest
+
+class DedupCacheTest(unittest.TestCase):
+  def setUp(self):
+    self._now = 0.0
+    self._cache = DedupCache(ttl=10, max_entries=3, clock=lambda: self._now)
+
+  def test_duplicates_per_topic(self):
+    """Verify a key is a duplicate only on the topic it was seen on."""
+    self.assertFalse(self._cache.Seen(b'topic', b'key'))
+    self.assertTrue(self._cache.Seen(b'topic', b'key'))
+    self.assertFalse(self._cache.Seen(b'other', b'key'))
+    stats = self._cache.Stats()
+    self.assertEqual((3, 1, 2), (stats['checks'], stats['duplicates'],
+                                 stats['entries']))
+
+  def test_expiry(self):
+    """Verify keys are forgotten ttl after they were last seen."""
+    self._cache.Seen(b'topic', b'a')
+    self._cache.Seen(b'topic', b'b')
+    self._now = 8
+    self.assertTrue(self._cache.Seen(b'topic', b'a'))
+    self._now = 12
+    self.assertFalse(self._cache.Seen(b'topic', b'b'))
+    self.assertTrue(self._cache.Seen(b'topic', b'a'))
+    self._now = 30
+    self._cache.Seen(b'topic', b'c')
+    self.assertEqual((1, 3), (self._cache.Stats()['entries'],
+                              self._cache.Stats()['expired']))
+
+  def test_least_recently_seen_evicted(self):
+    """Verify the key count is capped, dropping the least recently seen."""
+    for key in (b'a', b'b', b'c'):
+      self._cache.Seen(b'topic', key)
+    self._cache.Seen(b'topic', b'a')
+    self._cache.Seen(b'topic', b'd')
+    self.assertEqual(1, self._cache.Stats()['evicted'])
+    self.assertTrue(self._cache.Seen(b'topic', b'a'))
+    self.assertFalse(self._cache.Seen(b'topic', b'b'))
@@ -2,7 +2,28 @@
 # correctly, and mocks out the backends to ensure that the frontend forwards to
 # the backends appropriately.
 
+import gzip
+
+import tracing
+
+from backends.memory import MemoryBackend
+
+from capture import POLL
+from capture import PUBLISH
+from capture import ReadCapture
+from capture import TrafficCapture
+
+from compression import CompressedBody
+from compression import Compressor
 from frontend import PubSubResource
+from frontend import PubSubSite
+from frontend import _BodyBuffer
+from inbox import EncodeInbox
+from offsets import DecodeRange
+from pacing import PollPacer
+from ratelimit import RateLimiter
+from sketches import CurrentPublisher
+from sketches import TrafficSketches
 
 from mock import MagicMock
 from mock import patch
@@ -10,6 +31,8 @@ from mock import patch
 from twisted.trial import unittest
 from twisted.internet.defer import succeed
 from twisted.internet.defer import Deferred
+from twisted.internet.address import IPv4Address
+from twisted.internet.testing import StringTransport
 from twisted.web.server import NOT_DONE_YET
 from twisted.web.test.test_web import DummyRequest
 
@@ -31,7 +54,7 @@ class DummyRequestWithContent(DummyRequest):
 def _Render(resource, request):
   """Renders a request using a resource yeilding a deferred."""
   result = resource.render(request)
-  if isinstance(result, str):
+  if isinstance(result, bytes):
     request.write(result)
     request.finish()
     return succeed(None)
@@ -58,7 +81,7 @@ def _RenderToDeferredStatusBody(resource, request):
   d = _Render(resource, request)
   
   def GetStatusAndBody(unused_arg):
-    return (request.responseCode, "".join(request.written))
+    return (request.responseCode, b"".join(request.written))
   d.addCallback(GetStatusAndBody)
   return d
 
@@ -71,7 +94,7 @@ class FrontendTest(unittest.TestCase):
 
   def _CreateDummyRequest(self, method, endpoint, body=None):
     """Created a request object for the specified parameters."""
-    request = DummyRequestWithContent(endpoint.split('/'), body)
+    request = DummyRequestWithContent(endpoint.split(b'/'), body)
     request.method = method
     # TODO: body
     self._request = request
@@ -82,7 +105,7 @@ class FrontendTest(unittest.TestCase):
     request = self._CreateDummyRequest(method, endpoint, body=body)
     return _RenderToDeferredStatusBody(self._pubSubResource, request)
 
-  def _TestEndpoint(self, async, method, endpoint, expected_response_status,
+  def _TestEndpoint(self, is_async, method, endpoint, expected_response_status,
                     expected_response_body=None,
                     backend_method_mock=None, body=None,
                     backend_method_return_value=None,
@@ -95,7 +118,7 @@ class FrontendTest(unittest.TestCase):
     out the backend response, and then verify the results.
     
     Args:
-      async: Whether the backend is async or sync.
+      is_async: Whether the backend is is_async or sync.
       method: The HTTP method to use (i.e. 'POST').
       endpoint: The HTTP path to query.
       expected_response_status: The expected status of the HTTP response.
@@ -111,7 +134,7 @@ class FrontendTest(unittest.TestCase):
     """
     backend_method_deferred = Deferred()
     if backend_method_mock:
-      if async:
+      if is_async:
         backend_method_mock.return_value = backend_method_deferred
       else:
         if backend_method_return_value:
@@ -129,9 +152,9 @@ class FrontendTest(unittest.TestCase):
         backend_method_mock.assert_called_with(*expected_backend_method_args)
     d.addCallback(VerifyResult)
 
-    if async:
+    if is_async:
       self.assertFalse(
-          self._request.finished, 'Finished before async backend returned.')
+          self._request.finished, 'Finished before is_async backend returned.')
       if backend_method_return_value:
         backend_method_deferred.callback(backend_method_return_value)
       if backend_method_error:
@@ -141,10 +164,10 @@ class FrontendTest(unittest.TestCase):
   def test_sync_subscribe(self):
     """Verify subscribe works with syncronous backends."""
     return self._TestEndpoint(
-      async=False,
-      method='POST',
-      endpoint='test_topic/test_user',
-      expected_backend_method_args=['test_topic', 'test_user'],
+      is_async=False,
+      method=b'POST',
+      endpoint=b'test_topic/test_user',
+      expected_backend_method_args=[b'test_topic', b'test_user'],
       backend_method_mock=self._mock_backend.Subscribe,
       backend_method_return_value=1234,
       expected_response_status=1234)
@@ -152,10 +175,10 @@ class FrontendTest(unittest.TestCase):
   def test_async_subscribe(self):
     """Verify subscribe works with asyncronous backends."""
     return self._TestEndpoint(
-      async=True,
-      method='POST',
-      endpoint='test_topic/test_user',
-      expected_backend_method_args=['test_topic', 'test_user'],
+      is_async=True,
+      method=b'POST',
+      endpoint=b'test_topic/test_user',
+      expected_backend_method_args=[b'test_topic', b'test_user'],
       backend_method_mock=self._mock_backend.Subscribe,
       backend_method_return_value=1234,
       expected_response_status=1234)
@@ -172,10 +195,10 @@ class FrontendTest(unittest.TestCase):
     mock_time.side_effect = fake_time
 
     d = self._TestEndpoint(
-      async=False,
-      method='POST',
-      endpoint='test_topic/test_user',
-      expected_backend_method_args=['test_topic', 'test_user'],
+      is_async=False,
+      method=b'POST',
+      endpoint=b'test_topic/test_user',
+      expected_backend_method_args=[b'test_topic', b'test_user'],
       backend_method_mock=self._mock_backend.Subscribe,
       backend_method_return_value=4321,
       expected_response_status=4321)
@@ -193,13 +216,13 @@ class FrontendTest(unittest.TestCase):
 
   @patch('frontend.logging.info')
   @patch('frontend.logging.error')
-  def _TestSubscribeLoggingErrors(self, async, mock_log_error, mock_log_info):
+  def _TestSubscribeLoggingErrors(self, is_async, mock_log_error, mock_log_info):
     """Verify subscribe logs meaningful data on 500s."""
     d = self._TestEndpoint(
-      async=async,
-      method='POST',
-      endpoint='test_topic/test_user',
-      expected_backend_method_args=['test_topic', 'test_user'],
+      is_async=is_async,
+      method=b'POST',
+      endpoint=b'test_topic/test_user',
+      expected_backend_method_args=[b'test_topic', b'test_user'],
       backend_method_mock=self._mock_backend.Subscribe,
       backend_method_error=Exception("Except"),
       expected_response_status=500)
@@ -219,17 +242,17 @@ class FrontendTest(unittest.TestCase):
     self._TestSubscribeLoggingErrors(False)
 
   def test_subscribe_logging_errors_async(self):
-    """Verify subscribe logs meaningful data on 500s with async backend."""
+    """Verify subscribe logs meaningful data on 500s with is_async backend."""
     self._TestSubscribeLoggingErrors(True)
 
   def test_sync_postmessage(self):
     """Verify postmessage works with syncronous backends."""
     return self._TestEndpoint(
-      async=False,
-      method='POST',
-      endpoint='test_topic',
-      body='MESSAGE',
-      expected_backend_method_args=['test_topic', 'MESSAGE'],
+      is_async=False,
+      method=b'POST',
+      endpoint=b'test_topic',
+      body=b'MESSAGE',
+      expected_backend_method_args=[b'test_topic', b'MESSAGE'],
       backend_method_mock=self._mock_backend.PostMessage,
       backend_method_return_value=1234,
       expected_response_status=1234)
@@ -237,11 +260,11 @@ class FrontendTest(unittest.TestCase):
   def test_async_postmessage(self):
     """Verify postmessage works with asyncronous backends."""
     return self._TestEndpoint(
-      async=True,
-      method='POST',
-      endpoint='test_topic',
-      body='MESSAGE',
-      expected_backend_method_args=['test_topic', 'MESSAGE'],
+      is_async=True,
+      method=b'POST',
+      endpoint=b'test_topic',
+      body=b'MESSAGE',
+      expected_backend_method_args=[b'test_topic', b'MESSAGE'],
       backend_method_mock=self._mock_backend.PostMessage,
       backend_method_return_value=1234,
       expected_response_status=1234)
@@ -258,11 +281,11 @@ class FrontendTest(unittest.TestCase):
     mock_time.side_effect = fake_time
 
     d = self._TestEndpoint(
-      async=False,
-      method='POST',
-      endpoint='test_topic',
-      body='MESSAGE',
-      expected_backend_method_args=['test_topic', 'MESSAGE'],
+      is_async=False,
+      method=b'POST',
+      endpoint=b'test_topic',
+      body=b'MESSAGE',
+      expected_backend_method_args=[b'test_topic', b'MESSAGE'],
       backend_method_mock=self._mock_backend.PostMessage,
       backend_method_return_value=4321,
       expected_response_status=4321)
@@ -281,14 +304,14 @@ class FrontendTest(unittest.TestCase):
 
   @patch('frontend.logging.info')
   @patch('frontend.logging.error')
-  def _TestPostMessageLogErrors(self, async, mock_log_error, mock_log_info):
+  def _TestPostMessageLogErrors(self, is_async, mock_log_error, mock_log_info):
     """Verify postmessage logs meaningful data on 500s."""
     d = self._TestEndpoint(
-      async=async,
-      method='POST',
-      endpoint='test_topic',
-      body='MESSAGE',
-      expected_backend_method_args=['test_topic', 'MESSAGE'],
+      is_async=is_async,
+      method=b'POST',
+      endpoint=b'test_topic',
+      body=b'MESSAGE',
+      expected_backend_method_args=[b'test_topic', b'MESSAGE'],
       backend_method_mock=self._mock_backend.PostMessage,
       backend_method_error=Exception("Except"),
       expected_response_status=500)
@@ -308,40 +331,40 @@ class FrontendTest(unittest.TestCase):
     return self._TestPostMessageLogErrors(False)
 
   def test_postmessage_logging_errors_async(self):
-    """Verify postmessage logs meaningful data on 500s with async backends."""
+    """Verify postmessage logs meaningful data on 500s with is_async backends."""
     return self._TestPostMessageLogErrors(True)
 
   def test_post_bad_endpoint(self):
     """Verify that posting to endpoints with more than 2 '/'s is a 404."""
     return self._TestEndpoint(
-      async=False,
-      method='POST',
-      endpoint='test_topic/test_user/fun_for_all',
+      is_async=False,
+      method=b'POST',
+      endpoint=b'test_topic/test_user/fun_for_all',
       expected_response_status=404)
 
   def test_sync_getmessage(self):
     """Verify getmessage works with syncronous backends."""
     return self._TestEndpoint(
-      async=False,
-      method='GET',
-      endpoint='test_topic/test_user',
-      expected_backend_method_args=['test_topic', 'test_user'],
+      is_async=False,
+      method=b'GET',
+      endpoint=b'test_topic/test_user',
+      expected_backend_method_args=[b'test_topic', b'test_user'],
       backend_method_mock=self._mock_backend.GetMessage,
-      backend_method_return_value=(1234, 'MESSAGE'),
+      backend_method_return_value=(1234, b'MESSAGE'),
       expected_response_status=1234, 
-      expected_response_body='MESSAGE')
+      expected_response_body=b'MESSAGE')
 
   def test_async_getmessage(self):
     """Verify getmessage works with asyncronous backends."""
     return self._TestEndpoint(
-      async=True,
-      method='GET',
-      endpoint='test_topic/test_user',
-      expected_backend_method_args=['test_topic', 'test_user'],
+      is_async=True,
+      method=b'GET',
+      endpoint=b'test_topic/test_user',
+      expected_backend_method_args=[b'test_topic', b'test_user'],
       backend_method_mock=self._mock_backend.GetMessage,
-      backend_method_return_value=(1234, 'MESSAGE'),
+      backend_method_return_value=(1234, b'MESSAGE'),
       expected_response_status=1234, 
-      expected_response_body='MESSAGE')
+      expected_response_body=b'MESSAGE')
 
   @patch('frontend.logging.info')
   @patch('frontend.time.time')
@@ -355,14 +378,14 @@ class FrontendTest(unittest.TestCase):
     mock_time.side_effect = fake_time
 
     d = self._TestEndpoint(
-      async=False,
-      method='GET',
-      endpoint='test_topic/test_user',
-      expected_backend_method_args=['test_topic', 'test_user'],
+      is_async=False,
+      method=b'GET',
+      endpoint=b'test_topic/test_user',
+      expected_backend_method_args=[b'test_topic', b'test_user'],
       backend_method_mock=self._mock_backend.GetMessage,
-      backend_method_return_value=(4321, 'MESSAGE'),
+      backend_method_return_value=(4321, b'MESSAGE'),
       expected_response_status=4321,
-      expected_response_body='MESSAGE')
+      expected_response_body=b'MESSAGE')
 
     def VerifyResult(unused_argument):
       args, _ = mock_log.call_args
@@ -379,13 +402,13 @@ class FrontendTest(unittest.TestCase):
 
   @patch('frontend.logging.info')
   @patch('frontend.logging.error')
-  def _TestGetMessageLogErrors(self, async, mock_log_error, mock_log_info):
+  def _TestGetMessageLogErrors(self, is_async, mock_log_error, mock_log_info):
     """Verify getmessage logs meaningful data on 500s."""
     d = self._TestEndpoint(
-      async=async,
-      method='GET',
-      endpoint='test_topic/test_user',
-      expected_backend_method_args=['test_topic', 'test_user'],
+      is_async=is_async,
+      method=b'GET',
+      endpoint=b'test_topic/test_user',
+      expected_backend_method_args=[b'test_topic', b'test_user'],
       backend_method_mock=self._mock_backend.GetMessage,
       backend_method_error=Exception("Except"),
       expected_response_status=500)
@@ -405,32 +428,84 @@ class FrontendTest(unittest.TestCase):
     return self._TestGetMessageLogErrors(False)
 
   def test_getmessage_logging_errors_async(self):
-    """Verify getmessage logs meaningful data on 500s with async backends."""
+    """Verify getmessage logs meaningful data on 500s with is_async backends."""
     return self._TestGetMessageLogErrors(True)
 
   def test_get_bad_endpoint_long(self):
     """Verify that getting endpoints with more than 2 '/'s is a 404."""
     return self._TestEndpoint(
-      async=False,
-      method='GET',
-      endpoint='test_topic/test_user/fun_for_all',
+      is_async=False,
+      method=b'GET',
+      endpoint=b'test_topic/test_user/fun_for_all',
       expected_response_status=404)
 
   def test_get_bad_endpoint_short(self):
-    """Verify that getting endpoints with less than 1 '/'s is a 404."""
+    """Verify that getting the root is a 404."""
     return self._TestEndpoint(
-      async=False,
-      method='GET',
-      endpoint='test_topic',
+      is_async=False,
+      method=b'GET',
+      endpoint=b'',
       expected_response_status=404)
 
+  def test_async_getinbox(self):
+    """Verify a single segment GET reads the user's inbox as JSON."""
+    zipped = CompressedBody(gzip.compress(b'SECOND'))
+    return self._TestEndpoint(
+      is_async=True,
+      method=b'GET',
+      endpoint=b'test_user',
+      backend_method_mock=self._mock_backend.GetMessages,
+      backend_method_return_value=(
+          200, [(b'a', b'FIRST'), (b'b', zipped)], True),
+      expected_response_status=200,
+      expected_response_body=EncodeInbox(
+          [(b'a', b'FIRST'), (b'b', b'SECOND')], True),
+      expected_backend_method_args=(b'test_user', 100))
+
+  def test_getinbox_empty(self):
+    """Verify an empty inbox is a 204 with no body."""
+    return self._TestEndpoint(
+      is_async=False,
+      method=b'GET',
+      endpoint=b'test_user',
+      backend_method_mock=self._mock_backend.GetMessages,
+      backend_method_return_value=(204, [], False),
+      expected_response_status=204,
+      expected_response_body=b'')
+
+  def test_getinbox_limit(self):
+    """Verify the limit is passed on, and checked."""
+    request = self._CreateDummyRequest(b'GET', b'test_user')
+    request.args = {b'limit': [b'1001']}
+    self.assertEqual(b'', self._pubSubResource.render(request))
+    self.assertEqual(400, request.responseCode)
+    self._mock_backend.GetMessages.return_value = (204, [], False)
+    request = self._CreateDummyRequest(b'GET', b'test_user')
+    request.args = {b'limit': [b'5']}
+    d = _RenderToDeferredStatusBody(self._pubSubResource, request)
+    self._mock_backend.GetMessages.assert_called_with(b'test_user', 5)
+    return d
+
+  def test_peekinbox(self):
+    """Verify peek=1 reads the inbox without taking, with the seqs."""
+    self._mock_backend.PeekMessages.return_value = (200, [(b'a', b'X', 3)],
+                                                    False)
+    request = self._CreateDummyRequest(b'GET', b'test_user')
+    request.args = {b'limit': [b'5'], b'peek': [b'1']}
+    d = _RenderToDeferredStatusBody(self._pubSubResource, request)
+    self._mock_backend.PeekMessages.assert_called_with(b'test_user', 5)
+    self.assertFalse(self._mock_backend.GetMessages.called)
+    d.addCallback(self.assertEqual,
+                  (200, EncodeInbox([(b'a', b'X', 3)], False)))
+    return d
+
   def test_sync_unsubscribe(self):
     """Verify unsubscribe works with syncronous backends."""
     return self._TestEndpoint(
-      async=False,
-      method='DELETE',
-      endpoint='test_topic/test_user',
-      expected_backend_method_args=['test_topic', 'test_user'],
+      is_async=False,
+      method=b'DELETE',
+      endpoint=b'test_topic/test_user',
+      expected_backend_method_args=[b'test_topic', b'test_user'],
       backend_method_mock=self._mock_backend.Unsubscribe,
       backend_method_return_value=1234,
       expected_response_status=1234)
@@ -438,10 +513,10 @@ class FrontendTest(unittest.TestCase):
   def test_async_unsubscribe(self):
     """Verify unsubscribe works with asyncronous backends."""
     return self._TestEndpoint(
-      async=True,
-      method='DELETE',
-      endpoint='test_topic/test_user',
-      expected_backend_method_args=['test_topic', 'test_user'],
+      is_async=True,
+      method=b'DELETE',
+      endpoint=b'test_topic/test_user',
+      expected_backend_method_args=[b'test_topic', b'test_user'],
       backend_method_mock=self._mock_backend.Unsubscribe,
       backend_method_return_value=1234,
       expected_response_status=1234)
@@ -458,10 +533,10 @@ class FrontendTest(unittest.TestCase):
     mock_time.side_effect = fake_time
 
     d = self._TestEndpoint(
-      async=False,
-      method='DELETE',
-      endpoint='test_topic/test_user',
-      expected_backend_method_args=['test_topic', 'test_user'],
+      is_async=False,
+      method=b'DELETE',
+      endpoint=b'test_topic/test_user',
+      expected_backend_method_args=[b'test_topic', b'test_user'],
       backend_method_mock=self._mock_backend.Unsubscribe,
       backend_method_return_value=4321,
       expected_response_status=4321)
@@ -480,13 +555,13 @@ class FrontendTest(unittest.TestCase):
 
   @patch('frontend.logging.info')
   @patch('frontend.logging.error')
-  def _TestUnsubscribeLogErrors(self, async, mock_log_error, mock_log_info):
+  def _TestUnsubscribeLogErrors(self, is_async, mock_log_error, mock_log_info):
     """Verify unsubscribe logs meaningful data on 500s."""
     d = self._TestEndpoint(
-      async=async,
-      method='DELETE',
-      endpoint='test_topic/test_user',
-      expected_backend_method_args=['test_topic', 'test_user'],
+      is_async=is_async,
+      method=b'DELETE',
+      endpoint=b'test_topic/test_user',
+      expected_backend_method_args=[b'test_topic', b'test_user'],
       backend_method_mock=self._mock_backend.Unsubscribe,
       backend_method_error=Exception("Except"),
       expected_response_status=500)
@@ -506,22 +581,406 @@ class FrontendTest(unittest.TestCase):
     return self._TestUnsubscribeLogErrors(False)
 
   def test_unsubscribe_logging_errors_async(self):
-    """Verify unsubscribe logs meaningful data on 500s with async backends."""
+    """Verify unsubscribe logs meaningful data on 500s with is_async backends."""
     return self._TestUnsubscribeLogErrors(True)
 
   def test_delete_bad_endpoint_long(self):
     """Verify that deleting endpoints with more than 2 '/'s is a 404."""
     return self._TestEndpoint(
-      async=False,
-      method='DELETE',
-      endpoint='test_topic/test_user/fun_for_all',
+      is_async=False,
+      method=b'DELETE',
+      endpoint=b'test_topic/test_user/fun_for_all',
       expected_response_status=404)
 
   def test_delete_bad_endpoint_short(self):
     """Verify that deleting endpoints with less than 1 '/'s is a 404."""
     return self._TestEndpoint(
-      async=False,
-      method='DELETE',
-      endpoint='test_topic',
+      is_async=False,
+      method=b'DELETE',
+      endpoint=b'test_topic',
       expected_response_status=404)
 
+
+  def test_traced_request(self):
+    """Verify a request with a trace ID records spans and echoes the ID."""
+    tracer = tracing.Configure()
+    self.addCleanup(tracing.Configure)
+    def Subscribe(topic, user):
+      self.assertEqual('t1', tracing.CurrentTraceId())
+      return 200
+    self._mock_backend.Subscribe.side_effect = Subscribe
+    request = self._CreateDummyRequest(b'POST', b'test_topic/test_user')
+    request.requestHeaders.setRawHeaders(tracing.TRACE_HEADER, [b't1'])
+    d = _RenderToDeferredStatusBody(self._pubSubResource, request)
+
+    def VerifyResult(response_status_and_body):
+      self.assertEqual(200, response_status_and_body[0])
+      self.assertEqual([b't1'], request.responseHeaders.getRawHeaders(
+          tracing.TRACE_HEADER))
+      self.assertEqual(['backend.Subscribe', 'Subscribe'],
+                       [s['name'] for s in tracer.Spans('t1')])
+      self.assertEqual(None, tracing.CurrentTraceId())
+    d.addCallback(VerifyResult)
+    return d
+
+  def test_untraced_request(self):
+    """Verify unsampled requests record nothing and set no header."""
+    tracer = tracing.Configure(sample_rate=0.0)
+    self.addCleanup(tracing.Configure)
+    self._mock_backend.Subscribe.return_value = 200
+    d = self._Request(b'POST', b'test_topic/test_user')
+
+    def VerifyResult(unused_arg):
+      self.assertEqual([], tracer.Spans())
+      self.assertFalse(self._request.responseHeaders.hasHeader(
+          tracing.TRACE_HEADER))
+    d.addCallback(VerifyResult)
+    return d
+
+  def test_postmessage_compresses(self):
+    """Verify large bodies reach the backend compressed."""
+    self._pubSubResource = PubSubResource(
+        self._mock_backend, Compressor(threshold=10))
+    self._mock_backend.PostMessage.return_value = 200
+    d = self._Request(b'POST', b'test_topic', body=b'MESSAGE' * 10)
+
+    def VerifyResult(unused_arg):
+      args, _ = self._mock_backend.PostMessage.call_args
+      self.assertIsInstance(args[1], CompressedBody)
+      self.assertEqual(b'MESSAGE' * 10, gzip.decompress(args[1]))
+    d.addCallback(VerifyResult)
+    return d
+
+  def test_postmessage_corrupt_gzip(self):
+    """Verify gzip publishes that do not inflate get a 400, unstored."""
+    request = self._CreateDummyRequest(b'POST', b'test_topic', b'not gzip')
+    request.requestHeaders.setRawHeaders(b'Content-Encoding', [b'gzip'])
+    d = _RenderToDeferredStatusBody(self._pubSubResource, request)
+
+    def VerifyResult(status_and_body):
+      self.assertEqual(400, status_and_body[0])
+      self.assertFalse(self._mock_backend.PostMessage.called)
+    d.addCallback(VerifyResult)
+    return d
+
+  def test_postmessage_gzip_bomb(self):
+    """Verify gzip publishes inflating past the size limit get a 413."""
+    self._pubSubResource = PubSubResource(
+        self._mock_backend, Compressor(max_size=1000))
+    request = self._CreateDummyRequest(
+        b'POST', b'test_topic', gzip.compress(b'\0' * 2 ** 20))
+    request.requestHeaders.setRawHeaders(b'Content-Encoding', [b'gzip'])
+    d = _RenderToDeferredStatusBody(self._pubSubResource, request)
+
+    def VerifyResult(status_and_body):
+      self.assertEqual(413, status_and_body[0])
+      self.assertFalse(self._mock_backend.PostMessage.called)
+    d.addCallback(VerifyResult)
+    return d
+
+  def test_getmessage_compressed_passthrough(self):
+    """Verify compressed bodies are sent as is to clients accepting gzip."""
+    zipped = CompressedBody(gzip.compress(b'MESSAGE'))
+    self._mock_backend.GetMessage.return_value = (200, zipped)
+    request = self._CreateDummyRequest(b'GET', b'test_topic/test_user')
+    request.requestHeaders.setRawHeaders(b'Accept-Encoding', [b'gzip'])
+    d = _RenderToDeferredStatusBody(self._pubSubResource, request)
+
+    def VerifyResult(status_and_body):
+      self.assertEqual((200, zipped), status_and_body)
+      self.assertEqual([b'gzip'], request.responseHeaders.getRawHeaders(
+          b'Content-Encoding'))
+    d.addCallback(VerifyResult)
+    return d
+
+  def test_getmessage_compressed_inflated(self):
+    """Verify compressed bodies are inflated for clients without gzip."""
+    return self._TestEndpoint(
+      is_async=False,
+      method=b'GET',
+      endpoint=b'test_topic/test_user',
+      backend_method_mock=self._mock_backend.GetMessage,
+      backend_method_return_value=(
+          200, CompressedBody(gzip.compress(b'MESSAGE'))),
+      expected_response_status=200,
+      expected_response_body=b'MESSAGE')
+
+class RateLimitTest(unittest.TestCase):
+  def setUp(self):
+    self._backend = MagicMock()
+    self._backend.PostMessage.return_value = 200
+    self._backend.GetMessage.return_value = (204, None)
+    self._limiter = RateLimiter(clock=lambda: 0)
+    self._resource = PubSubResource(self._backend, limiter=self._limiter)
+
+  def _Request(self, method, path, body=b''):
+    request = DummyRequestWithContent(path, body)
+    request.method = method
+    _Render(self._resource, request)
+    return request
+
+  def test_poll_limited(self):
+    """Verify polls over the limit get a 429 and never reach the backend."""
+    self._limiter.SetLimit('poll', 'user', rate=0.5)
+    self.assertEqual(204, self._Request(b'GET', [b'topic', b'user'])
+                     .responseCode)
+    request = self._Request(b'GET', [b'topic', b'user'])
+    self.assertEqual(429, request.responseCode)
+    self.assertEqual([b'2'],
+                     request.responseHeaders.getRawHeaders(b'Retry-After'))
+    self.assertEqual(1, self._backend.GetMessage.call_count)
+
+  def test_publish_bytes_limited(self):
+    """Verify publishes are limited by body size."""
+    self._limiter.SetLimit('bytes', 'topic', rate=10)
+    self.assertEqual(200, self._Request(b'POST', [b'topic'], b'x' * 10)
+                     .responseCode)
+    self.assertEqual(429, self._Request(b'POST', [b'topic'], b'x')
+                     .responseCode)
+    self.assertEqual(200, self._Request(b'POST', [b'other'], b'x')
+                     .responseCode)
+    self.assertEqual(2, self._backend.PostMessage.call_count)
+
+  def test_limited_requests_not_sketched(self):
+    """Verify sketches count the publishes and polls that were served."""
+    sketches = TrafficSketches(clock=lambda: 0)
+    self._resource = PubSubResource(self._backend, limiter=self._limiter,
+                                    sketches=sketches)
+    self._limiter.SetLimit('publish', 'topic', rate=1)
+    self._Request(b'POST', [b'topic'], b'x' * 10)
+    self._Request(b'POST', [b'topic'], b'x' * 10)
+    self._Request(b'GET', [b'topic', b'user'])
+    current = sketches.Export()['current']
+    self.assertEqual((1, 1, 10), (current['publishes'], current['polls'],
+                                  current['published_bytes']))
+    self.assertIn(b'sketches', self._resource.AdminResources())
+
+  def test_publisher_forwarded(self):
+    """Verify the publisher is current in the backend, and trusted if said."""
+    publishers = []
+    self._backend.PostMessage.side_effect = (
+        lambda *args: publishers.append(CurrentPublisher()) or 200)
+    for trust in (False, True):
+      sketches = TrafficSketches(clock=lambda: 0)
+      self._resource = PubSubResource(self._backend, sketches=sketches,
+                                      trust_forwarded_for=trust)
+      request = DummyRequestWithContent([b'topic'], b'x')
+      request.method = b'POST'
+      request.getClientAddress = lambda: IPv4Address('TCP', '10.0.0.1', 80)
+      request.requestHeaders.setRawHeaders(b'X-Forwarded-For',
+                                           [b'10.0.0.9, 10.0.0.1'])
+      _Render(self._resource, request)
+      self.assertEqual(1, sketches.Export()['current']['publishes'])
+    self.assertEqual([b'10.0.0.1', b'10.0.0.9'], publishers)
+    self.assertEqual(None, CurrentPublisher())
+
+class TopicVersionTest(unittest.TestCase):
+  def test_versioned_backend(self):
+    """Verify polls and publishes carry the backend's topic version."""
+    backend = MemoryBackend()
+    backend.Subscribe(b'topic', b'user')
+    resource = PubSubResource(backend)
+    request = DummyRequest([b'topic', b'user'])
+    request.method = b'GET'
+    _Render(resource, request)
+    self.assertEqual(204, request.responseCode)
+    self.assertEqual([backend.TopicVersion(b'topic')],
+                     request.responseHeaders.getRawHeaders(b'X-Topic-Version'))
+    request = DummyRequestWithContent([b'topic'], b'message')
+    request.method = b'POST'
+    _Render(resource, request)
+    version = request.responseHeaders.getRawHeaders(b'X-Topic-Version')[0]
+    self.assertTrue(version.endswith(b'-1'))
+
+class PacingTest(unittest.TestCase):
+  def setUp(self):
+    self._now = 1000.0
+    self._backend = MemoryBackend(clock=lambda: self._now)
+    for topic in (b'hot', b'cold'):
+      self._backend.Subscribe(topic, b'user')
+    # 10 publishes a second.
+    for _ in range(100):
+      self._now += 0.1
+      self._backend.PostMessage(b'hot', b'm')
+      self._backend.GetMessage(b'hot', b'user')
+    self._resource = PubSubResource(self._backend,
+                                    pacer=PollPacer(max_wait=5.0))
+
+  def _Poll(self, topic):
+    request = DummyRequest([topic, b'user'])
+    request.method = b'GET'
+    _Render(self._resource, request)
+    return request.responseCode or 200, request.responseHeaders
+
+  def test_empty_polls_paced(self):
+    """Verify 204s ask for waits following the topic's rate."""
+    status, headers = self._Poll(b'hot')
+    self.assertEqual(204, status)
+    self.assertTrue(95 <= int(headers.getRawHeaders(b'X-Poll-After')[0]) <= 105)
+    self.assertFalse(headers.hasHeader(b'Retry-After'))
+    status, headers = self._Poll(b'cold')
+    self.assertEqual((b'0.000', [b'5000'], [b'5']), (
+        headers.getRawHeaders(b'X-Topic-Rate')[0],
+        headers.getRawHeaders(b'X-Poll-After'),
+        headers.getRawHeaders(b'Retry-After')))
+    self.assertIn(b'pacing', self._resource.AdminResources())
+
+  def test_messages_not_paced(self):
+    """Verify polls that got a message carry the hint, but no wait."""
+    self._backend.PostMessage(b'cold', b'm')
+    status, headers = self._Poll(b'cold')
+    self.assertEqual(200, status)
+    self.assertTrue(headers.hasHeader(b'X-Backend-Poll-Rate'))
+    self.assertFalse(headers.hasHeader(b'X-Poll-After'))
+
+  def test_unpaced(self):
+    """Verify there are no waits without a pacer, or for patterns."""
+    self._resource = PubSubResource(self._backend)
+    self.assertFalse(self._Poll(b'cold')[1].hasHeader(b'X-Poll-After'))
+    self._resource = PubSubResource(self._backend, pacer=PollPacer())
+    self._backend.Subscribe(b'cold.#', b'user')
+    headers = self._Poll(b'cold.#')[1]
+    self.assertFalse(headers.hasHeader(b'X-Topic-Rate'))
+    self.assertFalse(headers.hasHeader(b'X-Poll-After'))
+
+class OffsetTest(unittest.TestCase):
+  """Offset reads and commits, see offsets.py, over a MemoryBackend."""
+
+  def setUp(self):
+    self._backend = MemoryBackend()
+    self._backend.Subscribe(b'topic', b'user')
+    for body in (b'first', b'second'):
+      self._backend.PostMessage(b'topic', body)
+    self._resource = PubSubResource(self._backend)
+
+  def _Request(self, method, args):
+    request = DummyRequest([b'topic', b'user'])
+    request.method = method
+    request.args = args
+    _Render(self._resource, request)
+    return request.responseCode or 200, b''.join(request.written), request
+
+  def test_poll_seq(self):
+    """Verify polls carry the message's seq."""
+    _, body, request = self._Request(b'GET', {})
+    self.assertEqual((b'first', [b'1']), (
+        body, request.responseHeaders.getRawHeaders(b'X-Message-Seq')))
+
+  def test_read_and_commit(self):
+    """Verify reads return JSON ranges, and commits take what was read."""
+    status, body, request = self._Request(b'GET', {b'offset': [b'0'],
+                                                   b'limit': [b'1']})
+    self.assertEqual((200, ([(1, b'first')], 2)), (status, DecodeRange(body)))
+    self.assertEqual([b'application/json'],
+                     request.responseHeaders.getRawHeaders(b'Content-Type'))
+    self.assertEqual(200, self._Request(b'POST', {b'commit': [b'1']})[0])
+    status, body, _ = self._Request(b'GET', {b'offset': [b'0']})
+    self.assertEqual([(2, b'second')], DecodeRange(body)[0])
+    self.assertEqual((204, b''), self._Request(b'GET',
+                                               {b'offset': [b'3']})[:2])
+
+  def test_bad_args(self):
+    """Verify malformed offsets, limits and seqs are 400s."""
+    for method, args in ((b'GET', {b'offset': [b'x']}),
+                         (b'GET', {b'offset': [b'0'], b'limit': [b'0']}),
+                         (b'POST', {b'commit': [b'-1']})):
+      self.assertEqual(400, self._Request(method, args)[0])
+    self.assertEqual(2, self._backend.Backlog()['messages'])
+
+class IdempotencyKeyTest(unittest.TestCase):
+  def _Post(self, resource, key):
+    request = DummyRequestWithContent([b'topic'], b'message')
+    request.method = b'POST'
+    request.requestHeaders.setRawHeaders(b'Idempotency-Key', [key])
+    _Render(resource, request)
+    return request.responseCode
+
+  def test_retries_stored_once(self):
+    """Verify a publish retried with its key is acknowledged, stored once."""
+    backend = MemoryBackend()
+    backend.Subscribe(b'topic', b'user')
+    resource = PubSubResource(backend)
+    self.assertEqual([200, 200, 200], [self._Post(resource, key)
+                                       for key in (b'k1', b'k1', b'k2')])
+    self.assertEqual(2, len(backend.GetTopic(b'topic').messages))
+
+  def test_key_length(self):
+    """Verify empty and overlong keys are rejected before the backend."""
+    backend = MagicMock()
+    resource = PubSubResource(backend)
+    self.assertEqual(400, self._Post(resource, b''))
+    self.assertEqual(400, self._Post(resource, b'k' * 257))
+    self.assertFalse(backend.PostMessage.called)
+
+class BodyBufferTest(unittest.TestCase):
+  def test_single_copy(self):
+    """Verify the chunks are joined once and read back without copying."""
+    content = _BodyBuffer()
+    content.write(b'abc')
+    content.write(b'def')
+    self.assertEqual(6, content.tell())
+    content.seek(0, 0)
+    body = content.read()
+    self.assertEqual(b'abcdef', body)
+    self.assertEqual(b'', content.read())
+    content.seek(2)
+    self.assertEqual(b'cd', content.read(2))
+    content.seek(0)
+    self.assertIs(body, content.read())
+
+class PubSubSiteTest(unittest.TestCase):
+  def setUp(self):
+    self._mock_backend = MagicMock()
+    self._mock_backend.PostMessage.return_value = 200
+    site = PubSubSite(PubSubResource(self._mock_backend), max_message_size=10,
+                      timeout=None)
+    self._channel = site.buildProtocol(None)
+    self._transport = StringTransport()
+    self._channel.makeConnection(self._transport)
+
+  def _Post(self, body, headers=b''):
+    self._channel.dataReceived(
+        b'POST /topic HTTP/1.1\r\nHost: x\r\n' + headers + b'\r\n' + body)
+
+  def test_body_within_limit(self):
+    """Verify bodies up to the limit are published intact."""
+    self._Post(b'0123456789', b'Content-Length: 10\r\n')
+    self._mock_backend.PostMessage.assert_called_with(b'topic', b'0123456789')
+    self.assertIn(b' 200 ', self._transport.value())
+
+  def test_oversized_content_length(self):
+    """Verify a too large Content-Length gets a 413 before the body is read."""
+    self._Post(b'', b'Content-Length: 11\r\nExpect: 100-continue\r\n')
+    response = self._transport.value()
+    self.assertTrue(response.startswith(b'HTTP/1.1 413 '))
+    self.assertNotIn(b'100 Continue', response)
+    self.assertTrue(self._transport.disconnecting)
+    self._channel.dataReceived(b'0123456789A')
+    self.assertFalse(self._mock_backend.PostMessage.called)
+
+  def test_oversized_chunked_body(self):
+    """Verify a chunked body is refused once it grows past the limit."""
+    self._Post(b'6\r\n012345\r\n6\r\n6789AB\r\n0\r\n\r\n',
+               b'Transfer-Encoding: chunked\r\n')
+    self.assertTrue(self._transport.value().startswith(b'HTTP/1.1 413 '))
+    self.assertFalse(self._mock_backend.PostMessage.called)
+
+  def test_capture(self):
+    """Verify finished requests are recorded while a capture is on."""
+    path = self.mktemp()
+    capture = TrafficCapture()
+    self._channel.site.capture = capture
+    self._Post(b'01234', b'Content-Length: 5\r\n')
+    capture.Start(MagicMock())
+    capture.Begin(path)
+    self._Post(b'0123456789', b'Content-Length: 10\r\n')
+    self._mock_backend.GetMessage.return_value = (200, b'abc')
+    self._channel.dataReceived(b'GET /topic/user HTTP/1.1\r\nHost: x\r\n\r\n')
+    self._Post(b'', b'Content-Length: 11\r\n')
+    capture.End()
+    with open(path, 'rb') as f:
+      requests = list(ReadCapture(f)[2])
+    self.assertEqual([(PUBLISH, b'topic', b'', 200, 10),
+                      (POLL, b'topic', b'user', 200, 3)],
+                     [(r.op, r.topic, r.user, r.status, r.size)
+                      for r in requests])
@@ -0,0 +1,103 @@
+import gc
+import json
+
+from gcpauses import GcMonitor
+from gcpauses import GcResource
+from gcpauses import ParseThresholds
+
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+from twisted.web.test.test_web import DummyRequest
+
+class _Cycle(object):
+  def __init__(self):
+    self.me = self
+
+class GcMonitorTest(unittest.TestCase):
+  def setUp(self):
+    self._thresholds = gc.get_threshold()
+    self._clock = Clock()
+
+  def tearDown(self):
+    gc.unfreeze()
+    gc.set_threshold(*self._thresholds)
+
+  def _Monitor(self, **kwargs):
+    monitor = GcMonitor(**kwargs)
+    monitor.Start(self._clock)
+    self.addCleanup(monitor.Stop)
+    return monitor
+
+  def test_pauses_timed(self):
+    """Verify collections are timed and counted per generation."""
+    monitor = self._Monitor()
+    for _ in range(10):
+      _Cycle()
+    gc.collect(0)
+    gc.collect()
+    stats = monitor.Stats()
+    young, full = stats['generations'][0], stats['generations'][2]
+    self.assertTrue(young['collections'] >= 1)
+    self.assertEqual(1, full['collections'])
+    self.assertTrue(young['collected'] + full['collected'] >= 10)
+    self.assertTrue(0 < full['max_pause_ms'] == full['p99_pause_ms'])
+    monitor.Stop()
+    self.assertNotIn(monitor._Callback, gc.callbacks)
+
+  def test_thresholds_and_freeze(self):
+    """Verify thresholds are set in part, and the heap frozen and thawed."""
+    self.assertEqual((500, 20), ParseThresholds('500,20'))
+    for bad in ('x', '1,2,3,4', '-1'):
+      self.assertRaises(ValueError, ParseThresholds, bad)
+    monitor = self._Monitor(thresholds=(500,), freeze=True)
+    self.assertEqual((500,) + self._thresholds[1:], gc.get_threshold())
+    self.assertTrue(monitor.Stats()['frozen'] > 0)
+    monitor.Unfreeze()
+    self.assertEqual(0, gc.get_freeze_count())
+
+  def test_collects_when_idle(self):
+    """Verify full collections wait for an idle check, then run."""
+    monitor = self._Monitor(thresholds=(1000000,), idle_collect=1,
+                            idle_interval=0.25, idle_allocations=1 << 30)
+    self.assertTrue(gc.get_threshold()[2] >= 1 << 30)
+    for _ in range(3):
+      self._clock.advance(0.25)
+    self.assertEqual(0, monitor.Stats()['generations'][2]['collections'])
+    self._clock.advance(0.25)
+    stats = monitor.Stats()
+    self.assertEqual((1, 1), (stats.get('idle_collections'),
+                              stats['generations'][2]['collections']))
+    monitor.CollectWhenIdle(0)
+    self.assertEqual(self._thresholds[2], gc.get_threshold()[2])
+
+  def test_forced_when_busy(self):
+    """Verify a busy reactor still gets a full collection, later."""
+    monitor = self._Monitor(idle_collect=1, idle_interval=0.25,
+                            idle_allocations=0)
+    monitor.SetThresholds(700, 10, 5)
+    self.assertTrue(gc.get_threshold()[2] >= 1 << 30)
+    for _ in range(15):
+      self._clock.advance(0.25)
+    self.assertEqual(0, monitor.Stats().get('forced_collections', 0))
+    self._clock.advance(0.25)
+    self.assertEqual(1, monitor.Stats()['forced_collections'])
+    monitor.Stop()
+    self.assertEqual((700, 10, 5), gc.get_threshold())
+
+  def test_resource(self):
+    """Verify the admin endpoint reports and tunes."""
+    monitor = self._Monitor()
+    resource = GcResource(monitor)
+    request = DummyRequest([])
+    request.method = b'POST'
+    request.args = {b'threshold': [b'900,15'], b'collect': [b'1']}
+    stats = json.loads(resource.render(request))
+    self.assertEqual([900, 15], stats['thresholds'][:2])
+    self.assertEqual(1, stats['manual_collections'])
+    for args in ({b'collect': [b'3']}, {b'threshold': [b'x']},
+                 {b'idle_collect': [b'-1']}):
+      request = DummyRequest([])
+      request.method = b'POST'
+      request.args = args
+      resource.render(request)
+      self.assertEqual(400, request.responseCode)
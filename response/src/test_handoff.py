@@ -0,0 +1,103 @@
+import os
+import socket
+
+import client
+import handoff
+
+from backends.memory import MemoryBackend
+from frontend import PubSubResource
+from frontend import PubSubSite
+
+from mock import MagicMock
+
+from twisted.internet import reactor
+from twisted.internet import threads
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.task import deferLater
+from twisted.trial import unittest
+
+class HandoffTest(unittest.TestCase):
+  """Hands a real listening socket and state between two backends."""
+
+  def setUp(self):
+    self._path = os.path.abspath(self.mktemp())
+    self._old_backend = MemoryBackend()
+    self._old_site = PubSubSite(PubSubResource(self._old_backend))
+    self._listening = reactor.listenTCP(0, self._old_site,
+                                        interface='127.0.0.1')
+    self._host = '127.0.0.1:%d' % self._listening.getHost().port
+    self._component = MagicMock()
+    self._old = handoff.Handoff(self._old_backend, self._path, drain=0,
+                                components=[self._component])
+    self._old._Exit = MagicMock()
+    self._old.Start(reactor)
+    self._old.Serving(self._old_site, self._listening, None)
+
+  @inlineCallbacks
+  def tearDown(self):
+    # Left listening unless the test handed over.
+    if self._listening.connected:
+      yield self._listening.stopListening()
+    if self._old._port.connected:
+      yield self._old._port.stopListening()
+
+  @inlineCallbacks
+  def test_handoff(self):
+    """Verify the new backend gets the socket and state, then serves."""
+    self._old_backend.Subscribe(b'topic', b'a')
+    self._old_backend.Subscribe(b'topic', b'b')
+    self._old_backend.PostMessage(b'topic', b'first')
+    self._old_backend.PostMessage(b'topic', b'second')
+    self._old_backend.GetMessage(b'topic', b'a')
+    pooled = client.PubSubClient(self._host)
+    self.addCleanup(pooled.Close)
+    self.assertEqual(200, (yield pooled.Subscribe(b'other', b'user')))
+
+    new_backend = MemoryBackend()
+    new = handoff.Handoff(new_backend, self._path)
+    fd = yield threads.deferToThread(new.Receive)
+    self.assertTrue(new.received)
+    self.assertEqual(2, new.Stats()['received_messages'])
+    self._component.Stop.assert_called_with()
+    self._component.Flush.assert_called_with()
+
+    # The kept-alive connection to the old process is turned away.
+    self.assertEqual((503, b''), (yield pooled.Poll(b'topic', b'b')))
+    yield deferLater(reactor, 0.01, lambda: None)
+    self.assertTrue(self._old._Exit.called)
+    self.assertEqual(self._old.Stats()['sent_bytes'],
+                     new.Stats()['received_bytes'])
+
+    # Connections made meanwhile wait for the new process to accept them.
+    fresh = client.PubSubClient(self._host)
+    self.addCleanup(fresh.Close)
+    poll = fresh.Poll(b'topic', b'b')
+    yield deferLater(reactor, 0.05, lambda: None)
+    self.assertNoResult(poll)
+    new_site = PubSubSite(PubSubResource(new_backend))
+    adopted = reactor.adoptStreamPort(fd, socket.AF_INET, new_site)
+    os.close(fd)
+    self.addCleanup(adopted.stopListening)
+    new.Serving(new_site, adopted, None)
+    self.assertEqual((200, b'first'), (yield poll))
+    self.assertEqual((200, b'second'), (yield fresh.Poll(b'topic', b'a')))
+    self.assertEqual((204, b''), (yield fresh.Poll(b'other', b'user')))
+    self.assertTrue(new.Stats()['unavailable_ms'] > 0)
+
+  def test_nothing_to_take_over(self):
+    """Verify Receive returns None without a process to take over from."""
+    new = handoff.Handoff(MemoryBackend(), self._path + '.missing')
+    self.assertEqual(None, new.Receive())
+    self.assertFalse(new.received)
+
+  @inlineCallbacks
+  def test_failed_state(self):
+    """Verify the socket is still taken when the state does not arrive."""
+    self._old_backend.WriteSnapshot = MagicMock(side_effect=IOError('disk'))
+    new_backend = MemoryBackend()
+    new_backend.Subscribe(b'kept', b'user')
+    new = handoff.Handoff(new_backend, self._path)
+    fd = yield threads.deferToThread(new.Receive)
+    os.close(fd)
+    self.assertFalse(new.received)
+    self.assertEqual(200, new_backend.Unsubscribe(b'kept', b'user'))
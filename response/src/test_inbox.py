@@ -0,0 +1,41 @@
+import json
+
+from compression import CompressedBody
+from inbox import DecodeInbox
+from inbox import EncodeInbox
+from inbox import IsPeek
+from inbox import ParseLimit
+
+from twisted.trial import unittest
+
+class InboxFormatTest(unittest.TestCase):
+  def test_round_trip(self):
+    """Verify topics and bodies of any bytes survive, as does gzip."""
+    messages = [(b'caf\xc3\xa9', b'\x00\xff'), (b'\xff', CompressedBody(b'z'))]
+    data = EncodeInbox(messages, True)
+    self.assertEqual('café', json.loads(data)['messages'][0]['topic'])
+    decoded, partial = DecodeInbox(data)
+    self.assertEqual((messages, True), (decoded, partial))
+    self.assertIsInstance(decoded[1][1], CompressedBody)
+    self.assertEqual(([], False), DecodeInbox(b''))
+
+  def test_peeked_seqs(self):
+    """Verify peeked messages keep their seqs."""
+    messages = [(b't', b'a', 3), (b'u', CompressedBody(b'z'), 1)]
+    self.assertEqual((messages, False),
+                     DecodeInbox(EncodeInbox(messages, False)))
+
+  def test_for_response(self):
+    """Verify bodies are prepared for the client as given."""
+    data = EncodeInbox([(b't', CompressedBody(b'z'))], False,
+                       lambda body: (b'inflated', None))
+    self.assertEqual([(b't', b'inflated')], DecodeInbox(data)[0])
+
+  def test_parse_limit(self):
+    """Verify limits default, and must be from 1 to MAX_LIMIT."""
+    self.assertEqual(100, ParseLimit({}))
+    self.assertEqual(7, ParseLimit({b'limit': [b'7']}))
+    for bad in (b'0', b'1001', b'-1', b'x'):
+      self.assertEqual(None, ParseLimit({b'limit': [bad]}))
+    self.assertTrue(IsPeek({b'peek': [b'1']}))
+    self.assertFalse(IsPeek({b'limit': [b'1']}))
@@ -0,0 +1,86 @@
+import maintenance
+
+from maintenance import Maintenance
+from maintenance import StallMonitor
+
+from twisted.internet.defer import Deferred
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+
+class MaintenanceTest(unittest.TestCase):
+  def setUp(self):
+    self._clock = Clock()
+    # No budget: one step per reactor iteration.
+    self._maintenance = Maintenance(budget=0)
+    self._steps = []
+
+  def _Job(self, name, steps):
+    for i in range(steps):
+      self._steps.append((name, i))
+      yield
+
+  def test_inline_before_start(self):
+    """Verify jobs run to completion at once before Start."""
+    self._maintenance.Run(self._Job('a', 3), 'a')
+    self.assertEqual([('a', 0), ('a', 1), ('a', 2)], self._steps)
+    self.assertEqual(1, self._maintenance.Stats()['finished.a'])
+
+  def test_sliced(self):
+    """Verify started jobs run later, taking turns a step per slice."""
+    self._maintenance.Start(self._clock)
+    self._maintenance.Run(self._Job('a', 2), 'a')
+    self._maintenance.Run(self._Job('b', 2), 'b')
+    self.assertEqual([], self._steps)
+    self.assertEqual(2, self._maintenance.Stats()['running'])
+    self._clock.advance(0)
+    self.assertEqual([('a', 0), ('b', 0), ('a', 1), ('b', 1)], self._steps)
+    stats = self._maintenance.Stats()
+    self.assertEqual(0, stats['running'])
+    self.assertEqual(4, stats['steps'])
+    self.assertTrue(stats['slices'] >= 4)
+    self.assertEqual(1, stats['finished.b'])
+
+  def test_every_skips_while_running(self):
+    """Verify a periodic job never overlaps its previous run."""
+    waiting = Deferred()
+
+    def Job():
+      self._steps.append('run')
+      yield waiting  # The job is paused until it fires.
+    self._maintenance.Every(1, Job, 'p')
+    self._maintenance.Start(self._clock)
+    self._clock.advance(1)
+    self._clock.advance(1)
+    self.assertEqual(['run'], self._steps)
+    waiting.callback(None)
+    self._clock.advance(0)
+    self._clock.advance(1)
+    self.assertEqual(['run', 'run'], self._steps)
+    self.assertEqual(2, self._maintenance.Stats()['started.p'])
+
+  def test_stop(self):
+    """Verify Stop pauses jobs and periodic jobs."""
+    self._maintenance.Every(1, lambda: self._Job('p', 1), 'p')
+    self._maintenance.Start(self._clock)
+    self._maintenance.Run(self._Job('a', 2), 'a')
+    self._maintenance.Stop()
+    for _ in range(3):
+      self._clock.advance(1)
+    self.assertEqual([], self._steps)
+
+class StallMonitorTest(unittest.TestCase):
+  def test_stall(self):
+    """Verify a timer running late is counted as a stall."""
+    clock = Clock()
+    now = [100.0]
+    monitor = StallMonitor(interval=0.01, threshold=0.05)
+    self.patch(maintenance.time, 'time', lambda: now[0])
+    monitor.Start(clock)
+    now[0] += 0.01
+    clock.advance(0.01)
+    now[0] += 0.2  # The reactor was busy.
+    clock.advance(0.01)
+    stats = monitor.Stats()
+    self.assertEqual(2, stats['checks'])
+    self.assertEqual(1, stats['stalls'])
+    self.assertTrue(150 < stats['max_stall_ms'] < 250)
@@ -0,0 +1,37 @@
+import json
+
+from compression import CompressedBody
+from offsets import DecodeRange
+from offsets import EncodeRange
+from offsets import ParseCommit
+from offsets import ParseRead
+
+from twisted.trial import unittest
+
+class RangeFormatTest(unittest.TestCase):
+  def test_round_trip(self):
+    """Verify seqs and bodies of any bytes survive, as does gzip."""
+    messages = [(3, b'\x00\xff'), (7, CompressedBody(b'z'))]
+    data = EncodeRange(messages, 8)
+    self.assertEqual(8, json.loads(data)['next'])
+    decoded, next_offset = DecodeRange(data)
+    self.assertEqual((messages, 8), (decoded, next_offset))
+    self.assertIsInstance(decoded[1][1], CompressedBody)
+    self.assertEqual(([], None), DecodeRange(b''))
+
+  def test_for_response(self):
+    """Verify bodies are prepared for the client as given."""
+    data = EncodeRange([(1, CompressedBody(b'z'))], 2,
+                       lambda body: (b'inflated', None))
+    self.assertEqual([(1, b'inflated')], DecodeRange(data)[0])
+
+  def test_parse(self):
+    """Verify offsets and seqs must be numbers, and limits in range."""
+    self.assertEqual((5, 100), ParseRead({b'offset': [b'5']}))
+    self.assertEqual((0, 7), ParseRead({b'offset': [b'0'],
+                                        b'limit': [b'7']}))
+    for bad in ({b'offset': [b'x']}, {b'offset': [b'-1']},
+                {b'offset': [b'1'], b'limit': [b'1001']}):
+      self.assertEqual(None, ParseRead(bad))
+    self.assertEqual(9, ParseCommit({b'commit': [b'9']}))
+    self.assertEqual(None, ParseCommit({b'commit': [b'']}))
@@ -0,0 +1,69 @@
+import math
+
+from pacing import ParseRate
+from pacing import PollPacer
+from pacing import RateMeter
+
+from twisted.trial import unittest
+from twisted.web.test.test_web import DummyRequest
+
+class RateMeterTest(unittest.TestCase):
+  def test_steady_rate(self):
+    """Verify a steady rate averages out to itself, and then decays."""
+    meter = RateMeter()
+    self.assertEqual(0.0, meter.Rate(0))
+    for i in range(1000):
+      meter.Add(i * 0.1)
+    self.assertTrue(9.5 < meter.Rate(100) < 10.5)
+    self.assertAlmostEqual(meter.Rate(100) / math.e, meter.Rate(110),
+                           places=3)
+
+  def test_new_meter(self):
+    """Verify a meter that has only just seen events does not undercount."""
+    meter = RateMeter()
+    for i in range(20):
+      meter.Add(i * 0.1)
+    self.assertTrue(9 < meter.Rate(2.0) < 11)
+    meter = RateMeter()
+    meter.Add(0, count=10, tau=5.0)
+    self.assertTrue(9 < meter.Rate(0, tau=5.0) < 12)
+
+  def test_parse(self):
+    """Verify rates are non-negative numbers."""
+    self.assertEqual(1.5, ParseRate(b'1.500'))
+    for bad in (None, b'', b'x', b'-1'):
+      self.assertEqual(None, ParseRate(bad))
+
+class PollPacerTest(unittest.TestCase):
+  def test_wait(self):
+    """Verify waits follow the topic's rate, up to the maximum."""
+    pacer = PollPacer(max_wait=5.0)
+    self.assertEqual(0.01, pacer.Wait(100.0, 1e6))
+    self.assertEqual(2.0, pacer.Wait(0.5, 0))
+    self.assertEqual(5.0, pacer.Wait(0.01, 0))
+    self.assertEqual(5.0, pacer.Wait(0.0, 0))
+
+  def test_overloaded(self):
+    """Verify waits stretch while the backend is over its poll capacity."""
+    pacer = PollPacer(max_wait=5.0, poll_capacity=1000)
+    self.assertEqual(0.01, pacer.Wait(100.0, 1000))
+    self.assertEqual(0.04, pacer.Wait(100.0, 4000))
+    self.assertEqual(5.0, pacer.Wait(0.5, 4000))
+    self.assertEqual(2, pacer.Stats()['overloaded'])
+
+  def test_pace(self):
+    """Verify 204s say how long to wait, and long waits add Retry-After."""
+    pacer = PollPacer(max_wait=5.0)
+    request = DummyRequest([b'topic', b'user'])
+    pacer.Pace(request, 100.0, 0)
+    self.assertEqual([b'10'],
+                     request.responseHeaders.getRawHeaders(b'X-Poll-After'))
+    self.assertFalse(request.responseHeaders.hasHeader(b'Retry-After'))
+    request = DummyRequest([b'topic', b'user'])
+    pacer.Pace(request, 0.4, 0)
+    self.assertEqual([b'2500'],
+                     request.responseHeaders.getRawHeaders(b'X-Poll-After'))
+    self.assertEqual([b'3'],
+                     request.responseHeaders.getRawHeaders(b'Retry-After'))
+    self.assertEqual((2, 1), (pacer.Stats()['paced'],
+                              pacer.Stats()['retry_after']))
@@ -0,0 +1,46 @@
+from patterns import IsPattern
+from patterns import PatternIndex
+
+from twisted.trial import unittest
+
+class PatternsTest(unittest.TestCase):
+  def setUp(self):
+    self._index = PatternIndex()
+    for pattern in (b'orders.*', b'orders.#', b'*.created', b'#',
+                    b'orders.*.shipped', b'a.#.z'):
+      self._index.Add(pattern)
+
+  def _Match(self, topic):
+    return sorted(self._index.Match(topic))
+
+  def test_is_pattern(self):
+    """Verify only whole wildcard segments make a pattern."""
+    self.assertTrue(IsPattern(b'orders.*'))
+    self.assertTrue(IsPattern(b'#'))
+    self.assertFalse(IsPattern(b'orders'))
+    self.assertFalse(IsPattern(b'orders.a*'))
+
+  def test_match(self):
+    """Verify * matches one segment and # any number."""
+    self.assertEqual([b'#', b'orders.#'], self._Match(b'orders'))
+    self.assertEqual([b'#', b'*.created', b'orders.#', b'orders.*'],
+                     self._Match(b'orders.created'))
+    self.assertEqual([b'#', b'orders.#', b'orders.*.shipped'],
+                     self._Match(b'orders.eu.shipped'))
+    self.assertEqual([b'#', b'a.#.z'], self._Match(b'a.z'))
+    self.assertEqual([b'#', b'a.#.z'], self._Match(b'a.b.c.z'))
+    self.assertEqual([b'#'], self._Match(b'a.b.c'))
+
+  def test_remove(self):
+    """Verify removed patterns stop matching and the trie is pruned."""
+    self.assertEqual(6, len(self._index))
+    self._Match(b'orders.created')
+    self._index.Remove(b'#')
+    self._index.Remove(b'orders.*.shipped')
+    self._index.Remove(b'not.there')
+    self.assertEqual(4, len(self._index))
+    self.assertEqual([b'*.created', b'orders.#', b'orders.*'],
+                     self._Match(b'orders.created'))
+    self.assertEqual([b'orders.#'], self._Match(b'orders.eu.shipped'))
+    self.assertEqual(sorted([b'orders.*', b'orders.#', b'*.created', b'a.#.z']),
+                     sorted(self._index))
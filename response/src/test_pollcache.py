@@ -0,0 +1,78 @@
+from pollcache import ParseVersion
+from pollcache import PollCache
+
+from twisted.trial import unittest
+
+class PollCacheTest(unittest.TestCase):
+  def setUp(self):
+    self._now = 100.0
+    self._cache = PollCache(ttl=1.0, max_entries=2, clock=lambda: self._now)
+
+  def test_parse_version(self):
+    """Verify versions parse and garbage is ignored."""
+    self.assertEqual((b'ab-cd', 12), ParseVersion(b'ab-cd-12'))
+    self.assertEqual(None, ParseVersion(None))
+    self.assertEqual(None, ParseVersion(b'12'))
+    self.assertEqual(None, ParseVersion(b'e-x'))
+
+  def test_hit_until_version_moves(self):
+    """Verify a newer version of the topic invalidates the cached 204."""
+    self.assertFalse(self._cache.Lookup(b't', b'u'))
+    self._cache.Store(b't', b'u', b'e-3')
+    self.assertTrue(self._cache.Lookup(b't', b'u'))
+    self._cache.Observe(b't', b'e-2')  # Older responses change nothing.
+    self.assertTrue(self._cache.Lookup(b't', b'u'))
+    self._cache.Observe(b't', b'e-4')
+    self.assertFalse(self._cache.Lookup(b't', b'u'))
+    self.assertFalse(self._cache.Lookup(b't', b'u'))
+    stats = self._cache.Stats()
+    self.assertEqual((2, 2, 1), (stats['hits'], stats['misses'], stats['stale']))
+    self.assertEqual(0.4, stats['hit_rate'])
+
+  def test_out_of_order_store(self):
+    """Verify a 204 older than a version already seen is never served."""
+    self._cache.Observe(b't', b'e-5')
+    self._cache.Store(b't', b'u', b'e-4')
+    self.assertFalse(self._cache.Lookup(b't', b'u'))
+
+  def test_epochs_tracked_separately(self):
+    """Verify partitions on different backends do not invalidate each other."""
+    self._cache.Store(b't', b'u1', b'a-1')
+    self._cache.Store(b't', b'u2', b'b-7')
+    self._cache.Observe(b't', b'b-8')
+    self.assertTrue(self._cache.Lookup(b't', b'u1'))
+    self.assertFalse(self._cache.Lookup(b't', b'u2'))
+
+  def test_ttl_and_eviction(self):
+    """Verify entries expire after the TTL and the oldest are evicted."""
+    self._cache.Store(b't', b'u1', b'e-1')
+    self._now += 1.0
+    self.assertFalse(self._cache.Lookup(b't', b'u1'))
+    self.assertEqual(1, self._cache.Stats()['expired'])
+    for user in (b'u1', b'u2', b'u3'):
+      self._cache.Store(b't', user, b'e-1')
+    self.assertFalse(self._cache.Lookup(b't', b'u1'))
+    self.assertTrue(self._cache.Lookup(b't', b'u3'))
+    self.assertEqual(1, self._cache.Stats()['evicted'])
+
+  def test_versions_bounded(self):
+    """Verify versions are kept for the newest epochs and topics only."""
+    cache = PollCache(max_entries=2, max_epochs=2)
+    cache.Store(b't', b'u', b'old-3')
+    cache.Observe(b't', b'a-1')
+    cache.Observe(b't', b'b-1')
+    self.assertEqual([b'a', b'b'], list(cache._versions[b't']))
+    self.assertFalse(cache.Lookup(b't', b'u'))
+    for topic in (b't1', b't2', b't3'):
+      cache.Observe(topic, b'e-1')
+    self.assertEqual([b't2', b't3'], list(cache._versions))
+    self.assertEqual((2, 2), (cache.Stats()['topics'],
+                              cache.Stats()['versions_evicted']))
+
+  def test_forget_and_unversioned(self):
+    """Verify Forget drops an entry and unversioned 204s are not cached."""
+    self._cache.Store(b't', b'u', b'e-1')
+    self._cache.Forget(b't', b'u')
+    self.assertFalse(self._cache.Lookup(b't', b'u'))
+    self._cache.Store(b't', b'u', None)
+    self.assertFalse(self._cache.Lookup(b't', b'u'))
@@ -0,0 +1,121 @@
+import marshal
+import time
+
+import profiling
+
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+from twisted.web.test.test_web import DummyRequest
+
+def _Busy(seconds):
+  """Burns CPU on the calling thread so profilers have something to see."""
+  end = time.time() + seconds
+  while time.time() < end:
+    sum(range(100))
+
+class CpuProfilerTest(unittest.TestCase):
+  def setUp(self):
+    self._clock = Clock()
+    self._profiler = profiling.CpuProfiler(clock=self._clock, interval=0.001)
+
+  def test_cprofile_session_ends_after_seconds(self):
+    """Verify a cprofile session stops itself and produces pstats data."""
+    self.assertTrue(self._profiler.Start('cprofile', 5))
+    self.assertFalse(self._profiler.Start('cprofile', 5))
+    _Busy(0.01)
+    self._clock.advance(5)
+    self.assertFalse(self._profiler.Running())
+    stats = marshal.loads(self._profiler.Result('pstats'))
+    self.assertIn('_Busy', [func for _, _, func in stats])
+    self.assertIn(b'_Busy', self._profiler.Result('text'))
+    self.assertRaises(ValueError, self._profiler.Result, 'collapsed')
+
+  def test_sample_session(self):
+    """Verify sample mode collects collapsed stacks of the calling thread."""
+    self.assertTrue(self._profiler.Start('sample', 5))
+    _Busy(0.05)
+    self.assertTrue(self._profiler.Stop())
+    self.assertFalse(self._profiler.Stop())
+    self.assertEqual([], self._clock.getDelayedCalls())
+    collapsed = self._profiler.Result('collapsed')
+    self.assertIn(b'_Busy', collapsed)
+    self.assertRaises(ValueError, self._profiler.Result, 'pstats')
+
+  def test_no_result(self):
+    """Verify there is nothing to download before a session."""
+    self.assertEqual(None, self._profiler.Result('text'))
+
+class MemoryProfilerTest(unittest.TestCase):
+  def setUp(self):
+    self._profiler = profiling.MemoryProfiler()
+    self.addCleanup(self._profiler.Stop)
+
+  def test_diff_shows_growth(self):
+    """Verify the diff reports allocation sites that grew."""
+    self.assertTrue(self._profiler.Start())
+    self.assertFalse(self._profiler.Start())
+    self.assertIn(b'No baseline', self._profiler.Diff())
+    retained = [bytearray(1000) for _ in range(1000)]
+    diff = self._profiler.Diff(file_pattern='*test_profiling.py')
+    self.assertIn(b'test_profiling.py', diff)
+    self.assertEqual(1000, len(retained))
+
+class ProfileResourceTest(unittest.TestCase):
+  def setUp(self):
+    self._cpu = profiling.CpuProfiler(clock=Clock())
+    self._memory = profiling.MemoryProfiler()
+    self.addCleanup(self._memory.Stop)
+    self._resource = profiling.ProfileResource(self._cpu, self._memory)
+
+  def _Request(self, method, path, **args):
+    request = DummyRequest(path.split(b'/'))
+    request.method = method
+    request.args = dict((k.encode('ascii'), [v.encode('ascii')])
+                        for k, v in args.items())
+    body = getattr(self._resource, 'render_' + method.decode('ascii'))(request)
+    return request.responseCode or 200, body
+
+  def test_cpu_endpoints(self):
+    """Verify the CPU session can be started, stopped and downloaded."""
+    self.assertEqual(404, self._Request(b'GET', b'cpu')[0])
+    self.assertEqual(
+        400, self._Request(b'POST', b'cpu/start', mode='bogus')[0])
+    self.assertEqual(200, self._Request(b'POST', b'cpu/start', seconds='1')[0])
+    self.assertEqual(409, self._Request(b'POST', b'cpu/start')[0])
+    self.assertEqual(409, self._Request(b'GET', b'cpu')[0])
+    self.assertEqual(200, self._Request(b'POST', b'cpu/stop')[0])
+    self.assertEqual(200, self._Request(b'GET', b'cpu', format='pstats')[0])
+    self.assertEqual(400, self._Request(b'GET', b'cpu', format='collapsed')[0])
+
+  def test_memory_endpoints(self):
+    """Verify snapshots are only available while tracemalloc runs."""
+    self.assertEqual(409, self._Request(b'GET', b'memory/snapshot')[0])
+    self.assertEqual(200, self._Request(b'POST', b'memory/start')[0])
+    code, body = self._Request(b'GET', b'memory/snapshot', limit='3')
+    self.assertEqual(200, code)
+    self.assertIn(b'Top 3', body)
+    self.assertEqual(200, self._Request(b'GET', b'memory/diff')[0])
+    self.assertEqual(200, self._Request(b'POST', b'memory/stop')[0])
+    self.assertEqual(409, self._Request(b'POST', b'memory/stop')[0])
+
+  def test_bad_arguments(self):
+    """Verify bad or non-positive numbers are a 400, not a traceback."""
+    for seconds in ('abc', '0', '-1', 'nan', 'inf'):
+      self.assertEqual(
+          400, self._Request(b'POST', b'cpu/start', seconds=seconds)[0])
+    self.assertFalse(self._cpu.Running())
+    for frames in ('x', '0', '1.5'):
+      self.assertEqual(
+          400, self._Request(b'POST', b'memory/start', frames=frames)[0])
+    self.assertFalse(self._memory.Running())
+    self.assertEqual(200, self._Request(b'POST', b'memory/start')[0])
+    for limit in ('x', '0', '-3'):
+      self.assertEqual(
+          400, self._Request(b'GET', b'memory/snapshot', limit=limit)[0])
+      self.assertEqual(
+          400, self._Request(b'GET', b'memory/diff', limit=limit)[0])
+
+  def test_unknown_endpoint(self):
+    """Verify unknown admin paths are a 404."""
+    self.assertEqual(404, self._Request(b'GET', b'cats')[0])
+    self.assertEqual(404, self._Request(b'POST', b'cats')[0])
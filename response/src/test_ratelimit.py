@@ -0,0 +1,94 @@
+import json
+
+from ratelimit import ParseLimits
+from ratelimit import RateLimiter
+from ratelimit import RateLimitsResource
+from ratelimit import RetryAfter
+
+from twisted.trial import unittest
+from twisted.web.test.test_web import DummyRequest
+
+class ParseLimitsTest(unittest.TestCase):
+  def test_parse(self):
+    """Verify limits parse, with names and default bursts."""
+    self.assertEqual(
+        [('publish', 'topic', None, 100.0, 200.0),
+         ('poll', 'user', b'bob', 5.0, None)],
+        ParseLimits('publish:topic=100/200,poll:user:bob=5'))
+    self.assertEqual([], ParseLimits(None))
+
+  def test_parse_errors(self):
+    """Verify unknown kinds, scopes and rates are rejected."""
+    for spec in ('post:topic=1', 'poll:everyone=1', 'poll:user=x', 'poll=1'):
+      self.assertRaises(ValueError, ParseLimits, spec)
+
+class RateLimiterTest(unittest.TestCase):
+  def setUp(self):
+    self._now = 0.0
+    self._limiter = RateLimiter(clock=lambda: self._now)
+
+  def test_bucket_refills(self):
+    """Verify the burst is allowed, then the rate, with the wait reported."""
+    self._limiter.SetLimit('poll', 'user', rate=2, burst=3)
+    for _ in range(3):
+      self.assertEqual(0, self._limiter.Acquire(b't', b'u', poll=1))
+    self.assertEqual(0.5, self._limiter.Acquire(b't', b'u', poll=1))
+    self.assertEqual(0, self._limiter.Acquire(b't', b'other', poll=1))
+    self._now = 0.5
+    self.assertEqual(0, self._limiter.Acquire(b't', b'u', poll=1))
+    stats = self._limiter.Stats()
+    self.assertEqual((5, 1), (stats['poll_allowed'], stats['poll_limited']))
+
+  def test_all_buckets_or_none(self):
+    """Verify a request limited by one bucket takes from none of them."""
+    self._limiter.SetLimit('publish', 'global', rate=10)
+    self._limiter.SetLimit('bytes', 'topic', rate=100)
+    self.assertEqual(0, self._limiter.Acquire(b't', publish=1, bytes=60))
+    self.assertEqual(0.2, self._limiter.Acquire(b't', publish=1, bytes=60))
+    for i in range(9):
+      self.assertEqual(0, self._limiter.Acquire(b'u%d' % i, publish=1, bytes=1))
+    self.assertEqual(0.1, self._limiter.Acquire(b'v', publish=1, bytes=1))
+
+  def test_oversized_cost(self):
+    """Verify a cost above the burst passes on a full bucket and owes it."""
+    self._limiter.SetLimit('bytes', 'global', rate=100)
+    self.assertEqual(0, self._limiter.Acquire(b't', bytes=300))
+    self.assertAlmostEqual(2.01, self._limiter.Acquire(b't', bytes=1))
+
+  def test_named_override(self):
+    """Verify a named limit replaces the scope's default for that key."""
+    self._limiter.SetLimit('publish', 'topic', rate=1)
+    self._limiter.SetLimit('publish', 'topic', b'hot', rate=100)
+    self._limiter.Acquire(b'hot', publish=1)
+    self.assertEqual(0, self._limiter.Acquire(b'hot', publish=1))
+    self._limiter.Acquire(b'cold', publish=1)
+    self.assertEqual(1, self._limiter.Acquire(b'cold', publish=1))
+    self.assertEqual({'publish:topic': '1/1', 'publish:topic:hot': '100/100'},
+                     self._limiter.Limits())
+
+  def test_idle_buckets_expire(self):
+    """Verify buckets are dropped once they would be full again."""
+    self._limiter.SetLimit('poll', 'user', rate=1, burst=2)
+    for user in (b'a', b'b', b'c'):
+      self._limiter.Acquire(b't', user, poll=1)
+    self.assertEqual(3, self._limiter.Stats()['buckets'])
+    self._now = 1.0
+    self._limiter.Acquire(b't', b'd', poll=1)
+    self.assertEqual(1, self._limiter.Stats()['buckets'])
+
+  def test_retry_after(self):
+    """Verify Retry-After rounds up to whole seconds, at least 1."""
+    self.assertEqual(b'1', RetryAfter(0.01))
+    self.assertEqual(b'3', RetryAfter(2.5))
+
+  def test_resource(self):
+    """Verify limits can be read and set through the admin endpoint."""
+    resource = RateLimitsResource(self._limiter)
+    request = DummyRequest([])
+    request.args = {b'limit': [b'poll:user=5/10']}
+    self.assertEqual({'poll:user': '5/10'},
+                     json.loads(resource.render_POST(request))['limits'])
+    request = DummyRequest([])
+    request.args = {b'limit': [b'poll:nobody=5']}
+    resource.render_POST(request)
+    self.assertEqual(400, request.responseCode)
@@ -1,6 +1,8 @@
 import server
 
-from StringIO import StringIO
+from compression import CompressedBody
+
+from io import BytesIO
 
 from mock import patch
 from mock import ANY
@@ -10,10 +12,12 @@ from twisted.internet.defer import succeed
 from twisted.internet.defer import Deferred
 from twisted.internet.defer import DeferredList
 from twisted.trial import unittest
+from twisted.web.http_headers import Headers
 
 class DummyResponse(object):
-  def __init__(self, code):
+  def __init__(self, code, headers=None):
     self.code = code
+    self.headers = Headers(headers or {})
 
 class ServerTest(unittest.TestCase):
   """Test for the server class.
@@ -28,28 +32,29 @@ class ServerTest(unittest.TestCase):
   def test_request(self, mock_agent, mock_read_body):
     """Verify Request calls into Twisted as expected."""
     serv = server.Server('www.example.com')
-    mock_agent.assert_called_with(reactor)
+    self.assertFalse(mock_agent.called, 'Agent created before first request.')
     agent_request_deferred = Deferred()
-    mock_request = mock_agent.return_value.request
+    mock_request = mock_agent.usingEndpointFactory.return_value.request
     mock_request.return_value = agent_request_deferred
-    mock_read_body.return_value = succeed('body')
+    mock_read_body.return_value = succeed(b'body')
 
-    d = serv.Request('METHOD', '/hihi/hi', body='MOUSE')
+    d = serv.Request(b'METHOD', b'/hihi/hi', body=b'MOUSE')
+    mock_agent.usingEndpointFactory.assert_called_with(reactor, ANY)
 
     mock_request.assert_called_with(
-        'METHOD', 'http://www.example.com/hihi/hi', ANY, ANY)
+        b'METHOD', b'http://www.example.com/hihi/hi', ANY, ANY)
     args, _ = mock_request.call_args
     _, _, _, body = args
-    output = StringIO()
+    output = BytesIO()
     body_deferred = body.startProducing(output)
 
     def VerifySentBody(unused_arg):
-      self.assertEqual(output.getvalue(), 'MOUSE')
+      self.assertEqual(output.getvalue(), b'MOUSE')
     body_deferred.addCallback(VerifySentBody)
 
     def VerifyResult(arg):
       status, body = arg
-      self.assertEqual(body, 'body')
+      self.assertEqual(body, b'body')
       self.assertEqual(status, 200)
     d.addCallback(VerifyResult)
 
@@ -66,3 +71,43 @@ class ServerTest(unittest.TestCase):
     agent_request_deferred.callback(dummy_response)
     return dl
 
+
+  @patch('server.readBody')
+  @patch('server.Agent')
+  def test_request_compressed_response(self, mock_agent, mock_read_body):
+    """Verify gzip responses are returned as CompressedBody, not inflated."""
+    serv = server.Server('www.example.com')
+    mock_request = mock_agent.usingEndpointFactory.return_value.request
+    mock_request.return_value = succeed(
+        DummyResponse(200, {b'Content-Encoding': [b'gzip']}))
+    mock_read_body.return_value = succeed(b'zipped')
+
+    d = serv.GET(b'/topic/user', headers={b'Accept-Encoding': [b'gzip']})
+    args, _ = mock_request.call_args
+    self.assertEqual([b'gzip'], args[2].getRawHeaders(b'Accept-Encoding'))
+
+    def VerifyResult(arg):
+      status, body = arg
+      self.assertEqual(200, status)
+      self.assertIsInstance(body, CompressedBody)
+      self.assertEqual(b'zipped', body)
+    d.addCallback(VerifyResult)
+    return d
+
+  @patch('server.readBody')
+  @patch('server.Agent')
+  def test_request_with_headers(self, mock_agent, mock_read_body):
+    """Verify with_headers also returns the response headers."""
+    serv = server.Server('www.example.com')
+    mock_request = mock_agent.usingEndpointFactory.return_value.request
+    mock_request.return_value = succeed(DummyResponse(204, {b'X-A': [b'b']}))
+    mock_read_body.return_value = succeed(b'')
+
+    d = serv.GET(b'/topic/user', with_headers=True)
+
+    def VerifyResult(arg):
+      status, body, headers = arg
+      self.assertEqual((204, b''), (status, body))
+      self.assertEqual([b'b'], headers.getRawHeaders(b'X-A'))
+    d.addCallback(VerifyResult)
+    return d
@@ -0,0 +1,37 @@
+import os
+
+from backends.subscriptions import SubscriptionStore
+from shards import BuildShard
+from shards import ProcessComponents
+from snapshot import Snapshotter
+
+from twisted.trial import unittest
+
+class BuildShardTest(unittest.TestCase):
+  def test_defaults(self):
+    """Verify a shard needs no files, and uses the process's maintenance."""
+    maintenance, gc_monitor = ProcessComponents({'GC_IDLE_COLLECT': '2'})
+    self.assertEqual(2, gc_monitor._idle_collect)
+    backend, components, snapshotter = BuildShard(
+        maintenance, environ={'MESSAGE_RETENTION': '60'})
+    self.assertEqual(([], None), (components, snapshotter))
+    self.assertIs(maintenance, backend._maintenance)
+    self.assertEqual(60, backend._retention)
+    self.assertIn(b'dedup', backend.AdminResources())
+
+  def test_prefixed_files(self):
+    """Verify a shard's files are read with its prefix."""
+    db = os.path.abspath(self.mktemp())
+    snap = os.path.abspath(self.mktemp())
+    environ = {'BACKEND1_SUBSCRIPTIONS_DB': db, 'BACKEND1_SNAPSHOT_PATH': snap,
+               'SUBSCRIPTIONS_DB': 'unused', 'SNAPSHOT_INTERVAL': '30'}
+    maintenance, _ = ProcessComponents({})
+    backend, components, snapshotter = BuildShard(maintenance, 'BACKEND1_',
+                                                  environ)
+    self.addCleanup(components[0].Close)
+    self.assertIsInstance(components[0], SubscriptionStore)
+    self.assertEqual(db, components[0]._path)
+    self.assertIsInstance(snapshotter, Snapshotter)
+    self.assertEqual((snap, 30), (snapshotter._path, snapshotter._interval))
+    self.assertEqual(snapshotter, components[1])
+    self.assertIs(backend, snapshotter._backend)
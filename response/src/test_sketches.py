@@ -0,0 +1,155 @@
+import json
+
+from sketches import CountMinSketch
+from sketches import HyperLogLog
+from sketches import MergeExports
+from sketches import Report
+from sketches import SketchesResource
+from sketches import SpaceSaving
+from sketches import TrafficSketches
+
+from twisted.trial import unittest
+from twisted.web.test.test_web import DummyRequest
+
+class CountMinSketchTest(unittest.TestCase):
+  def test_estimates(self):
+    """Verify estimates are never under and close for a small sketch load."""
+    sketch = CountMinSketch(width=1024, depth=4)
+    for i in range(1000):
+      sketch.Add(b'key-%d' % i, i % 10)
+    sketch.Add(b'hot', 5000)
+    self.assertTrue(5000 <= sketch.Estimate(b'hot') <= 5050)
+    for i in range(0, 1000, 97):
+      estimate = sketch.Estimate(b'key-%d' % i)
+      self.assertTrue(i % 10 <= estimate <= i % 10 + 50)
+    self.assertTrue(sketch.Estimate(b'missing') <= 50)
+
+class SpaceSavingTest(unittest.TestCase):
+  def test_exact_under_capacity(self):
+    """Verify counts are exact while every key fits."""
+    summary = SpaceSaving(capacity=3)
+    for key in (b'a', b'b', b'a', b'c', b'a', b'b'):
+      summary.Add(key)
+    self.assertEqual([(b'a', 3, 0), (b'b', 2, 0), (b'c', 1, 0)], summary.Top())
+    self.assertEqual(1, summary.Min())
+
+  def test_heavy_hitters_survive(self):
+    """Verify frequent keys stay on top among many rare ones."""
+    summary = SpaceSaving(capacity=10)
+    for i in range(5000):
+      summary.Add(b'rare-%d' % i)
+      if i % 3 == 0:
+        summary.Add(b'hot')
+      if i % 5 == 0:
+        summary.Add(b'warm')
+    top = summary.Top(2)
+    self.assertEqual([b'hot', b'warm'], [key for key, _, _ in top])
+    for key, count, error in top:
+      true_count = 1667 if key == b'hot' else 1000
+      self.assertTrue(count - error <= true_count <= count)
+
+  def test_replaces_least_counted(self):
+    """Verify a new key takes over a least counted key's count as error."""
+    summary = SpaceSaving(capacity=2)
+    for key in (b'a', b'a', b'b', b'c'):
+      summary.Add(key)
+    self.assertEqual([(b'a', 2, 0), (b'c', 2, 1)], summary.Top())
+    self.assertEqual(2, summary.Min())
+
+class HyperLogLogTest(unittest.TestCase):
+  def test_count(self):
+    """Verify small and large counts are within a few percent."""
+    counter = HyperLogLog()
+    self.assertEqual(0, counter.Count())
+    for i in range(100):
+      counter.Add(b'user-%d' % i)
+      counter.Add(b'user-%d' % i)
+    self.assertTrue(98 <= counter.Count() <= 102)
+    for i in range(100, 50000):
+      counter.Add(b'user-%d' % i)
+    self.assertTrue(47500 <= counter.Count() <= 52500)
+
+  def test_merge(self):
+    """Verify a merge counts the union, including through an export."""
+    a, b = HyperLogLog(), HyperLogLog()
+    for i in range(3000):
+      a.Add(b'%d' % i)
+      b.Add(b'%d' % (i + 2000))
+    a.Merge(HyperLogLog.FromExport(b.Export()))
+    self.assertTrue(4750 <= a.Count() <= 5250)
+
+class TrafficSketchesTest(unittest.TestCase):
+  def setUp(self):
+    self._now = 100.0
+    self._sketches = TrafficSketches(window=10, top=5,
+                                     clock=lambda: self._now)
+
+  def _Record(self, sketches=None):
+    sketches = sketches or self._sketches
+    for i in range(20):
+      sketches.RecordPublish(b'hot', b'10.0.0.1', 100)
+      sketches.RecordPoll(b'hot', b'user-%d' % i)
+    sketches.RecordPublish(b'cold', b'10.0.0.2', 10)
+
+  def test_report(self):
+    """Verify the current window reports hot topics, rates and distincts."""
+    self._Record()
+    self._now = 104.0
+    report = Report(self._sketches.Export(b'hot')['current'])
+    self.assertEqual((21, 20, 2010), (report['publishes'], report['polls'],
+                                      report['published_bytes']))
+    self.assertEqual({'topic': 'hot', 'count': 20, 'error': 0,
+                      'per_second': 5.0}, report['top_published'][0])
+    self.assertEqual('hot', report['top_polled'][0]['topic'])
+    self.assertEqual((20, 2, 2), (report['distinct_subscribers'],
+                                  report['distinct_publishers'],
+                                  report['distinct_topics']))
+    self.assertEqual({'publishes': 20, 'polls': 20}, report['topic'])
+
+  def test_windows_rotate(self):
+    """Verify a request after the window ends starts a new one."""
+    self._Record()
+    self.assertEqual(None, self._sketches.Export()['previous'])
+    self._now = 111.0
+    self._sketches.RecordPoll(b'other', b'user')
+    exported = self._sketches.Export()
+    self.assertEqual(21, exported['previous']['publishes'])
+    self.assertEqual(11.0, exported['previous']['seconds'])
+    self.assertEqual((0, 1), (exported['current']['publishes'],
+                              exported['current']['polls']))
+
+  def test_merge_exports(self):
+    """Verify merged exports add counts and union distinct counts."""
+    other = TrafficSketches(window=10, top=5, clock=lambda: self._now)
+    self._Record()
+    self._Record(other)
+    other.RecordPoll(b'only-here', b'user-99')
+    merged = Report(MergeExports(
+        [self._sketches.Export(b'hot')['current'],
+         other.Export(b'hot')['current']]))
+    self.assertEqual((42, 41), (merged['publishes'], merged['polls']))
+    self.assertEqual(['hot', 40, 0],
+                     [merged['top_published'][0][k]
+                      for k in ('topic', 'count', 'error')])
+    self.assertEqual(21, merged['distinct_subscribers'])
+    self.assertEqual({'publishes': 40, 'polls': 40}, merged['topic'])
+    self.assertEqual(None, MergeExports([None, None]))
+
+  def test_resource(self):
+    """Verify the admin endpoint serves the report, or the raw export."""
+    self._Record()
+    resource = SketchesResource(self._sketches)
+    request = DummyRequest([])
+    request.args = {b'limit': [b'1']}
+    report = json.loads(resource.render_GET(request).decode('utf-8'))
+    self.assertEqual(10, report['window_seconds'])
+    self.assertEqual(1, len(report['current']['top_published']))
+    request = DummyRequest([])
+    request.args = {b'raw': [b'1']}
+    raw = json.loads(resource.render_GET(request).decode('utf-8'))
+    self.assertIn('subscribers', raw['current'])
+    for limit in (b'x', b'0', b'-1'):
+      request = DummyRequest([])
+      request.args = {b'limit': [limit]}
+      self.assertEqual(b'', resource.render_GET(request))
+      self.assertEqual(400, request.responseCode)
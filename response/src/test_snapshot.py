@@ -0,0 +1,86 @@
+import json
+import os
+import time
+
+from backends.memory import MemoryBackend
+from snapshot import SnapshotResource
+from snapshot import Snapshotter
+
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+from twisted.web.test.test_web import DummyRequest
+
+class SnapshotterTest(unittest.TestCase):
+  def setUp(self):
+    self._path = os.path.abspath(self.mktemp())
+    self._backend = MemoryBackend()
+    self._backend.Subscribe(b'topic', b'user')
+    self._backend.PostMessage(b'topic', b'message')
+    self._clock = Clock()
+    self._snapshotter = Snapshotter(self._backend, self._path,
+                                    on_shutdown=False)
+    self._snapshotter.Start(self._clock)
+
+  def _Wait(self, d):
+    """Advances the clock until the forked child has been reaped."""
+    results = []
+    d.addCallback(results.append)
+    deadline = time.time() + 10
+    while not results and time.time() < deadline:
+      time.sleep(0.01)
+      self._clock.advance(0.05)
+    self.assertTrue(results, 'Snapshot did not finish.')
+    return results[0]
+
+  def test_snapshot_and_restore(self):
+    """Verify a snapshot taken in a child restores into a new backend."""
+    d = self._snapshotter.Take()
+    # Changes after the fork are not in the snapshot.
+    self._backend.PostMessage(b'topic', b'later')
+    stats = self._Wait(d)
+    self.assertEqual(1, stats['snapshots'])
+    self.assertEqual(os.path.getsize(self._path), stats['last_bytes'])
+    self.assertFalse(stats['in_progress'])
+
+    restored = MemoryBackend()
+    snapshotter = Snapshotter(restored, self._path)
+    self.assertTrue(snapshotter.Restore())
+    self.assertEqual(1, snapshotter.Stats()['restored_messages'])
+    self.assertEqual((200, b'message'),
+                     restored.GetMessage(b'topic', b'user')[:2])
+    self.assertEqual((204, None), restored.GetMessage(b'topic', b'user'))
+
+  def test_concurrent_takes_share_a_snapshot(self):
+    """Verify a Take during a snapshot waits for it rather than forking."""
+    first = self._snapshotter.Take()
+    second = self._snapshotter.Take()
+    self._Wait(first)
+    self.assertEqual(1, self._Wait(second)['snapshots'])
+
+  def test_failed_snapshot(self):
+    """Verify a child that cannot write is counted as a failure."""
+    snapshotter = Snapshotter(self._backend, os.path.join(self._path, 'x'),
+                              on_shutdown=False)
+    snapshotter.Start(self._clock)
+    stats = self._Wait(snapshotter.Take())
+    self.assertEqual(1, stats['failures'])
+    self.assertFalse(snapshotter.Restore())
+
+  def test_stop(self):
+    """Verify Stop cancels periodic snapshots."""
+    snapshotter = Snapshotter(self._backend, self._path, interval=10,
+                              on_shutdown=False)
+    snapshotter.Start(self._clock)
+    snapshotter.Stop()
+    self._clock.advance(10)
+    self.assertFalse(snapshotter.Stats()['in_progress'])
+
+  def test_resource(self):
+    """Verify POST starts a snapshot and GET reports it."""
+    resource = SnapshotResource(self._snapshotter)
+    request = DummyRequest([])
+    self.assertTrue(json.loads(resource.render_POST(request))['in_progress'])
+    self.assertEqual(202, request.responseCode)
+    self._Wait(self._snapshotter.Take())
+    stats = json.loads(resource.render_GET(DummyRequest([])))
+    self.assertEqual(1, stats['snapshots'])
@@ -0,0 +1,86 @@
+import json
+
+import tracing
+
+from twisted.trial import unittest
+from twisted.web.test.test_web import DummyRequest
+
+class TracerTest(unittest.TestCase):
+  def setUp(self):
+    self._tracer = tracing.Tracer(sample_rate=0.0, capacity=3, process='p')
+
+  def test_begin_accepts_incoming_trace(self):
+    """Verify incoming trace IDs are always traced, even unsampled."""
+    self.assertEqual('abc-123', self._tracer.Begin(b'abc-123'))
+
+  def test_begin_rejects_bad_trace_ids(self):
+    """Verify malformed incoming IDs are treated as absent."""
+    self.assertEqual(None, self._tracer.Begin(b'no spaces allowed'))
+    self.assertEqual(None, self._tracer.Begin(b'x' * 65))
+
+  def test_begin_samples(self):
+    """Verify new traces are only started when sampled."""
+    self.assertEqual(None, self._tracer.Begin())
+    self._tracer.sample_rate = 1.0
+    trace_id = self._tracer.Begin()
+    self.assertEqual(16, len(trace_id))
+    self.assertNotEqual(trace_id, self._tracer.Begin())
+
+  def test_ring_buffer(self):
+    """Verify only the most recent spans are kept."""
+    for i in range(5):
+      self._tracer.Record('t%d' % (i % 2), 'span%d' % i, i, 0.5, {})
+    self.assertEqual(['span2', 'span3', 'span4'],
+                     [s['name'] for s in self._tracer.Spans()])
+    self.assertEqual(['span2', 'span4'],
+                     [s['name'] for s in self._tracer.Spans('t0')])
+    self.assertEqual([], self._tracer.Spans(limit=0))
+    span = self._tracer.Spans(limit=1)[0]
+    self.assertEqual('p', span['process'])
+    self.assertEqual(500, span['duration_ms'])
+
+class SpanTest(unittest.TestCase):
+  def setUp(self):
+    self._tracer = tracing.Configure(process='p')
+    self.addCleanup(tracing.Configure)
+
+  def test_no_span_without_trace(self):
+    """Verify nothing is recorded outside of a traced request."""
+    self.assertIs(tracing.NULL_SPAN, tracing.StartSpan('name'))
+
+  def test_span_recorded_under_trace(self):
+    """Verify spans started while a trace is active are recorded."""
+    token = tracing.Activate('trace')
+    try:
+      self.assertEqual('trace', tracing.CurrentTraceId())
+      span = tracing.StartSpan('stage', a=1)
+    finally:
+      tracing.Deactivate(token)
+    self.assertEqual(None, tracing.CurrentTraceId())
+    self.assertEqual('result', span.FinishPassthrough('result'))
+    recorded, = self._tracer.Spans('trace')
+    self.assertEqual('stage', recorded['name'])
+    self.assertEqual({'a': 1}, recorded['attrs'])
+
+  def test_traces_resource(self):
+    """Verify the admin endpoint exports spans as JSON."""
+    self._tracer.Record('t1', 'one', 0, 0, {})
+    self._tracer.Record('t2', 'two', 0, 0, {})
+    request = DummyRequest([])
+    request.args = {b'trace_id': [b't2']}
+    spans = json.loads(tracing.TracesResource().render_GET(request))
+    self.assertEqual(['two'], [s['name'] for s in spans])
+
+  def test_traces_resource_bad_limit(self):
+    """Verify limits that are not positive integers get a 400."""
+    self._tracer.Record('t1', 'one', 0, 0, {})
+    self._tracer.Record('t2', 'two', 0, 0, {})
+    request = DummyRequest([])
+    request.args = {b'limit': [b'1']}
+    spans = json.loads(tracing.TracesResource().render_GET(request))
+    self.assertEqual(['two'], [s['name'] for s in spans])
+    for bad in (b'abc', b'0', b'-1'):
+      request = DummyRequest([])
+      request.args = {b'limit': [bad]}
+      self.assertEqual(b'', tracing.TracesResource().render_GET(request))
+      self.assertEqual(400, request.responseCode)
@@ -0,0 +1,156 @@
+"""Request tracing across the frontend, routing, proxy and backend stages.
+
+A trace ID is accepted from (or, if sampled, generated for) each request that
+reaches PubSubResource and is made current with a contextvar while the backend
+is called, so HashBackend and ProxyBackend can record spans against it and
+ProxyBackend can forward it in the TRACE_HEADER to the backend process, which
+continues the same trace. Finished spans go into a fixed size ring buffer per
+process that the admin port exports.
+
+When a request is not sampled nothing is made current, StartSpan hands back a
+shared no-op span, and the only cost is a contextvar lookup per stage.
+"""
+
+import collections
+import contextvars
+import json
+import os
+import random
+import re
+import time
+
+from twisted.web.resource import Resource
+
+TRACE_HEADER = b'X-Trace-Id'
+
+_VALID_TRACE_ID = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+_current = contextvars.ContextVar('trace_id', default=None)
+
+class _Span(object):
+  """A stage of a traced request, recorded into the tracer on Finish."""
+
+  def __init__(self, tracer, trace_id, name, attrs):
+    self._tracer = tracer
+    self._trace_id = trace_id
+    self._name = name
+    self._attrs = attrs
+    self._start = time.time()
+
+  def Finish(self, **attrs):
+    """Records the span, adding attrs to the ones given at the start."""
+    self._attrs.update(attrs)
+    self._tracer.Record(self._trace_id, self._name, self._start,
+                        time.time() - self._start, self._attrs)
+
+  def FinishPassthrough(self, result):
+    """Deferred callback/errback form of Finish that passes result along."""
+    self.Finish()
+    return result
+
+class _NullSpan(object):
+  """Stands in for a span on requests that are not being traced."""
+
+  def Finish(self, **attrs):
+    pass
+
+  def FinishPassthrough(self, result):
+    return result
+
+NULL_SPAN = _NullSpan()
+
+class Tracer(object):
+  """Decides which requests to trace and keeps the most recent spans."""
+
+  def __init__(self, sample_rate=0.0, capacity=10000, process=None):
+    """Constructor.
+
+    Args:
+      sample_rate: Fraction of requests without an incoming trace ID to trace.
+      capacity: Number of spans kept in the ring buffer.
+      process: Label for spans from this process, defaults to the pid.
+    """
+    self.sample_rate = sample_rate
+    self._spans = collections.deque(maxlen=capacity)
+    self._process = process or str(os.getpid())
+
+  def Begin(self, incoming_trace_id=None):
+    """Returns the trace ID for a new request, or None if not traced.
+
+    Requests that arrive with a trace ID were sampled upstream and are always
+    traced so that a trace is never cut off half way through the cluster.
+    """
+    if incoming_trace_id is not None:
+      incoming_trace_id = incoming_trace_id.decode('ascii', 'replace')
+      if _VALID_TRACE_ID.match(incoming_trace_id):
+        return incoming_trace_id
+    if self.sample_rate and random.random() < self.sample_rate:
+      return '%016x' % random.getrandbits(64)
+    return None
+
+  def Record(self, trace_id, name, start, duration, attrs):
+    """Adds a finished span to the ring buffer."""
+    self._spans.append((trace_id, name, start, duration, attrs))
+
+  def Spans(self, trace_id=None, limit=None):
+    """Returns recorded spans as dicts, oldest first.
+
+    Args:
+      trace_id: If set, only spans of this trace.
+      limit: If set, only the most recent limit spans.
+    """
+    spans = [s for s in self._spans if trace_id is None or s[0] == trace_id]
+    if limit is not None:
+      # Not spans[-limit:], which is every span for a limit of 0.
+      spans = spans[max(0, len(spans) - limit):]
+    return [{'trace_id': t, 'name': name, 'process': self._process,
+             'start': start, 'duration_ms': 1000 * duration, 'attrs': attrs}
+            for t, name, start, duration, attrs in spans]
+
+TRACER = Tracer()
+
+def Configure(sample_rate=0.0, capacity=10000, process=None):
+  """Replaces the process wide tracer."""
+  global TRACER
+  TRACER = Tracer(sample_rate, capacity, process)
+  return TRACER
+
+def CurrentTraceId():
+  """Returns the trace ID of the request being dispatched, if traced."""
+  return _current.get()
+
+def Activate(trace_id):
+  """Makes trace_id current, returns a token for Deactivate."""
+  return _current.set(trace_id)
+
+def Deactivate(token):
+  """Restores the trace that was current before the matching Activate."""
+  _current.reset(token)
+
+def StartSpan(name, **attrs):
+  """Starts a span of the current trace, or a no-op span if not tracing."""
+  trace_id = _current.get()
+  if trace_id is None:
+    return NULL_SPAN
+  return _Span(TRACER, trace_id, name, attrs)
+
+class TracesResource(Resource):
+  """Admin endpoint exporting the ring buffer.
+
+  GET /?trace_id=ID&limit=N - Recorded spans as a JSON list. N must be a
+    positive integer (400 otherwise).
+  """
+  isLeaf = True
+
+  def render_GET(self, request):
+    trace_id = request.args.get(b'trace_id', [None])[0]
+    if trace_id is not None:
+      trace_id = trace_id.decode('ascii', 'replace')
+    limit = request.args.get(b'limit', [None])[0]
+    if limit is not None:
+      if not limit.isdigit() or not int(limit):
+        request.setResponseCode(400)
+        return b''
+      limit = int(limit)
+    request.setHeader(b'Content-Type', b'application/json')
+    return json.dumps(TRACER.Spans(trace_id, limit)).encode('utf-8')